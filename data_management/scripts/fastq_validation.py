@@ -0,0 +1,151 @@
+import os
+import re
+import zlib
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Integrity check of the fastq.gz files before they are uploaded (see upload.py).
+
+Every file is decompressed in full, in a pool of processes (one file per process at a time), which verifies the CRC and
+the length recorded at the end of every gzip member; a truncated or corrupt file fails here rather than hours later in
+cellranger (see align_library.py). The reads of every file are counted (lines / 4), and the files of the same lane and
+library (R1, R2, I1, I2) must have the same number of reads.
+
+The read counts are saved in the upload manifest (see s3_upload.py), so files that were checked before and did not
+change since are not decompressed again when the upload is rerun.
+"""
+
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+# the read (R1, R2, I1, I2) in the file name; the files of a lane that differ only by it are mates
+READ_PATTERN = re.compile(r"_([RI]\d+)_001\.fastq\.gz$")
+
+
+def count_fastq_reads(path):
+    """
+    Decompresses a fastq.gz file and counts its reads.
+
+    Parameters
+    ----------
+    path
+        path of the fastq.gz file
+
+    Returns
+    -------
+    (number of reads, None) or (None, error message)
+    """
+    n_lines = 0
+    last_byte = b"\n"
+    try:
+        with open(path, "rb") as f:
+            decompressor = None
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+                while len(block) > 0:
+                    if decompressor is None or decompressor.eof:
+                        # the next gzip member (files can be made of several, e.g. when concatenated)
+                        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    # the CRC and the length at the end of the member are checked by zlib
+                    data = decompressor.decompress(block)
+                    if len(data) > 0:
+                        n_lines += data.count(b"\n")
+                        last_byte = data[-1:]
+                    block = decompressor.unused_data
+        if decompressor is None:
+            return None, "empty file (not gzip compressed)"
+        if not decompressor.eof:
+            return None, "truncated gzip file"
+    except zlib.error as e:
+        return None, "corrupt gzip file ({})".format(e)
+    if last_byte != b"\n":
+        n_lines += 1
+    if n_lines % 4 != 0:
+        return None, "{} lines, which is not a multiple of 4 (truncated or malformed fastq)".format(n_lines)
+    return n_lines // 4, None
+
+
+def _count_file(args):
+    folder, rel_path = args
+    return rel_path, count_fastq_reads(os.path.join(folder, rel_path))
+
+
+def check_read_counts(read_counts):
+    """
+    Checks that the files of the same lane and library have the same number of reads.
+
+    Parameters
+    ----------
+    read_counts
+        dictionary of file name (or path) -> number of reads
+
+    Returns
+    -------
+    list of error messages
+    """
+    groups = {}
+    for f, n_reads in read_counts.items():
+        m = READ_PATTERN.search(f)
+        if m is not None:
+            groups.setdefault(f[: m.start()], []).append((m.group(1), n_reads))
+    errors = []
+    for prefix, reads in sorted(groups.items()):
+        if len(set([n for _, n in reads])) > 1:
+            errors.append(
+                "Files of {} have different numbers of reads: {}".format(
+                    prefix, ", ".join(["{} {}".format(r, n) for r, n in sorted(reads)])
+                )
+            )
+    return errors
+
+
+def check_fastq_integrity(folder, fastq_fns, manifest=None, processes=None):
+    """
+    Checks the integrity of the fastq.gz files (see above) and raises a ValueError if any of them is invalid.
+
+    Parameters
+    ----------
+    folder
+        folder containing the files
+    fastq_fns
+        paths of the files, relative to folder
+    manifest
+        upload manifest (see s3_upload.UploadManifest) to save the read counts to; files that are in it, with their
+        read counts, and did not change since are not checked again
+    processes
+        number of processes used for decompressing the files (default: the number of CPUs)
+
+    Returns
+    -------
+    dictionary of file -> number of reads
+    """
+    read_counts = {}
+    to_check = []
+    for f in fastq_fns:
+        n_reads = None if manifest is None else manifest.read_count(f, os.path.join(folder, f))
+        if n_reads is None:
+            to_check.append(f)
+        else:
+            read_counts[f] = n_reads
+    print("Checking the integrity of {} fastq files ({} were checked before)...".format(len(to_check), len(read_counts)))
+
+    errors = []
+    if len(to_check) > 0:
+        # the largest files first, so that they don't end up running alone at the end
+        to_check = sorted(to_check, key=lambda f: -os.path.getsize(os.path.join(folder, f)))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for f, (n_reads, error) in executor.map(_count_file, [(folder, f) for f in to_check]):
+                if error is not None:
+                    errors.append("Error for file: {}. {}".format(f, error))
+                    continue
+                read_counts[f] = n_reads
+                if manifest is not None:
+                    manifest.set_read_count(f, os.path.join(folder, f), n_reads)
+    errors += check_read_counts(read_counts)
+
+    if len(errors) > 0:
+        for msg in errors:
+            warnings.warn(msg)
+        raise ValueError(
+            "Error in fastq files. Check above warnings.\n{0} errors in {1} files".format(len(errors), len(fastq_fns))
+        )
+    print("fastq integrity check successful ({} reads).".format(sum(read_counts.values())))
+    return read_counts
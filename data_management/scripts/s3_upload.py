@@ -0,0 +1,539 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Parallel, resumable upload of a folder of fastq files to the immuneaging S3 bucket (see upload.py).
+
+Every file is uploaded with a multipart upload whose parts are sent concurrently (the parts of all the files share one
+pool of threads); each part is sent with its md5 (Content-MD5), so that S3 rejects parts that were corrupted in transit.
+While the parts of a file are uploaded, another thread of the pool computes the md5 of the whole file, which is saved in
+the manifest (see below) and in an md5sum file uploaded next to the fastq files
+(s3://immuneaging/<destination>/md5/<folder name>.md5; see the "fastq_md5_manifest" config of align_library.py).
+
+The progress of the upload is saved in a manifest in the uploaded folder (.upload_manifest.<destination>.json): the
+size, modification time, md5 and number of reads (see fastq_validation.py) of every file, the id of its multipart upload and the parts that were uploaded (saved
+at most every MANIFEST_SAVE_INTERVAL_SEC while parts are uploaded; other changes are saved immediately). An
+interrupted upload is resumed from the parts that were uploaded (and are still listed by S3), and files that were
+uploaded and verified before are skipped unless they changed. Once a file is uploaded, the ETag of the object is
+compared with the one computed from the md5 of its parts.
+
+Setting the environment variable IA_UPLOAD_LOCAL_ROOT uploads to a local directory instead of S3 (the bucket is a
+subdirectory of it), which can be used for testing:
+cd test_data
+./make_test_run.sh test_run 8 1000000
+cd ../
+IA_UPLOAD_LOCAL_ROOT=/tmp/fake_s3 python upload.py --aws_keys read_immuneaging_s3.sh --destination test --fastq test_data/test_run
+The layout of this directory (ETags and multipart uploads in progress kept next to the objects, see LocalObjectStore) is
+not that of the fake bucket of the data processing scripts (IA_S3_LOCAL_ROOT in data_processing/scripts/s3_utils.py):
+objects written by those scripts have no ETag here and are not seen by head(), so the two variables should not point to
+the same directory.
+"""
+
+BUCKET = "immuneaging"
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL_SEC = 10
+MANIFEST_SAVE_INTERVAL_SEC = 1
+
+
+def _md5(data):
+    return hashlib.md5(data)
+
+
+def multipart_etag(part_etags):
+    """
+    ETag of an object uploaded in parts with the given ETags (the md5 of each part), as computed by S3.
+    """
+    digest = hashlib.md5(b"".join([bytes.fromhex(e) for e in part_etags])).hexdigest()
+    return "{}-{}".format(digest, len(part_etags))
+
+
+def get_part_size(size, part_size):
+    """
+    Part size to be used for a file of the given size: part_size, unless the file would have more parts than S3 allows.
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    while -(-size // part_size) > MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+class LocalObjectStore:
+    """
+    A directory that stands in for S3 (see IA_UPLOAD_LOCAL_ROOT above): objects are stored under <root>/<bucket>/<key>, and
+    their ETags and the parts of multipart uploads in progress under <root>/.etags and <root>/.uploads.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _etag_path(self, bucket, key):
+        return os.path.join(self.root, ".etags", bucket, key)
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.root, ".uploads", upload_id)
+
+    def _write(self, bucket, key, source_paths, etag):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for source_path in source_paths:
+                with open(source_path, "rb") as source:
+                    f.write(source.read())
+        os.replace(tmp_path, path)
+        os.makedirs(os.path.dirname(self._etag_path(bucket, key)), exist_ok=True)
+        with open(self._etag_path(bucket, key), "w") as f:
+            f.write(etag)
+        return etag
+
+    def head(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path) or not os.path.isfile(self._etag_path(bucket, key)):
+            return None
+        with open(self._etag_path(bucket, key)) as f:
+            return {"size": os.path.getsize(path), "etag": f.read()}
+
+    def put_object(self, bucket, key, data):
+        upload_dir = self._upload_dir(uuid.uuid4().hex)
+        os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, "data"), "wb") as f:
+            f.write(data)
+        etag = self._write(bucket, key, [os.path.join(upload_dir, "data")], _md5(data).hexdigest())
+        os.remove(os.path.join(upload_dir, "data"))
+        os.rmdir(upload_dir)
+        return etag
+
+    def create_multipart_upload(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_dir(upload_id))
+        return upload_id
+
+    def list_parts(self, bucket, key, upload_id):
+        upload_dir = self._upload_dir(upload_id)
+        if not os.path.isdir(upload_dir):
+            return None
+        parts = {}
+        for f in os.listdir(upload_dir):
+            if f.endswith(".etag"):
+                with open(os.path.join(upload_dir, f)) as fp:
+                    parts[int(f.split(".")[0])] = fp.read()
+        return parts
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, content_md5):
+        if base64.b64encode(_md5(data).digest()).decode() != content_md5:
+            raise ValueError("The Content-MD5 of part {} of {} does not match its data.".format(part_number, key))
+        part_path = os.path.join(self._upload_dir(upload_id), str(part_number))
+        with open(part_path, "wb") as f:
+            f.write(data)
+        etag = _md5(data).hexdigest()
+        with open(part_path + ".etag", "w") as f:
+            f.write(etag)
+        return etag
+
+    def complete_multipart_upload(self, bucket, key, upload_id, part_etags):
+        upload_dir = self._upload_dir(upload_id)
+        parts = self.list_parts(bucket, key, upload_id)
+        for part_number, etag in enumerate(part_etags, 1):
+            if parts.get(part_number) != etag:
+                raise ValueError("Part {} of {} was not uploaded.".format(part_number, key))
+        part_paths = [os.path.join(upload_dir, str(i)) for i in range(1, len(part_etags) + 1)]
+        etag = self._write(bucket, key, part_paths, multipart_etag(part_etags))
+        for f in os.listdir(upload_dir):
+            os.remove(os.path.join(upload_dir, f))
+        os.rmdir(upload_dir)
+        return etag
+
+
+class S3ObjectStore:
+    """
+    The same operations as LocalObjectStore, on S3 (with the credentials set by set_access_keys in upload.py).
+    """
+
+    def __init__(self, max_concurrency):
+        try:
+            import boto3
+            import botocore.config
+        except ImportError as e:
+            raise ImportError(
+                "boto3 is not installed. Please install boto3 via: pip install boto3"
+            )
+        self.client = boto3.client(
+            "s3",
+            config=botocore.config.Config(
+                max_pool_connections=max_concurrency,
+                retries={"max_attempts": 10, "mode": "adaptive"},
+            ),
+        )
+        self.exceptions = self.client.exceptions
+
+    def head(self, bucket, key):
+        try:
+            response = self.client.head_object(Bucket=bucket, Key=key)
+        except self.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+                return None
+            raise
+        return {
+            "size": response["ContentLength"],
+            "etag": response["ETag"].strip('"'),
+        }
+
+    def put_object(self, bucket, key, data):
+        response = self.client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=data,
+            ContentMD5=base64.b64encode(_md5(data).digest()).decode(),
+        )
+        return response["ETag"].strip('"')
+
+    def create_multipart_upload(self, bucket, key):
+        return self.client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def list_parts(self, bucket, key, upload_id):
+        parts = {}
+        kwargs = {"Bucket": bucket, "Key": key, "UploadId": upload_id}
+        try:
+            while True:
+                response = self.client.list_parts(**kwargs)
+                for p in response.get("Parts", []):
+                    parts[p["PartNumber"]] = p["ETag"].strip('"')
+                if not response.get("IsTruncated"):
+                    return parts
+                kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+        except self.exceptions.NoSuchUpload:
+            return None
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, content_md5):
+        response = self.client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+            ContentMD5=content_md5,
+        )
+        return response["ETag"].strip('"')
+
+    def complete_multipart_upload(self, bucket, key, upload_id, part_etags):
+        response = self.client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [{"ETag": '"{}"'.format(e), "PartNumber": i} for i, e in enumerate(part_etags, 1)]
+            },
+        )
+        return response["ETag"].strip('"')
+
+
+def get_object_store(max_concurrency):
+    if "IA_UPLOAD_LOCAL_ROOT" in os.environ:
+        return LocalObjectStore(os.environ["IA_UPLOAD_LOCAL_ROOT"])
+    return S3ObjectStore(max_concurrency)
+
+
+class UploadManifest:
+    """
+    The manifest of the upload of a folder (see above); saved by replacing the file.
+    """
+
+    def __init__(self, path, destination):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_save = 0
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest["destination"] == destination:
+                self.files = manifest["files"]
+        self.destination = destination
+
+    def _entry(self, rel_path, size, mtime):
+        entry = self.files.get(rel_path)
+        if entry is None or entry["size"] != size or entry["mtime"] != mtime:
+            entry = {"size": size, "mtime": mtime, "reads": None, "part_size": None, "md5": None, "upload_id": None,
+                "parts": {}, "etag": None, "status": "pending"}
+            self.files[rel_path] = entry
+        return entry
+
+    def entry(self, rel_path, size, mtime, part_size):
+        """
+        The entry of the given file; a new one if the file is not in the manifest or changed since.
+        """
+        with self.lock:
+            entry = self._entry(rel_path, size, mtime)
+            if entry["part_size"] is None:
+                entry["part_size"] = part_size
+            return entry
+
+    def read_count(self, rel_path, path):
+        """
+        The number of reads of the given file (see fastq_validation.py); None if it was not counted or the file changed since.
+        """
+        with self.lock:
+            entry = self.files.get(rel_path)
+            if entry is None or entry["size"] != os.path.getsize(path) or entry["mtime"] != os.path.getmtime(path):
+                return None
+            return entry.get("reads")
+
+    def set_read_count(self, rel_path, path, n_reads):
+        with self.lock:
+            self._entry(rel_path, os.path.getsize(path), os.path.getmtime(path))["reads"] = n_reads
+            self._save()
+
+    def update(self, rel_path, **kwargs):
+        with self.lock:
+            self.files[rel_path].update(kwargs)
+            self._save()
+
+    def add_part(self, rel_path, part_number, etag):
+        with self.lock:
+            self.files[rel_path]["parts"][str(part_number)] = etag
+            if time.time() - self.last_save > MANIFEST_SAVE_INTERVAL_SEC:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"destination": self.destination, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
+
+def get_upload_manifest(folder, destination):
+    return UploadManifest(os.path.join(folder, ".upload_manifest.{}.json".format(destination)), destination)
+
+
+class FolderUpload:
+    """
+    Uploads the given files (paths relative to folder) to s3://immuneaging/<destination>/ (see above).
+
+    Parameters
+    ----------
+    folder
+        folder that contains the files
+    files
+        paths of the files to upload, relative to folder; they are uploaded with the same relative paths
+    destination
+        folder in the immuneaging bucket
+    max_concurrency
+        max number of parts (and checksums) processed concurrently
+    part_size_mb
+        size of the parts of the multipart uploads
+    store
+        object store to upload to (see get_object_store)
+    manifest
+        manifest of the upload (see get_upload_manifest)
+    """
+
+    def __init__(self, folder, files, destination, max_concurrency=16, part_size_mb=64, store=None, manifest=None):
+        self.folder = folder
+        self.files = files
+        self.destination = destination
+        self.part_size = part_size_mb * 1024 * 1024
+        self.store = get_object_store(max_concurrency) if store is None else store
+        self.manifest = get_upload_manifest(folder, destination) if manifest is None else manifest
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency))
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.pending = 0
+        self.errors = {}
+        self.bytes_total = 0
+        self.bytes_uploaded = 0
+        self.bytes_skipped = 0
+        self.files_done = 0
+
+    def _key(self, rel_path):
+        return "{}/{}".format(self.destination, rel_path.replace(os.sep, "/"))
+
+    def _read(self, rel_path, start, length):
+        with open(os.path.join(self.folder, rel_path), "rb") as f:
+            f.seek(start)
+            return f.read(length)
+
+    def _fail(self, rel_path, err):
+        with self.done:
+            if rel_path not in self.errors:
+                self.errors[rel_path] = err
+                self.pending -= 1
+                self.done.notify_all()
+
+    def _finish(self, rel_path, n_bytes, skipped=False):
+        with self.done:
+            self.pending -= 1
+            self.files_done += 1
+            if skipped:
+                self.bytes_skipped += n_bytes
+            self.done.notify_all()
+
+    def _add_bytes(self, n_bytes):
+        with self.lock:
+            self.bytes_uploaded += n_bytes
+
+    def _checksum(self, rel_path, state):
+        # the md5 of the whole file, computed while its parts are uploaded
+        try:
+            md5 = hashlib.md5()
+            with open(os.path.join(self.folder, rel_path), "rb") as f:
+                for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+                    md5.update(block)
+            self.manifest.update(rel_path, md5=md5.hexdigest())
+            self._part_done(rel_path, state)
+        except Exception as e:
+            self._fail(rel_path, e)
+
+    def _upload_part(self, rel_path, state, part_number):
+        if rel_path in self.errors:
+            return
+        try:
+            entry = state["entry"]
+            start = (part_number - 1) * entry["part_size"]
+            data = self._read(rel_path, start, min(entry["part_size"], entry["size"] - start))
+            md5 = _md5(data)
+            etag = self.store.upload_part(BUCKET, self._key(rel_path), entry["upload_id"], part_number, data,
+                base64.b64encode(md5.digest()).decode())
+            if etag != md5.hexdigest():
+                raise ValueError("Part {} of {} was corrupted during the upload.".format(part_number, rel_path))
+            self.manifest.add_part(rel_path, part_number, etag)
+            self._add_bytes(len(data))
+            self._part_done(rel_path, state)
+        except Exception as e:
+            self._fail(rel_path, e)
+
+    def _part_done(self, rel_path, state):
+        with state["lock"]:
+            state["remaining"] -= 1
+            last = state["remaining"] == 0
+        if last:
+            self._complete(rel_path, state["entry"])
+
+    def _part_etags(self, entry):
+        return [entry["parts"][str(i)] for i in range(1, -(-entry["size"] // entry["part_size"]) + 1)]
+
+    def _expected_etag(self, entry):
+        # the ETag of the object if its content is that of the file
+        return entry["md5"] if entry["upload_id"] is None else multipart_etag(self._part_etags(entry))
+
+    def _complete(self, rel_path, entry):
+        # all the parts and the checksum are done
+        etag = self.store.complete_multipart_upload(BUCKET, self._key(rel_path), entry["upload_id"], self._part_etags(entry))
+        self.manifest.update(rel_path, etag=etag, status="uploaded")
+        self._verify(rel_path, entry)
+
+    def _verify(self, rel_path, entry):
+        o = self.store.head(BUCKET, self._key(rel_path))
+        if o is None or o["size"] != entry["size"] or o["etag"] != self._expected_etag(entry):
+            raise ValueError("s3://{}/{} does not match {} after the upload.".format(BUCKET, self._key(rel_path), rel_path))
+        self.manifest.update(rel_path, status="verified")
+        self._finish(rel_path, entry["size"])
+
+    def _start(self, rel_path):
+        try:
+            path = os.path.join(self.folder, rel_path)
+            size = os.path.getsize(path)
+            entry = self.manifest.entry(rel_path, size, os.path.getmtime(path), get_part_size(size, self.part_size))
+            # the part size of an upload that is resumed is that of its parts
+            part_size = entry["part_size"]
+            key = self._key(rel_path)
+            if entry["status"] in ["uploaded", "verified"]:
+                o = self.store.head(BUCKET, key)
+                if o is not None and o["size"] == size and o["etag"] == self._expected_etag(entry):
+                    self.manifest.update(rel_path, status="verified")
+                    self._finish(rel_path, size, skipped=True)
+                    return
+            if size < part_size:
+                # a single request; S3 checks its md5
+                data = self._read(rel_path, 0, size)
+                md5 = _md5(data).hexdigest()
+                etag = self.store.put_object(BUCKET, key, data)
+                self.manifest.update(rel_path, md5=md5, etag=etag, parts={}, upload_id=None, status="uploaded")
+                self._add_bytes(size)
+                self._verify(rel_path, entry)
+                return
+            n_parts = -(-size // part_size)
+            uploaded = None
+            if entry["upload_id"] is not None:
+                # parts are uploaded again unless S3 has them with the ETag recorded in the manifest
+                uploaded = self.store.list_parts(BUCKET, key, entry["upload_id"])
+            if uploaded is None:
+                upload_id = self.store.create_multipart_upload(BUCKET, key)
+                self.manifest.update(rel_path, upload_id=upload_id, parts={}, status="uploading")
+                uploaded = {}
+            parts = [i for i in range(1, n_parts + 1) if uploaded.get(i) is None or entry["parts"].get(str(i)) != uploaded[i]]
+            with self.lock:
+                self.bytes_skipped += sum([min(part_size, size - (i - 1) * part_size) for i in range(1, n_parts + 1) if i not in parts])
+            checksum = entry["md5"] is None
+            state = {"entry": entry, "remaining": len(parts) + int(checksum), "lock": threading.Lock()}
+            if state["remaining"] == 0:
+                self._complete(rel_path, entry)
+            if checksum:
+                self.executor.submit(self._checksum, rel_path, state)
+            for i in parts:
+                self.executor.submit(self._upload_part, rel_path, state, i)
+        except Exception as e:
+            self._fail(rel_path, e)
+
+    def _report(self, start_time):
+        elapsed = time.time() - start_time
+        uploaded_mb = self.bytes_uploaded / 1024 / 1024
+        print(
+            "Uploaded {:.2f} of {:.2f} GB ({} of {} files) in {:.0f} sec; {:.1f} MB/sec".format(
+                (self.bytes_uploaded + self.bytes_skipped) / 1024 ** 3,
+                self.bytes_total / 1024 ** 3,
+                self.files_done,
+                len(self.files),
+                elapsed,
+                uploaded_mb / max(elapsed, 1e-6),
+            )
+        )
+        sys.stdout.flush()
+
+    def run(self):
+        """
+        Uploads the files and waits for them to be uploaded and verified; reports the progress and the throughput.
+        Returns True if all the files were uploaded.
+        """
+        start_time = time.time()
+        self.bytes_total = sum([os.path.getsize(os.path.join(self.folder, f)) for f in self.files])
+        self.pending = len(self.files)
+        for rel_path in self.files:
+            self.executor.submit(self._start, rel_path)
+        with self.done:
+            while self.pending > 0:
+                if not self.done.wait(PROGRESS_INTERVAL_SEC):
+                    self._report(start_time)
+        self.executor.shutdown(wait=True)
+        self.manifest.save()
+        self._report(start_time)
+        if self.bytes_skipped > 0:
+            print("{:.2f} GB were uploaded before and were not uploaded again.".format(self.bytes_skipped / 1024 ** 3))
+        for rel_path, err in self.errors.items():
+            print("Failed to upload {}: {}".format(rel_path, err))
+        if len(self.errors) == 0:
+            self._upload_md5sums()
+        return len(self.errors) == 0
+
+    def _upload_md5sums(self):
+        # md5sum file of all the uploaded files (e.g. for checking the downloads in align_library.py)
+        lines = ["{}  {}\n".format(self.manifest.files[f]["md5"], f.replace(os.sep, "/")) for f in sorted(self.files)]
+        key = "{}/md5/{}.md5".format(self.destination, os.path.basename(os.path.normpath(self.folder)))
+        self.store.put_object(BUCKET, key, "".join(lines).encode())
+        print("Saved the md5 checksums of the files to s3://{}/{}".format(BUCKET, key))
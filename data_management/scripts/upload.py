@@ -2,6 +2,8 @@ import pandas as pd
 import argparse
 import warnings
 import os
+from s3_upload import FolderUpload, get_upload_manifest
+from fastq_validation import check_fastq_integrity
 
 """
 This script can be tested as follows:
@@ -12,6 +14,13 @@ cd ../
 python upload.py --aws_keys read_immuneaging_s3.sh --destination test --fastq test_data/bad
 # testing good file names (files should be uploaded to AWS):
 python upload.py --aws_keys read_immuneaging_s3.sh --destination test --fastq test_data/good
+# testing corrupt fastq files (the script should issue a warning "xyz errors in xyz files")
+python upload.py --aws_keys read_immuneaging_s3.sh --destination test --fastq test_data/corrupt
+# testing an upload of non-empty files (see s3_upload.py; rerunning it resumes the upload, or skips the files that were uploaded):
+cd test_data
+./make_test_run.sh test_run 8 1000000
+cd ../
+IA_UPLOAD_LOCAL_ROOT=/tmp/fake_s3 python upload.py --aws_keys read_immuneaging_s3.sh --destination test --fastq test_data/test_run
 """
 
 def set_access_keys(filepath):
@@ -140,6 +149,24 @@ def parse_args():
         default=False,
         help="if force upload, ignore checks",
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="number of processes used for checking the integrity of the fastq files (default: the number of CPUs)",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=16,
+        help="max number of parts of files uploaded concurrently",
+    )
+    parser.add_argument(
+        "--part_size_mb",
+        type=int,
+        default=64,
+        help="size of the parts of the files that are uploaded (in MB)",
+    )
     args = parser.parse_args()
     return args
 
@@ -366,7 +393,7 @@ def check_fastq_filenames(fastq_fns, samples, donors):
             valid_seq_run = True
         except: pass
 
-        if s_number[0] == "S" and len(s_number) >=2 2:
+        if s_number[0] == "S" and len(s_number) >= 2:
             try:
                 int(s_number[1:])
                 valid_s_number = True
@@ -420,17 +447,44 @@ def check_fastq_filenames(fastq_fns, samples, donors):
     return is_valid
 
 
-def upload_to_s3(source, destination):
+def get_s3_destination(destination):
     """
-    Upload source filenames to destination in s3.
+    Folder in the immuneaging bucket for the given --destination.
     """
     if destination == "sanger" or destination == "columbia":
-        destination = "raw_" + destination
-    else:
-        destination = "test_folder"
-    aws_cmd = "aws s3 sync {} s3://immuneaging/{}".format(source, destination)
-    print("Running aws command: ", aws_cmd)
-    os.system(aws_cmd)
+        return "raw_" + destination
+    return "test_folder"
+
+
+def upload_to_s3(source, destination, fastq_fns, manifest=None, max_concurrency=16, part_size_mb=64):
+    """
+    Upload source filenames to destination in s3.
+
+    The files are uploaded concurrently, in parts, and verified; an interrupted upload is resumed when rerun
+    (see s3_upload.py).
+
+    Parameters
+    ----------
+    source
+        folder containing the files
+    destination
+        folder in the immuneaging bucket (see get_s3_destination)
+    fastq_fns
+        paths of the files to upload, relative to source
+    manifest
+        manifest of the upload (see s3_upload.get_upload_manifest)
+    """
+    print("Uploading {} files from {} to s3://immuneaging/{}".format(len(fastq_fns), source, destination))
+    upload = FolderUpload(
+        source,
+        fastq_fns,
+        destination,
+        max_concurrency=max_concurrency,
+        part_size_mb=part_size_mb,
+        manifest=manifest,
+    )
+    if not upload.run():
+        raise RuntimeError("Not all files were uploaded. Rerun the command to resume the upload.")
 
 
 def validate_args(args):
@@ -446,6 +500,11 @@ if __name__ == "__main__":
     validate_args(args)
 
     fastq_fns = get_fastq_gzs_in_folder(args.fastq, recursive=args.recursive)
+    # paths relative to the folder (the recursive search returns paths that include it)
+    fastq_fns = [os.path.relpath(f, args.fastq) if args.recursive else f for f in fastq_fns]
+
+    destination = get_s3_destination(args.destination)
+    manifest = get_upload_manifest(args.fastq, destination)
 
     # comment out if we want to give the force option
     args.force = False
@@ -458,6 +517,8 @@ if __name__ == "__main__":
         check_sheet(donors, samples, dictionary)
 
         check_fastq_filenames(fastq_fns, samples, donors)
+        # decompresses all the files; the read counts are saved in the manifest of the upload
+        check_fastq_integrity(args.fastq, fastq_fns, manifest, processes=args.processes)
 
     set_access_keys(args.aws_keys)
-    upload_to_s3(args.fastq, args.destination)
+    upload_to_s3(args.fastq, destination, fastq_fns, manifest, args.max_concurrency, args.part_size_mb)
@@ -29,3 +29,16 @@ touch good/582C_003_TCR_CZI-IA9924337_S1_L001_R1_001.fastq.gz
 touch good/582C_003_BCR_CZI-IA9924353_S1_L001_R1_001.fastq.gz
 touch good/582C_003_HTO_CZI-IA9924369_S1_L001_R1_001.fastq.gz
 touch good/591C_010_GEX_CZI-IA10034921_S1_L001_R1_001.fastq.gz
+
+# empty fastq files (valid gzip files with no reads), so that the good files pass the integrity check in upload.py
+for f in bad/*.fastq.gz good/*.fastq.gz; do
+    gzip -c < /dev/null > $f
+done
+
+# files with valid names that fail the integrity check
+mkdir corrupt
+# R1 and R2 with different numbers of reads
+printf "@r1\nACGT\n+\nFFFF\n" | gzip > corrupt/582C_001_GEX_CZI-IA9924321_S1_L001_R1_001.fastq.gz
+printf "@r1\nACGT\n+\nFFFF\n@r2\nACGT\n+\nFFFF\n" | gzip > corrupt/582C_001_GEX_CZI-IA9924321_S1_L001_R2_001.fastq.gz
+# truncated file
+seq 100000 | gzip | head -c 20000 > corrupt/582C_001_GEX_CZI-IA9924321_S1_L002_R1_001.fastq.gz
@@ -0,0 +1,22 @@
+# Makes a folder of gzipped fastq files with valid names and random reads, e.g. for testing uploads (see s3_upload.py).
+# Use as follows: ./make_test_run.sh <folder> <number of files (R1/R2 pairs, one pair per lane)> <number of reads per file>
+# Example: ./make_test_run.sh test_run 8 1000000
+
+mkdir -p $1
+
+for i in $(seq 1 $(($2 / 2))); do
+    lane=$(printf "L%03d" $i)
+    for read in R1 R2; do
+        if [ $read = R1 ]; then length=28; else length=90; fi
+        awk -v n=$3 -v length_=$length -v seed=$i -v lane=$lane 'BEGIN {
+            srand(seed);
+            split("ACGT", bases, "");
+            split("FFF:,", quals, "");
+            for (r = 1; r <= n; r++) {
+                seq = ""; qual = "";
+                for (j = 0; j < length_; j++) { seq = seq bases[int(rand() * 4) + 1]; qual = qual quals[int(rand() * 5) + 1]; }
+                printf "@A00123:8:H5KJ3DSXY:%s:%d\n%s\n+\n%s\n", lane, r, seq, qual;
+            }
+        }' | gzip -1 > $1/582C_001_GEX_CZI-IA9924321_S1_${lane}_${read}_001.fastq.gz
+    done
+done
@@ -0,0 +1,98 @@
+## Benchmarks running the alignment jobs of a donor with alignment_scheduler.py vs. one after the other (as in the script generated by
+## generate_library_alignment_script.py, where every cellranger call gets all the cores of the node). Reports the makespan of both.
+## The jobs run a fake align_library.py that simulates the download of the fastq files (at a given bandwidth) and a cellranger run whose
+## runtime follows Amdahl's law in its number of cores (IA_ALIGNER_LOCALCORES, or all the cores of the node) and that holds memory in
+## proportion to IA_ALIGNER_LOCALMEM. Also checks that the cores and memory of the concurrent fake alignments never exceed those of the node.
+## Run as follows: python benchmark_alignment_scheduler.py <working_dir> <node_cores> <node_mem_gb> <library sizes in GB> <download_gb_per_sec> <align_sec_per_gb_core> <serial_fraction>
+## where library sizes is a comma-separated list of <lib_type>:<GB of fastq files>
+## Example: python benchmark_alignment_scheduler.py /tmp/alignment_scheduler_benchmark 64 256 GEX:40,GEX:30,GEX:25,GEX:10,BCR:3,TCR:3,BCR:2,TCR:2 4 0.4 0.15
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+node_cores = int(sys.argv[2])
+node_mem_gb = int(sys.argv[3])
+libraries = [(lib.split(":")[0], float(lib.split(":")[1])) for lib in sys.argv[4].split(",")]
+download_gb_per_sec = float(sys.argv[5])
+align_sec_per_gb_core = float(sys.argv[6])
+serial_fraction = float(sys.argv[7])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+
+import alignment_scheduler
+from alignment_scheduler import AlignmentJob, AlignmentScheduler
+
+alignment_scheduler.POLL_INTERVAL_SEC = 0.05
+# the fake fastq files are sparse; the disk is not part of the benchmark
+alignment_scheduler.DISK_PER_INPUT_BYTE = 0
+usage_file = os.path.join(working_dir, "usage.log")
+
+# the fake align_library.py: <usage_file> <lib_type> <GB of fastq files>
+fake_script = os.path.join(working_dir, "fake_align_library.py")
+with open(fake_script, "w") as f:
+    f.write('''
+import os, sys, time
+usage_file, lib_type, input_gb = sys.argv[1], sys.argv[2], float(sys.argv[3])
+fastq_file = os.path.join("fastq", "lib_R1_001.fastq.gz")
+if not os.path.exists(fastq_file):
+    time.sleep(input_gb / {download_gb_per_sec})
+    os.makedirs("fastq", exist_ok=True)
+    with open(fastq_file, "wb") as f:
+        f.truncate(int(input_gb * 1024 ** 3))
+if os.environ.get("IA_ALIGN_STAGE") == "fetch":
+    sys.exit()
+cores = int(os.environ.get("IA_ALIGNER_LOCALCORES", {node_cores}))
+mem_gb = int(os.environ.get("IA_ALIGNER_LOCALMEM", {node_mem_gb}))
+memory = bytearray(mem_gb * 1024 * 1024) # a MB per GB
+with open(usage_file, "a") as f:
+    f.write("{{}} {{}} {{}}\\n".format(time.time(), cores, mem_gb))
+time.sleep(input_gb * {align_sec_per_gb_core} * ({serial_fraction} + (1 - {serial_fraction}) / cores))
+with open(usage_file, "a") as f:
+    f.write("{{}} {{}} {{}}\\n".format(time.time(), -cores, -mem_gb))
+'''.format(download_gb_per_sec=download_gb_per_sec, node_cores=node_cores, node_mem_gb=node_mem_gb, align_sec_per_gb_core=align_sec_per_gb_core,
+    serial_fraction=serial_fraction))
+
+def make_jobs(name):
+    jobs = []
+    for i, (lib_type, input_gb) in enumerate(libraries):
+        work_dir = os.path.join(working_dir, name, "lib{}-{}".format(i, lib_type))
+        jobs.append(AlignmentJob("{} lib{}".format(lib_type, i), lib_type, work_dir, os.path.join(work_dir, "fastq"),
+            [sys.executable, fake_script, usage_file, lib_type, str(input_gb)]))
+    return jobs
+
+def peak_usage():
+    # max cores and memory used at a time by the fake alignments
+    with open(usage_file) as f:
+        changes = sorted([tuple(float(v) for v in line.split()) for line in f])
+    cores, mem, peak_cores, peak_mem = 0, 0, 0, 0
+    for _, c, m in changes:
+        cores, mem = cores + c, mem + m
+        peak_cores, peak_mem = max(peak_cores, cores), max(peak_mem, mem)
+    return peak_cores, peak_mem
+
+def sequential(jobs):
+    # as in the generated script: fetch and align each library in turn, with all the cores of the node
+    for job in jobs:
+        os.makedirs(job.work_dir)
+        subprocess.run(job.command, cwd=job.work_dir, check=True)
+
+print("{} libraries ({:.0f} GB of fastq files) on a node with {} cores and {} GB".format(len(libraries), sum([gb for _, gb in libraries]), node_cores, node_mem_gb))
+start = time.time()
+sequential(make_jobs("sequential"))
+sequential_sec = time.time() - start
+print("sequential: makespan {:.1f} sec".format(sequential_sec))
+
+os.remove(usage_file)
+scheduler = AlignmentScheduler(make_jobs("scheduled"), cores=node_cores, mem_gb=node_mem_gb, max_fetches=1, min_free_disk_gb=0)
+assert len(scheduler.run()) == 0
+peak_cores, peak_mem = peak_usage()
+assert peak_cores <= node_cores and peak_mem <= node_mem_gb
+print("scheduled: makespan {:.1f} sec ({:.2f}x); peak use of {:.0f} cores and {:.0f} GB".format(scheduler.makespan, sequential_sec / scheduler.makespan,
+    peak_cores, peak_mem))
+shutil.rmtree(working_dir, ignore_errors=True)
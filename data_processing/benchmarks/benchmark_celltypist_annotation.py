@@ -0,0 +1,125 @@
+## Benchmarks the CellTypist step of utils.annotate: the previous implementation (celltypist.annotate with majority voting for every (resolution, model) pair, plus another
+## celltypist.annotate of the abundant cell types for the dotplot) vs. the current one (one prediction per model; majority voting and dotplots derived from it for every resolution).
+## Synthetic counts and synthetic CellTypist models (logistic regression over random genes) are used; the number of predictions and the wall time of each implementation are reported
+## and the annotations of both implementations are compared.
+## Run as follows: python benchmark_celltypist_annotation.py <working_dir> <n_cells> <n_genes> <n_models> <resolutions>
+## Example: python benchmark_celltypist_annotation.py /tmp/celltypist_benchmark 20000 3000 3 0.5,1.0,2.0,5.0
+
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from anndata import AnnData
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import StandardScaler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+n_models = int(sys.argv[4])
+resolutions = [float(i) for i in sys.argv[5].split(",")]
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+# celltypist writes the dotplots into a "figures" directory under the current working directory
+os.chdir(working_dir)
+
+import scanpy as sc
+import celltypist
+import utils
+from logger import SimpleLogger
+
+def synthetic_data(seed=0):
+    # cells of a few types, each with its own set of highly expressed genes
+    rng = np.random.default_rng(seed)
+    n_types = 8
+    cell_types = rng.integers(0, n_types, n_cells)
+    rates = rng.gamma(0.5, 1, (n_types, n_genes))
+    X = scipy.sparse.csr_matrix(rng.poisson(rates[cell_types]).astype(np.float32))
+    adata = AnnData(X, obs=pd.DataFrame(index=["cell{}".format(i) for i in range(n_cells)]), var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+    adata.obsm["X_synthetic"] = np.eye(n_types)[cell_types] * 5 + rng.normal(0, 1, (n_cells, n_types))
+    return adata
+
+def synthetic_model(adata, seed):
+    # a celltypist model trained on a random subset of the genes against noisy labels
+    rng = np.random.default_rng(seed)
+    genes = np.sort(rng.choice(adata.n_vars, adata.n_vars // 2, replace=False))
+    X = np.log1p(adata.X[:, genes].toarray() / adata.X.sum(axis=1).A * 1e4)
+    labels = np.array(["type{}".format(i) for i in np.argmax(adata.obsm["X_synthetic"] + rng.normal(0, 2, adata.obsm["X_synthetic"].shape), axis=1)])
+    scaler = StandardScaler().fit(X)
+    clf = LogisticRegression(max_iter=200).fit(scaler.transform(X), labels)
+    clf.features = adata.var_names[genes].values
+    model_path = os.path.join(working_dir, "model{}.pkl".format(seed))
+    celltypist.models.Model(clf, scaler, "synthetic model {}".format(seed)).write(model_path)
+    return model_path
+
+def previous_implementation(adata, model_paths, model_urls, components_key, neighbors_key, n_neighbors, resolutions, model_name, dotplot_min_frac, logger, save_all_outputs=False):
+    # the CellTypist part of utils.annotate before predictions were reused across resolutions
+    adata_new = adata.copy()
+    sc.pp.normalize_total(adata_new, target_sum=1e4)
+    sc.pp.log1p(adata_new)
+    dotplot_paths = []
+    sc.pp.neighbors(adata_new, n_neighbors = n_neighbors, use_rep = components_key, key_added = neighbors_key)
+    leiden_labels = utils.leiden_sweep(adata_new, resolutions, neighbors_key, logger)
+    for r in range(len(resolutions)):
+        resolution = resolutions[r]
+        adata_new.obs["leiden"] = leiden_labels[resolution]
+        leiden_key_added = f"{model_name}.leiden_resolution_{str(resolution)}"
+        adata.obs[leiden_key_added] = adata_new.obs["leiden"]
+        for m in range(len(model_paths)):
+            celltypist_model_name = model_urls[m].split("/")[-1].split(".")[0]
+            model_path = model_paths[m]
+            predictions = celltypist.annotate(adata_new, model = model_path, majority_voting = True, over_clustering = 'leiden')
+            adata.obs["celltypist_majority_voting.{0}.{1}.leiden_resolution_{2}".format(celltypist_model_name, model_name, str(resolution))] = predictions.predicted_labels["majority_voting"]
+            if r == 0 and save_all_outputs:
+                adata.obs["celltypist_model_url.{0}".format(celltypist_model_name)] = model_urls[m]
+                adata.obs["celltypist_predicted_labels.{0}".format(celltypist_model_name)] = predictions.predicted_labels["predicted_labels"]
+                adata.obsm["celltypist_probability_matrix.{0}".format(celltypist_model_name)] = predictions.probability_matrix
+            abundant_cell_types = utils.find_abundant_labels(labels = predictions.predicted_labels["predicted_labels"], frac = dotplot_min_frac)
+            dotplot_predictions = celltypist.annotate(
+                adata_new[predictions.predicted_labels["predicted_labels"].isin(abundant_cell_types),:].copy(),
+                model = model_path,
+                majority_voting = True,
+                over_clustering = 'leiden'
+            )
+            celltypist.dotplot(dotplot_predictions, use_as_reference = 'leiden', use_as_prediction = 'predicted_labels', show = False, return_fig = False)
+            dotplot_filename = "celltypist_dotplot.{}.{}.leiden_resolution_{}.min_frac_{}".format(celltypist_model_name, model_name, str(resolution), str(dotplot_min_frac))
+            sc.pl._utils.savefig_or_show(dotplot_filename, show = False, save = True)
+            dotplot_paths.append(os.path.join(os.getcwd(), "figures", dotplot_filename + ".pdf"))
+    return dotplot_paths
+
+# count the predictions (each one scales and classifies all the given cells)
+n_predictions = [0]
+celltype = celltypist.classifier.Classifier.celltype
+def counted_celltype(self, *args, **kwargs):
+    n_predictions[0] += 1
+    return celltype(self, *args, **kwargs)
+celltypist.classifier.Classifier.celltype = counted_celltype
+
+adata = synthetic_data()
+model_paths = [synthetic_model(adata, seed) for seed in range(n_models)]
+model_urls = ["https://example.org/models/synthetic_model_{}.pkl".format(i) for i in range(n_models)]
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+results = {}
+for name, implementation in [("previous", previous_implementation), ("current", utils.annotate)]:
+    adata_run = adata.copy()
+    n_predictions[0] = 0
+    start = time.time()
+    dotplot_paths = implementation(adata_run, model_paths, model_urls, "X_synthetic", "neighbors", 15, resolutions, "synthetic", 0.05, logger, save_all_outputs=True)
+    results[name] = (time.time() - start, n_predictions[0], adata_run, dotplot_paths)
+    print("{}: {} models x {} resolutions, {} predictions, {:.2f} sec".format(name, n_models, len(resolutions), n_predictions[0], results[name][0]))
+
+previous, current = results["previous"][2], results["current"][2]
+assert results["previous"][3] == results["current"][3]
+assert list(previous.obs.columns) == list(current.obs.columns)
+for column in previous.obs.columns:
+    assert (previous.obs[column].astype(str) == current.obs[column].astype(str)).all(), column
+for key in previous.obsm.keys():
+    assert np.allclose(previous.obsm[key], current.obsm[key])
+print("annotations are identical; speedup: {:.2f}x".format(results["previous"][0] / max(results["current"][0], 1e-9)))
+shutil.rmtree(working_dir, ignore_errors=True)
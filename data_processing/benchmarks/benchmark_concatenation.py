@@ -0,0 +1,144 @@
+## Benchmarks the concatenation of samples in integrate_samples.py: reading all samples into memory and concatenating them (as the script used to do)
+## vs. the out-of-core concatenation in concatenation.py (metadata first, then the counts of one sample at a time appended to a memory-mapped csr
+## matrix on disk). Each approach runs in a separate process and writes concatenated_data_before_processing.h5ad; peak RSS is reported for each,
+## and the two outputs are checked to be identical. The samples are synthetic processed samples with partially overlapping genes and protein panels.
+## Peak RSS includes the pages of the memory-mapped counts that are touched while writing the output; these are backed by the files on disk and
+## can be reclaimed by the OS, so the peak anonymous RSS (sampled from /proc/self/status, i.e. linux only) is reported as well.
+## Run as follows: python benchmark_concatenation.py <working_dir> <n_samples> <n_cells_per_sample> <n_genes> <integration_level>
+## Example: python benchmark_concatenation.py /tmp/concatenation_benchmark 8 20000 10000 tissue
+
+import os
+import sys
+import time
+import shutil
+import resource
+import threading
+import subprocess
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+warnings.simplefilter("ignore")
+DROP_OBSM = ('X_pca', 'X_scVI', 'X_totalVI', 'X_umap_pca', 'X_umap_scvi', 'X_umap_totalvi')
+
+def pad_proteins(adata_dict):
+    # as in integrate_samples.py
+    proteins = set()
+    for sample_id in adata_dict:
+        proteins.update(adata_dict[sample_id].obsm["protein_expression"].columns)
+    proteins = list(proteins)
+    for sample_id in adata_dict:
+        df = pd.DataFrame(columns = proteins, index = adata_dict[sample_id].obs.index)
+        df[adata_dict[sample_id].obsm["protein_expression"].columns] = adata_dict[sample_id].obsm["protein_expression"].copy()
+        adata_dict[sample_id].obsm["protein_expression"] = df
+
+def concatenate(adata_dict):
+    sample_ids = list(adata_dict.keys())
+    adata = adata_dict[sample_ids[0]]
+    return adata.concatenate([adata_dict[sample_ids[j]] for j in range(1, len(sample_ids))], join="outer", index_unique=None)
+
+def sample_anonymous_rss(peak):
+    # peak[0] is the peak RssAnon (in kB) seen so far
+    while True:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon"):
+                    peak[0] = max(peak[0], int(line.split()[1]))
+        time.sleep(0.01)
+
+def run(mode, working_dir, h5ad_files, integration_level):
+    # one approach; runs in its own process
+    import scanpy as sc
+    from h5ad_reader import H5adReader
+    from concatenation import read_sample_metadata, concatenate_layer, common_layers
+    from logger import SimpleLogger
+    peak_anonymous = [0]
+    threading.Thread(target=sample_anonymous_rss, args=(peak_anonymous,), daemon=True).start()
+    start = time.time()
+    adata_dict = {}
+    if mode == "in memory":
+        for h5ad_file in h5ad_files:
+            sample_id = os.path.basename(h5ad_file)
+            adata_dict[sample_id] = sc.read_h5ad(h5ad_file)
+            adata_dict[sample_id].obs["sample_id"] = sample_id
+            for field in DROP_OBSM:
+                if field in adata_dict[sample_id].obsm:
+                    del adata_dict[sample_id].obsm[field]
+            adata_dict[sample_id].X = adata_dict[sample_id].layers['raw_counts']
+            if integration_level != "tissue":
+                del adata_dict[sample_id].layers
+            del adata_dict[sample_id].obsp
+        pad_proteins(adata_dict)
+        adata = concatenate(adata_dict)
+    else:
+        logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+        sources = []
+        for h5ad_file in h5ad_files:
+            sample_id = os.path.basename(h5ad_file)
+            with H5adReader(h5ad_file) as reader:
+                adata_dict[sample_id] = read_sample_metadata(reader, None, drop_obsm = DROP_OBSM)
+            adata_dict[sample_id].obs["sample_id"] = sample_id
+            sources.append((h5ad_file, None))
+        pad_proteins(adata_dict)
+        adata = concatenate(adata_dict)
+        counts_dir = os.path.join(working_dir, "concatenated_counts")
+        adata.X = concatenate_layer(os.path.join(counts_dir, "raw_counts"), adata.var_names, sources, "raw_counts", logger).to_csr()
+        if integration_level == "tissue":
+            for layer in common_layers(h5ad_files):
+                adata.layers[layer] = concatenate_layer(os.path.join(counts_dir, layer), adata.var_names, sources, layer, logger).to_csr()
+    del adata_dict
+    adata.write(os.path.join(working_dir, mode.replace(" ", "_") + ".h5ad"), compression="lzf")
+    print("{:.2f} {:.1f} {:.1f}".format(time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, peak_anonymous[0] / 1024))
+
+if sys.argv[1] == "--run":
+    run(sys.argv[2], sys.argv[3], sys.argv[4].split(","), sys.argv[5])
+    sys.exit()
+
+working_dir = os.path.abspath(sys.argv[1])
+n_samples = int(sys.argv[2])
+n_cells_per_sample = int(sys.argv[3])
+n_genes = int(sys.argv[4])
+integration_level = sys.argv[5]
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+
+# synthetic processed samples; each sample has ~95% of the genes and one of two protein panels
+rng = np.random.default_rng(0)
+genes = np.array(["gene{}".format(i) for i in range(n_genes)])
+h5ad_files = []
+for i in range(n_samples):
+    sample_genes = genes[rng.random(n_genes) < 0.95]
+    counts = scipy.sparse.random(n_cells_per_sample, len(sample_genes), density=0.05, format="csr", random_state=i,
+        data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    obs = pd.DataFrame({"donor_id": pd.Categorical(["D{}".format(i % 3)] * n_cells_per_sample), "total_counts": np.asarray(counts.sum(axis=1)).ravel(),
+        "leiden": pd.Categorical(rng.choice([str(k) for k in range(20)], n_cells_per_sample))},
+        index=["AAAC{}-1_S{}".format(j, i) for j in range(n_cells_per_sample)])
+    adata = anndata.AnnData(counts.copy(), obs=obs, var=pd.DataFrame({"n_cells": rng.integers(0, 100, len(sample_genes))}, index=sample_genes))
+    adata.layers["raw_counts"] = counts
+    adata.layers["decontaminated_counts"] = counts.copy()
+    adata.obsm["X_pca"] = rng.random((n_cells_per_sample, 50)).astype(np.float32)
+    adata.obsm["X_umap_scvi"] = rng.random((n_cells_per_sample, 2)).astype(np.float32)
+    panel = ["CD{}".format(k) for k in range(10 + 5 * (i % 2))]
+    adata.obsm["protein_expression"] = pd.DataFrame(rng.poisson(5, (n_cells_per_sample, len(panel))).astype(float), index=adata.obs_names, columns=panel)
+    h5ad_files.append(os.path.join(working_dir, "S{}.h5ad".format(i)))
+    adata.write_h5ad(h5ad_files[-1], compression="lzf")
+    del adata, counts
+total_mb = sum([os.path.getsize(f) for f in h5ad_files]) / 1024 / 1024
+
+print("{} samples x {} cells, {} genes, {} level; {:.1f} MB of h5ad files".format(n_samples, n_cells_per_sample, n_genes, integration_level, total_mb))
+for mode in ["in memory", "out of core"]:
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", mode, working_dir, ",".join(h5ad_files), integration_level],
+        stdout=subprocess.PIPE, check=True).stdout.decode().strip().split("\n")[-1].split()
+    print("{}: {} sec, peak RSS {} MB, peak anonymous RSS {} MB".format(mode, out[0], out[1], out[2]))
+
+# the order of the padded protein columns follows the iteration order of a set of strings, which differs between processes
+a = anndata.read_h5ad(os.path.join(working_dir, "in_memory.h5ad"))
+b = anndata.read_h5ad(os.path.join(working_dir, "out_of_core.h5ad"))
+assert a.obs.equals(b.obs) and a.var.equals(b.var) and a.X.dtype == b.X.dtype and (a.X != b.X).nnz == 0
+assert set(a.obsm.keys()) == set(b.obsm.keys()) and all([a.obsm[k].equals(b.obsm[k][a.obsm[k].columns]) for k in a.obsm])
+assert set(a.layers.keys()) == set(b.layers.keys()) and all([(a.layers[k] != b.layers[k]).nnz == 0 for k in a.layers])
+print("the concatenated data are identical")
+shutil.rmtree(working_dir, ignore_errors=True)
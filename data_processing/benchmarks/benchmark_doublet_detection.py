@@ -0,0 +1,74 @@
+## Benchmarks the doublet detection step of process_sample.py: the previous implementation (dense matrix, with the per-batch loop repeated once per batch) vs. run_scrublet in doublets.py (sparse, one run per batch, batches in parallel processes).
+## Synthetic samples with a varying number of libraries are generated; every (implementation, number of libraries) pair runs in a fresh process so that the reported peak RSS (including worker processes) is not affected by previous runs.
+## Run as follows: python benchmark_doublet_detection.py <n_cells_per_lib> <n_genes> <n_libs_list> <max_workers>
+## Example: python benchmark_doublet_detection.py 3000 2000 2,4,8,16 8
+
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+import numpy as np
+import scipy.sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+def synthetic_sample(n_libs, n_cells_per_lib, n_genes, seed=0):
+    # negative binomial-like counts with ~5% density, library-specific scaling
+    rng = np.random.default_rng(seed)
+    n_cells = n_libs * n_cells_per_lib
+    X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=seed, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    batches = np.repeat(np.array(["lib{}".format(i) for i in range(n_libs)]), n_cells_per_lib)
+    return X, batches
+
+def previous_implementation(X, batches):
+    X = X.toarray() # rna.X.A in process_sample.py
+    for batch in np.unique(batches):
+        doublet_scores = np.zeros(shape=(X.shape[0]))
+        doublet_predictions = np.zeros(shape=(X.shape[0]))
+        for b in np.unique(batches):
+            mask = batches == b
+            scores, predictions = scrublet.Scrublet(X[mask], sim_doublet_ratio=10.).scrub_doublets(verbose=False)
+            doublet_scores[mask] = scores
+            doublet_predictions[mask] = predictions
+    return doublet_scores, doublet_predictions
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux; for children it is the peak of the largest worker process
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+def current_rss_mb():
+    with open("/proc/self/status") as fp:
+        return [int(l.split()[1]) for l in fp if l.startswith("VmRSS:")][0] / 1024
+
+if sys.argv[1] == "--run":
+    implementation, n_libs, n_cells_per_lib, n_genes, max_workers = sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6])
+    # both implementations import their dependencies before the measurement starts
+    import scrublet
+    from doublets import run_scrublet
+    X, batches = synthetic_sample(n_libs, n_cells_per_lib, n_genes)
+    baseline_rss = current_rss_mb()
+    start = time.time()
+    if implementation == "previous":
+        scores, predictions = previous_implementation(X, batches)
+    else:
+        scores, predictions = run_scrublet(X, batches, max_workers=max_workers)
+    print(json.dumps({"time": time.time() - start, "peak_rss_mb": peak_rss_mb() - baseline_rss, "scores": [float(i) for i in scores]}))
+    sys.exit(0)
+
+n_cells_per_lib = int(sys.argv[1])
+n_genes = int(sys.argv[2])
+n_libs_list = [int(i) for i in sys.argv[3].split(",")]
+max_workers = int(sys.argv[4])
+
+print("n_libs\timplementation\twall time (sec)\tpeak RSS above the baseline after imports (MB)")
+for n_libs in n_libs_list:
+    results = {}
+    for implementation in ["previous", "run_scrublet"]:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", implementation, str(n_libs), str(n_cells_per_lib), str(n_genes), str(max_workers)],
+            capture_output=True, text=True, check=True).stdout
+        results[implementation] = json.loads(out.strip().split("\n")[-1])
+        print("{}\t{}\t{:.2f}\t{:.0f}".format(n_libs, implementation, results[implementation]["time"], results[implementation]["peak_rss_mb"]))
+    assert np.allclose(results["previous"]["scores"], results["run_scrublet"]["scores"])
+    print("{}\tspeedup: {:.2f}x; scores are identical".format(n_libs, results["previous"]["time"] / max(results["run_scrublet"]["time"], 1e-9)))
@@ -0,0 +1,111 @@
+## Benchmarks writing the two h5ad outputs of integrate_samples.py (the integrated object and its cleaned-up version): the previous way (two
+## full files, the second one written after cleanup_adata) vs. write_anndata_with_cleanup in utils.py (X, the layers and the embeddings
+## of the cleaned-up file are copied from the first one chunk by chunk rather than compressed again). Reports the write time and the bytes
+## written (i.e. uploaded) by each. Checks that both outputs open as regular h5ad files on their own (anndata.read_h5ad, each file alone in
+## its directory) and with H5adReader (locally and from the object store, a LocalStore, with only the cleaned-up file uploaded), and that
+## they are identical to those written the previous way.
+## Run as follows: python benchmark_dual_output.py <working_dir> <n_cells> <n_genes>
+## Example: python benchmark_dual_output.py /tmp/dual_output_benchmark 200000 20000
+
+import os
+import sys
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+warnings.simplefilter("ignore")
+
+from s3_utils import s3_cp
+from h5ad_reader import H5adReader
+from utils import write_anndata_with_object_cols, write_anndata_with_cleanup
+from fake_store import timed
+
+def make_adata():
+    # synthetic integrated tissue, with the obs columns that cleanup_adata moves to obsm
+    rng = np.random.default_rng(0)
+    X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=0, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    donors = ["D{}".format(i) for i in range(4)]
+    obs = pd.DataFrame({
+        "donor_id": pd.Categorical(rng.choice(donors, n_cells)),
+        "sample_id": pd.Categorical(rng.choice(["S1", "S2"], n_cells)),
+        "TCR-clonotype": rng.choice(["c1", "c2", "nan"], n_cells),
+        "BCR-clonotype": rng.choice(["c3", "c4", "nan"], n_cells),
+        "celltypist_predicted_labels.Immune_All_Low": pd.Categorical(rng.choice(["T", "B", "NK"], n_cells)),
+        "median_cluster_scores_pct_counts_mt": rng.random(n_cells),
+        "bh_pval_pct_counts_mt": rng.random(n_cells),
+        "seq_run": pd.Categorical(rng.choice(["R1", "R2"], n_cells)),
+        "pct_counts_mt": rng.random(n_cells),
+        "scvi_batch_key_donor_id.leiden_resolution_3.0": pd.Categorical(rng.choice([str(i) for i in range(30)], n_cells)),
+        "sample_pipeline_version": pd.Categorical(["D0__v1"] * n_cells),
+    }, index=["AAACCTG{}-1_lib1".format(i) for i in range(n_cells)])
+    for donor in donors:
+        obs["{}-hashtag".format(donor)] = rng.random(n_cells)
+    adata = anndata.AnnData(X, obs=obs, var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+    adata.layers["decontaminated_counts"] = X.copy()
+    for key, dim in [("X_pca", 50), ("X_scvi_integrated_batch_key_donor_id", 10), ("X_umap_scvi_integrated_batch_key_donor_id", 2)]:
+        adata.obsm[key] = rng.random((n_cells, dim)).astype(np.float32)
+    adata.obsm["protein_expression"] = pd.DataFrame(rng.poisson(10, (n_cells, 20)).astype(float), index=adata.obs_names,
+        columns=["CD28"] + ["p{}".format(i) for i in range(19)])
+    neighbors = rng.integers(0, n_cells, (n_cells, 10))
+    adata.obsp["connectivities"] = scipy.sparse.csr_matrix((rng.random(neighbors.size), neighbors.ravel(), np.arange(0, neighbors.size + 1, 10)),
+        shape=(n_cells, n_cells))
+    return adata
+
+def write_previous(adata, data_dir):
+    return write_anndata_with_object_cols(adata, data_dir, "T.v1.h5ad") + write_anndata_with_object_cols(adata, data_dir, "T.v1.cleanup.h5ad", cleanup=True)
+
+def assert_same(a, b):
+    pd.testing.assert_frame_equal(a.obs, b.obs)
+    pd.testing.assert_frame_equal(a.var, b.var)
+    assert (a.X != b.X).nnz == 0
+    assert set(a.layers.keys()) == set(b.layers.keys()) and all([(a.layers[k] != b.layers[k]).nnz == 0 for k in a.layers])
+    assert set(a.obsm.keys()) == set(b.obsm.keys())
+    for k in a.obsm:
+        if isinstance(a.obsm[k], pd.DataFrame):
+            pd.testing.assert_frame_equal(a.obsm[k], b.obsm[k])
+        else:
+            assert np.array_equal(a.obsm[k], b.obsm[k])
+    assert set(a.obsp.keys()) == set(b.obsp.keys())
+    assert set(a.uns.keys()) == set(b.uns.keys())
+
+results = {}
+for name, write in [("previous", write_previous), ("copied", lambda adata, data_dir: write_anndata_with_cleanup(adata, data_dir, "T.v1.h5ad", "T.v1.cleanup.h5ad"))]:
+    data_dir = os.path.join(working_dir, name)
+    os.makedirs(data_dir)
+    adata = make_adata()
+    files, sec = timed(write, adata, data_dir)
+    results[name] = (data_dir, files)
+    print("{:<9} write {:.2f} sec; {}".format(name, sec, ", ".join(["{} {:.1f} MB".format(f, os.path.getsize(os.path.join(data_dir, f)) / 1024 / 1024) for f in files])
+        + "; total {:.1f} MB".format(sum([os.path.getsize(os.path.join(data_dir, f)) for f in files]) / 1024 / 1024)))
+    del adata
+
+(previous_dir, _), (copied_dir, copied_files) = results["previous"], results["copied"]
+os.chdir(working_dir)
+for f in copied_files:
+    # each file alone in its directory, as when only one of them is downloaded
+    alone_dir = os.path.join(working_dir, "alone", f)
+    os.makedirs(alone_dir)
+    shutil.copy(os.path.join(copied_dir, f), alone_dir)
+    assert_same(anndata.read_h5ad(os.path.join(previous_dir, f)), anndata.read_h5ad(os.path.join(alone_dir, f)))
+# H5adReader, locally and from the object store
+rows = np.arange(n_cells // 2, n_cells // 2 + n_cells // 20)
+expected = anndata.read_h5ad(os.path.join(previous_dir, "T.v1.cleanup.h5ad"))
+s3_cp(os.path.join(copied_dir, "T.v1.cleanup.h5ad"), "s3://immuneaging/integrated_samples/T/v1/T.v1.cleanup.h5ad")
+for path in [os.path.join(working_dir, "alone", "T.v1.cleanup.h5ad", "T.v1.cleanup.h5ad"), "s3://immuneaging/integrated_samples/T/v1/T.v1.cleanup.h5ad"]:
+    with H5adReader(path) as reader:
+        part = reader.read(layers=["decontaminated_counts"], obsm=["X_scvi_integrated_batch_key_donor_id"], rows=rows)
+        assert (part.X != expected.X[rows]).nnz == 0 and (part.layers["decontaminated_counts"] != expected.layers["decontaminated_counts"][rows]).nnz == 0
+        assert np.array_equal(part.obsm["X_scvi_integrated_batch_key_donor_id"], expected.obsm["X_scvi_integrated_batch_key_donor_id"][rows])
+print("both outputs are identical to those written the previous way (anndata.read_h5ad and H5adReader, locally and from the object store)")
+shutil.rmtree(working_dir, ignore_errors=True)
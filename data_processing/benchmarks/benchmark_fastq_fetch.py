@@ -0,0 +1,91 @@
+## Benchmarks downloading the fastq files of a library: one s3_cp per file in a loop (as align_library.py used to do), s3_cp_many (one
+## concurrent transfer per file) and FastqFetcher in fastq_fetch.py (ranged parts of all the files fetched concurrently).
+## The object store is a throttled fake (ThrottledStore in fake_store.py: a LocalStore with a latency per request and a bandwidth per connection).
+## Also interrupts a FastqFetcher half way and reports the bytes fetched again when resuming, and checks that every download is identical to
+## its source, including against an md5sum manifest.
+## Run as follows: python benchmark_fastq_fetch.py <working_dir> <n_files> <file_size_mb> <latency_sec> <bandwidth_mb_per_sec>
+## Example: python benchmark_fastq_fetch.py /tmp/fastq_fetch_benchmark 8 256 0.05 50
+
+import os
+import sys
+import time
+import shutil
+import warnings
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_files = int(sys.argv[2])
+file_size = int(float(sys.argv[3]) * 1024 * 1024)
+latency = float(sys.argv[4])
+bandwidth = float(sys.argv[5]) * 1024 * 1024
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+warnings.simplefilter("ignore")
+
+from s3_utils import s3_cp, s3_cp_many
+from logger import SimpleLogger
+from fastq_fetch import FastqFetcher, file_md5
+from fake_store import ThrottledStore, install_store, timed
+
+# synthetic fastq files of a GEX library (random bytes, like gzipped reads)
+rng = np.random.default_rng(0)
+s3_dir = "s3://immuneaging/raw_columbia/"
+names = ["D1_1_GEX_lib1_S{}_L001_R{}_001.fastq.gz".format(i // 2 + 1, i % 2 + 1) for i in range(n_files)]
+source_dir = os.path.join(working_dir, "source")
+os.makedirs(source_dir)
+manifest = {}
+for name in names:
+    path = os.path.join(source_dir, name)
+    with open(path, "wb") as f:
+        f.write(rng.bytes(file_size))
+    manifest[name] = file_md5(path)
+    s3_cp(path, s3_dir + name)
+install_store(ThrottledStore(os.environ["IA_S3_LOCAL_ROOT"], latency, bandwidth))
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+
+def transfers(name):
+    target_dir = os.path.join(working_dir, name)
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.makedirs(target_dir)
+    return [(s3_dir + f, os.path.join(target_dir, f)) for f in names]
+
+def sequential(t):
+    for source, target in t:
+        s3_cp(source, target)
+
+def fetch(t, manifest=None):
+    fetcher = FastqFetcher(t, logger, manifest=manifest)
+    assert fetcher.wait()
+    fetcher.close()
+    return fetcher.bytes_fetched
+
+def assert_same(t):
+    for source, target in t:
+        assert file_md5(target) == manifest[os.path.basename(target)]
+        assert not os.path.exists(target + ".partial") and not os.path.exists(target + ".parts")
+
+total_mb = n_files * file_size / 1024 / 1024
+print("{} files of {:.0f} MB; {:.0f} MB/sec per connection, {:.2f} sec per request".format(n_files, file_size / 1024 / 1024, bandwidth / 1024 / 1024, latency))
+for name, func in [("s3_cp loop", sequential), ("s3_cp_many", s3_cp_many), ("FastqFetcher", fetch), ("FastqFetcher (md5 manifest)", lambda t: fetch(t, manifest))]:
+    t = transfers(name.replace(" ", "_"))
+    _, sec = timed(func, t)
+    assert_same(t)
+    print("{:<28} {:>7.2f} sec {:>8.1f} MB/sec".format(name, sec, total_mb / sec))
+
+# interrupted half way, then resumed
+t = transfers("resumed")
+fetcher = FastqFetcher(t, logger)
+while fetcher.bytes_fetched < n_files * file_size / 2:
+    time.sleep(0.01)
+fetcher.cancel()
+interrupted = fetcher.bytes_fetched
+resumed, sec = timed(fetch, t)
+assert_same(t)
+print("interrupted after {:.1f} MB; resuming fetched {:.1f} MB of {:.1f} MB in {:.2f} sec".format(interrupted / 1024 / 1024, resumed / 1024 / 1024, total_mb, sec))
+# a second run finds all the files in local
+assert fetch(t) == 0
+print("all downloads are identical to their source")
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,99 @@
+## Benchmarks the storage profiles of the h5ad writer (h5ad_writer.py) on synthetic processed objects of several sizes: write time, file size,
+## time to read the whole file (anndata.read_h5ad) and time to read a range of rows and a set of scattered rows of the raw counts and of an
+## embedding (H5adReader), locally and from the object store (a LocalStore), where the bytes transferred are also reported.
+## The objects read back are checked to be identical to those that were written, for every profile.
+## Run as follows: python benchmark_h5ad_profiles.py <working_dir> <sizes> [<profiles>]
+## where sizes is a comma-separated list of <n_cells>x<n_genes> and profiles a comma-separated list of names in h5ad_writer.PROFILES (default all)
+## Example: python benchmark_h5ad_profiles.py /tmp/h5ad_profiles_benchmark 5000x2000,50000x10000,200000x20000 lzf,lzf_rows,gzip,none
+
+import os
+import sys
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+sizes = [tuple([int(n) for n in size.split("x")]) for size in sys.argv[2].split(",")]
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+warnings.simplefilter("ignore")
+
+from s3_utils import s3_cp
+from h5ad_reader import H5adReader
+from h5ad_writer import PROFILES, write_h5ad
+from fake_store import timed
+
+profiles = sys.argv[3].split(",") if len(sys.argv) > 3 else list(PROFILES.keys())
+
+def make_adata(n_cells, n_genes):
+    # synthetic processed object: counts in X and two layers, embeddings, a neighbor graph and a few obs columns
+    rng = np.random.default_rng(0)
+    X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=0, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    obs = pd.DataFrame({
+        "donor_id": pd.Categorical(rng.choice(["D1", "D2", "D3"], n_cells)),
+        "total_counts": np.asarray(X.sum(axis=1)).ravel(),
+        "leiden": pd.Categorical(rng.choice([str(i) for i in range(30)], n_cells)),
+    }, index=["AAACCTG{}-1_lib1".format(i) for i in range(n_cells)])
+    adata = anndata.AnnData(X, obs=obs, var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+    adata.layers["raw_counts"] = X.copy()
+    adata.layers["decontaminated_counts"] = X.copy()
+    for key, dim in [("X_pca", 50), ("X_scVI", 10), ("X_umap_scvi", 2)]:
+        adata.obsm[key] = rng.random((n_cells, dim)).astype(np.float32)
+    adata.obsm["protein_expression"] = pd.DataFrame(rng.poisson(10, (n_cells, 20)).astype(float), index=adata.obs_names,
+        columns=["p{}".format(i) for i in range(20)])
+    neighbors = rng.integers(0, n_cells, (n_cells, 10))
+    adata.obsp["connectivities"] = scipy.sparse.csr_matrix((rng.random(neighbors.size), neighbors.ravel(), np.arange(0, neighbors.size + 1, 10)),
+        shape=(n_cells, n_cells))
+    return adata
+
+def assert_same(a, b):
+    pd.testing.assert_frame_equal(a.obs, b.obs)
+    assert (a.X != b.X).nnz == 0 and a.X.dtype == b.X.dtype
+    assert set(a.layers.keys()) == set(b.layers.keys()) and all([(a.layers[k] != b.layers[k]).nnz == 0 for k in a.layers])
+    assert set(a.obsm.keys()) == set(b.obsm.keys())
+    for k in a.obsm:
+        if isinstance(a.obsm[k], pd.DataFrame):
+            pd.testing.assert_frame_equal(a.obsm[k], b.obsm[k])
+        else:
+            assert np.array_equal(a.obsm[k], b.obsm[k])
+    assert (a.obsp["connectivities"] != b.obsp["connectivities"]).nnz == 0
+
+def read_rows(path, rows):
+    with H5adReader(path) as reader:
+        counts, embedding = reader.read_layer("raw_counts", rows), reader.read_obsm("X_scVI", rows)
+        return (counts, embedding), reader.bytes_read
+
+print("{:<16} {:<9} {:>9} {:>10} {:>10} {:>26} {:>26}".format("size", "profile", "size (MB)", "write (s)", "read (s)",
+    "range of rows (s / MB)", "scattered rows (s / MB)"))
+for n_cells, n_genes in sizes:
+    adata = make_adata(n_cells, n_genes)
+    rng = np.random.default_rng(1)
+    row_range = np.arange(n_cells // 2, n_cells // 2 + max(1, n_cells // 20))
+    scattered_rows = np.sort(rng.choice(n_cells, max(1, n_cells // 20), replace=False))
+    expected = {name: (adata.layers["raw_counts"][rows], adata.obsm["X_scVI"][rows]) for name, rows in [("range", row_range), ("scattered", scattered_rows)]}
+    for profile in profiles:
+        path = os.path.join(working_dir, "{}x{}.{}.h5ad".format(n_cells, n_genes, profile))
+        _, write_sec = timed(write_h5ad, adata, path, profile)
+        full, read_sec = timed(anndata.read_h5ad, path)
+        assert_same(adata, full)
+        del full
+        s3_path = "s3://immuneaging/benchmark/" + os.path.basename(path)
+        s3_cp(path, s3_path)
+        row_reads = []
+        for name, rows in [("range", row_range), ("scattered", scattered_rows)]:
+            ((counts, embedding), _), sec = timed(read_rows, path, rows)
+            (_, bytes_read) = read_rows(s3_path, rows)
+            assert (counts != expected[name][0]).nnz == 0 and np.array_equal(embedding, expected[name][1])
+            row_reads.append("{:.3f} / {:.2f}".format(sec, bytes_read / 1024 / 1024))
+        print("{:<16} {:<9} {:>9.1f} {:>10.2f} {:>10.2f} {:>26} {:>26}".format("{}x{}".format(n_cells, n_genes), profile,
+            os.path.getsize(path) / 1024 / 1024, write_sec, read_sec, *row_reads))
+        os.remove(path)
+    del adata
+print("the objects read back are identical to those that were written, for every profile")
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,124 @@
+## Benchmarks reading parts of an h5ad file on S3 by downloading and reading the whole file (as the scripts used to do) vs. with the H5adReader
+## in h5ad_reader.py (ranged reads of only the requested parts), for each of the uses that were changed to the reader: the number of cells
+## (vdj_utils.gather_extra_info_for_ir_libs), the barcodes (vdj_utils.get_ir_gex_intersection), the obs columns and umap embeddings
+## (dashboard_utils.get_tissue_integration_results_csv) and the cells of one compartment (integrate_samples.py).
+## The file is a synthetic processed sample served by a LocalStore; bytes read are the bytes transferred from the store and peak memory is
+## measured with tracemalloc. The parts that are read are checked to be identical to those of the full read.
+## Run as follows: python benchmark_h5ad_reader.py <working_dir> <n_cells> <n_genes> <compartment_fraction>
+## Example: python benchmark_h5ad_reader.py /tmp/h5ad_reader_benchmark 50000 10000 0.1
+
+import os
+import sys
+import time
+import shutil
+import warnings
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+compartment_fraction = float(sys.argv[4])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+warnings.simplefilter("ignore")
+
+from s3_utils import s3_cp
+from h5ad_reader import H5adReader
+
+# synthetic processed sample
+rng = np.random.default_rng(0)
+X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=0, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+obs = pd.DataFrame({
+    "sample_id": pd.Categorical(["S1"] * n_cells),
+    "donor_id": pd.Categorical(rng.choice(["D1", "D2", "D3"], n_cells)),
+    "age": pd.Categorical(rng.choice(["30-35", "55-60", "70-75"], n_cells)),
+    "total_counts": np.asarray(X.sum(axis=1)).ravel(),
+    "leiden": pd.Categorical(rng.choice([str(i) for i in range(30)], n_cells)),
+    "celltypist_predicted_labels.1": pd.Categorical(rng.choice(["T", "B", "Mono", "NK"], n_cells)),
+}, index=["AAACCTG{}-1_lib1".format(i) for i in range(n_cells)])
+adata = anndata.AnnData(X, obs=obs, var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+adata.layers["raw_counts"] = X.copy()
+for key, dim in [("X_pca", 50), ("X_scVI", 10), ("X_umap_pca", 2), ("X_umap_scvi", 2)]:
+    adata.obsm[key] = rng.random((n_cells, dim)).astype(np.float32)
+adata.obsm["protein_expression"] = pd.DataFrame(rng.poisson(10, (n_cells, 20)).astype(float), index=adata.obs_names, columns=["p{}".format(i) for i in range(20)])
+local_file = os.path.join(working_dir, "sample.h5ad")
+adata.write_h5ad(local_file, compression="lzf")
+s3_path = "s3://immuneaging/processed_samples/sample.h5ad"
+s3_cp(local_file, s3_path)
+file_size = os.path.getsize(local_file)
+compartment_barcodes = list(adata.obs_names[rng.random(n_cells) < compartment_fraction])
+umap_keys = ["X_umap_pca", "X_umap_scvi"]
+del adata, X
+
+def full_read(part):
+    # download the file and read all of it
+    local_path = os.path.join(working_dir, "download", "sample.h5ad")
+    s3_cp(s3_path, local_path)
+    adata = anndata.read_h5ad(local_path)
+    os.remove(local_path)
+    if part == "n_obs":
+        return adata.n_obs
+    if part == "barcodes":
+        return adata.obs_names
+    if part == "obs":
+        return anndata.AnnData(obs=adata.obs, obsm={k: adata.obsm[k] for k in umap_keys})
+    adata = adata[adata.obs_names.isin(compartment_barcodes)].copy()
+    return adata
+
+def lazy_read(part):
+    with H5adReader(s3_path) as reader:
+        if part == "n_obs":
+            result = reader.n_obs
+        elif part == "barcodes":
+            result = reader.obs_names
+        elif part == "obs":
+            result = reader.read(var=[], X=False, obsm=umap_keys, layers=[])
+        else:
+            obsm_keys = [k for k in reader.obsm_keys() if k not in ("X_pca", "X_scVI", "X_umap_pca", "X_umap_scvi")]
+            result = reader.read(X=False, obsm=obsm_keys, layers=["raw_counts"], uns=True, barcodes=compartment_barcodes)
+        lazy_read.bytes_read = reader.bytes_read
+    return result
+
+def measure(func, part):
+    tracemalloc.start()
+    start = time.time()
+    result = func(part)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def check_same(part, full, lazy):
+    if part == "n_obs":
+        assert full == lazy
+    elif part == "barcodes":
+        assert full.equals(lazy)
+    elif part == "obs":
+        pd.testing.assert_frame_equal(full.obs, lazy.obs)
+        for k in umap_keys:
+            assert np.array_equal(full.obsm[k], lazy.obsm[k])
+    else:
+        pd.testing.assert_frame_equal(full.obs, lazy.obs)
+        pd.testing.assert_frame_equal(full.var, lazy.var)
+        assert (full.layers["raw_counts"] != lazy.layers["raw_counts"]).nnz == 0
+        pd.testing.assert_frame_equal(full.obsm["protein_expression"], lazy.obsm["protein_expression"])
+
+print("file: {} cells x {} genes, {:.1f} MB; compartment: {} cells".format(n_cells, n_genes, file_size / 1024 / 1024, len(compartment_barcodes)))
+print("{:<12} {:>24} {:>24} {:>24}".format("part", "bytes read (MB)", "peak memory (MB)", "time (sec)"))
+for part in ["n_obs", "barcodes", "obs", "compartment"]:
+    full, full_sec, full_peak = measure(full_read, part)
+    lazy, lazy_sec, lazy_peak = measure(lazy_read, part)
+    check_same(part, full, lazy)
+    print("{:<12} {:>24} {:>24} {:>24}".format(part,
+        "{:.2f} -> {:.2f}".format(file_size / 1024 / 1024, lazy_read.bytes_read / 1024 / 1024),
+        "{:.1f} -> {:.1f}".format(full_peak / 1024 / 1024, lazy_peak / 1024 / 1024),
+        "{:.2f} -> {:.2f}".format(full_sec, lazy_sec)))
+print("the parts read are identical to those of the full read")
+shutil.rmtree(working_dir, ignore_errors=True)
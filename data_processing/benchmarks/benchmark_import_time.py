@@ -0,0 +1,82 @@
+## Benchmarks the startup time of the command line tools that only generate configs and scripts or digest logs, and enforces a budget
+## for each: the top-level imports of every tool (its module-level import statements, including `from base_utils import *`) are run
+## in a fresh python process, n_runs times, and the median time must be within budget_sec. Fails as well if any of the heavy modules
+## of the analysis stack (see HEAVY_MODULES) was imported, which is what happens when a tool imports utils.py rather than
+## base_utils.py, or when a module-level import of base_utils.py pulls in the stack. For reference, reports the time it takes to import
+## utils.py (if the stack is installed) and the slowest imports of every tool (from python -X importtime). Finally, runs
+## check_base_utils.py, which calls the helpers of base_utils.py (an import does not catch names the helpers use but don't import).
+## Run as follows: python benchmark_import_time.py <n_runs> <budget_sec>
+## Example: python benchmark_import_time.py 5 1.5
+
+import os
+import re
+import ast
+import sys
+import json
+import time
+import tempfile
+import statistics
+import subprocess
+
+scripts_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+n_runs = int(sys.argv[1])
+budget_sec = float(sys.argv[2])
+
+ENTRY_POINTS = ["generate_processing_config_files.py", "generate_processing_scripts.py", "generate_library_alignment_script.py",
+    "generate_integration_config_files_and_script.py", "generate_scanvi_integration_config_files_and_script.py", "digest_logs.py"]
+HEAVY_MODULES = ["anndata", "scanpy", "scvi", "torch", "celltypist", "scirpy", "statsmodels", "scipy", "utils"]
+
+def get_imports(script):
+    # the module-level import statements of the script, as source
+    with open(os.path.join(scripts_dir, script)) as f:
+        tree = ast.parse(f.read())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+def run_imports(imports, importtime = False):
+    # the time it took to run the imports in a fresh process (including the start of the interpreter) and the heavy modules loaded
+    code = "\n".join(["import sys, json", "sys.path.insert(0, {!r})".format(scripts_dir)] + imports +
+        ["print(json.dumps([m for m in {!r} if m in sys.modules]))".format(HEAVY_MODULES)])
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    start = time.time()
+    proc = subprocess.run(args, cwd = scripts_dir, capture_output = True, text = True)
+    elapsed = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().split("\n")[-1])
+    return elapsed, json.loads(proc.stdout.strip().split("\n")[-1]), proc.stderr
+
+def slowest_imports(importtime_output, n = 3):
+    # the top-level imports (as seen by the script) that took the longest, with their cumulative time in sec
+    times = []
+    for line in importtime_output.split("\n"):
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S+)$", line)
+        if match is not None:
+            times.append((match.group(2), int(match.group(1)) / 1e6))
+    return sorted(times, key = lambda t: -t[1])[:n]
+
+baseline = statistics.median([run_imports([])[0] for _ in range(n_runs)])
+print("python startup: {:.3f} sec".format(baseline))
+try:
+    utils_sec = statistics.median([run_imports(["import utils"])[0] for _ in range(n_runs)])
+    print("import utils: {:.2f} sec".format(utils_sec))
+except RuntimeError as err:
+    print("import utils: not available here ({})".format(err))
+
+over_budget = []
+for script in ENTRY_POINTS:
+    imports = get_imports(script)
+    runs = [run_imports(imports) for _ in range(n_runs)]
+    elapsed = statistics.median([r[0] for r in runs])
+    heavy = runs[0][1]
+    slowest = slowest_imports(run_imports(imports, importtime = True)[2])
+    print("{}: {:.3f} sec (budget {:.2f} sec){}; slowest: {}".format(script, elapsed, budget_sec,
+        "; heavy modules: {}".format(", ".join(heavy)) if len(heavy) > 0 else "", ", ".join(["{} {:.3f}".format(m, t) for m, t in slowest])))
+    assert len(heavy) == 0, "{} imports {}".format(script, ", ".join(heavy))
+    if elapsed > budget_sec:
+        over_budget.append(script)
+assert len(over_budget) == 0, "over budget: {}".format(", ".join(over_budget))
+
+with tempfile.TemporaryDirectory() as working_dir:
+    proc = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_base_utils.py"),
+        os.path.join(working_dir, "check")], capture_output = True, text = True)
+assert proc.returncode == 0, "check_base_utils.py failed:\n{}".format(proc.stderr.strip())
+print(proc.stdout.strip().split("\n")[-1])
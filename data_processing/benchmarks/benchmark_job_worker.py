@@ -0,0 +1,136 @@
+## Benchmarks draining the job queue with one and with several job_worker.py workers that share the queue (a fake bucket on the local
+## filesystem, see IA_S3_LOCAL_ROOT in s3_utils.py), and reports the throughput and the tail latencies of the jobs (see queue_stats).
+## The jobs are stubs that sleep (libraries lib_sec, samples sample_sec) and check that the libraries of a sample were processed first.
+## With several workers, one of them is killed (with its job) half way; its job must be taken over once its lease expires. Checks that
+## every job is done, and done once (only the job of the killed worker runs twice).
+## Run as follows: python benchmark_job_worker.py <working_dir> <n_workers> <n_donors> <libraries_per_donor> <samples_per_donor> <lib_sec> <sample_sec> <lease_sec>
+## Example: python benchmark_job_worker.py /tmp/job_worker_benchmark 4 3 4 3 1 1.5 3
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_workers = int(sys.argv[2])
+n_donors = int(sys.argv[3])
+libraries_per_donor = int(sys.argv[4])
+samples_per_donor = int(sys.argv[5])
+stage_sec = {"process_library": float(sys.argv[6]), "process_sample": float(sys.argv[7])}
+lease_sec = float(sys.argv[8])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+
+import job_worker
+from job_worker import JobWorker, queue_path, queue_stats
+from s3_utils import s3_cp, s3_list
+
+outputs_dir = os.path.join(working_dir, "outputs")
+runs_file = os.path.join(working_dir, "runs.log")
+
+# the stub job: <configs_file> <sec>; writes <donor>.<library>.done and fails if a library of a sample was not processed
+stub_script = os.path.join(working_dir, "stub_job.py")
+with open(stub_script, "w") as f:
+    f.write('''
+import os, sys, json, time
+configs_file, sec = sys.argv[1], float(sys.argv[2])
+with open(configs_file) as f:
+    configs = json.load(f)
+name = os.path.basename(configs_file)
+if "library_ids" in configs:
+    for lib_id in configs["library_ids"].split(","):
+        assert os.path.exists(os.path.join({outputs_dir!r}, "{{}}.{{}}.done".format(configs["donor"], lib_id))), "missing library " + lib_id
+with open({runs_file!r}, "a") as f:
+    f.write(name + "\\n")
+time.sleep(sec)
+if "library_id" in configs:
+    open(os.path.join({outputs_dir!r}, "{{}}.{{}}.done".format(configs["donor"], configs["library_id"])), "w").close()
+'''.format(outputs_dir=outputs_dir, runs_file=runs_file))
+
+def queue_jobs():
+    # the configs files of generate_processing_config_files.py, uploaded to the queue
+    configs_dir = os.path.join(working_dir, "configs")
+    shutil.rmtree(configs_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(working_dir, "bucket"), ignore_errors=True)
+    shutil.rmtree(outputs_dir, ignore_errors=True)
+    os.makedirs(configs_dir)
+    os.makedirs(outputs_dir)
+    if os.path.exists(runs_file):
+        os.remove(runs_file)
+    names = []
+    def queue(job_type, name, configs):
+        with open(os.path.join(configs_dir, name), "w") as f:
+            json.dump(configs, f)
+        s3_cp(os.path.join(configs_dir, name), queue_path(job_type, name))
+        names.append(name)
+    for d in range(n_donors):
+        donor, seq_run = "D{}".format(d), "001"
+        library_ids = ["L{}-{}".format(d, l) for l in range(libraries_per_donor)]
+        for s in range(samples_per_donor):
+            sample_id = "{}-S{}".format(donor, s)
+            sample_libs = [library_ids[s % libraries_per_donor], library_ids[(s + 1) % libraries_per_donor]]
+            queue("process_sample", "process_sample.configs.{}.txt".format(sample_id), {"donor": donor, "seq_run": seq_run, "sample_id": sample_id,
+                "library_ids": ",".join(sample_libs), "library_types": "GEX,GEX"})
+        for library_id in library_ids:
+            queue("process_library", "process_library.{}.{}.{}.GEX.configs.txt".format(donor, seq_run, library_id), {"donor": donor,
+                "seq_run": seq_run, "library_id": library_id, "library_type": "GEX"})
+    return names
+
+def run_worker(i):
+    # in its own process group, so that killing the worker also kills its job (as when a node dies)
+    os.setpgrp()
+    worker = JobWorker(["process_library", "process_sample"], os.path.join(working_dir, "worker{}".format(i)), working_dir,
+        worker_id = "worker{}".format(i), lease_sec = lease_sec, poll_sec = 0.2, max_idle_sec = lease_sec * 2,
+        command = lambda job_type, configs_file: [sys.executable, stub_script, configs_file, str(stage_sec[job_type])])
+    worker.run()
+
+def runs():
+    with open(runs_file) as f:
+        return [line.strip() for line in f]
+
+def drain(n, kill_one):
+    names = queue_jobs()
+    start = time.time()
+    workers = [multiprocessing.Process(target=run_worker, args=(i,)) for i in range(n)]
+    for w in workers:
+        w.start()
+    killed = None
+    if kill_one:
+        # kill a worker in the middle of a job
+        while len(runs() if os.path.exists(runs_file) else []) < len(names) // 2:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        killed = workers[0]
+        os.killpg(killed.pid, signal.SIGKILL)
+    for w in workers:
+        w.join()
+    # the workers stop after being idle for max_idle_sec
+    elapsed = time.time() - start - lease_sec * 2
+    done = [k.split("/")[-1] for t in ["process_library", "process_sample"] for k in s3_list(queue_path(t, state="done"))]
+    assert sorted(done) == sorted(names), "not all jobs are done"
+    assert all([len(s3_list(queue_path(t))) == 0 for t in ["process_library", "process_sample"]])
+    rerun = [name for name in set(runs()) if runs().count(name) > 1]
+    assert len(rerun) <= (1 if kill_one else 0), "jobs that ran more than once: {}".format(rerun)
+    stats = {t: queue_stats(t) for t in ["process_library", "process_sample"]}
+    print("{} worker(s){}: {} jobs in {:.1f} sec ({:.0f} jobs per hour); {} job(s) ran twice".format(n, " (one killed)" if kill_one else "",
+        len(names), elapsed, len(names) / elapsed * 3600, len(rerun)))
+    for t in stats:
+        print("  {}: wait p50 {:.1f} / p95 {:.1f} / p99 {:.1f} sec; total p50 {:.1f} / p95 {:.1f} / max {:.1f} sec".format(t,
+            stats[t]["wait"]["p50"], stats[t]["wait"]["p95"], stats[t]["wait"]["p99"], stats[t]["total"]["p50"], stats[t]["total"]["p95"],
+            stats[t]["total"]["max"]))
+    return elapsed
+
+n_jobs = n_donors * (libraries_per_donor + samples_per_donor)
+print("{} jobs ({} donors with {} libraries and {} samples each); lease of {} sec".format(n_jobs, n_donors, libraries_per_donor,
+    samples_per_donor, lease_sec))
+one_sec = drain(1, False)
+many_sec = drain(n_workers, False)
+print("speedup with {} workers: {:.2f}x".format(n_workers, one_sec / many_sec))
+drain(n_workers, True)
+shutil.rmtree(working_dir, ignore_errors=True)
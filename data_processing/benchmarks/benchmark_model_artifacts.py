@@ -0,0 +1,107 @@
+## Benchmarks saving and loading scvi models as done previously (model.save() plus a copy of the training data written as an lzf h5ad into the
+## model directory, then the directory zipped with deflate) vs. the model artifacts of model_artifacts.py (weights and registry plus a reference
+## to the training cells, packaged in one pass; also with float16 weights). Reports the size of the zip and the save and load times, where
+## loading includes unpacking the zip and rebuilding the training data (read from the model directory, or from the referenced h5ad file).
+## Also checks that the latent representation of the loaded models matches that of the trained model, and that a model trained without a
+## batch key (as for samples with a single library) is packaged and its training data rebuilt.
+## The model is trained for a few epochs on synthetic counts; the training time is not part of the benchmark.
+## Run as follows: python benchmark_model_artifacts.py <working_dir> <n_cells> <n_genes> <n_hvgs> <max_epochs>
+## Example: python benchmark_model_artifacts.py /tmp/model_artifacts_benchmark 100000 10000 3000 2
+
+import os
+import sys
+import shutil
+import zipfile
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+import scvi
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+n_hvgs = int(sys.argv[4])
+max_epochs = int(sys.argv[5])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+warnings.simplefilter("ignore")
+
+from model_artifacts import save_model_artifact, extract_model_artifact, read_model_manifest, read_model_training_data, load_model_artifact
+from fake_store import timed
+
+def zipdir(path, ziph):
+    # as in utils.py
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), os.path.join(path, '..')))
+
+# synthetic stage output (all genes, counts in X) and the training data (the highly variable genes of the same cells)
+rng = np.random.default_rng(0)
+X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=0, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+obs = pd.DataFrame({"donor_id": pd.Categorical(rng.choice(["D1", "D2", "D3", "D4"], n_cells))}, index=["AAACCTG{}-1_lib1".format(i) for i in range(n_cells)])
+output = anndata.AnnData(X, obs=obs, var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+output_file = "sample.processed.v1.h5ad"
+output.write(os.path.join(working_dir, output_file), compression="lzf")
+rna = output[:, rng.choice(n_genes, n_hvgs, replace=False)].copy()
+scvi.data.setup_anndata(rna, batch_key="donor_id")
+model = scvi.model.SCVI(rna)
+model.train(max_epochs=max_epochs)
+latent = model.get_latent_representation()
+dir_name = "sample.scvi_model_batch_key_donor_id"
+
+def save_previous(artifact_path, model_dir_path):
+    model.save(model_dir_path, overwrite=True)
+    model.adata.copy().write(os.path.join(model_dir_path, "sample.v1.scvi_model_batch_key_donor_id.data.h5ad"), compression="lzf")
+    zipf = zipfile.ZipFile(artifact_path, 'w', zipfile.ZIP_DEFLATED)
+    zipdir(model_dir_path, zipf)
+    zipf.close()
+
+def load_previous(artifact_path, target_dir):
+    shutil.unpack_archive(artifact_path, target_dir)
+    model_dir = os.path.join(target_dir, dir_name)
+    data = anndata.read_h5ad(os.path.join(model_dir, "sample.v1.scvi_model_batch_key_donor_id.data.h5ad"))
+    return scvi.model.SCVI.load(model_dir, adata=data)
+
+def load_artifact(artifact_path, target_dir):
+    model_dir = extract_model_artifact(artifact_path, target_dir)
+    return load_model_artifact(scvi.model.SCVI, model_dir, read_model_training_data(model_dir, os.path.join(working_dir, output_file)))
+
+formats = [
+    ("previous", save_previous, load_previous),
+    ("artifact", lambda a, d: save_model_artifact(model, a, d, "scvi", "donor_id", output_file), load_artifact),
+    ("artifact_fp16", lambda a, d: save_model_artifact(model, a, d, "scvi", "donor_id", output_file, reduced_precision=True), load_artifact),
+]
+print("{} cells, {} genes ({} used by the model)".format(n_cells, n_genes, n_hvgs))
+print("{:<14} {:>10} {:>10} {:>10} {:>22}".format("format", "size (MB)", "save (s)", "load (s)", "max latent difference"))
+for name, save, load in formats:
+    artifact_path = os.path.join(working_dir, "{}.zip".format(name))
+    _, save_sec = timed(save, artifact_path, os.path.join(working_dir, "save", dir_name))
+    loaded, load_sec = timed(load, artifact_path, os.path.join(working_dir, "load", name))
+    difference = np.abs(loaded.get_latent_representation() - latent).max()
+    assert difference < (1e-2 if name.endswith("fp16") else 1e-5)
+    print("{:<14} {:>10.2f} {:>10.2f} {:>10.2f} {:>22.2e}".format(name, os.path.getsize(artifact_path) / 1024 / 1024, save_sec, load_sec, difference))
+    shutil.rmtree(os.path.join(working_dir, "save"), ignore_errors=True)
+
+class StubModel:
+    # a model trained with batch_key=None: only what save_model_artifact uses
+    def __init__(self, adata):
+        self.adata = adata
+    def save(self, dir_path, overwrite=False):
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, "model.pt"), "wb") as f:
+            f.write(b"weights")
+
+no_batch = output[:, rna.var_names].copy()
+del no_batch.obs["donor_id"]
+artifact_path = os.path.join(working_dir, "no_batch_key.zip")
+save_model_artifact(StubModel(no_batch), artifact_path, os.path.join(working_dir, "save", "sample.scvi_model_batch_key_None"), "scvi", None, output_file)
+model_dir = extract_model_artifact(artifact_path, os.path.join(working_dir, "load", "no_batch_key"))
+assert read_model_manifest(model_dir)["batch_key"] is None
+data = read_model_training_data(model_dir, os.path.join(working_dir, output_file))
+assert list(data.obs.columns) == list(output.obs.columns) and data.n_obs == n_cells and list(data.var_names) == list(rna.var_names)
+print("artifact of a model without a batch key: ok")
+shutil.rmtree(working_dir, ignore_errors=True)
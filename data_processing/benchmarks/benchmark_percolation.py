@@ -0,0 +1,122 @@
+## Benchmarks the percolation scores of process_sample.py (all the configured scores over the overclustering) and the per-cluster statistics of integrate_samples.py:
+## the previous implementation (one .loc assignment per cluster) vs. percolation.py (categorical codes, grouped statistics and broadcasting by indexing).
+## Synthetic obs with the scores of the default process_sample configs are generated. The previous implementation is O(clusters x cells), so it is only run if
+## n_cells x n_clusters is at most <max_previous_work>; when it is run, the outputs of both implementations are compared, both with
+## all the categories of the overclustering used and with unused categories (clusters without cells, e.g. after subsetting the cells).
+## Run as follows: python benchmark_percolation.py <n_cells_list> <n_clusters_list> <max_previous_work>
+## Example: python benchmark_percolation.py 100000,1000000 1000,10000 1e10
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from anndata import AnnData
+from scipy.stats import norm
+from statsmodels.stats import multitest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from percolation import percolate_observations, add_cluster_statistics
+
+# as in generate_processing_config_files.py
+percolation_scores = {
+    "doublet_probability" : {"score_key": "doublet_probability"},
+    "doublet_hypothesis_probability": {"score_key": "doublet_hypothesis_probability"},
+    "pct_counts_hb": {"score_key": "pct_counts_hb"},
+    "double_ir": {"score_key": "double_ir", "threshold": "True"},
+    "celltypist_predicted_labels.RBC_model_CZI": {"score_key": "celltypist_predicted_labels.RBC_model_CZI", "threshold": "RBC"},
+    "total_counts" : {"score_key": "total_counts", "threshold": 2000, "exclude_high": False},
+    "n_genes" : {"score_key": "n_genes", "threshold": 1200, "exclude_high": False},
+    "n_proteins" : {"score_key": "n_proteins", "threshold": 200, "exclude_high": False}
+}
+
+def synthetic_adata(n_cells, n_clusters, seed=0):
+    # clusters of varying sizes, with a few clusters that have high doublet probabilities / low counts
+    rng = np.random.default_rng(seed)
+    clusters = np.sort(rng.zipf(1.5, n_cells) % n_clusters)
+    outlier = rng.random(n_clusters) < 0.05
+    obs = pd.DataFrame(index=["cell{}".format(i) for i in range(n_cells)])
+    obs["overclustering_percolate"] = pd.Categorical(clusters.astype(str))
+    obs["doublet_probability"] = np.clip(rng.beta(1, 10, n_cells) + 0.5 * outlier[clusters], 0, 1)
+    obs["doublet_hypothesis_probability"] = rng.random(n_cells)
+    obs["pct_counts_hb"] = rng.exponential(0.1, n_cells).astype(np.float32)
+    obs["double_ir"] = pd.Categorical(np.where(rng.random(n_cells) < 0.02 + 0.3 * outlier[clusters], "True", "False"))
+    obs["celltypist_predicted_labels.RBC_model_CZI"] = pd.Categorical(np.where(rng.random(n_cells) < 0.01, "RBC", "other"))
+    obs["total_counts"] = rng.lognormal(8, 0.5, n_cells) * np.where(outlier[clusters], 0.2, 1)
+    obs["n_genes"] = rng.poisson(1500, n_cells) * np.where(outlier[clusters], 0.5, 1)
+    obs["n_proteins"] = rng.poisson(250, n_cells)
+    return AnnData(obs=obs)
+
+def with_unused_categories(adata, n_unused=3):
+    adata = adata.copy()
+    adata.obs["overclustering_percolate"] = adata.obs["overclustering_percolate"].cat.add_categories(
+        ["unused{}".format(i) for i in range(n_unused)])
+    return adata
+
+def previous_percolate_observation(adata, overclustering_key, score_key, exclude_high=True, qval=0.1, threshold=None):
+    # utils.percolate_observation before percolation.py
+    def grouped_threshold(x, threshold):
+        if isinstance(threshold, str):
+            return np.mean(x==threshold)
+        elif threshold is not None:
+            return np.mean(x>threshold)
+        else:
+            return np.median(x)
+    df = adata.obs.groupby(overclustering_key, observed=False).agg({score_key: lambda x: grouped_threshold(x, threshold)})
+    for cluster in df.index:
+        adata.obs.loc[adata.obs[overclustering_key] == cluster, f'{score_key}_median_cluster_scores'] = df.loc[cluster, score_key]
+    med = adata.obs[f'{score_key}_median_cluster_scores'][adata.obs[f'{score_key}_median_cluster_scores']>0].median()
+    mad = 0.03 + np.median(abs(adata.obs[f'{score_key}_median_cluster_scores'][adata.obs[f'{score_key}_median_cluster_scores'] < med] - med))
+    if exclude_high:
+        pvals = 1 - norm.cdf(adata.obs[f'{score_key}_median_cluster_scores'], loc = med, scale = 1.4826*mad)
+    else:
+        pvals = norm.cdf(adata.obs[f'{score_key}_median_cluster_scores'], loc = med, scale = 1.4826*mad)
+    adata.obs[f'{score_key}_bh_pval'] = multitest.fdrcorrection(pvals, alpha=qval)[1]
+    adata.obs[f'{score_key}_percolation'] = adata.obs[f'{score_key}_bh_pval'] < qval
+
+def previous_implementation(adata):
+    # process_sample.py and then integrate_samples.py before percolation.py
+    adata.obs['sum_percolation_score'] = 0
+    for obs_key in percolation_scores:
+        previous_percolate_observation(adata, overclustering_key='overclustering_percolate', **percolation_scores[obs_key])
+        adata.obs['sum_percolation_score'] += adata.obs[f'{obs_key}_percolation'].astype(int)
+    adata.obs['sum_percolation_score'] = adata.obs['sum_percolation_score'].astype(float)
+    df = adata.obs.groupby('overclustering_percolate', observed=False)['sum_percolation_score'].agg(['median', 'mean', lambda x: x.quantile(0.75)])
+    for cluster in df.index:
+        adata.obs.loc[adata.obs['overclustering_percolate'] == cluster, 'sum_percolation_score_q75_cluster'] = df.loc[cluster, '<lambda_0>']
+        adata.obs.loc[adata.obs['overclustering_percolate'] == cluster, 'sum_percolation_score_median_cluster'] = df.loc[cluster, 'median']
+        adata.obs.loc[adata.obs['overclustering_percolate'] == cluster, 'sum_percolation_score_mean_cluster'] = df.loc[cluster, 'mean']
+
+def current_implementation(adata):
+    adata.obs['sum_percolation_score'] = 0
+    adata.obs['sum_percolation_score'] = percolate_observations(adata, 'overclustering_percolate', percolation_scores)
+    adata.obs['sum_percolation_score'] = adata.obs['sum_percolation_score'].astype(float)
+    add_cluster_statistics(adata.obs, 'overclustering_percolate', 'sum_percolation_score')
+
+n_cells_list = [int(float(i)) for i in sys.argv[1].split(",")]
+n_clusters_list = [int(float(i)) for i in sys.argv[2].split(",")]
+max_previous_work = float(sys.argv[3])
+
+print("n_cells\tn_clusters\tunused categories\timplementation\twall time (sec)")
+for n_cells, n_clusters in zip(n_cells_list, n_clusters_list):
+    for unused in [False, True]:
+        adata = synthetic_adata(n_cells, n_clusters)
+        if unused:
+            adata = with_unused_categories(adata)
+        results = {}
+        for name, implementation in [("previous", previous_implementation), ("percolation.py", current_implementation)]:
+            if name == "previous" and n_cells * n_clusters > max_previous_work:
+                print("{}\t{}\t{}\t{}\tskipped".format(n_cells, n_clusters, unused, name))
+                continue
+            adata_run = adata.copy()
+            start = time.time()
+            implementation(adata_run)
+            results[name] = (time.time() - start, adata_run.obs)
+            print("{}\t{}\t{}\t{}\t{:.2f}".format(n_cells, n_clusters, unused, name, results[name][0]))
+        if "previous" in results:
+            previous, current = results["previous"][1], results["percolation.py"][1]
+            assert list(previous.columns) == list(current.columns)
+            for column in previous.columns:
+                assert np.array_equal(previous[column].values, current[column].values), column
+            print("{}\t{}\t{}\tspeedup: {:.2f}x; outputs are identical".format(n_cells, n_clusters, unused,
+                results["previous"][0] / max(results["percolation.py"][0], 1e-9)))
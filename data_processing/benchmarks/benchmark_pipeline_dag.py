@@ -0,0 +1,158 @@
+## Benchmarks running the processing jobs of several donors with pipeline_dag.py vs. one after the other (as in the .sh files written by
+## generate_processing_scripts.py: the library jobs of every donor, then its sample jobs, then the integration). Reports the makespan of
+## both and the critical path and utilization reported by the executor.
+## The jobs are stubs that sleep (libraries lib_sec, samples sample_sec, the integration integration_sec) and check that the outputs of the
+## jobs they depend on exist. One library job fails on its first attempt (it is retried). Also interrupts a run half way, resumes it, and
+## checks that no job that was done before the interruption runs again.
+## Run as follows: python benchmark_pipeline_dag.py <working_dir> <n_donors> <libraries_per_donor> <samples_per_donor> <node_cores> <lib_sec> <sample_sec> <integration_sec>
+## Example: python benchmark_pipeline_dag.py /tmp/pipeline_dag_benchmark 3 6 4 16 2 3 4
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_donors = int(sys.argv[2])
+libraries_per_donor = int(sys.argv[3])
+samples_per_donor = int(sys.argv[4])
+node_cores = int(sys.argv[5])
+stage_sec = {"process_library": float(sys.argv[6]), "process_sample": float(sys.argv[7]), "integrate_samples": float(sys.argv[8])}
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+
+import pipeline_dag
+from pipeline_dag import PipelineExecutor, build_pipeline_tasks, read_configs_files
+
+pipeline_dag.POLL_INTERVAL_SEC = 0.05
+pipeline_dag.RETRY_DELAY_SEC = 0.5
+outputs_dir = os.path.join(working_dir, "outputs")
+runs_file = os.path.join(working_dir, "runs.log")
+
+# the stub job: <configs_file> <sec>; writes <name>.done once it slept and fails if an input is missing
+stub_script = os.path.join(working_dir, "stub_job.py")
+with open(stub_script, "w") as f:
+    f.write('''
+import os, sys, json, time
+configs_file, sec = sys.argv[1], float(sys.argv[2])
+with open(configs_file) as f:
+    configs = json.load(f)
+for input_name in configs["stub_inputs"]:
+    assert os.path.exists(os.path.join({outputs_dir!r}, input_name + ".done")), "missing input " + input_name
+with open({runs_file!r}, "a") as f:
+    f.write(configs["stub_name"] + "\\n")
+time.sleep(sec)
+if configs.get("stub_fail_once") and not os.path.exists(configs_file + ".failed"):
+    open(configs_file + ".failed", "w").close()
+    sys.exit(1)
+open(os.path.join({outputs_dir!r}, configs["stub_name"] + ".done"), "w").close()
+'''.format(outputs_dir=outputs_dir, runs_file=runs_file))
+
+def write_configs(name):
+    # configs files as written by generate_processing_config_files.py, generate_processing_scripts.py and
+    # generate_integration_config_files_and_script.py; the jobs files list them per donor, in the order of the .sh files
+    configs_dir = os.path.join(working_dir, name, "configs")
+    os.makedirs(configs_dir)
+    def write(configs_name, configs, stub_name, stub_inputs):
+        filename = os.path.join(configs_dir, configs_name)
+        configs.update({"stub_name": stub_name, "stub_inputs": stub_inputs})
+        with open(filename, "w") as f:
+            json.dump(configs, f)
+        return filename
+    jobs_files = []
+    all_sample_ids = []
+    for d in range(n_donors):
+        donor, seq_run = "D{}".format(d), "001"
+        library_ids = ["L{}-{}".format(d, l) for l in range(libraries_per_donor)]
+        lib_files = []
+        for l, library_id in enumerate(library_ids):
+            lib_files.append(write("process_library.{}.configs.txt".format(library_id), {"donor": donor, "seq_run": seq_run,
+                "library_type": "GEX", "library_id": library_id, "stub_fail_once": d == 0 and l == 0}, library_id, []))
+        sample_files = []
+        for s in range(samples_per_donor):
+            sample_id = "{}-S{}".format(donor, s)
+            # every sample is in two of the libraries of its donor
+            sample_libs = [library_ids[s % libraries_per_donor], library_ids[(s + 1) % libraries_per_donor]]
+            sample_files.append(write("process_sample.{}.configs.txt".format(sample_id), {"donor": donor, "seq_run": seq_run,
+                "sample_id": sample_id, "library_ids": ",".join(sample_libs), "library_types": "GEX,GEX"}, sample_id, sample_libs))
+            all_sample_ids.append(sample_id)
+        for stage, files in [("process_library", lib_files), ("process_sample", sample_files)]:
+            jobs_files.append(os.path.join(configs_dir, "{}.{}_jobs.sh".format(donor, stage)))
+            with open(jobs_files[-1], "w") as f:
+                f.write("".join([fn + "\n" for fn in files]))
+    jobs_files.append(write("integrate_samples.All.configs.txt", {"output_prefix": "All", "sample_ids": ",".join(all_sample_ids)},
+        "All", all_sample_ids))
+    return jobs_files
+
+def make_tasks(jobs_files):
+    return build_pipeline_tasks(read_configs_files(jobs_files), command = lambda stage, configs_file, configs: [sys.executable, stub_script,
+        configs_file, str(stage_sec[stage])], cores = {"process_library": 2, "process_sample": 4, "integrate_samples": node_cores})
+
+def reset_outputs():
+    shutil.rmtree(outputs_dir, ignore_errors=True)
+    os.makedirs(outputs_dir)
+    if os.path.exists(runs_file):
+        os.remove(runs_file)
+
+def runs():
+    with open(runs_file) as f:
+        return [line.strip() for line in f]
+
+n_jobs = n_donors * (libraries_per_donor + samples_per_donor) + 1
+print("{} donors with {} libraries and {} samples each, one integration ({} jobs) on a node with {} cores".format(n_donors, libraries_per_donor,
+    samples_per_donor, n_jobs, node_cores))
+
+# one job after the other, retrying the failed one right away
+reset_outputs()
+jobs_files = write_configs("sequential")
+start = time.time()
+for task in make_tasks(jobs_files):
+    if subprocess.run(task.command).returncode != 0:
+        subprocess.run(task.command, check=True)
+sequential_sec = time.time() - start
+print("sequential: makespan {:.1f} sec".format(sequential_sec))
+
+reset_outputs()
+jobs_files = write_configs("dag")
+executor = PipelineExecutor(make_tasks(jobs_files), os.path.join(working_dir, "dag", "state.json"), cores=node_cores, mem_gb=1024)
+assert len(executor.run()) == 0
+assert len(runs()) == n_jobs + 1
+stats = executor.report()
+print("dag: makespan {:.1f} sec ({:.2f}x); critical path {:.1f} sec ({}); lower bound {:.1f} sec; core utilization {:.0%}".format(
+    stats["makespan"], sequential_sec / stats["makespan"], stats["critical_path_sec"], " -> ".join(stats["critical_path"]),
+    stats["lower_bound_sec"], stats["core_utilization"]))
+
+# interrupt a run half way (as with ctrl-c) and resume it
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+reset_outputs()
+jobs_files = write_configs("resume")
+state_file = os.path.join(working_dir, "resume", "state.json")
+interrupted = PipelineExecutor(make_tasks(jobs_files), state_file, cores=node_cores, mem_gb=1024)
+signal.signal(signal.SIGALRM, interrupt)
+signal.setitimer(signal.ITIMER_REAL, stats["makespan"] / 2)
+try:
+    interrupted.run()
+except KeyboardInterrupt:
+    pass
+signal.setitimer(signal.ITIMER_REAL, 0)
+with open(state_file) as f:
+    done_before = [name for name, s in json.load(f).items() if s["status"] == "done"]
+stub_names = {}
+for task in make_tasks(jobs_files):
+    with open(task.configs_file) as f:
+        stub_names[task.name] = json.load(f)["stub_name"]
+runs_before = len(runs())
+resumed = PipelineExecutor(make_tasks(jobs_files), state_file, cores=node_cores, mem_gb=1024)
+assert len(resumed.run()) == 0
+rerun = runs()[runs_before:]
+assert all([stub_names[name] not in rerun for name in done_before])
+print("resume: {} of {} jobs were done when the run was interrupted after {:.1f} sec; {} jobs ran on resume ({:.1f} sec)".format(
+    len(done_before), n_jobs, stats["makespan"] / 2, len(rerun), resumed.makespan))
+shutil.rmtree(working_dir, ignore_errors=True)
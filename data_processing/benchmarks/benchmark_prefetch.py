@@ -0,0 +1,87 @@
+## Benchmarks reading the input h5ad files of process_sample.py / integrate_samples.py when they are downloaded one at a time before reading any of them
+## (as the scripts used to do) vs. with the Prefetcher in prefetch.py (concurrent downloads in the background, each file is read as soon as it arrives).
+## The files are served by a throttled fake object store (ThrottledStore in fake_store.py: a LocalStore with a latency per request and a bandwidth per connection), which also corrupts
+## the first download of one of the files in order to exercise the verification; the disk budget is checked by tracking the bytes downloaded ahead of the reader.
+## Run as follows: python benchmark_prefetch.py <working_dir> <n_files> <n_cells_per_file> <latency_sec> <bandwidth_mb_per_sec> <max_concurrency> <disk_budget_mb>
+## Example: python benchmark_prefetch.py /tmp/prefetch_benchmark 8 20000 0.2 50 4 200
+
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from prefetch import Prefetcher
+from logger import SimpleLogger
+from fake_store import ThrottledStore
+
+working_dir = os.path.abspath(sys.argv[1])
+n_files = int(sys.argv[2])
+n_cells_per_file = int(sys.argv[3])
+latency = float(sys.argv[4])
+bandwidth = float(sys.argv[5]) * 1024 * 1024
+max_concurrency = int(sys.argv[6])
+disk_budget = int(float(sys.argv[7]) * 1024 * 1024)
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+
+# synthetic processed libraries
+rng = np.random.default_rng(0)
+keys = []
+for i in range(n_files):
+    key = "processed_libraries/lib{}/v1/lib{}.processed.v1.h5ad".format(i, i)
+    path = os.path.join(working_dir, "bucket", "immuneaging", key)
+    os.makedirs(os.path.dirname(path))
+    X = scipy.sparse.random(n_cells_per_file, 2000, density=0.05, format="csr", random_state=i, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    obs = pd.DataFrame({"Classification": rng.choice(["S1", "S2"], n_cells_per_file)}, index=["lib{}-cell{}".format(i, j) for j in range(n_cells_per_file)])
+    anndata.AnnData(X, obs=obs).write_h5ad(path)
+    keys.append(key)
+total_mb = sum([os.path.getsize(os.path.join(working_dir, "bucket", "immuneaging", k)) for k in keys]) / 1024 / 1024
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+
+def read_library(path):
+    # what process_sample.py does with every library right after reading it
+    adata = anndata.read_h5ad(path)
+    return adata[adata.obs["Classification"] == "S1"].copy()
+
+def download_then_read(store, local_dir):
+    for key in keys:
+        store.download("immuneaging", key, os.path.join(local_dir, os.path.basename(key)))
+    adatas = []
+    for key in keys:
+        store.handed(os.path.getsize(os.path.join(local_dir, os.path.basename(key))))
+        adatas.append(read_library(os.path.join(local_dir, os.path.basename(key))))
+    return adatas
+
+def prefetch_and_read(store, local_dir):
+    transfers = [("s3://immuneaging/" + key, os.path.join(local_dir, os.path.basename(key))) for key in keys]
+    prefetcher = Prefetcher(transfers, logger, max_concurrency=max_concurrency, disk_budget=disk_budget, store=store)
+    adatas = []
+    for _, local_path in transfers:
+        assert prefetcher.wait(local_path)
+        store.handed(os.path.getsize(local_path))
+        adatas.append(read_library(local_path))
+    return adatas
+
+print("{} files, {:.1f} MB in total; latency {} sec, {} MB/sec per connection, max concurrency {}, disk budget {} MB".format(
+    n_files, total_mb, latency, sys.argv[5], max_concurrency, sys.argv[7]))
+results = {}
+for name, run in [("download then read", download_then_read), ("prefetcher", prefetch_and_read)]:
+    local_dir = os.path.join(working_dir, name.replace(" ", "_"))
+    os.makedirs(local_dir)
+    store = ThrottledStore(os.path.join(working_dir, "bucket"), latency, bandwidth, etags=True, corrupt_key=keys[1] if name == "prefetcher" else None)
+    start = time.time()
+    adatas = run(store, local_dir)
+    results[name] = (time.time() - start, adatas)
+    print("{}: {:.2f} sec, {} downloads, max {:.1f} MB downloaded ahead of the reader".format(name, results[name][0], store.n_downloads, store.max_ahead / 1024 / 1024))
+
+for a, b in zip(results["download then read"][1], results["prefetcher"][1]):
+    assert (a.X != b.X).nnz == 0 and a.obs.equals(b.obs)
+print("the data read is identical (one corrupted download was detected and retried); speedup: {:.2f}x".format(
+    results["download then read"][0] / results["prefetcher"][0]))
+shutil.rmtree(working_dir, ignore_errors=True)
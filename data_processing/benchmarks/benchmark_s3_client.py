@@ -0,0 +1,68 @@
+## Compares the time it takes to list and download a set of files from S3 by shelling out to the aws cli (one process per file, as the processing scripts used to do) vs. using the in-process pooled client in s3_utils.py.
+## Run as follows (s3_access_file can be "local" for benchmarking against a local fake bucket set up via the IA_S3_LOCAL_ROOT environment variable, in which case cp is used as the subprocess baseline):
+## python benchmark_s3_client.py <s3_access_file> <s3_dir> <include_pattern> <n_repeats> <working_dir>
+## Example: python benchmark_s3_client.py ~/.aws_keys.sh s3://immuneaging/cell_filtering/ "*.csv" 3 /tmp/s3_benchmark
+
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from s3_utils import LOCAL_ROOT_ENV, s3_list, s3_sync, split_s3_path
+
+s3_access_file = sys.argv[1]
+s3_dir = sys.argv[2].rstrip("/") + "/"
+include = sys.argv[3]
+n_repeats = int(sys.argv[4])
+working_dir = sys.argv[5]
+
+local_mode = s3_access_file == "local"
+if local_mode:
+    assert os.environ.get(LOCAL_ROOT_ENV, "") != "", "{} must be set when running in local mode".format(LOCAL_ROOT_ENV)
+else:
+    # avoid importing the heavy dependencies of utils.py only for reading the credentials
+    keys = {}
+    with open(s3_access_file) as fp:
+        for line in fp:
+            if len(line.rstrip()) and line[0] != "#":
+                pair = "".join(line.rstrip().split(" ")[1:]).split("=")
+                keys[pair[0]] = pair[1]
+    os.environ.update(keys)
+
+def subprocess_run():
+    # list + one process per file
+    if local_mode:
+        bucket, prefix = split_s3_path(s3_dir)
+        local_dir = os.path.join(os.environ[LOCAL_ROOT_ENV], bucket, prefix)
+        files = [f for f in os.listdir(local_dir) if fnmatch.fnmatch(f, include)]
+        for f in files:
+            subprocess.run(["cp", os.path.join(local_dir, f), target_dir], check=True)
+    else:
+        ls = subprocess.run(["aws", "s3", "ls", s3_dir], capture_output=True, text=True).stdout
+        files = [i.split(" ")[-1] for i in ls.rstrip().split("\n") if fnmatch.fnmatch(i.split(" ")[-1], include)]
+        for f in files:
+            subprocess.run(["aws", "s3", "cp", "--no-progress", s3_dir + f, target_dir], capture_output=True, check=True)
+    return len(files)
+
+def in_process_run():
+    return len(s3_sync(s3_dir, target_dir, include, only_if_changed=False).rstrip().split("\n"))
+
+results = {}
+for name, func in [("subprocess", subprocess_run), ("in-process", in_process_run)]:
+    times = []
+    for r in range(n_repeats):
+        target_dir = os.path.join(working_dir, name)
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.makedirs(target_dir)
+        start = time.time()
+        n_files = func()
+        times.append(time.time() - start)
+    n_bytes = sum([os.path.getsize(os.path.join(target_dir, f)) for f in os.listdir(target_dir)])
+    results[name] = min(times)
+    print("{}: {} files, {:.1f} MB; best of {} runs: {:.2f} sec ({:.1f} MB/sec)".format(
+        name, n_files, n_bytes / 1e6, n_repeats, min(times), n_bytes / 1e6 / max(min(times), 1e-9)))
+print("speedup of in-process client: {:.2f}x".format(results["subprocess"] / max(results["in-process"], 1e-9)))
+shutil.rmtree(working_dir, ignore_errors=True)
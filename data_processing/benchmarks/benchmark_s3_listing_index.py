@@ -0,0 +1,70 @@
+## Benchmarks the lookup of the latest aligned version of libraries by listing the bucket (as the config generation scripts used to do) vs. using the local listing index in s3_index.py.
+## A fake bucket with the layout of aligned_libraries/ is created on the local filesystem and served through the local backend of s3_utils.py; the results of both approaches are compared for equality.
+## Run as follows: python benchmark_s3_listing_index.py <working_dir> <n_libs> <n_versions> <n_files_per_lib>
+## Example (~50k keys): python benchmark_s3_listing_index.py /tmp/s3_index_benchmark 2000 5 5
+
+import os
+import re
+import sys
+import time
+import shutil
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+working_dir = os.path.abspath(sys.argv[1])
+n_libs = int(sys.argv[2])
+n_versions = int(sys.argv[3])
+n_files_per_lib = int(sys.argv[4])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+os.environ["IA_S3_INDEX_PATH"] = os.path.join(working_dir, "index.sqlite")
+from s3_utils import s3_list
+from s3_index import get_listing_index, s3_latest_version
+
+print("Seeding the fake bucket...")
+libs = ["CZI-IA{}".format(10000000 + i) for i in range(n_libs)]
+n_keys = 0
+for i, lib in enumerate(libs):
+    # libraries have a varying number of versions
+    for v in range(1, 1 + (i % n_versions) + 1):
+        lib_dir = os.path.join(os.environ["IA_S3_LOCAL_ROOT"], "immuneaging", "aligned_libraries", "v{}".format(v), "D{}_001_GEX_{}".format(i // 10, lib))
+        os.makedirs(lib_dir)
+        file_names = ["D{}_001.{}.v{}.h5ad".format(i // 10, lib, v)] + ["D{}_001_GEX_{}.cellranger.file_{}.csv".format(i // 10, lib, j) for j in range(n_files_per_lib - 1)]
+        for f in file_names:
+            open(os.path.join(lib_dir, f), "w").close()
+            n_keys += 1
+print("{} keys, {} libraries".format(n_keys, n_libs))
+
+def scan(lib):
+    filenames = s3_list("s3://immuneaging/aligned_libraries")
+    latest_version = -1
+    for filename in filenames:
+        m = re.search("({}\\.v)(\\d+)\\.h5ad$".format(lib), filename)
+        if bool(m):
+            latest_version = max(latest_version, int(m[2]))
+    return latest_version
+
+def indexed(lib):
+    return s3_latest_version("s3://immuneaging/aligned_libraries", "({}\\.v)(\\d+)\\.h5ad$".format(lib), component=lib)
+
+# listing the bucket for every lookup is too slow to do for all libraries; time a sample of them and extrapolate
+n_scanned = min(n_libs, 20)
+start = time.time()
+scanned = [scan(lib) for lib in libs[:n_scanned]]
+scan_time = (time.time() - start) * n_libs / n_scanned
+print("listing per lookup: {:.2f} sec for {} lookups (extrapolated from {})".format(scan_time, n_libs, n_scanned))
+
+start = time.time()
+versions = [indexed(lib) for lib in libs]
+index_time = time.time() - start
+print("listing index (cold, including the initial listing): {:.2f} sec for {} lookups".format(index_time, n_libs))
+
+start = time.time()
+versions_warm = [indexed(lib) for lib in libs]
+print("listing index (warm): {:.2f} sec for {} lookups".format(time.time() - start, n_libs))
+
+assert scanned == versions[:n_scanned] and versions == versions_warm
+assert versions == [(i % n_versions) + 1 for i in range(n_libs)]
+print("results are identical; speedup: {:.1f}x".format(scan_time / max(index_time, 1e-9)))
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,98 @@
+## Benchmarks reading the immune aging Google sheet by downloading it on every call (as read_immune_aging_sheet used to do) vs. using the snapshot cache in sheet_cache.py.
+## The sheet is served by a local fake server (with an artificial latency per request, to mimic the Google sheets API) and the calls made by a process_sample.py run are replayed:
+## Donors and Samples at the top of the script, and for each library the lookup of its donor, its protein panel, and the Samples lookups done in vdj_utils.
+## Run as follows: python benchmark_sheet_cache.py <working_dir> <n_libs> <latency_sec>
+## Example: python benchmark_sheet_cache.py /tmp/sheet_benchmark 8 0.5
+
+import os
+import sys
+import time
+import shutil
+import threading
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+working_dir = os.path.abspath(sys.argv[1])
+n_libs = int(sys.argv[2])
+latency = float(sys.argv[3])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+
+# fake tabs of the sheet
+libs = ["CZI-IA{}".format(10000000 + i) for i in range(n_libs)]
+panels = ["Protein panel {}".format(i) for i in range(2)]
+tabs = {
+    "Samples": pd.DataFrame({"Sample_ID": ["S{}".format(i) for i in range(n_libs)], "Donor ID": ["D{}".format(i // 4) for i in range(n_libs)],
+        "GEX lib": libs, "Protein panel": [panels[i % len(panels)] for i in range(n_libs)]}),
+    "Donors": pd.DataFrame({"Donor ID": ["D{}".format(i) for i in range(n_libs // 4 + 1)], "Age (years)": [50] * (n_libs // 4 + 1)}),
+    "CITE key": pd.DataFrame({"Protein": ["CD{}".format(i) for i in range(100)]}),
+    "Dictionary": pd.DataFrame({"Field": ["Donor ID", "Sample_ID"]}),
+}
+for panel in panels:
+    tabs[panel] = pd.DataFrame({"Protein": ["CD{}".format(i) for i in range(100)], "Internal name": ["P{}".format(i) for i in range(100)]})
+
+n_requests = [0]
+class FakeSheetHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        n_requests[0] += 1
+        time.sleep(latency)
+        sheet = parse_qs(urlparse(self.path).query)["sheet"][0]
+        body = bytes(tabs[sheet].to_csv(index=False), "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSheetHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = "http://127.0.0.1:{}/gviz/tq?tqx=out:csv&sheet={{}}".format(server.server_address[1])
+os.environ["IA_SHEET_URL"] = url
+os.environ["IA_CACHE_DIR"] = os.path.join(working_dir, "cache")
+from sheet_cache import get_sheet_snapshot, read_sheet_cached
+
+def download_every_time(sheet):
+    import gdown
+    output_fn = gdown.download(url.format(sheet), os.path.join(working_dir, "sheet.csv"), quiet=True)
+    data = pd.read_csv(output_fn)
+    os.remove(output_fn)
+    return data
+
+def process_sample_run(read_sheet):
+    results = [read_sheet("Donors"), read_sheet("Samples")]
+    for j in range(n_libs):
+        results.append(read_sheet("Samples")) # get_donor_id_for_lib
+        results.append(read_sheet(results[-1]["Protein panel"].iloc[j])) # get_internal_protein_names
+        results.append(read_sheet("Samples")) # get_ir_gex_intersection
+        results.append(read_sheet("Samples")) # report_vdj_lib_ss_and_fp_metrics_for_all_libs
+    return results
+
+runs = {}
+for name, read_sheet in [("download per call", download_every_time), ("snapshot cache (cold)", read_sheet_cached), ("snapshot cache (warm)", read_sheet_cached)]:
+    n_requests[0] = 0
+    start = time.time()
+    results = process_sample_run(read_sheet)
+    runs[name] = (time.time() - start, n_requests[0], results)
+    print("{}: {} calls, {} downloads, {:.2f} sec".format(name, len(results), n_requests[0], runs[name][0]))
+
+# a new process reads the snapshot from disk
+get_sheet_snapshot()._sheets.clear()
+n_requests[0] = 0
+start = time.time()
+results = process_sample_run(read_sheet_cached)
+print("snapshot cache (new process, from disk): {} calls, {} downloads, {:.2f} sec".format(len(results), n_requests[0], time.time() - start))
+
+baseline = runs["download per call"]
+for name in ["snapshot cache (cold)", "snapshot cache (warm)"]:
+    assert all([a.equals(b) for a, b in zip(baseline[2], runs[name][2])])
+print("results are identical; downloads saved: {}, seconds saved: {:.2f} (cold cache)".format(
+    baseline[1] - runs["snapshot cache (cold)"][1], baseline[0] - runs["snapshot cache (cold)"][0]))
+server.shutdown()
+shutil.rmtree(working_dir, ignore_errors=True)
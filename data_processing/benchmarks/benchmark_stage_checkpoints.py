@@ -0,0 +1,132 @@
+## Benchmarks rerunning a synthetic sample with stage checkpoints (checkpoints.py) after a change to a late config, vs. rerunning all
+## of its stages. The sample goes through stand-ins for the stages of process_sample.py, with the same dependencies between them:
+## decontx -> annotation -> (scvi model, doublets) -> late stage (neighbors/UMAP, which is not checkpointed), where every checkpointed
+## stage does some work on the counts and then sleeps for stage_sec (standing in for decontX in R, celltypist and model training).
+## Runs the sample once to fill the cache, then reruns it after changing umap_min_dist (only the late stage should run), after
+## changing n_highly_variable_genes (decontx should be restored and the stages after it should run), and on a fresh local cache
+## with the checkpoints in the object store only (a fake bucket on the local filesystem, see IA_S3_LOCAL_ROOT in s3_utils.py).
+## Checks that the outputs of every rerun are the same as those of a run without checkpoints.
+## Run as follows: python benchmark_stage_checkpoints.py <working_dir> <n_cells> <n_genes> <stage_sec>
+## Example: python benchmark_stage_checkpoints.py /tmp/stage_checkpoints_benchmark 20000 2000 2
+
+import os
+import sys
+import time
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+stage_sec = float(sys.argv[4])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+
+from checkpoints import StageCheckpoints
+from logger import SimpleLogger
+
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+data_dir = os.path.join(working_dir, "data")
+os.makedirs(data_dir)
+s3_dir = "s3://immuneaging/stage_checkpoints"
+
+rng = np.random.default_rng(0)
+counts = sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=0, data_rvs=lambda n: rng.poisson(3, n) + 1).astype(np.float32)
+obs = pd.DataFrame({"batch": rng.choice(["0", "1"], n_cells)}, index=pd.Index(["cell{}-{}".format(i, i % 2) for i in range(n_cells)]))
+base_configs = {"filter_decontaminated_cells_min_genes": 20, "n_highly_variable_genes": 500, "n_latent": 10, "scvi_max_epochs": 10,
+    "umap_min_dist": 0.5}
+
+def run_sample(configs, checkpoints):
+    # the outputs of the sample: a data frame of the per-cell results and the late-stage embedding
+    decontx = checkpoints.stage("decontx", {"counts": counts, "cells": obs.index, "batch": obs["batch"].values})
+    if decontx.restored:
+        contamination = decontx.values["contamination"]
+        decontx.restore_file("model", os.path.join(data_dir, "decontx_model.npy"))
+    else:
+        totals = np.asarray(counts.sum(axis=1)).ravel()
+        contamination = np.clip(1 - totals / totals.max(), 0, 0.5)
+        np.save(os.path.join(data_dir, "decontx_model.npy"), np.outer(contamination[:100], np.ones(100)))
+        time.sleep(stage_sec)
+        decontx.save({"contamination": contamination}, files={"model": os.path.join(data_dir, "decontx_model.npy")})
+    decontaminated = sparse.diags(1 - contamination) @ counts
+    annotation = checkpoints.stage("annotation", {"decontx": decontx, "obs": obs}, configs, ["filter_decontaminated_cells_min_genes",
+        "n_highly_variable_genes"])
+    if annotation.restored:
+        cells, genes, labels = annotation.values["cells"], annotation.values["genes"], annotation.values["labels"]
+    else:
+        cells = np.where(np.asarray((decontaminated > 0).sum(axis=1)).ravel() >= configs["filter_decontaminated_cells_min_genes"])[0]
+        annotation.add_to_log("Removed {} cells with total decontaminated counts below filter_decontaminated_cells_min_genes={}".format(
+            n_cells - len(cells), configs["filter_decontaminated_cells_min_genes"]))
+        x = decontaminated[cells]
+        mean = np.asarray(x.mean(axis=0)).ravel()
+        var = np.asarray(x.multiply(x).mean(axis=0)).ravel() - mean ** 2
+        genes = np.sort(np.argsort(-var)[:configs["n_highly_variable_genes"]])
+        labels = np.asarray(x[:, genes].argmax(axis=1)).ravel() % 10
+        time.sleep(stage_sec)
+        annotation.save({"cells": cells, "genes": genes, "labels": labels})
+    x = np.log1p(decontaminated[cells][:, genes].toarray())
+    model = checkpoints.stage("scvi_batch_key_batch", {"annotation": annotation}, configs, ["n_latent", "scvi_max_epochs"])
+    if model.restored:
+        latent = model.values["latent"]
+    else:
+        u, s, _ = np.linalg.svd(x - x.mean(axis=0), full_matrices=False)
+        latent = u[:, :configs["n_latent"]] * s[:configs["n_latent"]]
+        time.sleep(stage_sec * 2)
+        model.save({"latent": latent})
+    doublets = checkpoints.stage("doublets", {"annotation": annotation, "batches": obs["batch"].values[cells]})
+    if doublets.restored:
+        scores = doublets.values["scores"]
+    else:
+        projection = x @ np.random.default_rng(1).standard_normal((x.shape[1], 20))
+        scores = np.linalg.norm(projection - projection.mean(axis=0), axis=1)
+        scores = scores / scores.max()
+        time.sleep(stage_sec)
+        doublets.save({"scores": scores})
+    # the late stage always runs
+    neighbors = np.argsort(latent @ latent[:200].T, axis=1)[:, -5:]
+    embedding = latent[neighbors].mean(axis=1)[:, :2] * (1 - configs["umap_min_dist"])
+    return pd.DataFrame({"label": labels, "doublet_score": scores, "contamination": contamination[cells]}, index=obs.index[cells]), embedding
+
+def timed_run(configs, cache_dir, enabled=True):
+    checkpoints = StageCheckpoints(logger, cache_dir=cache_dir, s3_dir=s3_dir, enabled=enabled)
+    start = time.time()
+    outputs = run_sample(configs, checkpoints)
+    return time.time() - start, outputs, checkpoints.stages
+
+def check_same(a, b):
+    pd.testing.assert_frame_equal(a[0], b[0])
+    assert np.array_equal(a[1], b[1])
+
+cache_dir = os.path.join(working_dir, "cache")
+print("{} cells, {} genes; {:.1f} sec per stage (2x for the model)".format(n_cells, n_genes, stage_sec))
+nocache_sec, nocache_outputs, _ = timed_run(base_configs, cache_dir, enabled=False)
+print("without checkpoints: {:.1f} sec".format(nocache_sec))
+first_sec, first_outputs, _ = timed_run(base_configs, cache_dir)
+check_same(first_outputs, nocache_outputs)
+print("first run (saving the checkpoints): {:.1f} sec (overhead {:.1f} sec)".format(first_sec, first_sec - nocache_sec))
+
+for change, expected_ran in [({"umap_min_dist": 0.3}, []),
+        ({"n_highly_variable_genes": 400}, ["annotation", "scvi_batch_key_batch", "doublets"]),
+        ({"n_latent": 8}, ["scvi_batch_key_batch"])]:
+    configs = dict(base_configs, **change)
+    sec, outputs, stages = timed_run(configs, cache_dir)
+    ran = [name for name in stages if stages[name] == "ran"]
+    assert ran == expected_ran, "{}: ran {}".format(change, ran)
+    _, expected_outputs, _ = timed_run(configs, cache_dir, enabled=False)
+    check_same(outputs, expected_outputs)
+    print("rerun after changing {}: {:.1f} sec ({:.1f}x); stages that ran: {}".format(", ".join(change), sec, nocache_sec / sec,
+        ", ".join(ran) or "none"))
+
+# another node: the checkpoints are restored from the object store
+configs = dict(base_configs, umap_min_dist=0.3)
+sec, outputs, stages = timed_run(configs, os.path.join(working_dir, "cache_other_node"))
+assert all([stages[name] == "restored" for name in stages])
+_, expected_outputs, _ = timed_run(configs, cache_dir, enabled=False)
+check_same(outputs, expected_outputs)
+print("rerun on a node with an empty local cache (restored from the object store): {:.1f} sec ({:.1f}x)".format(sec, nocache_sec / sec))
+shutil.rmtree(working_dir, ignore_errors=True)
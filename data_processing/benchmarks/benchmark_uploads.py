@@ -0,0 +1,83 @@
+## Benchmarks the uploads of a process_sample.py run: synchronous uploads at the end of the script (as it used to do) vs. the UploadQueue in uploads.py
+## (each output is uploaded in the background as soon as it is written). The run is replayed with the outputs of process_sample.py (configs, decontX model,
+## totalVI and scVI model zips, h5ad file, log file) of the given sizes and with the steps that produce them simulated by sleeping for the given durations;
+## the files are uploaded to a throttled fake object store (ThrottledStore in fake_store.py: a LocalStore with a latency per request and a bandwidth per connection).
+## A second run of the queue re-uploads the same outputs in order to check that unchanged files are skipped (by their md5 etag).
+## Run as follows: python benchmark_uploads.py <working_dir> <latency_sec> <bandwidth_mb_per_sec> <h5ad_mb> <model_mb> <decontx_mb> <step_sec>
+## Example: python benchmark_uploads.py /tmp/uploads_benchmark 0.2 20 200 50 30 5
+
+import os
+import sys
+import time
+import shutil
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+latency = float(sys.argv[2])
+bandwidth = float(sys.argv[3]) * 1024 * 1024
+h5ad_mb = float(sys.argv[4])
+model_mb = float(sys.argv[5])
+decontx_mb = float(sys.argv[6])
+step_sec = float(sys.argv[7])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+
+import s3_utils
+from uploads import UploadQueue
+from logger import SimpleLogger
+from fake_store import ThrottledStore, install_store
+
+def write_output(path, size_mb, seed):
+    # random (incompressible) content
+    with open(path, "wb") as fp:
+        fp.write(np.random.default_rng(seed).bytes(int(size_mb * 1024 * 1024)))
+
+def process_sample_run(data_dir, s3_output_dir, logger, uploads=None):
+    # the outputs of process_sample.py in the order in which they are written; upload(files) is either synchronous or queued
+    def upload(files):
+        if uploads is None:
+            s3_utils.s3_sync(data_dir, s3_output_dir, files, only_if_changed=True)
+        else:
+            uploads.submit(data_dir, s3_output_dir, files)
+    outputs = [("configs.txt", 0.01, []), ("decontx_model.RData", decontx_mb, ["decontX"]), ("totalvi_model.zip", model_mb, ["totalVI"]),
+        ("scvi_model.zip", model_mb, ["scVI"]), ("processed.h5ad", h5ad_mb, ["scrublet", "celltypist", "umap"])]
+    for f, size_mb, steps in outputs:
+        for step in steps:
+            time.sleep(step_sec)
+        write_output(os.path.join(data_dir, f), size_mb, len(f))
+        # the script used to upload all the outputs but the configs at the end
+        if uploads is not None or f == "configs.txt":
+            upload(f)
+    if uploads is None:
+        upload(["processed.h5ad"])
+        upload(["scvi_model.zip", "totalvi_model.zip"])
+        upload(["decontx_model.RData"])
+    else:
+        uploads.wait()
+    logging_file = os.path.join(data_dir, "log.txt")
+    write_output(logging_file, 0.01, 0)
+    s3_utils.s3_sync(data_dir, s3_output_dir, "log.txt", only_if_changed=True)
+
+store = ThrottledStore(os.path.join(working_dir, "bucket"), latency, bandwidth, etags=True)
+install_store(store)
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+total_mb = h5ad_mb + 2 * model_mb + decontx_mb
+print("outputs: {:.0f} MB; latency {} sec, {} MB/sec per connection, {} sec per pipeline step (7 steps)".format(total_mb, latency, sys.argv[3], step_sec))
+results = {}
+for name in ["synchronous uploads at the end", "upload queue", "upload queue (unchanged outputs)"]:
+    data_dir = os.path.join(working_dir, name.split(" (")[0].replace(" ", "_"))
+    os.makedirs(data_dir, exist_ok=True)
+    s3_output_dir = "s3://immuneaging/processed_samples/{}/v1/".format(name.split(" (")[0].replace(" ", "_"))
+    store.n_uploads = 0
+    start = time.time()
+    process_sample_run(data_dir, s3_output_dir, logger, None if name.startswith("synchronous") else UploadQueue(logger, max_concurrency=4))
+    results[name] = time.time() - start
+    print("{}: {:.2f} sec, {} uploads".format(name, results[name], store.n_uploads))
+
+compute_sec = 7 * step_sec
+print("wall time saved by the upload queue: {:.2f} sec (time spent on uploads after the last step: {:.2f} -> {:.2f} sec)".format(
+    results["synchronous uploads at the end"] - results["upload queue"], results["synchronous uploads at the end"] - compute_sec, results["upload queue"] - compute_sec))
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,118 @@
+## Benchmarks running a batch of jobs in a warm worker (warm_worker.py: the jobs are forked from one process that imported the
+## libraries and loaded the models once) vs. one python process per job (as in the .sh files written by generate_processing_scripts.py).
+## The jobs are synthetic: each imports numpy and pandas plus a stub module whose import takes import_sec (standing in for the rest
+## of the stack: scanpy, scvi-tools, torch, celltypist, scirpy), loads a pickled model of model_mb MB through warm_cache.get_resident
+## (as utils.get_celltypist_model does with the celltypist models), and then works for work_sec. Reports the makespan of the batch,
+## the overhead per job and the startup cost of the warm worker, and checks that the outputs of the jobs are the same in both modes
+## and that a job cannot change the state seen by the next one.
+## Run as follows: python benchmark_warm_worker.py <working_dir> <n_jobs> <import_sec> <model_mb> <work_sec>
+## Example: python benchmark_warm_worker.py /tmp/warm_worker_benchmark 20 4 200 0.5
+
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_jobs = int(sys.argv[2])
+import_sec = float(sys.argv[3])
+model_mb = float(sys.argv[4])
+work_sec = float(sys.argv[5])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+sys.path.append(working_dir)
+
+from warm_cache import get_resident
+from warm_worker import WarmWorker
+
+# the stub for the rest of the stack
+with open(os.path.join(working_dir, "heavy_stack_stub.py"), "w") as f:
+    f.write("import time\ntime.sleep({})\nsettings = {{}}\n".format(import_sec))
+
+model_file = os.path.join(working_dir, "model.pkl")
+with open(model_file, "wb") as f:
+    pickle.dump({"coef": np.random.rand(int(model_mb * 1024 * 1024 / 8 / 1000), 1000)}, f)
+
+def load_model(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+# the job: <configs_file>; writes <configs_file>.out with a result and the state it found
+job_script = os.path.join(working_dir, "job.py")
+with open(job_script, "w") as f:
+    f.write('''
+import os, sys, json, time, pickle
+sys.path.append({scripts_dir!r})
+sys.path.append({working_dir!r})
+import numpy as np
+import pandas as pd
+import heavy_stack_stub
+from warm_cache import get_resident
+configs_file = sys.argv[1]
+with open(configs_file) as f:
+    configs = json.load(f)
+def load():
+    with open(configs["model_file"], "rb") as f:
+        return pickle.load(f)
+model = get_resident(("model", configs["model_file"]), load)
+# state left behind by a previous job would show here
+leaked = dict(heavy_stack_stub.settings)
+heavy_stack_stub.settings["job"] = configs["job"]
+os.environ["IA_BENCHMARK_JOB"] = str(configs["job"])
+rng = np.random.default_rng(configs["job"])
+start = time.time()
+result = 0.0
+while time.time() - start < {work_sec}:
+    result += float(rng.random(1000) @ model["coef"][:1000, 0])
+with open(configs_file + ".out", "w") as f:
+    json.dump({{"model_sum": float(model["coef"][:10].sum()), "leaked": leaked}}, f)
+'''.format(scripts_dir=scripts_dir, working_dir=working_dir, work_sec=work_sec))
+
+configs_files = []
+for i in range(n_jobs):
+    configs_files.append(os.path.join(working_dir, "job{}.configs.txt".format(i)))
+    with open(configs_files[-1], "w") as f:
+        json.dump({"job": i, "model_file": model_file}, f)
+commands = [[sys.executable, job_script, fn] for fn in configs_files]
+
+def outputs():
+    results = []
+    for fn in configs_files:
+        with open(fn + ".out") as f:
+            results.append(json.load(f))
+        os.remove(fn + ".out")
+    return results
+
+print("{} jobs; import of {:.1f} sec (+ numpy and pandas), model of {:.0f} MB, {:.1f} sec of work per job".format(n_jobs, import_sec,
+    model_mb, work_sec))
+start = time.time()
+for command in commands:
+    subprocess.run(command, check=True)
+cold_sec = time.time() - start
+cold_outputs = outputs()
+print("one process per job: {:.1f} sec ({:.2f} sec of overhead per job)".format(cold_sec, cold_sec / n_jobs - work_sec))
+
+start = time.time()
+worker = WarmWorker(["numpy", "pandas", "heavy_stack_stub"], preload=lambda configs: get_resident(("model", configs["model_file"]),
+    lambda: load_model(configs["model_file"])))
+exit_codes = worker.run(commands)
+warm_sec = time.time() - start
+assert exit_codes == [0] * n_jobs
+warm_outputs = outputs()
+assert warm_outputs == cold_outputs
+assert all([len(o["leaked"]) == 0 for o in warm_outputs]) and "IA_BENCHMARK_JOB" not in os.environ
+print("warm worker: {:.1f} sec ({:.2f}x); startup {:.1f} sec, preloading {:.1f} sec, {:.2f} sec of overhead per job".format(warm_sec,
+    cold_sec / warm_sec, worker.startup_sec, worker.preload_sec, (warm_sec - worker.startup_sec - worker.preload_sec) / n_jobs - work_sec))
+# the number of jobs from which the warm worker is faster
+overhead_cold = cold_sec / n_jobs - work_sec
+overhead_warm = (warm_sec - worker.startup_sec - worker.preload_sec) / n_jobs - work_sec
+if overhead_cold > overhead_warm:
+    print("the startup of the warm worker is amortized after {:.1f} jobs".format((worker.startup_sec + worker.preload_sec) / (overhead_cold - overhead_warm)))
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,81 @@
+## Benchmarks the zarr output format in zarr_store.py vs. the lzf-compressed h5ad files, on a synthetic processed sample: writing (lzf h5ad vs. zarr
+## with the chunks of X and the layers compressed concurrently), uploading and downloading (one object vs. the chunk files, transferred concurrently)
+## and partial reads of an obs column, an embedding and a range of rows (H5adReader vs. ZarrReader, both reading from the object store).
+## The object store is a throttled fake (ThrottledStore in fake_store.py: a LocalStore with a latency per request and a bandwidth per connection).
+## Also checks the round trips h5ad -> zarr -> h5ad (identical to the original) and that the parts read by ZarrReader are identical to those read by
+## H5adReader, with the checks of check_zarr_output.py (which runs them on its own, without the object store).
+## Run as follows: python benchmark_zarr_output.py <working_dir> <n_cells> <n_genes> <latency_sec> <bandwidth_mb_per_sec>
+## Example: python benchmark_zarr_output.py /tmp/zarr_output_benchmark 50000 10000 0.05 50
+
+import os
+import sys
+import time
+import shutil
+import warnings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+n_cells = int(sys.argv[2])
+n_genes = int(sys.argv[3])
+latency = float(sys.argv[4])
+bandwidth = float(sys.argv[5]) * 1024 * 1024
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+warnings.simplefilter("ignore")
+
+from s3_utils import s3_cp, s3_sync
+from h5ad_reader import H5adReader
+from zarr_store import ZarrReader, write_zarr, list_zarr_files
+from uploads import UploadQueue
+from logger import SimpleLogger
+from check_zarr_output import make_sample, assert_same_part, get_parts, check_round_trips
+from fake_store import ThrottledStore, install_store, timed, dir_size
+
+adata = make_sample(n_cells, n_genes)
+data_dir = os.path.join(working_dir, "data")
+os.makedirs(data_dir)
+h5ad_file, zarr_file = "sample.h5ad", "sample.zarr"
+
+print("sample: {} cells x {} genes; latency {} sec, {} MB/sec per connection".format(n_cells, n_genes, latency, sys.argv[5]))
+_, h5ad_sec = timed(adata.write, os.path.join(data_dir, h5ad_file), compression="lzf")
+_, zarr_sec = timed(write_zarr, adata, os.path.join(data_dir, zarr_file))
+zarr_files = list_zarr_files(data_dir, zarr_file)
+print("write: h5ad {:.2f} sec ({:.1f} MB); zarr {:.2f} sec ({:.1f} MB in {} files)".format(h5ad_sec, os.path.getsize(os.path.join(data_dir, h5ad_file)) / 1024 / 1024,
+    zarr_sec, dir_size(os.path.join(data_dir, zarr_file)) / 1024 / 1024, len(zarr_files)))
+del adata
+
+# round trips
+check_round_trips(os.path.join(data_dir, h5ad_file), os.path.join(data_dir, zarr_file), working_dir)
+print("the round trips h5ad -> zarr -> h5ad are identical to the original")
+
+install_store(ThrottledStore(os.environ["IA_S3_LOCAL_ROOT"], latency, bandwidth))
+s3_dir = "s3://immuneaging/processed_samples/sample/v1/"
+logger = SimpleLogger(filename=os.path.join(working_dir, "benchmark.log"))
+
+def upload(files):
+    uploads = UploadQueue(logger)
+    uploads.submit(data_dir, s3_dir, files)
+    assert uploads.wait()
+_, h5ad_sec = timed(upload, [h5ad_file])
+_, zarr_sec = timed(upload, zarr_files)
+print("upload: h5ad {:.2f} sec; zarr {:.2f} sec".format(h5ad_sec, zarr_sec))
+_, h5ad_sec = timed(s3_cp, s3_dir + h5ad_file, os.path.join(working_dir, "download", h5ad_file))
+_, zarr_sec = timed(s3_sync, s3_dir + zarr_file, os.path.join(working_dir, "download", zarr_file))
+print("download: h5ad {:.2f} sec; zarr {:.2f} sec".format(h5ad_sec, zarr_sec))
+
+parts = get_parts(n_cells)
+print("{:<12} {:>28} {:>28}".format("part", "bytes read h5ad/zarr (MB)", "time h5ad/zarr (sec)"))
+for name, read in parts:
+    results = []
+    for reader_class, path in [(H5adReader, s3_dir + h5ad_file), (ZarrReader, s3_dir + zarr_file)]:
+        start = time.time()
+        with reader_class(path) as reader:
+            results.append((read(reader), reader.fileobj.bytes_read, time.time() - start))
+    (h5ad_part, h5ad_bytes, h5ad_sec), (zarr_part, zarr_bytes, zarr_sec) = results
+    assert_same_part(h5ad_part, zarr_part)
+    print("{:<12} {:>28} {:>28}".format(name, "{:.2f} / {:.2f}".format(h5ad_bytes / 1024 / 1024, zarr_bytes / 1024 / 1024),
+        "{:.2f} / {:.2f}".format(h5ad_sec, zarr_sec)))
+print("the parts read from zarr are identical to those read from h5ad")
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,110 @@
+## Calls the helpers of base_utils.py (the configs, versions, S3 transfers, sample sheet and log helpers that were moved out of utils.py),
+## so that a name the helpers use but base_utils.py does not import fails here rather than in the middle of a pipeline run; importing
+## the module does not catch these. The helpers run against a fake bucket on the local filesystem (see IA_S3_LOCAL_ROOT in s3_utils.py)
+## and a local snapshot of the sample sheet with a synthetic Samples tab (see IA_SHEET_OFFLINE in sheet_cache.py). Fails as well if
+## calling the helpers imported any of the heavy modules in benchmark_import_time.HEAVY_MODULES. Also run by benchmark_import_time.py.
+## Run as follows: python check_base_utils.py <working_dir>
+## Example: python check_base_utils.py /tmp/base_utils_check
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+working_dir = os.path.abspath(sys.argv[1])
+
+shutil.rmtree(working_dir, ignore_errors=True)
+os.makedirs(working_dir)
+os.environ["IA_S3_LOCAL_ROOT"] = os.path.join(working_dir, "bucket")
+os.environ["IA_CACHE_DIR"] = os.path.join(working_dir, "cache")
+os.environ["IA_SHEET_OFFLINE"] = "1"
+os.chdir(working_dir)
+
+import base_utils
+from logger import SimpleLogger
+from s3_utils import s3_cp, s3_exists
+
+# as in benchmark_import_time.py
+HEAVY_MODULES = ["anndata", "scanpy", "scvi", "torch", "celltypist", "scirpy", "statsmodels", "scipy", "utils"]
+
+logger = SimpleLogger(filename=os.path.join(working_dir, "check.log"))
+data_dir = os.path.join(working_dir, "data")
+os.makedirs(data_dir)
+
+keys_file = os.path.join(working_dir, "keys.sh")
+with open(keys_file, "w") as f:
+    f.write("export AWS_ACCESS_KEY_ID=test\nexport AWS_SECRET_ACCESS_KEY=test\n")
+assert base_utils.set_access_keys(keys_file, return_dict=True) == {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test"}
+base_utils.set_access_keys(keys_file)
+
+assert base_utils.get_date_from_time(base_utils.get_current_time()) == time.strftime(base_utils.DATE_FORMAT)
+configs = {"donor": "D1", "seq_run": "001", "n_latent": 10, "code_path": "/code"}
+with open(os.path.join(working_dir, "configs.txt"), "w") as f:
+    json.dump(configs, f)
+assert base_utils.load_configs(os.path.join(working_dir, "configs.txt")) == configs
+
+# configs versions: the first configs are v1, the same configs up to a variable key are v1 again, and other configs are v2
+configs_dir = "s3://immuneaging/aligned_libraries/configs"
+assert base_utils.get_configs_version_alignment(configs, data_dir, configs_dir, "align_library.", ["code_path"]) == "v1"
+assert base_utils.get_configs_version_alignment(dict(configs, code_path="/other"), data_dir, configs_dir, "align_library.", ["code_path"]) == "v1"
+assert base_utils.get_configs_version_alignment(dict(configs, n_latent=8), data_dir, configs_dir, "align_library.", ["code_path"]) == "v2"
+
+# processed outputs: get_configs_status finds the version of the configs next to an existing output
+sample_path = "s3://immuneaging/processed_samples/S1_GEX"
+assert base_utils.get_configs_status(configs, sample_path, "process_sample.configs.S1_GEX", ["code_path"], data_dir) == [True, "v1"]
+configs_file = os.path.join(data_dir, "process_sample.configs.S1_GEX.v1.txt")
+with open(configs_file, "w") as f:
+    json.dump(configs, f)
+open(os.path.join(data_dir, "S1_GEX.unstim.v1.h5ad"), "w").close()
+s3_cp(configs_file, sample_path + "/v1/")
+s3_cp(os.path.join(data_dir, "S1_GEX.unstim.v1.h5ad"), sample_path + "/v1/")
+assert base_utils.get_configs_status(configs, sample_path, "process_sample.configs.S1_GEX", ["code_path"], data_dir) == [False, "v1"]
+assert base_utils.get_configs_status(dict(configs, n_latent=8), sample_path, "process_sample.configs.S1_GEX", ["code_path"], data_dir) == [True, "v2"]
+assert base_utils.get_latest_object_version(keys_file, sample_path) == "v1"
+
+# transfers
+upload_dir = os.path.join(working_dir, "upload")
+os.makedirs(upload_dir)
+open(os.path.join(upload_dir, "a.log"), "w").close()
+base_utils.aws_sync(upload_dir, "s3://immuneaging/logs", "a.log", logger)
+assert s3_exists("s3://immuneaging/logs/a.log")
+base_utils.aws_sync("s3://immuneaging/logs", data_dir, "a.log", logger, only_if_changed=True)
+assert base_utils.dir_and_files_exist(data_dir, [os.path.join(data_dir, "a.log")])
+assert not base_utils.dir_and_files_exist(data_dir, [os.path.join(data_dir, "b.log")])
+with open(os.path.join(upload_dir, "table.csv"), "w") as f:
+    f.write("a,b\n1,2\n")
+base_utils.aws_sync(upload_dir, "s3://immuneaging/tables", "table.csv", logger)
+assert base_utils.read_csv_from_aws(data_dir, "s3://immuneaging/tables", "table.csv", logger)["b"].tolist() == [2]
+with zipfile.ZipFile(os.path.join(working_dir, "upload.zip"), "w") as zipf:
+    base_utils.zipdir(upload_dir, zipf)
+    assert sorted(zipf.namelist()) == ["upload/a.log", "upload/table.csv"]
+
+# renaming TLN samples to LLN
+open(os.path.join(data_dir, "D1-TLN_GEX.v1.h5ad"), "w").close()
+s3_cp(os.path.join(data_dir, "D1-TLN_GEX.v1.h5ad"), "s3://immuneaging/processed_samples/D1-TLN_GEX/v1/")
+base_utils.handle_sample_tln_to_lln_renaming("D1")
+assert s3_exists("s3://immuneaging/processed_samples/D1-LLN_GEX/v1/D1-LLN_GEX.v1.h5ad")
+
+# the sample sheet
+import pandas as pd
+from sheet_cache import get_sheet_snapshot
+samples = pd.DataFrame({"Sample_ID": ["S1", "S2", "S3"], "Donor ID": ["D1", "D1", "D2"], "Seq run": [1, 1, 2],
+    "Organ": ["SPL", "BMA", None], "GEX lib": ["L1", "L2", "L3"]})
+get_sheet_snapshot()._save({"Samples": samples}, time.time())
+pd.testing.assert_frame_equal(base_utils.read_immune_aging_sheet("Samples"), samples)
+assert base_utils.get_sheet_version("Samples")[-1] is not None
+assert base_utils.get_all_donors() == [{"Donor ID": "D1", "Seq run": "1"}, {"Donor ID": "D2", "Seq run": "2"}]
+assert list(base_utils.get_tissues_or_compartments(keys_file, "tissue", skip_tissues=["BMA"])) == ["SPL"]
+assert base_utils.get_tissues_or_compartments(keys_file, "compartment") == ["T", "B", "Myeloid", "Other"]
+
+assert base_utils.strip_integration_markers("AACTGTCAAGTCGT-1_CZI-IA11512684-1-2-10") == "AACTGTCAAGTCGT-1_CZI-IA11512684"
+base_utils.draw_separator_line()
+
+heavy = [m for m in HEAVY_MODULES if m in sys.modules]
+assert len(heavy) == 0, "calling the helpers of base_utils.py imported {}".format(", ".join(heavy))
+print("all the helpers of base_utils.py ran")
+os.chdir("/")
+shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,108 @@
+## Equality checks of the zarr output format in zarr_store.py, on a (small) synthetic processed sample written to local files: the round trips
+## h5ad -> zarr -> h5ad (write_zarr, h5ad_to_zarr and zarr_to_h5ad, read back with anndata) are identical to the original, and the parts read by
+## ZarrReader (an obs column, an embedding, a range of rows of a layer) are identical to those read by H5adReader. The functions are also used by
+## benchmark_zarr_output.py, which runs the same checks on a larger sample and against a throttled object store.
+## Run as follows: python check_zarr_output.py <working_dir> [<n_cells> <n_genes>]
+## Example: python check_zarr_output.py /tmp/zarr_output_check 2000 500
+
+import os
+import sys
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import anndata
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from h5ad_reader import H5adReader
+from zarr_store import ZarrReader, write_zarr, h5ad_to_zarr, zarr_to_h5ad
+
+def make_sample(n_cells, n_genes, seed=0):
+    # synthetic processed sample, with the kinds of elements the processed samples have (categorical and numeric obs columns,
+    # layers, obsm arrays and data frames, obsp, uns)
+    rng = np.random.default_rng(seed)
+    X = scipy.sparse.random(n_cells, n_genes, density=0.05, format="csr", random_state=seed, data_rvs=lambda k: rng.poisson(3, k) + 1).astype(np.float32)
+    obs = pd.DataFrame({
+        "donor_id": pd.Categorical(rng.choice(["D1", "D2", "D3"], n_cells)),
+        "total_counts": np.asarray(X.sum(axis=1)).ravel(),
+        "leiden": pd.Categorical(rng.choice([str(i) for i in range(30)], n_cells)),
+        "celltypist_predicted_labels.1": pd.Categorical(rng.choice(["T", "B", "Mono", "NK"], n_cells)),
+    }, index=["AAACCTG{}-1_lib1".format(i) for i in range(n_cells)])
+    adata = anndata.AnnData(X, obs=obs, var=pd.DataFrame({"n_cells": rng.integers(0, 1000, n_genes)}, index=["gene{}".format(i) for i in range(n_genes)]))
+    adata.layers["raw_counts"] = X.copy()
+    adata.layers["decontaminated_counts"] = X.copy()
+    for key, dim in [("X_pca", 50), ("X_scVI", 10), ("X_umap_pca", 2), ("X_umap_scvi", 2)]:
+        adata.obsm[key] = rng.random((n_cells, dim)).astype(np.float32)
+    adata.obsm["protein_expression"] = pd.DataFrame(rng.poisson(10, (n_cells, 20)).astype(float), index=adata.obs_names, columns=["p{}".format(i) for i in range(20)])
+    neighbors = rng.integers(0, n_cells, (n_cells, 10))
+    adata.obsp["connectivities"] = scipy.sparse.csr_matrix((rng.random(neighbors.size), neighbors.ravel(), np.arange(0, neighbors.size + 1, 10)), shape=(n_cells, n_cells))
+    adata.uns["leiden_colors"] = np.array(["#1f77b4"] * 30, dtype=object)
+    adata.uns["neighbors"] = {"params": {"n_neighbors": 15, "method": "umap"}}
+    return adata
+
+def assert_same(a, b):
+    pd.testing.assert_frame_equal(a.obs, b.obs)
+    pd.testing.assert_frame_equal(a.var, b.var)
+    assert (a.X != b.X).nnz == 0 and a.X.dtype == b.X.dtype
+    assert set(a.layers.keys()) == set(b.layers.keys()) and all([(a.layers[k] != b.layers[k]).nnz == 0 for k in a.layers])
+    assert set(a.obsm.keys()) == set(b.obsm.keys())
+    for k in a.obsm:
+        if isinstance(a.obsm[k], pd.DataFrame):
+            pd.testing.assert_frame_equal(a.obsm[k], b.obsm[k])
+        else:
+            assert np.array_equal(a.obsm[k], b.obsm[k])
+    assert set(a.obsp.keys()) == set(b.obsp.keys()) and all([(a.obsp[k] != b.obsp[k]).nnz == 0 for k in a.obsp])
+    assert np.array_equal(a.uns["leiden_colors"], b.uns["leiden_colors"]) and a.uns["neighbors"]["params"] == b.uns["neighbors"]["params"]
+
+def assert_same_part(a, b):
+    # parts read by H5adReader and ZarrReader (see PARTS)
+    if isinstance(a, pd.DataFrame):
+        pd.testing.assert_frame_equal(a, b)
+    elif isinstance(a, anndata.AnnData):
+        pd.testing.assert_frame_equal(a.obs, b.obs)
+        assert set(a.layers.keys()) == set(b.layers.keys()) and all([(a.layers[k] != b.layers[k]).nnz == 0 for k in a.layers])
+    else:
+        assert np.array_equal(a, b)
+
+def get_parts(n_cells):
+    # (name, read function) of the parts read by the partial readers
+    rows = np.arange(n_cells // 2, n_cells // 2 + n_cells // 20)
+    return [
+        ("obs column", lambda r: r.read_obs(["leiden"])),
+        ("embedding", lambda r: r.read_obsm("X_umap_scvi")),
+        ("{} rows".format(len(rows)), lambda r: r.read(X=False, obsm=[], layers=["raw_counts"], rows=rows)),
+    ]
+
+def check_round_trips(h5ad_path, zarr_path, working_dir):
+    # zarr_path is the store written from the same object by write_zarr
+    converted_zarr, converted_h5ad = os.path.join(working_dir, "converted.zarr"), os.path.join(working_dir, "converted.h5ad")
+    h5ad_to_zarr(h5ad_path, converted_zarr)
+    zarr_to_h5ad(converted_zarr, converted_h5ad)
+    original = anndata.read_h5ad(h5ad_path)
+    assert_same(original, anndata.read_zarr(zarr_path))
+    assert_same(original, anndata.read_zarr(converted_zarr))
+    assert_same(original, anndata.read_h5ad(converted_h5ad))
+
+def check_parts(h5ad_path, zarr_path, n_cells):
+    for _, read in get_parts(n_cells):
+        with H5adReader(h5ad_path) as h5ad_reader, ZarrReader(zarr_path) as zarr_reader:
+            assert_same_part(read(h5ad_reader), read(zarr_reader))
+
+if __name__ == "__main__":
+    working_dir = os.path.abspath(sys.argv[1])
+    n_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    n_genes = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    shutil.rmtree(working_dir, ignore_errors=True)
+    os.makedirs(working_dir)
+    warnings.simplefilter("ignore")
+    adata = make_sample(n_cells, n_genes)
+    h5ad_path, zarr_path = os.path.join(working_dir, "sample.h5ad"), os.path.join(working_dir, "sample.zarr")
+    adata.write(h5ad_path, compression="lzf")
+    write_zarr(adata, zarr_path)
+    check_round_trips(h5ad_path, zarr_path, working_dir)
+    print("the round trips h5ad -> zarr -> h5ad are identical to the original")
+    check_parts(h5ad_path, zarr_path, n_cells)
+    print("the parts read from zarr are identical to those read from h5ad")
+    shutil.rmtree(working_dir, ignore_errors=True)
@@ -0,0 +1,82 @@
+## The throttled fake object store and the timing helpers shared by the benchmarks. ThrottledStore is a LocalStore (see IA_S3_LOCAL_ROOT in
+## s3_utils.py) where every request takes latency seconds and every transfer is limited to the given bandwidth per connection; it counts the
+## downloads and uploads, tracks the bytes downloaded ahead of the reader (see handed) and can truncate the first download of one object
+## (corrupt_key) in order to exercise the verification of the downloads. Not a benchmark on its own.
+## Usage: from fake_store import ThrottledStore, install_store, timed, dir_size
+
+import os
+import time
+import threading
+
+from s3_utils import LocalStore, S3Object, md5_etag
+import s3_utils
+
+class ThrottledStore(LocalStore):
+    # every request takes latency seconds and every transfer is limited to bandwidth (bytes per second); with etags=True objects have
+    # md5 etags as in S3 (LocalStore gives none); the first download of corrupt_key is truncated
+    def __init__(self, root, latency, bandwidth, etags=False, corrupt_key=None):
+        super().__init__(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.etags = etags
+        self.corrupt_key = corrupt_key
+        self.n_downloads = 0
+        self.n_uploads = 0
+        self.ahead = 0
+        self.max_ahead = 0
+        self._lock = threading.Lock()
+
+    def head(self, bucket, key):
+        time.sleep(self.latency)
+        o = super().head(bucket, key)
+        if o is None or not self.etags:
+            return o
+        return S3Object(o.key, o.size, o.last_modified, md5_etag(self._path(bucket, key)))
+
+    def list_objects(self, bucket, prefix):
+        time.sleep(self.latency)
+        return super().list_objects(bucket, prefix)
+
+    def read_range(self, bucket, key, start, length):
+        data = super().read_range(bucket, key, start, length)
+        time.sleep(self.latency + len(data) / self.bandwidth)
+        return data
+
+    def download(self, bucket, key, local_path):
+        size = os.path.getsize(self._path(bucket, key))
+        with self._lock:
+            self.n_downloads += 1
+            self.ahead += size
+            self.max_ahead = max(self.max_ahead, self.ahead)
+        time.sleep(self.latency + size / self.bandwidth)
+        super().download(bucket, key, local_path)
+        if key == self.corrupt_key:
+            self.corrupt_key = None
+            # the file will be downloaded again
+            self.handed(size)
+            with open(local_path, "r+b") as fp:
+                fp.truncate(size // 2)
+
+    def upload(self, local_path, bucket, key):
+        with self._lock:
+            self.n_uploads += 1
+        time.sleep(self.latency + os.path.getsize(local_path) / self.bandwidth)
+        super().upload(local_path, bucket, key)
+
+    def handed(self, size):
+        # size bytes downloaded earlier were handed to the reader
+        with self._lock:
+            self.ahead -= size
+
+def install_store(store):
+    # makes store the object store of s3_utils (get_object_store), for the IA_S3_LOCAL_ROOT and access keys of the environment
+    s3_utils._store = store
+    s3_utils._store_key = (os.environ["IA_S3_LOCAL_ROOT"], os.environ.get("AWS_ACCESS_KEY_ID", ""), os.environ.get("AWS_SECRET_ACCESS_KEY", ""))
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def dir_size(path):
+    return sum([os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files])
@@ -29,6 +29,15 @@ VARIABLE_CONFIG_KEYS = ["donor",
 "s3_access_file",
 ]
 
+def get_aligner_resource_args():
+    # cores and memory of the aligner, when set by the scheduler (see alignment_scheduler.py); cellranger uses all of the node's otherwise
+    args = ""
+    if "IA_ALIGNER_LOCALCORES" in os.environ:
+        args += " --localcores={}".format(os.environ["IA_ALIGNER_LOCALCORES"])
+    if "IA_ALIGNER_LOCALMEM" in os.environ:
+        args += " --localmem={}".format(os.environ["IA_ALIGNER_LOCALMEM"])
+    return args
+
 def get_aligner_cmd(aligner, donor_id, seq_run, data_dir, data_dir_fastq, samples, cite_key, chemistry, GEX_lib = None, ADT_lib = None, HTO_lib = None, TCR_lib = None, BCR_lib = None, protein_panel = None):
     assert aligner == "cellranger" # no other option is currently implemented
     assert GEX_lib or TCR_lib or BCR_lib
@@ -116,7 +125,7 @@ def get_aligner_cmd(aligner, donor_id, seq_run, data_dir, data_dir_fastq, sample
         aligner_cmd = "{} vdj --id={} --fastqs={} --reference={} --sample={}".format(aligner_software_path, IR_lib_name, os.path.join(data_dir_fastq, IR_lib), aligner_vdj_file, IR_lib_name)
         aligned_data_dir = os.path.join(data_dir, IR_lib_name, "outs/")
 
-    return (aligner_cmd, aligned_data_dir, outputs_to_save)
+    return (aligner_cmd + get_aligner_resource_args(), aligned_data_dir, outputs_to_save)
 
 configs_dir_remote = "s3://immuneaging/aligned_libraries/configs/"
 configs_file_remote_prefix = "align_library."
@@ -143,9 +152,8 @@ output_file_exists = False
 logger_file_exists = False
 
 # check if aligned files are already on the server
-ls_cmd = 'aws s3 ls s3://immuneaging/aligned_libraries/{} --recursive'.format(configs_version)
-aligned_files = os.popen(ls_cmd).read()
-for f in aligned_files.rstrip().split('\n'):
+aligned_files = s3_list("s3://immuneaging/aligned_libraries/{}".format(configs_version))
+for f in aligned_files:
     j = f.split('/')[-1]
     if (lib_type == "GEX" and j == h5ad_file) or ((lib_type == "BCR" or lib_type == "TCR") and j == contigs_file):
         output_file = j
@@ -161,6 +169,8 @@ logger_file_path = os.path.join(data_dir, logger_file)
 if os.path.isfile(logger_file_path):
     os.remove(logger_file_path)
 logger = SimpleLogger(filename = logger_file_path)
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
 
 logger.add_to_log("Running align_library.py...")
 logger.add_to_log("Starting time: {}".format(get_current_time()))
@@ -211,11 +221,18 @@ chemistry = lib_chems_flat[0]
 logger.add_to_log("detected chemistry = {}".format(chemistry))
 
 logger.add_to_log("Downloading fastq files from S3...")
-# don't rely on 'aws s3 sync' commands which seem to be buggy in some cases; copy file if it doesn't exist on local.
-ls_cmd = 'aws s3 ls {0}'.format(site_s3_dir)
-ls = os.popen(ls_cmd).read()
+# don't rely on 'aws s3 sync' commands which seem to be buggy in some cases; the files are fetched in the background (see fastq_fetch.py)
+# while the alignment command is prepared, and interrupted downloads are resumed.
+site_s3_files = s3_ls(site_s3_dir)
 data_dir_fastq = os.path.join(data_dir, "fastq")
 os.system("mkdir -p " + data_dir_fastq)
+fastq_manifest = None
+if "fastq_md5_manifest" in configs:
+    manifest_file = os.path.join(data_dir, configs["fastq_md5_manifest"].split("/")[-1])
+    logger.add_to_log("Downloading the fastq checksums from {}...".format(configs["fastq_md5_manifest"]))
+    logger.add_to_log("aws response: {}".format(s3_cp(configs["fastq_md5_manifest"], manifest_file)))
+    fastq_manifest = read_md5_manifest(manifest_file)
+transfers = []
 for lib_id in lib_ids:
     if lib_id != "none":
         logger.add_to_log("Downloading fastq files from S3 for lib {}...".format(lib_id))
@@ -223,15 +240,24 @@ for lib_id in lib_ids:
         os.system("mkdir -p " + data_dir_lib)
         # for GEX libs, we need to grab _GEX, _ADT, _HTO, but for BCR/TCR we only need that one type
         lib_pattern = "{}_{}_{}.*{}.*.fastq.gz".format(donor_id, seq_run, lib_type, lib_id) if lib_type in ["BCR", "TCR"] else "{}_{}.*{}.*.fastq.gz".format(donor_id, seq_run, lib_id)
-        for i in re.split(' |\n',ls.rstrip()):
+        for i in site_s3_files:
             if re.search(lib_pattern, i):
-                f = os.path.join(data_dir_lib,i)
-                if os.path.isfile(f):
-                    logger.add_to_log("file {} is already in local.".format(f))
-                else:
-                    cp_cmd = 'aws s3 cp --no-progress {0} {1}'.format(os.path.join(site_s3_dir,i), data_dir_lib)
-                    logger.add_to_log("cp_cmd: {}".format(cp_cmd))
-                    logger.add_to_log("aws response: {}".format(os.popen(cp_cmd).read()))
+                logger.add_to_log("cp: {} -> {}".format(os.path.join(site_s3_dir,i), data_dir_lib))
+                transfers.append((os.path.join(site_s3_dir,i), os.path.join(data_dir_lib,i)))
+# the files of all the libraries are downloaded concurrently, in parts; files that are already in local are skipped
+fastq_fetcher = FastqFetcher(transfers, logger, manifest = fastq_manifest)
+if os.environ.get("IA_ALIGN_STAGE") == "fetch":
+    # only download the fastq files; the scheduler (see alignment_scheduler.py) runs the alignment later on
+    if not fastq_fetcher.wait():
+        msg = "Failed to download the fastq files. Terminating execution."
+        logger.add_to_log(msg, level="error")
+        print(msg)
+        sys.exit(1)
+    fastq_fetcher.close()
+    msg = "Done downloading the fastq files of library {}".format(lib_ids[0])
+    logger.add_to_log(msg)
+    print(msg)
+    sys.exit()
 
 logger.add_to_log("Preparing alignment command...")
 TCR_lib, BCR_lib, GEX_lib, ADT_lib, HTO_lib = None, None, None, None, None
@@ -258,10 +284,18 @@ alignment_cmd, aligned_data_dir, aligner_outputs_to_save = get_aligner_cmd(align
 alignment_exists = dir_and_files_exist(aligned_data_dir, aligner_outputs_to_save)
 prefix = "_".join([donor_id, seq_run, lib_type, lib_ids[0]])
 if alignment_exists:
+    fastq_fetcher.cancel()
     logger.add_to_log("Alignment outputs for the following command already exist:")
     logger.add_to_log("alignment_cmd:\n{}".format(alignment_cmd))
     logger.add_to_log("Skipping alignment.")
 else:
+    logger.add_to_log("Waiting for the fastq files...")
+    if not fastq_fetcher.wait():
+        msg = "Failed to download the fastq files. Terminating execution."
+        logger.add_to_log(msg, level="error")
+        print(msg)
+        sys.exit(1)
+    fastq_fetcher.close()
     logger.add_to_log("Running the following alignment command:\n{}".format(alignment_cmd))
     alignment_output = os.popen(alignment_cmd).read()
     alignment_exists = dir_and_files_exist(aligned_data_dir, aligner_outputs_to_save)
@@ -271,7 +305,7 @@ else:
             logger.add_to_log("Rerunning after changing chemistry argument...")
             # remove the output directory, which is required in order to prevent errors in a following execution of cellranger
             os.system("rm -r {}".format(os.path.join(data_dir, prefix)))
-            alignment_cmd = alignment_cmd[0:alignment_cmd.index("--chemistry=")] + "--chemistry=SC5P-R2"
+            alignment_cmd = alignment_cmd[0:alignment_cmd.index("--chemistry=")] + "--chemistry=SC5P-R2" + get_aligner_resource_args()
             logger.add_to_log("alignment_cmd:\n{}".format(alignment_cmd))
             logger.add_to_log("Output from aligner:\n" + os.popen(alignment_cmd).read())
             alignment_exists = dir_and_files_exist(aligned_data_dir, aligner_outputs_to_save)
@@ -282,7 +316,7 @@ if not alignment_exists:
     msg = "Not all alignment outputs were generated. Terminating execution."
     logger.add_to_log(msg, level="error")
     print(msg)
-    sys.exit()
+    sys.exit(1)
 
 logger.add_to_log("Uploading aligner outputs to S3...")
 for out in aligner_outputs_to_save:
@@ -298,10 +332,8 @@ for out in aligner_outputs_to_save:
         new_name = "{}.{}.csv".format(os.path.splitext(old_name)[0], configs_version)
         shutil.move(old_name, new_name)
         out_file = new_name.split("/")[-1]
-    sync_cmd = 'aws s3 sync --no-progress {0} s3://immuneaging/aligned_libraries/{1}/{2} --exclude "*" --include {3}'.format(data_dir, configs_version, prefix, out_file)
     logger.add_to_log("Uploading aligner output {}...".format(out_file))
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}".format(os.popen(sync_cmd).read()))
+    uploads.submit(data_dir, "s3://immuneaging/aligned_libraries/{}/{}".format(configs_version, prefix), out_file)
 
 if lib_type == "GEX":
     logger.add_to_log("Converting aligned data to h5ad...")
@@ -310,17 +342,15 @@ if lib_type == "GEX":
     adata.write(os.path.join(data_dir, h5ad_file), compression="lzf")
 
     logger.add_to_log("Uploading h5ad file to S3...")
-    sync_cmd = 'aws s3 sync --no-progress {0} s3://immuneaging/aligned_libraries/{1}/{2} --exclude "*" --include {3}'.format(data_dir, configs_version, prefix, h5ad_file)
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}".format(os.popen(sync_cmd).read()))
+    uploads.submit(data_dir, "s3://immuneaging/aligned_libraries/{}/{}".format(configs_version, prefix), h5ad_file)
 
+uploads.wait()
 msg = "Done aligning library {}".format(lib_ids[0])
 logger.add_to_log(msg)
 print(msg)
 
 # upload log file to S3
-cmd = 'aws s3 sync --no-progress {0} s3://immuneaging/aligned_libraries/{1}/{2} --exclude "*" --include {3}'.format(data_dir, configs_version, prefix, logger_file.split('/')[-1])
-os.system(cmd)
+s3_sync(data_dir, "s3://immuneaging/aligned_libraries/{}/{}".format(configs_version, prefix), logger_file.split('/')[-1])
 
 # remove fastq files
 os.system("rm -r {}".format(data_dir_fastq))
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+from typing import Dict, List, NamedTuple, Optional
+
+from resources import get_available_memory
+
+# Runs the library alignment jobs of a donor (see generate_library_alignment_script.py) concurrently on one node, instead of one
+# after the other with every cellranger call given all the cores of the node.
+# Every job runs align_library.py twice: first with IA_ALIGN_STAGE=fetch, which only downloads the fastq files of the library, then
+# as usual (the fastq files are then found in local), with the cores and memory of cellranger set by IA_ALIGNER_LOCALCORES and
+# IA_ALIGNER_LOCALMEM. Downloads (up to max_fetches at a time) thus overlap with the alignment of libraries that were downloaded
+# before. Once the fastq files of a library are in local, the cores and memory of its alignment are sized from their total size
+# (see size_alignment_job), and the alignments that are ready start, largest first, as long as the cores and memory they need are
+# free. A download starts only if the disk keeps min_free_disk_gb free after the outputs of the alignments in progress or waiting
+# (estimated as DISK_PER_INPUT_BYTE times the size of their fastq files) are written.
+#
+# Run as follows: python alignment_scheduler.py <jobs_file>
+# where jobs_file is the json file written by generate_library_alignment_script.py (a list of {"name", "lib_type", "work_dir",
+# "fastq_dir", "command"}); the output of every run of a job is written to alignment_scheduler.<fetch/align>.log in its work_dir.
+#
+# The following environment variables can be used to control the scheduler (all are optional):
+# IA_SCHED_CORES - number of cores to use (default all the cores of the node)
+# IA_SCHED_MEM_GB - memory to use, in GB (default the available memory of the node)
+# IA_SCHED_MAX_FETCHES - max number of libraries downloaded at a time (default 1; every download is itself concurrent, see fastq_fetch.py)
+# IA_SCHED_MIN_FREE_DISK_GB - disk space to keep free, in GB (default 50)
+
+# cellranger's minimum requirements (count with a human reference, vdj) and the cores given per GB of fastq files
+MIN_CORES = {"GEX": 8, "BCR": 4, "TCR": 4}
+MIN_MEM_GB = {"GEX": 64, "BCR": 16, "TCR": 16}
+MEM_GB_PER_CORE = 4
+CORES_PER_INPUT_GB = 0.5
+# cellranger's outputs and temporary files relative to the size of the fastq files
+DISK_PER_INPUT_BYTE = 3
+POLL_INTERVAL_SEC = 1
+
+class AlignmentJob(NamedTuple):
+    name: str
+    lib_type: str
+    work_dir: str
+    fastq_dir: str
+    command: List[str]
+
+class JobResources(NamedTuple):
+    cores: int
+    mem_gb: int
+
+def size_alignment_job(lib_type: str, input_bytes: int, cores: int, mem_gb: int) -> JobResources:
+    # resources of the alignment of a library with fastq files of the given total size, on a node with the given cores and memory
+    job_cores = max(MIN_CORES[lib_type], int(round(input_bytes / 1024 ** 3 * CORES_PER_INPUT_GB)))
+    job_cores = min(job_cores, cores)
+    job_mem_gb = min(max(MIN_MEM_GB[lib_type], job_cores * MEM_GB_PER_CORE), mem_gb)
+    return JobResources(job_cores, job_mem_gb)
+
+def dir_size(path: str) -> int:
+    return sum([os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files])
+
+def read_jobs(jobs_file: str) -> List[AlignmentJob]:
+    with open(jobs_file) as f:
+        return [AlignmentJob(**job) for job in json.load(f)]
+
+class AlignmentScheduler:
+    """
+    Runs the given alignment jobs (see above) and reports their timeline. run() returns the names of the jobs that failed.
+    """
+    def __init__(self, jobs: List[AlignmentJob], cores: Optional[int] = None, mem_gb: Optional[int] = None, max_fetches: Optional[int] = None,
+        min_free_disk_gb: Optional[float] = None):
+        if cores is None:
+            cores = int(os.environ.get("IA_SCHED_CORES", os.cpu_count()))
+        if mem_gb is None:
+            mem_gb = int(os.environ.get("IA_SCHED_MEM_GB", 0)) or int(get_available_memory() / 1024 ** 3)
+        if max_fetches is None:
+            max_fetches = int(os.environ.get("IA_SCHED_MAX_FETCHES", 1))
+        if min_free_disk_gb is None:
+            min_free_disk_gb = float(os.environ.get("IA_SCHED_MIN_FREE_DISK_GB", 50))
+        self.jobs = jobs
+        self.cores = cores
+        self.mem_gb = mem_gb
+        self.max_fetches = max_fetches
+        self.min_free_disk = min_free_disk_gb * 1024 ** 3
+        self.events = []
+
+    def _log(self, msg: str) -> None:
+        print("[{:8.1f}s] {}".format(time.time() - self.start_time, msg))
+        sys.stdout.flush()
+
+    def _start(self, job: AlignmentJob, stage: str, env: Dict[str, str]) -> subprocess.Popen:
+        os.makedirs(job.work_dir, exist_ok = True)
+        log = open(os.path.join(job.work_dir, "alignment_scheduler.{}.log".format(stage)), "w")
+        proc = subprocess.Popen(job.command, cwd = job.work_dir, env = dict(os.environ, **env), stdout = log, stderr = subprocess.STDOUT)
+        log.close()
+        self.events.append((job.name, stage, "start", time.time() - self.start_time))
+        return proc
+
+    def _free_disk(self, path: str) -> int:
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return shutil.disk_usage(path).free
+
+    def run(self) -> List[str]:
+        self.start_time = time.time()
+        to_fetch = list(self.jobs)
+        fetching = {}   # name -> (job, process)
+        ready = []      # (job, input bytes)
+        aligning = {}   # name -> (job, process, resources, input bytes)
+        failed = []
+        while len(to_fetch) + len(fetching) + len(ready) + len(aligning) > 0:
+            # downloads
+            pending_outputs = sum([DISK_PER_INPUT_BYTE * b for _, b in ready] + [DISK_PER_INPUT_BYTE * a[3] for a in aligning.values()])
+            while len(to_fetch) > 0 and len(fetching) < self.max_fetches:
+                job = to_fetch[0]
+                if len(fetching) + len(ready) + len(aligning) > 0 and self._free_disk(job.work_dir) - pending_outputs < self.min_free_disk:
+                    break
+                to_fetch.pop(0)
+                self._log("downloading the fastq files of {}".format(job.name))
+                fetching[job.name] = (job, self._start(job, "fetch", {"IA_ALIGN_STAGE": "fetch"}))
+            # alignments, largest first
+            free_cores = self.cores - sum([a[2].cores for a in aligning.values()])
+            free_mem_gb = self.mem_gb - sum([a[2].mem_gb for a in aligning.values()])
+            for job, input_bytes in sorted(ready, key = lambda r: -r[1]):
+                resources = size_alignment_job(job.lib_type, input_bytes, self.cores, self.mem_gb)
+                if resources.cores <= free_cores and resources.mem_gb <= free_mem_gb:
+                    ready.remove((job, input_bytes))
+                    free_cores -= resources.cores
+                    free_mem_gb -= resources.mem_gb
+                    self._log("aligning {} ({:.1f} GB of fastq files) with {} cores and {} GB".format(job.name, input_bytes / 1024 ** 3,
+                        resources.cores, resources.mem_gb))
+                    proc = self._start(job, "align", {"IA_ALIGNER_LOCALCORES": str(resources.cores), "IA_ALIGNER_LOCALMEM": str(resources.mem_gb)})
+                    aligning[job.name] = (job, proc, resources, input_bytes)
+            time.sleep(POLL_INTERVAL_SEC)
+            for name, (job, proc) in list(fetching.items()):
+                if proc.poll() is not None:
+                    del fetching[name]
+                    self.events.append((name, "fetch", "end", time.time() - self.start_time))
+                    if proc.returncode != 0:
+                        self._log("failed to download the fastq files of {} (exit code {})".format(name, proc.returncode))
+                        failed.append(name)
+                    else:
+                        ready.append((job, dir_size(job.fastq_dir) if os.path.isdir(job.fastq_dir) else 0))
+            for name, (job, proc, _, _) in list(aligning.items()):
+                if proc.poll() is not None:
+                    del aligning[name]
+                    self.events.append((name, "align", "end", time.time() - self.start_time))
+                    if proc.returncode != 0:
+                        self._log("failed to align {} (exit code {})".format(name, proc.returncode))
+                        failed.append(name)
+                    else:
+                        self._log("done aligning {}".format(name))
+        self.makespan = time.time() - self.start_time
+        self._log("done; {} of {} jobs failed".format(len(failed), len(self.jobs)))
+        return failed
+
+if __name__ == "__main__":
+    jobs = read_jobs(sys.argv[1])
+    failed = AlignmentScheduler(jobs).run()
+    if len(failed) > 0:
+        print("Failed jobs: {}".format(", ".join(failed)))
+        sys.exit(1)
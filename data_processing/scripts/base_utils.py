@@ -0,0 +1,293 @@
+import os
+import glob
+import json
+import time
+import logging
+from math import floor
+from datetime import datetime
+from typing import Type, List, NamedTuple, Optional
+from logger import BaseLogger
+from s3_utils import s3_list, s3_ls, s3_exists, s3_cp, s3_cp_many, s3_sync, s3_mv, s3_rm
+from s3_index import s3_list_cached, s3_exists_cached, s3_latest_version, refresh_listing_index
+
+# The helpers of utils.py that do not need the analysis stack (scanpy, scvi-tools, torch, celltypist, anndata, scipy, statsmodels):
+# configs, access keys, S3 transfers, the sample sheet and log formatting. The command line tools that only generate configs and
+# scripts or digest logs (generate_processing_config_files.py, generate_processing_scripts.py, generate_library_alignment_script.py,
+# digest_logs.py) import this module rather than utils.py, which imports all of it and takes seconds to load; pandas and numpy are
+# imported by the functions that use them. utils.py re-exports everything here, so `from utils import *` works as before.
+# Keep the imports at the top of this module light: benchmarks/benchmark_import_time.py fails if a heavy module is imported by any
+# of the tools above.
+
+AUTHORIZED_EXECUTERS = ["b750bd0287811e901c88dc328187e25f", "1c75133ab6a1fc3ed9233d3fe40b3d73", "5781bb0290325ec9e3f9c4c930dc3412"] # md5 checksums of the AWS_SECRET_ACCESS_KEY value of those that are authorized to upload outputs of processing scripts to the server; note that individuals with upload permission to aws can bypass that by changing the code - this is just designed to alert users that they should only use sandbox mode.
+
+class CELLRANGER_METRICS_NT(NamedTuple):
+    MEDIAN_GENES_PER_CELL: str = "Median Genes per Cell"
+    MEDIAN_UMI_COUNTS_PER_CELL: str = "Median UMI Counts per Cell"
+    SEQUENCING_SATURATION: str = "Sequencing Saturation"
+CELLRANGER_METRICS = CELLRANGER_METRICS_NT()
+# these are formatted strings that we use to log QC stats and use them to parse those lines back
+# if you edit these make sure to update all call sites that use them
+QC_STRING_DOUBLETS = "Removed {} estimated doublets (percent removed: {:.2f}%); {} droplets remained."
+QC_STRING_AMBIENT_RNA = "Removed {} cells (percent removed: {:.2f}%) with total decontaminated counts below filter_decontaminated_cells_min_genes={}"
+QC_STRING_VDJ = "Removed {} vdj genes (percent removed: {:.2f}%); {} genes remained."
+QC_STRING_RBC = "Removed {} red blood cells (percent removed: {:.2f}%); {} droplets remained."
+QC_STRING_COUNTS = "Final number of cells: {}, final number of genes: {}."
+QC_STRING_START_TIME = "Starting time: {}"
+
+TIME_FORMAT = "%H:%M, %m-%d-%Y"
+DATE_FORMAT = "%m/%d/%Y"
+
+def get_current_time():
+    return time.strftime(TIME_FORMAT)
+
+def get_date_from_time(t: str):
+    dt = datetime.strptime(t, TIME_FORMAT)
+    return dt.strftime(DATE_FORMAT)
+
+def set_access_keys(filepath, return_dict = False):
+	"""
+	Sets the user's access keys to the AWS S3 bucket.
+
+	Assumes this file includes only two uncommented lines with keys:
+	export AWS_ACCESS_KEY_ID=<key>
+	export AWS_SECRET_ACCESS_KEY=<key>
+
+	If return_dict == True then only returns the dictionary.
+	"""
+	keys = {}
+	with open(filepath) as fp:
+		for i in fp:
+			if len(i.rstrip()) and i[0]!="#":
+				cmd = i.rstrip().split(" ")
+				assert(cmd[0] == "export")
+				cmd.pop(0)
+				for i in range(len(cmd)-1,-1,-1):
+					if len(cmd[i]) == 0:
+						cmd.pop(i)
+				pair = "".join(cmd).split("=")
+				keys[pair[0]] = pair[1]
+	if return_dict:
+		return(keys)
+	for k in keys:
+		os.environ[k] = keys[k]
+
+def load_configs(filename):
+    with open(filename) as f: 
+        data = f.read()	
+    configs = json.loads(data)
+    return configs
+
+def get_configs_status(configs, s3_path, configs_file_prefix, variable_config_keys, data_dir):
+	# the version names the outputs to write, so the listing must not be stale (another node may have written a new version)
+	files = s3_list_cached(s3_path, max_age=0)
+	files_set = set(files)
+	latest_configs_file = None
+	latest_version_num = 0
+	is_new_version = False
+	for f in files:
+		j = f.split('/')[-1].split('.')[0:-1]
+		if ".".join(j[0:-1]) == configs_file_prefix and '/'.join(f.split('/')[:-1] + ['.'.join([f.split('/')[-3], 'unstim', f.split('/')[-2], 'h5ad'])]) in files_set:
+			v = int(j[-1][1:])
+			if v > latest_version_num:
+				latest_version_num = v
+				latest_configs_file = "/".join(f.split('/')[-2:])
+	if latest_configs_file is None:
+		version = 1
+	else:
+		s3_cp('{}/{}'.format(s3_path, latest_configs_file), data_dir)
+		configs_invariant = {i:configs[i] for i in configs if i not in variable_config_keys}
+		with open(os.path.join(data_dir, latest_configs_file.split('/')[-1])) as f:
+			latest_configs = json.loads(f.read().rstrip())
+			latest_configs_invariant = {i:latest_configs[i] for i in latest_configs if i not in variable_config_keys}
+			if configs_invariant == latest_configs_invariant:
+				version = latest_version_num
+			else:
+				version = latest_version_num + 1
+	if version > latest_version_num:
+		is_new_version = True
+	print(is_new_version,"v"+str(version))
+	return [is_new_version,"v"+str(version)]
+
+def get_latest_object_version(s3_access_file: str, s3_path: str, folder_name: Optional[str] = None, max_age: Optional[float] = None):
+    set_access_keys(s3_access_file)
+    # search for patterns of /vX/ in the keys under s3_path (using the local listing index); callers that read or write the
+    # object of the version pass max_age=0 to list s3_path again, the cached listing is good enough for generating configs
+    latest_version = s3_latest_version(s3_path, component=folder_name, max_age=max_age)
+    if latest_version == -1:
+        print(f"Could not find the latest version. s3_path: {s3_path}")
+    return "v" + str(latest_version)
+
+def get_configs_version_alignment(configs, data_dir, configs_dir_remote, configs_file_remote_prefix, variable_config_keys):
+	# This function checks if the configs file is using configs that were already used (while disregarding fields variable_config_keys) and are therefore documented on S3.
+	# If this is the first time these configs are used then it creates a new configs version and uploads the new configs to S3.
+	# Finally, the version of the configs is returned; to be used for stamping results files with the configs version.
+	configs_dir_local = os.path.join(data_dir,"configs")
+	os.system("mkdir -p " + configs_dir_local)
+	s3_sync(configs_dir_remote, configs_dir_local)
+	version = None
+	max_version = 0
+	configs_invariant = {i:configs[i] for i in configs if i not in variable_config_keys}
+	for configs_file in glob.glob(os.path.join(configs_dir_local,"*.txt")):
+		with open(configs_file) as f:
+			f_configs = json.loads(f.read().rstrip())
+		if configs_invariant == f_configs:
+			version = configs_file.split('/')[-1][0:-4].split('.')[1]
+			break
+		version_num = int(configs_file.split('/')[-1][0:-4].split('.')[1][1:])
+		if (version_num > max_version):
+			max_version = version_num
+	if version is None:
+		version = "v{0}".format(max_version+1)
+		configs_file = os.path.join(configs_dir_local,"{0}{1}.txt".format(configs_file_remote_prefix, version))
+		with open(configs_file, 'w') as f:
+			json.dump(configs_invariant, f)
+		s3_sync(configs_dir_local, configs_dir_remote, configs_file.split('/')[-1])
+	return version
+
+def zipdir(path, ziph):
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), 
+                os.path.join(path, '..')))
+
+def read_immune_aging_sheet(sheet, output_fn=None, quiet=True):
+    import pandas as pd
+    from sheet_cache import read_sheet_cached
+    if 'IA_sample_spreadsheet.xlsx' in os.listdir(os.getcwd()):
+        logging.warning(f'Using previously downloaded sample spreadsheet at {os.getcwd()}/IA_sample_spreadsheet.xlsx')
+        data = pd.read_excel('IA_sample_spreadsheet.xlsx', sheet_name=sheet)
+    else:
+        # served from the local snapshot of the sheet, which is downloaded once and reused until it expires (see sheet_cache.py);
+        # output_fn is no longer used since the downloaded tabs are kept in the snapshot
+        data = read_sheet_cached(sheet, quiet=quiet)
+    return data
+
+def get_sheet_version(sheet):
+    # identifies the content that read_immune_aging_sheet(sheet) returns: the modification time of the local spreadsheet, or
+    # the time the tab in the snapshot was downloaded; e.g. for caching tables that are derived from the tab. None if the tab
+    # was not read yet or expired, i.e. if read_immune_aging_sheet(sheet) would read it again
+    if 'IA_sample_spreadsheet.xlsx' in os.listdir(os.getcwd()):
+        return ("xlsx", os.path.abspath('IA_sample_spreadsheet.xlsx'), os.path.getmtime('IA_sample_spreadsheet.xlsx'))
+    from sheet_cache import get_sheet_snapshot
+    snapshot = get_sheet_snapshot()
+    fetched_at = snapshot.fetched_at(sheet)
+    return None if fetched_at is None else ("snapshot", snapshot.snapshot_dir, sheet, fetched_at)
+
+def draw_separator_line():
+    try:
+        width = os.get_terminal_size().columns / 5
+        print(" " * floor(width)  + "\u2014" * 3 * floor(width) + " " * floor(width) + "\n")
+    except:
+        # we might end up here if we can't get the terminal size. In this case, just draw a line
+        # with a hard-coded length
+        width = 50
+        print("\u2014" * width + "\n")
+
+def aws_sync(source: str, target: str, include, logger: Type[BaseLogger], do_log: bool = True, only_if_changed: bool = False) -> str:
+    # transfers the files in source that match include (a pattern or a list of patterns) into target; see s3_utils.s3_sync.
+    # like the aws cli, failures are logged rather than raised - callers check for the existence of the files they need.
+    if do_log:
+        logger.add_to_log("syncing {}...".format(include))
+        logger.add_to_log("sync: {} -> {} (include: {})".format(source, target, include))
+    try:
+        aws_response = s3_sync(source, target, include, only_if_changed = only_if_changed)
+    except Exception as err:
+        aws_response = ""
+        logger.add_to_log("Failed to sync {} from {} to {}: {}".format(include, source, target, err), level="error")
+    if do_log:
+        logger.add_to_log("aws response: {}\n".format(aws_response))
+    return aws_response
+
+def dir_and_files_exist(dir_name: str, file_names: List[str]) -> bool:
+    exists = os.path.isdir(dir_name)
+    if exists:
+        for fn in file_names:
+            if not os.path.isfile(fn):
+                exists = False
+                break
+    return exists
+
+def strip_integration_markers(barcode: str, valid_libs: List[str] = None) -> str:
+    # for example from "AACTGTCAAGTCGT-1_CZI-IA11512684-1-2-10" returns "AACTGTCAAGTCGT-1_CZI-IA11512684"
+    # Note this function assumes that the library id encoded in the barcode is of the form xxx-yyy (for example "CZI-IA11512684"),
+    # otherwise, the behavior is undefined
+    parts = barcode.split("_")
+    cell_barcode = parts[0]
+    lib_id_plus_integration_markers = parts[1].split("-")
+    lib_id = "-".join([lib_id_plus_integration_markers[0], lib_id_plus_integration_markers[1]])
+    if valid_libs is not None and lib_id not in valid_libs:
+        raise ValueError(f"lib_id {lib_id} is not a valid library. Are you sure your barcode {barcode} contains a lib_id of the form xxx-yyy?")
+    return "_".join([cell_barcode, lib_id])
+
+def get_all_donors() -> dict:
+    samples = read_immune_aging_sheet("Samples")
+    df = samples[["Donor ID", "Seq run"]].astype("str")
+    donor_to_seq = df.drop_duplicates().to_dict(orient="records")
+    return donor_to_seq
+
+# Utility function to rename TLN folders and files to LLN on S3
+# as a consequence of renaming these samples in our IA Sample spreadsheet
+def handle_sample_tln_to_lln_renaming(donor_id: str, delete_lln: bool = False):
+    path_prefix = "s3://immuneaging/processed_samples/"
+    def get_tln_lln_folders():
+        lln_folders, tln_folders = [], []
+        for folder_name in s3_ls(path_prefix):
+            if folder_name.startswith(donor_id + "-LLN"):
+                lln_folders.append(folder_name)
+            elif folder_name.startswith(donor_id + "-TLN"):
+                tln_folders.append(folder_name)
+        return lln_folders, tln_folders
+    lln_folders, tln_folders = get_tln_lln_folders()
+    if len(lln_folders) > 0:
+        if delete_lln:
+            for lf in lln_folders:
+                s3_rm(path_prefix+lf, recursive=True)
+        else:
+            print("LLN folder(s) present: {}".format(", ".join(lln_folders)))
+            return
+    if len(tln_folders) > 0:
+        for tf in tln_folders:
+            dest = tf.replace("TLN", "LLN")
+            s3_mv(path_prefix+tf, path_prefix+dest, recursive=True)
+    # rename TLN to LLN in file names
+    lln_folders, _ = get_tln_lln_folders()
+    for lf in lln_folders:
+        for dir_name in s3_list(path_prefix+lf):
+            file_name = dir_name.split('/')[-1]
+            dir_name_no_file_name = dir_name.removesuffix(file_name)
+            new_file_name = file_name.replace("TLN", "LLN")
+            if new_file_name == file_name:
+                continue
+            ia_path = "s3://immuneaging/"
+            print("mv {} {}".format(ia_path+dir_name, ia_path+dir_name_no_file_name+new_file_name))
+            s3_mv(ia_path+dir_name, ia_path+dir_name_no_file_name+new_file_name)
+
+def read_csv_from_aws(
+        data_dir: str,
+        aws_dir: str,
+        aws_filename: str,
+        logger: Type[BaseLogger],
+    ):
+    import pandas as pd
+    aws_sync(aws_dir, data_dir, aws_filename, logger, do_log=False, only_if_changed=True)
+    file_path = os.path.join(data_dir, aws_filename)
+    if not os.path.isfile(file_path):
+        msg = "Failed to download file {} from S3.".format(aws_filename)
+        logger.add_to_log(msg, level="error")
+        raise ValueError(msg)
+    return pd.read_csv(file_path)
+
+def get_tissues_or_compartments(s3_access_file: str, tissue_or_compartment: str, skip_tissues: Optional[List[str]] = None):
+    import numpy as np
+    import pandas as pd
+    assert tissue_or_compartment in ["tissue", "compartment"]
+    set_access_keys(s3_access_file)
+    samples = read_immune_aging_sheet("Samples")
+    tissues_or_compartments = []
+    if tissue_or_compartment == "tissue":
+        tissues_or_compartments = np.unique(samples["Organ"][np.logical_not(pd.isnull(samples["Organ"]))])
+        if skip_tissues is not None:
+            tissues_or_compartments = [t for t in tissues_or_compartments if t not in skip_tissues]
+    else:
+        tissues_or_compartments = ["T", "B", "Myeloid", "Other"]
+    return tissues_or_compartments
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import hashlib
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Type
+
+from logger import BaseLogger
+from s3_index import get_cache_dir
+from s3_utils import s3_cp, s3_cp_many, s3_exists, s3_list, split_s3_path
+
+# Content-addressed checkpoints of the stages of a processing script (e.g. decontX, celltypist, the scvi/totalvi models and
+# scrublet in process_sample.py). A failure late in a script (e.g. in the UMAP) or a change to a late config (e.g. umap_min_dist)
+# used to rerun all the stages before it. Instead, every stage declares its inputs (values, the files it reads, and the stages it
+# depends on) and the config keys it uses; the key of the stage is a hash of the content of those, so a stage whose inputs and
+# configs did not change finds its outputs under the same key and restores them instead of running:
+#
+#   stage = checkpoints.stage("decontx", inputs = {"counts": adata.X, "batch": batches}, configs = configs, config_keys = [...])
+#   if stage.restored:
+#       contamination = stage.values["contamination"]
+#       stage.restore_file("model", model_file)
+#   else:
+#       contamination = ... (messages that should be in the log of every run go through stage.add_to_log)
+#       stage.save({"contamination": contamination}, files = {"model": model_file})
+#
+# A stage that depends on another passes it as one of its inputs (its key is then part of the key of the stage), so that
+# only the stages downstream of a change run again. A checkpoint holds the values of the stage (pickled, so AnnData objects,
+# data frames and arrays are restored as they were), copies of its output files, and the messages it logged (replayed into
+# the log on restore, so that digest_logs.py finds the QC lines of the stage in every run).
+# Checkpoints are kept in a local cache (evicted least recently used first) and, if IA_STAGE_CACHE_S3 is set, also in the
+# object store, so that a rerun on another node restores them from there. The manifest of a checkpoint is written last, so a
+# checkpoint without one (e.g. of a run that was killed while saving it) is ignored.
+#
+# The following environment variables can be used to control the checkpoints (all are optional):
+# IA_STAGE_CACHE - if set to 0, every stage runs and nothing is saved (default 1)
+# IA_STAGE_CACHE_DIR - the local cache (default <IA_CACHE_DIR>/stage_checkpoints)
+# IA_STAGE_CACHE_MAX_GB - max size of the local cache (default 50)
+# IA_STAGE_CACHE_S3 - S3 dir of a shared cache (e.g. s3://immuneaging/stage_checkpoints; default none)
+
+FORMAT_VERSION = 1
+DEFAULT_MAX_GB = 50
+MANIFEST_FILE = "manifest.json"
+VALUES_FILE = "values.pkl"
+FILES_DIR = "files"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+class FileContent(NamedTuple):
+    """
+    An input file of a stage; it is part of the key of the stage through a hash of its content (rather than its path).
+    """
+    path: str
+
+def _update_hash(h, value: Any) -> None:
+    # the heavy libraries are only looked at if they were imported by the caller, so that this module stays light
+    h.update(type(value).__name__.encode())
+    if isinstance(value, Stage):
+        h.update(value.key.encode())
+    elif isinstance(value, FileContent):
+        with open(value.path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+    elif value is None or isinstance(value, (bool, int, float, str, bytes)):
+        h.update(repr(value).encode())
+    elif isinstance(value, (list, tuple)):
+        h.update(str(len(value)).encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        h.update(str(len(value)).encode())
+        for k in sorted(value, key = str):
+            _update_hash(h, str(k))
+            _update_hash(h, value[k])
+    elif "numpy" in sys.modules and isinstance(value, sys.modules["numpy"].ndarray):
+        h.update("{}{}".format(value.dtype.str, value.shape).encode())
+        if value.dtype.hasobject:
+            _update_hash(h, [str(v) for v in value.ravel()])
+        else:
+            h.update(sys.modules["numpy"].ascontiguousarray(value).data)
+    elif "scipy.sparse" in sys.modules and sys.modules["scipy.sparse"].issparse(value):
+        value = value.tocsr()
+        value.sort_indices()
+        h.update(str(value.shape).encode())
+        for a in [value.data, value.indices, value.indptr]:
+            _update_hash(h, a)
+    elif "pandas" in sys.modules and isinstance(value, (sys.modules["pandas"].DataFrame, sys.modules["pandas"].Series,
+            sys.modules["pandas"].Index)):
+        pd = sys.modules["pandas"]
+        if isinstance(value, pd.DataFrame):
+            _update_hash(h, [str(c) for c in value.columns])
+            _update_hash(h, [str(t) for t in value.dtypes])
+        elif isinstance(value, pd.Series):
+            _update_hash(h, [str(value.name), str(value.dtype)])
+        else:
+            value = value.to_series()
+        try:
+            _update_hash(h, pd.util.hash_pandas_object(value, index = True).values)
+        except TypeError:
+            # unhashable cells (e.g. lists)
+            _update_hash(h, value.astype(str).values)
+    elif "anndata" in sys.modules and isinstance(value, sys.modules["anndata"].AnnData):
+        _update_hash(h, {"X": value.X, "obs": value.obs, "var": value.var, "layers": dict(value.layers), "obsm": dict(value.obsm),
+            "uns": dict(value.uns)})
+    else:
+        h.update(pickle.dumps(value, protocol = 4))
+
+def content_hash(value: Any) -> str:
+    h = hashlib.sha256()
+    _update_hash(h, value)
+    return h.hexdigest()
+
+def _dir_size(path: str) -> int:
+    return sum([os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files])
+
+class Stage:
+    """
+    A stage of a script with a key (see above). If restored is True then values holds the values the stage saved and
+    its files can be restored with restore_file(); otherwise the stage should run and then save its outputs with save().
+    add_to_log() has the interface of BaseLogger.add_to_log, so a stage can be passed as the logger of the functions it calls.
+    """
+    def __init__(self, checkpoints: "StageCheckpoints", name: str, key: str):
+        self.checkpoints = checkpoints
+        self.name = name
+        self.key = key
+        self.restored = False
+        self.values = {}
+        self.manifest = None
+        self._messages = []
+        self._start = time.time()
+
+    def path(self) -> str:
+        return os.path.join(self.checkpoints.cache_dir, self.name, self.key)
+
+    def add_to_log(self, s, level = "info"):
+        self._messages.append((s, level))
+        self.checkpoints.logger.add_to_log(s, level = level)
+
+    def save(self, values: Dict[str, Any], files: Optional[Dict[str, str]] = None) -> None:
+        """
+        Saves the outputs of the stage: values are pickled and files (name -> local path) are copied into the checkpoint.
+        A checkpoint that cannot be saved is logged and skipped - the outputs of the stage are not affected.
+        """
+        self.values = values
+        if not self.checkpoints.enabled:
+            return
+        try:
+            self.checkpoints.save(self, values, files or {}, time.time() - self._start)
+        except Exception as err:
+            self.checkpoints.logger.add_to_log("Failed to save checkpoint of stage {}: {}".format(self.name, err), level = "warning")
+
+    def restore_file(self, name: str, path: str) -> None:
+        # copies the file saved under name into path (which may be the path of the file in another configs version)
+        shutil.copyfile(os.path.join(self.path(), FILES_DIR, name), path)
+
+class StageCheckpoints:
+    """
+    Creates the stages of a script (with stage()) and saves and restores their checkpoints (see above).
+    """
+    def __init__(self, logger: Type[BaseLogger], cache_dir: Optional[str] = None, s3_dir: Optional[str] = None,
+            enabled: Optional[bool] = None, max_gb: Optional[float] = None):
+        if enabled is None:
+            enabled = os.environ.get("IA_STAGE_CACHE", "1") != "0"
+        if cache_dir is None:
+            cache_dir = os.environ.get("IA_STAGE_CACHE_DIR", os.path.join(get_cache_dir(), "stage_checkpoints"))
+        if s3_dir is None:
+            s3_dir = os.environ.get("IA_STAGE_CACHE_S3", "")
+        if max_gb is None:
+            max_gb = float(os.environ.get("IA_STAGE_CACHE_MAX_GB", DEFAULT_MAX_GB))
+        self.logger = logger
+        self.enabled = enabled
+        self.cache_dir = cache_dir
+        self.s3_dir = s3_dir.rstrip("/") if len(s3_dir) > 0 else None
+        self.max_bytes = max_gb * 1024 ** 3
+        # name -> "restored" or "ran"
+        self.stages = {}
+        # the time the restored stages took when they ran
+        self.saved_sec = 0
+
+    def stage(self, name: str, inputs: Dict[str, Any], configs: Optional[Dict] = None, config_keys: Sequence[str] = (),
+            version: int = 1) -> Stage:
+        """
+        Returns the stage with the given name, restored from its checkpoint if there is one for its key. The key is a hash of
+        the inputs, the values of config_keys in configs (missing keys are part of the key as well) and version, which should
+        be incremented when the code of the stage changes the outputs.
+        """
+        configs = configs or {}
+        key = content_hash([FORMAT_VERSION, name, version, inputs, {k: configs.get(k, "<missing>") for k in config_keys}])
+        stage = Stage(self, name, key)
+        if self.enabled and self._fetch(stage):
+            try:
+                with open(os.path.join(stage.path(), VALUES_FILE), "rb") as f:
+                    stage.values = pickle.load(f)
+                with open(os.path.join(stage.path(), MANIFEST_FILE)) as f:
+                    stage.manifest = json.load(f)
+                stage.restored = True
+            except Exception as err:
+                self.logger.add_to_log("Failed to restore checkpoint of stage {}: {}".format(name, err), level = "warning")
+        if stage.restored:
+            # marks the checkpoint as used, for the eviction
+            os.utime(os.path.join(stage.path(), MANIFEST_FILE))
+            self.logger.add_to_log("Restored stage {} from checkpoint {} (saved {}, ran for {:.1f} sec)".format(name, key[:16],
+                stage.manifest["created"], stage.manifest["elapsed_sec"]))
+            for s, level in stage.manifest["messages"]:
+                self.logger.add_to_log(s, level = level)
+            self.saved_sec += stage.manifest["elapsed_sec"]
+        self.stages[name] = "restored" if stage.restored else "ran"
+        return stage
+
+    def _fetch(self, stage: Stage) -> bool:
+        # True if the checkpoint of the stage is in the local cache, downloading it from the object store if needed
+        if os.path.isfile(os.path.join(stage.path(), MANIFEST_FILE)):
+            return True
+        if self.s3_dir is None:
+            return False
+        s3_path = "{}/{}/{}".format(self.s3_dir, stage.name, stage.key)
+        try:
+            if not s3_exists("{}/{}".format(s3_path, MANIFEST_FILE)):
+                return False
+            tmp_dir = "{}.{}.tmp".format(stage.path(), os.getpid())
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+            bucket, prefix = split_s3_path(s3_path + "/")
+            transfers = [("s3://{}/{}".format(bucket, k), os.path.join(tmp_dir, k[len(prefix):])) for k in s3_list(s3_path + "/")]
+            for _, target in transfers:
+                os.makedirs(os.path.dirname(target), exist_ok = True)
+            s3_cp_many(transfers)
+            self._commit(tmp_dir, stage.path())
+            self.logger.add_to_log("Downloaded checkpoint of stage {} from {}".format(stage.name, s3_path))
+            return True
+        except Exception as err:
+            self.logger.add_to_log("Failed to download checkpoint of stage {} from {}: {}".format(stage.name, s3_path, err),
+                level = "warning")
+            return False
+
+    def _commit(self, tmp_dir: str, path: str) -> None:
+        # moves a complete checkpoint into place; another process may have saved the same one in the meantime
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        try:
+            os.rename(tmp_dir, path)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    def save(self, stage: Stage, values: Dict[str, Any], files: Dict[str, str], elapsed_sec: float) -> None:
+        start = time.time()
+        tmp_dir = "{}.{}.tmp".format(stage.path(), os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+        os.makedirs(os.path.join(tmp_dir, FILES_DIR))
+        with open(os.path.join(tmp_dir, VALUES_FILE), "wb") as f:
+            pickle.dump(values, f, protocol = pickle.HIGHEST_PROTOCOL)
+        for name, path in files.items():
+            # copied rather than linked, since the script may write to the same path again
+            shutil.copyfile(path, os.path.join(tmp_dir, FILES_DIR, name))
+        manifest = {"format_version": FORMAT_VERSION, "stage": stage.name, "key": stage.key, "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_sec": elapsed_sec, "files": sorted(files.keys()), "messages": stage._messages}
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+        if os.path.isdir(stage.path()):
+            shutil.rmtree(stage.path())
+        self._commit(tmp_dir, stage.path())
+        size = _dir_size(stage.path())
+        if self.s3_dir is not None:
+            s3_path = "{}/{}/{}".format(self.s3_dir, stage.name, stage.key)
+            s3_cp_many([(os.path.join(stage.path(), f), "{}/{}".format(s3_path, f)) for f in
+                [VALUES_FILE] + [os.path.join(FILES_DIR, name) for name in files]])
+            s3_cp(os.path.join(stage.path(), MANIFEST_FILE), "{}/{}".format(s3_path, MANIFEST_FILE))
+        self.logger.add_to_log("Saved checkpoint of stage {} ({}, {:.1f} MB) in {:.1f} sec".format(stage.name, stage.key[:16],
+            size / 1024 ** 2, time.time() - start))
+        self.prune()
+
+    def prune(self) -> List[str]:
+        # evicts the least recently used checkpoints from the local cache until it is within max_gb; returns their paths
+        checkpoints = []
+        for name in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            for key in os.listdir(os.path.join(self.cache_dir, name)):
+                if key.endswith(".tmp"):
+                    # being saved or downloaded
+                    continue
+                path = os.path.join(self.cache_dir, name, key)
+                if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+                    checkpoints.append((os.path.getmtime(os.path.join(path, MANIFEST_FILE)), _dir_size(path), path))
+        total = sum([c[1] for c in checkpoints])
+        evicted = []
+        for _, size, path in sorted(checkpoints):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+            evicted.append(path)
+        return evicted
+
+    def report(self) -> str:
+        restored = [name for name in self.stages if self.stages[name] == "restored"]
+        return "Stages restored from checkpoints: {} (saving {:.1f} sec); stages that ran: {}".format(
+            ", ".join(restored) if len(restored) > 0 else "none", self.saved_sec,
+            ", ".join([name for name in self.stages if self.stages[name] == "ran"]) or "none")
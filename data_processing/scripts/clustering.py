@@ -0,0 +1,62 @@
+## Leiden clustering with multiple resolutions on top of one neighborhood graph. The graph is computed once by the caller and every
+## resolution only runs the (much cheaper) community detection; resolutions run in parallel in separate python processes that read
+## the graph from a file. This script is also the entry point of these processes:
+## Run as follows: python clustering.py <adjacency_npz_file> <resolution> <n_iterations> <output_file>
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import pandas as pd
+import scipy.sparse
+from typing import List, Optional, Type
+
+from logger import BaseLogger
+from resources import get_available_memory, run_python_scripts
+
+def _leiden(adjacency, resolution: float, n_iterations: int) -> tuple:
+    # same as running sc.tl.leiden on the anndata object that holds the graph
+    import scanpy as sc
+    from anndata import AnnData
+    start = time.time()
+    adata = AnnData(obs = pd.DataFrame(index = [str(i) for i in range(adjacency.shape[0])]))
+    sc.tl.leiden(adata, resolution = resolution, key_added = "leiden", adjacency = adjacency, n_iterations = n_iterations)
+    return adata.obs["leiden"].values, time.time() - start
+
+def leiden_sweep(adata, resolutions: List[float], neighbors_key: str, logger: Type[BaseLogger], n_iterations: int = 2,
+    max_workers: Optional[int] = None, tmp_dir: Optional[str] = None) -> dict:
+    """
+    Runs Leiden clustering with each of the given resolutions on the (precomputed) neighborhood graph in adata.uns[neighbors_key]
+    and returns a dict mapping each resolution to the cluster labels (same as running sc.tl.leiden with that resolution).
+    Resolutions run in parallel processes, up to max_workers (default: number of CPUs) at a time and as memory allows.
+    """
+    adjacency = adata.obsp[adata.uns[neighbors_key]["connectivities_key"]]
+    max_workers = min(len(resolutions), os.cpu_count() if max_workers is None else max_workers)
+    available_memory = get_available_memory()
+    if available_memory is not None:
+        # each process loads the graph and builds an igraph object from it (roughly 60 bytes per edge overall)
+        max_workers = min(max_workers, max(1, available_memory // max(adjacency.nnz * 60, 1)))
+    if max_workers > 1:
+        tmp_dir = tempfile.mkdtemp(dir = tmp_dir)
+        try:
+            adjacency_file = os.path.join(tmp_dir, "adjacency.npz")
+            scipy.sparse.save_npz(adjacency_file, scipy.sparse.csr_matrix(adjacency), compressed = False)
+            output_files = [os.path.join(tmp_dir, "leiden.{}.pkl".format(i)) for i in range(len(resolutions))]
+            run_python_scripts([[os.path.abspath(__file__), adjacency_file, str(resolutions[i]), str(n_iterations), output_files[i]]
+                for i in range(len(resolutions))], max_workers)
+            results = [pd.read_pickle(f) for f in output_files]
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+    else:
+        results = [_leiden(adjacency, resolution, n_iterations) for resolution in resolutions]
+    for resolution, (_, seconds) in zip(resolutions, results):
+        logger.add_to_log("Leiden clustering using resolution={0} took {1:.2f} seconds.".format(resolution, seconds))
+    return {resolution: labels for resolution, (labels, _) in zip(resolutions, results)}
+
+if __name__ == "__main__":
+    adjacency_file = sys.argv[1]
+    resolution = float(sys.argv[2])
+    n_iterations = int(sys.argv[3])
+    output_file = sys.argv[4]
+    pd.to_pickle(_leiden(scipy.sparse.load_npz(adjacency_file), resolution, n_iterations), output_file)
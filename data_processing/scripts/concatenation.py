@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from anndata import AnnData
+from typing import List, Optional, Sequence, Tuple, Type
+
+from logger import BaseLogger
+from h5ad_reader import H5adReader
+
+# Out-of-core concatenation of samples (used by integrate_samples.py). Reading all the samples into memory and then concatenating
+# them holds every sample plus the concatenated copy (and, with an outer join, its reindexed intermediates) in memory at once.
+# Instead:
+# 1. Everything but the count matrices (obs, var, obsm, uns) is read for all samples, each with an empty placeholder matrix, and
+#    concatenated as before; this gives the union of the genes (and proteins) and all the metadata of the concatenated data.
+# 2. The count matrices are then read one sample at a time, aligned to the union of the genes, and appended to a csr matrix on disk
+#    (SparseRowStore), which is memory-mapped for the downstream steps.
+# Peak memory is therefore bounded by the counts of the largest sample (plus the metadata of all samples) rather than by the
+# counts of all samples.
+
+INT32_MAX = np.iinfo(np.int32).max
+
+class SparseRowStore:
+    """
+    A csr matrix on disk to which rows are appended one block at a time: data and indices are written to raw binary files in store_dir
+    and indptr is kept in memory. to_csr() returns the matrix with data and indices memory-mapped copy-on-write, so that in-place
+    changes never reach the files; it can be called more than once (e.g. for X and for a layer with the same counts).
+    """
+    def __init__(self, store_dir: str, n_cols: int, dtype: np.dtype, max_nnz: int):
+        os.makedirs(store_dir, exist_ok = True)
+        self.n_cols = n_cols
+        self.dtype = np.dtype(dtype)
+        # scipy casts the indices to int32 whenever they fit, which would copy a memory-mapped int64 array into memory
+        self.index_dtype = np.dtype(np.int32 if max(n_cols, max_nnz) <= INT32_MAX else np.int64)
+        self.data_file = os.path.join(store_dir, "data.bin")
+        self.indices_file = os.path.join(store_dir, "indices.bin")
+        self._data_fp = open(self.data_file, "wb")
+        self._indices_fp = open(self.indices_file, "wb")
+        self._indptr = [np.zeros(1, dtype = self.index_dtype)]
+        self.n_rows = 0
+        self.nnz = 0
+
+    def append(self, matrix: scipy.sparse.csr_matrix) -> None:
+        assert matrix.shape[1] == self.n_cols, "Expected {} columns, got {}.".format(self.n_cols, matrix.shape[1])
+        matrix.data.astype(self.dtype, copy = False).tofile(self._data_fp)
+        matrix.indices.astype(self.index_dtype, copy = False).tofile(self._indices_fp)
+        self._indptr.append(matrix.indptr[1:].astype(self.index_dtype) + self.nnz)
+        self.n_rows += matrix.shape[0]
+        self.nnz += matrix.nnz
+
+    def _map(self, path: str, dtype: np.dtype) -> np.ndarray:
+        if self.nnz == 0:
+            # an empty file cannot be memory-mapped
+            return np.zeros(0, dtype = dtype)
+        return np.memmap(path, dtype = dtype, mode = "c", shape = (self.nnz,))
+
+    def to_csr(self) -> scipy.sparse.csr_matrix:
+        for fp in [self._data_fp, self._indices_fp]:
+            if not fp.closed:
+                fp.close()
+        # set the arrays directly since the constructor would validate (and possibly copy) them
+        matrix = scipy.sparse.csr_matrix((self.n_rows, self.n_cols), dtype = self.dtype)
+        matrix.data = self._map(self.data_file, self.dtype)
+        matrix.indices = self._map(self.indices_file, self.index_dtype)
+        matrix.indptr = np.concatenate(self._indptr)
+        matrix.has_sorted_indices = True
+        return matrix
+
+def read_sample_metadata(reader: H5adReader, rows: Optional[np.ndarray] = None, drop_obsm: Sequence[str] = ()) -> AnnData:
+    """
+    Reads everything but the count matrices (obs, var, obsm but drop_obsm, and uns) of the given rows (all if None) of a sample. X is an
+    empty placeholder, so that the metadata of all samples can be concatenated (as the full data were) without reading their counts.
+    """
+    adata = reader.read(X = False, obsm = [k for k in reader.obsm_keys() if k not in drop_obsm], layers = [], uns = True, rows = rows)
+    return AnnData(X = scipy.sparse.csr_matrix(adata.shape, dtype = np.float32), obs = adata.obs, var = adata.var, obsm = dict(adata.obsm), uns = adata.uns)
+
+def common_layers(h5ad_files: List[str]) -> List[str]:
+    # the layers that all the given files have (those that are kept when concatenating), in the order of the first file
+    layers = None
+    for h5ad_file in h5ad_files:
+        with H5adReader(h5ad_file) as reader:
+            keys = reader.layers_keys()
+        layers = keys if layers is None else [k for k in layers if k in keys]
+    return [] if layers is None else layers
+
+def concatenate_layer(store_dir: str, var_names: pd.Index, sources: List[Tuple[str, Optional[np.ndarray]]], layer: str,
+    logger: Type[BaseLogger]) -> SparseRowStore:
+    """
+    Appends the given layer of the given (h5ad file, rows) sources, one source at a time and in the given order, to a SparseRowStore
+    in store_dir. The columns are aligned to var_names (e.g. the union of the genes of the samples); genes that are missing in a
+    sample are zero, as in an outer join.
+    """
+    # the size and dtype of the result are known from the metadata of the sources
+    nnz, dtypes = 0, []
+    for h5ad_file, rows in sources:
+        with H5adReader(h5ad_file) as reader:
+            nnz += reader.nnz(layer, rows)
+            dtypes.append(reader.file["layers"][layer]["data"].dtype)
+    store = SparseRowStore(store_dir, len(var_names), np.result_type(*dtypes), nnz)
+    for h5ad_file, rows in sources:
+        with H5adReader(h5ad_file) as reader:
+            counts = scipy.sparse.csr_matrix(reader.read_layer(layer, rows))
+            columns = var_names.get_indexer(reader.var_names)
+        if np.any(columns < 0):
+            raise ValueError("Genes of {} are missing from the concatenated genes.".format(h5ad_file))
+        counts = scipy.sparse.csr_matrix((counts.data, columns[counts.indices], counts.indptr), shape = (counts.shape[0], len(var_names)))
+        counts.sort_indices()
+        store.append(counts)
+        del counts
+    logger.add_to_log("Wrote {} of {} samples ({} cells, {} non-zero values) to {}.".format(layer, len(sources), store.n_rows, store.nnz, store_dir))
+    return store
@@ -152,9 +152,7 @@ def generate_tissue_integration_figures(adata, tissue, version, working_dir, bas
         
         logger.add_to_log("Uploading {} to aws...".format(zip_filename))
         aws_destination = "{}/{}/{}/{}".format(base_s3_url, base_s3_dir, tissue, version)
-        sync_cmd = 'aws s3 sync --no-progress {} {} --exclude "*" --include {}'.format(working_dir, aws_destination, zip_filename)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        utils.aws_sync(working_dir, aws_destination, zip_filename, logger, only_if_changed=True)
         
         shutil.rmtree(figures_dir)
         figures_urls.append("{}{}/{}/{}/{}".format(base_aws_url, base_s3_dir, tissue, version, zip_filename))
@@ -205,12 +203,11 @@ def get_tissue_integration_results_csv(working_dir: str, s3_access_file: str, rm
             file_name = "{}.{}.h5ad".format(tissue, version)
 
             # first check to see if we have an anndata for this tissue
-            ls_cmd = "aws s3 ls {}/{}/{}/{}/".format(BASE_S3_URL, BASE_S3_DIR, tissue, version)
-            files = os.popen(ls_cmd).read()
-            logger.add_to_log("aws response: {}\n".format(files))
+            files = utils.s3_ls("{}/{}/{}/{}/".format(BASE_S3_URL, BASE_S3_DIR, tissue, version))
+            logger.add_to_log("aws response: {}\n".format("\n".join(files)))
             found = False
-            for f in files.rstrip().split('\n'):
-                if f.split(' ')[-1] == file_name:
+            for f in files:
+                if f == file_name:
                     found = True
                     break
 
@@ -218,14 +215,13 @@ def get_tissue_integration_results_csv(working_dir: str, s3_access_file: str, rm
                 logger.add_to_log("Integrated annotated data not found for tissue {}".format(tissue))
             else:
                 csv_row[CSV_HEADER_ANNDATA] = "{}{}/{}/{}/{}".format(BASE_AWS_URL, BASE_S3_DIR, tissue, version, file_name)
-                dir_name = "{}/{}/{}/{}/".format(BASE_S3_URL, BASE_S3_DIR, tissue, version)
-                sync_cmd = 'aws s3 sync --no-progress {} {} --exclude "*" --include {}'.format(dir_name, working_dir, file_name)
-                logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-                logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
-                
-                # now extract info from the adata
-                h5ad_file = os.path.join(working_dir, file_name)
-                adata = sc.read_h5ad(h5ad_file)
+                s3_path = "{}/{}/{}/{}/{}".format(BASE_S3_URL, BASE_S3_DIR, tissue, version, file_name)
+
+                # now extract info from the adata; only obs and the umap embeddings are needed, so read them directly from S3
+                # rather than downloading and reading all of the integrated data
+                with utils.H5adReader(s3_path) as reader:
+                    umap_keys = [k for k in reader.obsm_keys() if k.startswith("X_umap")]
+                    adata = reader.read(var = [], X = False, obsm = umap_keys, layers = [])
                 csv_row[CSV_HEADER_CELL_COUNT] = adata.n_obs
                 csv_row[CSV_HEADER_SAMPLES] = np.unique(adata.obs["sample_id"])
                 csv_row[CSV_HEADER_SAMPLE_COUNT] = len(csv_row[CSV_HEADER_SAMPLES])
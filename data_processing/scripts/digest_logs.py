@@ -18,7 +18,7 @@ import logging
 import io
 import re
 
-import utils
+import base_utils
 from logger import RichLogger, not_found_sign
 
 logging.getLogger('parse').setLevel(logging.WARNING)
@@ -30,7 +30,7 @@ class BaseDigestClass(ABC):
 
         # set aws credentials
         if self.logs_location == "aws":
-            utils.set_access_keys(self.s3_access_file)
+            base_utils.set_access_keys(self.s3_access_file)
 
     def _ingest_and_sanity_check_input(self, args):
         assert(len(args) == 10)
@@ -52,7 +52,7 @@ class BaseDigestClass(ABC):
             logger.add_to_log("*** Be wary of using the \"latest\" option as it can hide failures. For example if you expect the latest to be N and some library failed, we would grab the latest version that succeeded (<N) and report success. If you know the version you expect, provide it explicitly. ***", level="warning")
 
     def _get_all_samples(self) -> pd.DataFrame:
-        samples = utils.read_immune_aging_sheet("Samples", quiet=True)
+        samples = base_utils.read_immune_aging_sheet("Samples", quiet=True)
         indices = samples["Donor ID"] == self.donor_id
         return samples[indices]
 
@@ -110,19 +110,9 @@ class BaseDigestClass(ABC):
                     aws_dir_name = self._get_aws_dir_name()
                     # find the latest version if needed
                     if self.version == "latest":
-                        latest_version = -1
-                        ls_cmd = "aws s3 ls s3://immuneaging/{}/{} --recursive".format(aws_dir_name, prefix)
-                        ls  = os.popen(ls_cmd).read()
-                        if len(ls) != 0:
-                            filenames = ls.split("\n")
-                            for filename in filenames:
-                                # search for patterns of .vX.log. If there is a match, group
-                                # one is ".v" and group 2 is "X" (X can be any integer >0)
-                                m = re.search("(\.v)(\d+)\.log$", filename)
-                                if bool(m):
-                                    version = int(m[2])
-                                    if latest_version < version:
-                                        latest_version = version
+                        # search for patterns of .vX.log. If there is a match, group
+                        # one is ".v" and group 2 is "X" (X can be any integer >0)
+                        latest_version = base_utils.s3_latest_version("s3://immuneaging/{}/{}".format(aws_dir_name, prefix), "(\.v)(\d+)\.log$")
                         # will be v-1 if we could not find any log file above - this will cause
                         # the code further below to fail to find the file and emit an error message
                         version = "v" + str(latest_version)
@@ -133,10 +123,8 @@ class BaseDigestClass(ABC):
                             version = self.version_ir
                     object_versions.append(version)
                     filename = self._get_log_file_name(object_id, version)
-                    sync_cmd = 'aws s3 sync --no-progress s3://immuneaging/{}/{}/{} {} --exclude "*" --include {}'.format(aws_dir_name, prefix, version, self.working_dir, filename)
                     logger.add_to_log("syncing {}...".format(filename))
-                    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-                    resp = os.popen(sync_cmd).read()
+                    resp = base_utils.aws_sync("s3://immuneaging/{}/{}/{}".format(aws_dir_name, prefix, version), self.working_dir, filename, logger, do_log=False, only_if_changed=True)
                     if len(resp) == 0:
                         logger.add_to_log("empty response from aws.\n", level="error")
                     else:
@@ -210,7 +198,7 @@ class BaseDigestClass(ABC):
                 for key,value in log_lines_to_print.items():
                     if not first_item:
                         # draw a separator line between files
-                        utils.draw_separator_line()
+                        base_utils.draw_separator_line()
                     file_name = key.split("/")[-1]
                     print(file_name + ":\n")
                     for line in value:
@@ -290,7 +278,7 @@ class DigestSampleProcessingLogs(BaseDigestClass):
                 }
                 for line in lines:
                     # cell count
-                    parse_line(line, utils.QC_STRING_COUNTS, 0, CSV_HEADER_CELL_COUNT, csv_row)
+                    parse_line(line, base_utils.QC_STRING_COUNTS, 0, CSV_HEADER_CELL_COUNT, csv_row)
                     # failures and warnings
                     if self._is_failure_line(line):
                         csv_row[CSV_HEADER_FAILED] = "Yes"
@@ -307,18 +295,18 @@ class DigestSampleProcessingLogs(BaseDigestClass):
                         else:
                             csv_row[CSV_HEADER_WARNING_REASON] += " --- " + stripped_line
                     # doublets
-                    parse_line(line, utils.QC_STRING_DOUBLETS, 1, CSV_HEADER_DOUBLETS, csv_row)
+                    parse_line(line, base_utils.QC_STRING_DOUBLETS, 1, CSV_HEADER_DOUBLETS, csv_row)
                     # ambient rna
-                    parse_line(line, utils.QC_STRING_AMBIENT_RNA, 1, CSV_HEADER_AMBIENT_RNA, csv_row)
+                    parse_line(line, base_utils.QC_STRING_AMBIENT_RNA, 1, CSV_HEADER_AMBIENT_RNA, csv_row)
                     # vdj genes
-                    parse_line(line, utils.QC_STRING_VDJ, 1, CSV_HEADER_VDJ, csv_row)
+                    parse_line(line, base_utils.QC_STRING_VDJ, 1, CSV_HEADER_VDJ, csv_row)
                     # red blood cells
-                    parse_line(line, utils.QC_STRING_RBC, 1, CSV_HEADER_RBC, csv_row)
+                    parse_line(line, base_utils.QC_STRING_RBC, 1, CSV_HEADER_RBC, csv_row)
                     # last processed
                     # the "(" acts as a delimiter, to avoid reading more than needed (since we don't currently log a period after the time)
-                    parsed = parse_line(line, utils.QC_STRING_START_TIME + " (", 0, CSV_HEADER_LAST_PROCESSED, csv_row)
+                    parsed = parse_line(line, base_utils.QC_STRING_START_TIME + " (", 0, CSV_HEADER_LAST_PROCESSED, csv_row)
                     if parsed:
-                        csv_row[CSV_HEADER_LAST_PROCESSED] = utils.get_date_from_time(csv_row[CSV_HEADER_LAST_PROCESSED])
+                        csv_row[CSV_HEADER_LAST_PROCESSED] = base_utils.get_date_from_time(csv_row[CSV_HEADER_LAST_PROCESSED])
                 csv_rows.append(csv_row)
 
             # write the csv
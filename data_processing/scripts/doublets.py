@@ -0,0 +1,72 @@
+## Doublet detection with scrublet, separately on every batch (library) of a sample; batches run in parallel in separate
+## python processes that read their batch from a file. This script is also the entry point of these processes:
+## Run as follows: python doublets.py <counts_npz_file> <sim_doublet_ratio> <output_file>
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from typing import Optional
+
+from resources import get_available_memory, run_python_scripts
+
+def _scrublet(X, sim_doublet_ratio: float) -> tuple:
+    import scrublet
+    scores, predictions = scrublet.Scrublet(X, sim_doublet_ratio=sim_doublet_ratio).scrub_doublets()
+    if predictions is None:
+        # scrublet could not set a threshold automatically; no cells are called as doublets in that case
+        predictions = np.zeros(X.shape[0], dtype=bool)
+    return scores, predictions
+
+def _estimate_scrublet_memory(n_obs: int, n_vars: int, nnz: int, sim_doublet_ratio: float) -> int:
+    # rough upper bound (in bytes) of the peak memory of scrublet on one batch: the simulated doublets add sim_doublet_ratio
+    # times the number of cells, and the normalized matrix of the highly variable genes (~15% of the genes) is densified for the PCA
+    n_total = n_obs * (1 + sim_doublet_ratio)
+    return int(n_total * max(1, 0.15 * n_vars) * 8 * 3 + nnz * (1 + 2 * sim_doublet_ratio) * 12 * 2)
+
+def run_scrublet(X, batches: Optional[np.ndarray] = None, max_workers: Optional[int] = None, sim_doublet_ratio: float = 10., tmp_dir: Optional[str] = None) -> tuple:
+    """
+    Runs scrublet separately on every batch of cells (or on all the cells if batches is None) and returns the doublet
+    scores and predictions of all the cells, in the order of the rows of X. X is kept sparse and each batch runs in
+    its own process; the number of concurrent processes is bounded by max_workers (default: number of CPUs) and by the
+    available memory.
+    """
+    if batches is None:
+        batches = np.zeros(X.shape[0], dtype=int)
+    unique_batches = pd.unique(batches)
+    rows = [np.flatnonzero(batches == b) for b in unique_batches]
+    tasks = [X[r] for r in rows]
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    available_memory = get_available_memory()
+    if available_memory is not None:
+        batch_memory = max([_estimate_scrublet_memory(t.shape[0], t.shape[1], t.nnz if hasattr(t, "nnz") else t.size, sim_doublet_ratio) for t in tasks])
+        max_workers = min(max_workers, max(1, available_memory // max(batch_memory, 1)))
+    max_workers = max(1, min(max_workers, len(tasks)))
+    if max_workers == 1:
+        results = [_scrublet(t, sim_doublet_ratio) for t in tasks]
+    else:
+        tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            input_files = [os.path.join(tmp_dir, "batch.{}.npz".format(i)) for i in range(len(tasks))]
+            output_files = [os.path.join(tmp_dir, "scrublet.{}.pkl".format(i)) for i in range(len(tasks))]
+            for t, f in zip(tasks, input_files):
+                scipy.sparse.save_npz(f, scipy.sparse.csr_matrix(t), compressed=False)
+            run_python_scripts([[os.path.abspath(__file__), input_files[i], str(sim_doublet_ratio), output_files[i]] for i in range(len(tasks))], max_workers)
+            results = [pd.read_pickle(f) for f in output_files]
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    order = np.concatenate(rows)
+    doublet_scores = np.empty(X.shape[0], dtype=float)
+    doublet_predictions = np.empty(X.shape[0], dtype=bool)
+    doublet_scores[order] = np.concatenate([r[0] for r in results])
+    doublet_predictions[order] = np.concatenate([r[1] for r in results])
+    return doublet_scores, doublet_predictions
+
+if __name__ == "__main__":
+    counts_file = sys.argv[1]
+    sim_doublet_ratio = float(sys.argv[2])
+    output_file = sys.argv[3]
+    pd.to_pickle(_scrublet(scipy.sparse.load_npz(counts_file), sim_doublet_ratio), output_file)
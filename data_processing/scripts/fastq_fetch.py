@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Type
+
+from logger import BaseLogger
+from s3_utils import S3Object, content_matches, get_max_concurrency, get_object_store, split_s3_path
+
+# Resumable, concurrent download of the fastq files of a library (see align_library.py). Every file is split into parts that are
+# fetched with ranged GETs, and the parts of all the files of the library are fetched concurrently, so that a library of a few
+# large fastqs uses the bandwidth of the node rather than that of a single connection. The transfers start in the background as
+# soon as the files are known and the aligner is started once all of them are present (see FastqFetcher.wait).
+#
+# A file is written into <file>.partial, and the parts that were written are recorded in <file>.parts (after the object's size
+# and etag, so that a changed object starts over). An interrupted job thus resumes from the parts it already has. Once all the
+# parts are there, the file is verified against the manifest (an md5sum file, see read_md5_manifest) when it lists the file, or
+# else against the size and etag of the object (see s3_utils.content_matches), and only then renamed to <file>.
+#
+# The following environment variables can be used to control the transfers (all are optional):
+# IA_FASTQ_MAX_CONCURRENCY - max number of parts fetched concurrently (default IA_S3_MAX_CONCURRENCY)
+# IA_FASTQ_PART_SIZE_MB - size of the parts (default 16)
+
+PARTIAL_SUFFIX = ".partial"
+PARTS_SUFFIX = ".parts"
+DEFAULT_PART_SIZE_MB = 16
+VERIFY_MAX_ATTEMPTS = 2
+
+def read_md5_manifest(path: str) -> Dict[str, str]:
+    # an md5sum file ("<md5>  <file name>" per line); returns {file name (without directories): md5}
+    manifest = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(None, 1)
+            if len(fields) == 2:
+                manifest[os.path.basename(fields[1].lstrip("*"))] = fields[0].lower()
+    return manifest
+
+def file_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class _FileTransfer:
+    def __init__(self, source: str, local_path: str, o: S3Object, part_size: int):
+        self.source = source
+        self.local_path = local_path
+        self.object = o
+        self.part_size = part_size
+        self.n_parts = max(1, -(-o.size // part_size))
+        self.remaining = 0
+        self.attempt = 0
+        self.lock = threading.Lock()
+
+    @property
+    def partial_path(self) -> str:
+        return self.local_path + PARTIAL_SUFFIX
+
+    @property
+    def parts_path(self) -> str:
+        return self.local_path + PARTS_SUFFIX
+
+    def header(self) -> dict:
+        return {"size": self.object.size, "etag": self.object.etag, "last_modified": self.object.last_modified, "part_size": self.part_size}
+
+    def completed_parts(self) -> set:
+        # the parts written by a previous (interrupted) transfer of the same object, if any
+        if not (os.path.isfile(self.partial_path) and os.path.isfile(self.parts_path)):
+            return set()
+        with open(self.parts_path) as f:
+            lines = f.read().split("\n")
+        try:
+            if json.loads(lines[0]) != self.header():
+                return set()
+            # a line that was being written when the transfer was interrupted is incomplete
+            return set([int(i) for i in lines[1:] if i.isdigit() and int(i) < self.n_parts])
+        except ValueError:
+            return set()
+
+    def start(self) -> List[int]:
+        # prepares the partial file; returns the parts that are left to fetch
+        completed = self.completed_parts()
+        if len(completed) == 0:
+            os.makedirs(os.path.dirname(self.local_path), exist_ok = True)
+            with open(self.partial_path, "wb") as f:
+                f.truncate(self.object.size)
+            with open(self.parts_path, "w") as f:
+                f.write(json.dumps(self.header()) + "\n")
+        parts = [i for i in range(self.n_parts) if i not in completed]
+        self.remaining = len(parts)
+        return parts
+
+    def reset(self) -> None:
+        for path in [self.partial_path, self.parts_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+class FastqFetcher:
+    """
+    Downloads the given (s3 path, local path) transfers in the background (see above); call wait() before using the files.
+    manifest maps file names to md5 checksums. Files that already exist locally with the size of the object (and the md5 of the
+    manifest, if it lists them) are not downloaded again.
+    """
+    def __init__(self, transfers: List[Tuple[str, str]], logger: Type[BaseLogger], manifest: Optional[Dict[str, str]] = None,
+        max_concurrency: Optional[int] = None, part_size: Optional[int] = None, store = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("IA_FASTQ_MAX_CONCURRENCY", get_max_concurrency()))
+        if part_size is None:
+            part_size = int(os.environ.get("IA_FASTQ_PART_SIZE_MB", DEFAULT_PART_SIZE_MB)) * 1024 * 1024
+        self.logger = logger
+        self.manifest = {} if manifest is None else manifest
+        self.part_size = part_size
+        self.store = get_object_store() if store is None else store
+        self.local_paths = [os.path.abspath(t[1]) for t in transfers]
+        self._sources = [t[0] for t in transfers]
+        self._cancelled = False
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._pending = len(transfers)
+        self._executor = ThreadPoolExecutor(max_workers = max(1, max_concurrency))
+        self.bytes_fetched = 0
+        for source, local_path in zip(self._sources, self.local_paths):
+            self._executor.submit(self._start, source, local_path)
+
+    def _fail(self, local_path: str, err: Exception) -> None:
+        with self._done:
+            self._errors[local_path] = err
+            self._pending -= 1
+            self._done.notify_all()
+
+    def _finish(self, local_path: str) -> None:
+        with self._done:
+            self._pending -= 1
+            self._done.notify_all()
+
+    def _is_valid(self, path: str, o: S3Object) -> bool:
+        if not os.path.isfile(path) or os.path.getsize(path) != o.size:
+            return False
+        md5 = self.manifest.get(os.path.basename(path[:-len(PARTIAL_SUFFIX)] if path.endswith(PARTIAL_SUFFIX) else path))
+        if md5 is not None:
+            return file_md5(path) == md5
+        return content_matches(path, o) is not False
+
+    def _start(self, source: str, local_path: str) -> None:
+        try:
+            o = self.store.head(*split_s3_path(source))
+            if o is None:
+                raise FileNotFoundError("{} does not exist.".format(source))
+            if os.path.isfile(local_path) and self._is_valid(local_path, o):
+                self.logger.add_to_log("file {} is already in local.".format(local_path))
+                self._finish(local_path)
+                return
+            transfer = _FileTransfer(source, local_path, o, self.part_size)
+            self._submit_parts(transfer)
+        except Exception as err:
+            self._fail(local_path, err)
+
+    def _submit_parts(self, transfer: _FileTransfer) -> None:
+        parts = transfer.start()
+        if len(parts) < transfer.n_parts:
+            self.logger.add_to_log("Resuming the download of {} ({} of {} parts left)...".format(transfer.source, len(parts), transfer.n_parts))
+        if len(parts) == 0:
+            self._complete(transfer)
+        for i in parts:
+            self._executor.submit(self._fetch_part, transfer, i)
+
+    def _fetch_part(self, transfer: _FileTransfer, i: int) -> None:
+        if self._cancelled or transfer.local_path in self._errors:
+            return
+        try:
+            start = i * transfer.part_size
+            length = min(transfer.part_size, transfer.object.size - start)
+            data = self.store.read_range(*split_s3_path(transfer.source), start, length)
+            if len(data) != length:
+                raise IOError("Got {} bytes instead of {} from {} at offset {}.".format(len(data), length, transfer.source, start))
+            with open(transfer.partial_path, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+            with transfer.lock:
+                # recorded only once the part is written
+                with open(transfer.parts_path, "a") as f:
+                    f.write("{}\n".format(i))
+                transfer.remaining -= 1
+                last = transfer.remaining == 0
+            with self._lock:
+                self.bytes_fetched += length
+            if last:
+                self._complete(transfer)
+        except Exception as err:
+            self._fail(transfer.local_path, err)
+
+    def _complete(self, transfer: _FileTransfer) -> None:
+        if self._is_valid(transfer.partial_path, transfer.object):
+            os.replace(transfer.partial_path, transfer.local_path)
+            os.remove(transfer.parts_path)
+            # like the aws cli, keep the modification time of the object
+            os.utime(transfer.local_path, (transfer.object.last_modified, transfer.object.last_modified))
+            self._finish(transfer.local_path)
+            return
+        transfer.reset()
+        transfer.attempt += 1
+        if transfer.attempt >= VERIFY_MAX_ATTEMPTS:
+            self._fail(transfer.local_path, ValueError("Failed to download {}: the downloaded file does not match the size or checksum "
+                "of the {}.".format(transfer.source, "manifest" if os.path.basename(transfer.local_path) in self.manifest else "object")))
+            return
+        self.logger.add_to_log("Downloaded file {} does not match {} (attempt {} of {}).".format(
+            transfer.local_path, transfer.source, transfer.attempt, VERIFY_MAX_ATTEMPTS), level = "warning")
+        self._submit_parts(transfer)
+
+    def wait(self) -> bool:
+        """
+        Waits for all the files to be downloaded and verified. Returns True if all of them are available locally; failures are logged.
+        """
+        with self._done:
+            while self._pending > 0 and not self._cancelled:
+                self._done.wait()
+        for local_path, err in self._errors.items():
+            self.logger.add_to_log("Failed to download {}: {}".format(local_path, err), level = "error")
+        return not self._cancelled and len(self._errors) == 0
+
+    def cancel(self) -> None:
+        # stops fetching parts (e.g. if the alignment outputs already exist); the parts written so far are kept for resuming
+        with self._done:
+            self._cancelled = True
+            self._done.notify_all()
+        self._executor.shutdown(wait = True)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait = True)
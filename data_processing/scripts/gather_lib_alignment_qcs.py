@@ -27,6 +27,8 @@ from utils import *
 set_access_keys(s3_access_file)
 
 logger = RichLogger()
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
 
 CSV_FIELDS_FOR_GEX = {
     "Estimated Number of Cells",
@@ -65,29 +67,19 @@ def combine_data(samples, donor_id, seq_run, site):
         column_name = "{} lib".format(lib_type)
         libs_all = samples[indices][column_name]
         failed_libs = set()
-        ls_cmd = "aws s3 ls s3://immuneaging/aligned_libraries --recursive"
-        ls  = os.popen(ls_cmd).read()
         for i in range(len(libs_all)):
             if libs_all.iloc[i] is np.nan:
                 continue
             libs = libs_all.iloc[i].split(",")
             for lib in libs:
-                # find the latest aligned_lib_version
-                latest_version = -1
-                if len(ls) != 0:
-                    filenames = ls.split("\n")
-                    if lib_type == "GEX":
-                        # search for patterns of <lib id>.vX.h5ad. If there is a match, group
-                        # one is "<lib id>.v" and group 2 is "X" (X can be any integer >0)
-                        pattern = "({}\.v)(\d+)\.h5ad$".format(lib)
-                    else:
-                        pattern = "({}_{}\.cellranger\.filtered_contig_annotations\.v)(\d+)\.csv".format(lib_type, lib)
-                    for filename in filenames:
-                        m = re.search(pattern, filename)
-                        if bool(m):
-                            version = int(m[2])
-                            if latest_version < version:
-                                latest_version = version
+                # find the latest aligned_lib_version (the aligned_libraries listing is cached in the local listing index)
+                if lib_type == "GEX":
+                    # search for patterns of <lib id>.vX.h5ad. If there is a match, group
+                    # one is "<lib id>.v" and group 2 is "X" (X can be any integer >0)
+                    pattern = "({}\.v)(\d+)\.h5ad$".format(lib)
+                else:
+                    pattern = "({}_{}\.cellranger\.filtered_contig_annotations\.v)(\d+)\.csv".format(lib_type, lib)
+                latest_version = s3_latest_version("s3://immuneaging/aligned_libraries", pattern, component=lib)
                 if latest_version == -1:
                     failed_libs.add(lib)
                     # skip
@@ -107,11 +99,8 @@ def combine_data(samples, donor_id, seq_run, site):
             aligned_lib_version = lib[2]
             logger.add_to_log("Downloading metrics.csv file for lib id {}, lib type {} from S3...".format(lib_id, lib_type))
             metrics_csv_file_name = "{}_{}_{}_{}.cellranger.metrics_summary.csv".format(donor_id, seq_run, lib_type, lib_id)
-            sync_cmd = 'aws s3 sync --no-progress s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/ {} --exclude "*" --include {}'.format(
-                aligned_lib_version, donor_id, seq_run, lib_type, lib_id, lib_data_dir, metrics_csv_file_name
-            )
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-            logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+            s3_dir = "s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/".format(aligned_lib_version, donor_id, seq_run, lib_type, lib_id)
+            aws_sync(s3_dir, lib_data_dir, metrics_csv_file_name, logger, only_if_changed=True)
             metrics_csv_file = os.path.join(lib_data_dir, metrics_csv_file_name)
             if not os.path.isfile(metrics_csv_file):
                 msg = "Failed to download file {} from S3.".format(metrics_csv_file)
@@ -140,9 +129,7 @@ def combine_data(samples, donor_id, seq_run, site):
                 combined_df.to_csv(f)
             # upload the combined csv file to AWS
             logger.add_to_log("Uploading combined metrics file {} to S3...".format(combined_metrics.split("/")[-1]))
-            sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/combined_lib_alignment_metrics/{}/ --exclude "*" --include {}'.format(data_dir, generic_lib_type, combined_metrics.split("/")[-1])
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-            logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+            uploads.submit(data_dir, "s3://immuneaging/combined_lib_alignment_metrics/{}/".format(generic_lib_type), combined_metrics.split("/")[-1])
         else:
             combined_metrics = ""
 
@@ -160,11 +147,8 @@ def combine_data(samples, donor_id, seq_run, site):
             aligned_lib_version = lib[2]
             logger.add_to_log("Downloading aligned h5ad file for lib id {}, lib type {} from S3...".format(lib_id, lib_type))
             aligned_h5ad_file_name = "{}_{}.{}.{}.h5ad".format(donor_id, seq_run, lib_id, aligned_lib_version)
-            sync_cmd = 'aws s3 sync --no-progress s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/ {} --exclude "*" --include {}'.format(
-                aligned_lib_version, donor_id, seq_run, lib_type, lib_id, lib_data_dir, aligned_h5ad_file_name
-            )
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-            logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+            s3_dir = "s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/".format(aligned_lib_version, donor_id, seq_run, lib_type, lib_id)
+            aws_sync(s3_dir, lib_data_dir, aligned_h5ad_file_name, logger, only_if_changed=True)
             aligned_h5ad_file = os.path.join(lib_data_dir, aligned_h5ad_file_name)
             if not os.path.isfile(aligned_h5ad_file):
                 msg = "Failed to download file {} from S3.".format(aligned_h5ad_file)
@@ -207,9 +191,7 @@ def combine_csv_all_donors(lib_type: str, per_donor_files: List[str]):
     with open(all_donors_metrics, 'w') as f:
         combined_df.to_csv(f)
     logger.add_to_log("☑ Uploading combined metrics across all donors for lib type {} to S3...".format(lib_type))
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/combined_lib_alignment_metrics/{}/ --exclude "*" --include {}'.format(output_destination, lib_type, all_donors_metrics.split("/")[-1])
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(output_destination, "s3://immuneaging/combined_lib_alignment_metrics/{}/".format(lib_type), all_donors_metrics.split("/")[-1])
 
 def plot_data_all_donors(lib_type: str, per_donor_data: List[pd.DataFrame]):
     if lib_type != "GEX":
@@ -237,18 +219,14 @@ def plot_data_all_donors(lib_type: str, per_donor_data: List[pd.DataFrame]):
     with open(d_file, 'w') as f:
         d.to_csv(f)
     logger.add_to_log("☑ Uploading combined lib data across all donors for lib type {} to S3...".format(lib_type))
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/combined_lib_alignment_metrics/{}/ --exclude "*" --include {}'.format(output_destination, lib_type, d_file.split("/")[-1])
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(output_destination, "s3://immuneaging/combined_lib_alignment_metrics/{}/".format(lib_type), d_file.split("/")[-1])
     # now plot
     g = sns.catplot(x="Count type", y="Counts", col="Lib id", data=d, kind="violin", col_wrap=4).set(xlabel=None, ylabel=None)
     plt.show()
     fig_path = os.path.join(output_destination, "all_donors_per_{}_lib_counts.pdf".format(lib_type))
     g.fig.savefig(fig_path, dpi=100)
     logger.add_to_log("☑ Uploading combined lib plots across all donors for lib type {} to S3...".format(lib_type))
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/combined_lib_alignment_metrics/{}/ --exclude "*" --include {}'.format(output_destination, lib_type, fig_path.split("/")[-1])
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(output_destination, "s3://immuneaging/combined_lib_alignment_metrics/{}/".format(lib_type), fig_path.split("/")[-1])
 
 donors = read_immune_aging_sheet("Donors")
 samples = read_immune_aging_sheet("Samples")
@@ -270,3 +248,4 @@ if task_type == "csv":
     combine_csv_all_donors("IR", per_donor_ir_combined)
 else:
     plot_data_all_donors("GEX", per_donor_gex_combined)
+uploads.wait()
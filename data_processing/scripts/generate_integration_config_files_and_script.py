@@ -8,6 +8,7 @@ import sys
 import os
 import json
 import numpy as np
+import pandas as pd
 import re 
 
 code_path = sys.argv[1]
@@ -18,7 +19,7 @@ apply_filtering = sys.argv[5]
 assert integration_level in ["tissue", "compartment", "all"]
 
 sys.path.append(code_path)
-from utils import *
+from base_utils import *
 
 python_env = "immune_aging.py_env.v4"
 
@@ -133,18 +134,13 @@ for tissue_or_compartment in tissues_or_compartments:
             if sample_id in bad_sample_id:
                 print(f'Removed {sample_id} from integration as it was defined in bad_sample_id.')
                 continue
-            ls_cmd = "aws s3 ls s3://immuneaging/processed_samples/{}_GEX --recursive | grep .log".format(sample_id)
-            ls  = os.popen(ls_cmd).read()
-            if len(ls) == 0:
-                continue
+            filenames = s3_list_cached("s3://immuneaging/processed_samples/{}_GEX".format(sample_id), contains=".log")
             # find the latest version available
-            filenames = ls.split("\n")[:-1]
             if len(filenames):
                 for latest_version in sorted([int(i.split('.')[-2][1:]) for i in filenames], reverse=True):
                     version = "v"+str(latest_version)
                     # check if h5ad file is available
-                    ls_cmd = "aws s3 ls s3://immuneaging/processed_samples/{0}_GEX/{1}/{0}_GEX.processed.{1}.h5ad".format(sample_id,version)
-                    if len(os.popen(ls_cmd).read())>0:
+                    if s3_exists_cached("s3://immuneaging/processed_samples/{0}_GEX/{1}/{0}_GEX.processed.{1}.h5ad".format(sample_id,version)):
                         versions.append(version)
                         final_sample_ids.append(sample_id)
                         break
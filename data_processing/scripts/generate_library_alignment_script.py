@@ -1,6 +1,7 @@
 """
 This script creates a bash script that can be used for executing the library alignment pipeline for a single donor.
 The script gets a configuration file (for a specific donor), path to the immune aging code base, and a filename for the bash output file.
+It also writes a jobs file for running the alignments concurrently rather than in sequence (see alignment_scheduler.py).
 
 **NOTE**: the path to the code base and path to the configs file must be absolute paths.
 
@@ -10,6 +11,7 @@ python generate_library_alignment_script.py donor_id seq_run /path/to/code /path
 
 import os
 import sys
+import json
 import pandas as pd
 
 donor_id = sys.argv[1]
@@ -19,7 +21,7 @@ configs_file = sys.argv[4]
 output_dir = sys.argv[5]
 
 sys.path.append(code_path)
-from utils import *
+from base_utils import *
 
 configs = load_configs(configs_file)
 
@@ -62,6 +64,7 @@ for i in range(len(sample_indices)):
 l_cd_mkdir = []
 l_align_lib = []
 l_align_msg = []
+jobs = []
 donor_run = "_".join([donor_id,seq_run])
 for r in GEX_runs:
     # name the dir after the GEX lib's name
@@ -77,6 +80,10 @@ for r in TCR_runs:
     l_cd_mkdir.append(os.path.join(output_dir, "S3", donor_run, "{}-{}".format(r,"TCR")))
     l_align_lib.append("python {0}/align_library.py {1} {0} TCR {2}".format(code_path, configs_file, r))
     l_align_msg.append("echo \"Execution of align_library.py on TCR {} is complete.\"".format(r))
+for work_dir, align_lib in zip(l_cd_mkdir, l_align_lib):
+    lib_type, lib_ids = align_lib.split(" ")[-2:]
+    jobs.append({"name": "{} {}".format(lib_type, lib_ids), "lib_type": lib_type, "work_dir": work_dir,
+        "fastq_dir": os.path.join(work_dir, "fastq"), "command": [sys.executable] + align_lib.split(" ")[1:]})
 
 alignment_script = "{}_align_libraries.sh".format(donor_run)
 f = open(alignment_script,'w')
@@ -89,3 +96,9 @@ for i in range(len(l_cd_mkdir)):
     f.write(l_align_msg[i] + "\n")
 f.close()
 print("generated file " + alignment_script)
+
+jobs_file = "{}_align_libraries.jobs.json".format(donor_run)
+with open(jobs_file, "w") as f:
+    json.dump(jobs, f, indent = 2)
+print("generated file {} (run the alignments concurrently with: python {} {})".format(jobs_file,
+    os.path.join(code_path, "alignment_scheduler.py"), jobs_file))
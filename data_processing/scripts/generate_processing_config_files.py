@@ -15,6 +15,7 @@ import sys
 import os
 import json
 from typing import List
+import numpy as np
 from logger import RichLogger
 
 config_type = sys.argv[1]
@@ -28,7 +29,7 @@ processed_ir_lib_version = sys.argv[8]
 sandbox_mode = sys.argv[9]
 
 sys.path.append(code_path)
-from utils import *
+from base_utils import *
 
 celltypist_model_urls = "https://celltypist.cog.sanger.ac.uk/models/Pan_Immune_CellTypist/v2/Immune_All_Low.pkl,https://celltypist.cog.sanger.ac.uk/models/Pan_Immune_CellTypist/v2/Immune_All_High.pkl"
 rbc_model_url = "s3://immuneaging/unpublished_celltypist_models/RBC_model_CZI.pkl"
@@ -47,8 +48,6 @@ if config_type in ["library", "all"]:
         failed_libs = set()
         #Read from AWS, single call and fetching is faster.
         set_access_keys(s3_access_file)
-        ls_cmd = "aws s3 ls s3://immuneaging/aligned_libraries --recursive"
-        ls  = os.popen(ls_cmd).read()
         
         for i in range(len(libs_all)):
             if libs_all.iloc[i] is np.nan:
@@ -58,22 +57,14 @@ if config_type in ["library", "all"]:
             for j in range(len(libs)):
                 lib = libs[j]
                 corresponding_gex_lib = gex_libs[j]
-                # find the latest aligned_lib_version
-                latest_version = -1
-                if len(ls) != 0:
-                    filenames = ls.split("\n")
-                    if lib_type == "GEX":
-                        # search for patterns of <lib id>.vX.h5ad. If there is a match, group
-                        # one is "<lib id>.v" and group 2 is "X" (X can be any integer >0)
-                        pattern = "({}\.v)(\d+)\.h5ad$".format(lib)
-                    else:
-                        pattern = "({}_{}\.cellranger\.filtered_contig_annotations\.v)(\d+)\.csv".format(lib_type, lib)
-                    for filename in filenames:
-                        m = re.search(pattern, filename)
-                        if bool(m):
-                            version = int(m[2])
-                            if latest_version < version:
-                                latest_version = version
+                # find the latest aligned_lib_version (the aligned_libraries listing is cached in the local listing index)
+                if lib_type == "GEX":
+                    # search for patterns of <lib id>.vX.h5ad. If there is a match, group
+                    # one is "<lib id>.v" and group 2 is "X" (X can be any integer >0)
+                    pattern = "({}\.v)(\d+)\.h5ad$".format(lib)
+                else:
+                    pattern = "({}_{}\.cellranger\.filtered_contig_annotations\.v)(\d+)\.csv".format(lib_type, lib)
+                latest_version = s3_latest_version("s3://immuneaging/aligned_libraries", pattern, component=lib)
                 if latest_version == -1:
                     failed_libs.add(lib)
                     # skip
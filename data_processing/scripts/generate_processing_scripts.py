@@ -1,4 +1,6 @@
 ## This script generates .sh files with commands for running the current processing jobs in the job queue on S3 (one script for running the library processing jobs in the queue and one for the sample processing jobs).
+## The generated files can also be run all at once, as a dependency graph on one node, with pipeline_dag.py (e.g. python pipeline_dag.py <state_file> <generated files>).
+## Alternatively, the jobs can be left in the queue and pulled by job_worker.py daemons running on any number of nodes.
 ## Example: python generate_processing_scripts.py <aws_credentials_file> /data/yosef2/scratch/immuneaging/processing_results /data/yosef2/users/erahmani/projects/immune_aging/code /data/yosef2/scratch/immuneaging/jobs_sh
 
 import sys
@@ -12,8 +14,8 @@ output_destination = sys.argv[2]
 code_path = sys.argv[3]
 output_path = sys.argv[4]
 
-sys.path.append("code_path")
-from utils import *
+sys.path.append(code_path)
+from base_utils import *
 set_access_keys(s3_access_file)
 
 os.system("mkdir -p " + output_destination)
@@ -30,18 +32,16 @@ outfiles = []
 
 for job_type in ("process_library", "process_sample"):
     sh_cmds = {}
-    ls_cmd = 'aws s3 ls s3://immuneaging/job_queue/{}/'.format(job_type)
-    aws_response = os.popen(ls_cmd).read()
-    if len(aws_response):
-        sync_cmd = 'aws s3 cp --recursive --no-progress s3://immuneaging/job_queue/{}/ {}'.format(job_type, jobs_queue_destination)
-        print("Running aws command: " + sync_cmd)
-        print("output:\n" + os.popen(sync_cmd).read())
+    queued_files = s3_ls('s3://immuneaging/job_queue/{}/'.format(job_type))
+    if len(queued_files):
+        print("Downloading the job queue of type {} from S3 into {}".format(job_type, jobs_queue_destination))
+        print("output:\n" + s3_sync('s3://immuneaging/job_queue/{}/'.format(job_type), jobs_queue_destination, only_if_changed=False))
     else:
         print("No jobs of type " + job_type)
         next
-    for i in aws_response.split("\n"):
+    for i in queued_files:
         if "configs" in i:
-            configs_filename = i.split(" ")[-1]
+            configs_filename = i
             queue_filename = os.path.join(jobs_queue_destination,configs_filename)
             with open(queue_filename, "r") as f:
                 configs = json.loads(f.read())
@@ -58,8 +58,7 @@ for job_type in ("process_library", "process_sample"):
             # add commands for running the current job
             sh_cmds[configs["donor"]].append('{}'.format(run_filename))
     # move the original file on S3 from the queue to the running folder
-    mv_cmd = 'aws s3 mv --recursive s3://immuneaging/job_queue/{0}/ s3://immuneaging/job_queue/{0}.running/ --exclude "*" --include "{0}*"'.format(job_type)
-    os.system(mv_cmd)
+    s3_mv('s3://immuneaging/job_queue/{0}/'.format(job_type), 's3://immuneaging/job_queue/{0}.running/'.format(job_type), recursive=True, include="{0}*".format(job_type))
     # save the commands in sh_cmds, for each donor separately
     if len(sh_cmds):
         for i in sh_cmds:
@@ -73,5 +72,7 @@ for job_type in ("process_library", "process_sample"):
 if (len(outfiles)):
     print("Generated the following files:")
     print(outfiles)
+    print("To run them all at once (libraries concurrently, then the samples that use them): python {} {} {}".format(
+        os.path.join(code_path, "pipeline_dag.py"), os.path.join(output_path, "pipeline_dag.state.json"), " ".join(outfiles)))
 else:
     print("There are no jobs to run. Generated no files.")
\ No newline at end of file
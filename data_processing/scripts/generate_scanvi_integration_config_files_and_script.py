@@ -15,7 +15,7 @@ integration_level = sys.argv[4]
 assert integration_level in ["tissue", "compartment"]
 
 sys.path.append(code_path)
-from utils import *
+from base_utils import *
 
 python_env = "immune_aging.py_env.v4"
 celltypist_model_urls = "https://celltypist.cog.sanger.ac.uk/models/Pan_Immune_CellTypist/v2/Immune_All_Low.pkl,https://celltypist.cog.sanger.ac.uk/models/Pan_Immune_CellTypist/v2/Immune_All_High.pkl"
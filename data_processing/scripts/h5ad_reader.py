@@ -0,0 +1,350 @@
+import os
+import h5py
+import posixpath
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from typing import List, Optional, Sequence
+
+from s3_utils import S3ObjectFile, is_s3_path
+
+# Lazy reading of h5ad files. Many scripts need only a small part of an h5ad file (its number of cells, its barcodes, a few obs
+# columns, or the cells of one compartment), yet used to download the whole file and load all of it (including X, layers and
+# obsm) into memory. H5adReader opens the file without loading anything and reads only the requested obs/var columns, obsm keys,
+# layers and rows directly from the HDF5 file. Files on S3 are opened through ranged reads (see s3_utils.S3ObjectFile), so only
+# the parts that are read are transferred.
+#
+# The parts that are read are the same objects (values, dtypes, index) as the corresponding parts of anndata.read_h5ad(),
+# subset to the requested rows. varm, obsp and varp are not read.
+#
+# Both the layout written by anndata 0.7 (categories referenced by an attribute of the codes) and the encodings of later versions
+# (encoding-type attributes) are supported. The same layout is read from zarr stores (see zarr_store.ZarrReader), whose groups and
+# arrays have the same interface as those of h5py.
+#
+# X, layers and obsm keys that are HDF5 external links to another h5ad file in the same directory are read from that file, which
+# is opened the same way (i.e. through ranged reads on S3).
+
+# number of rows read at a time when reading a subset of the rows; blocks that contain none of the rows are skipped
+ROWS_PER_BLOCK = 16384
+# within a block, rows are read as separate ranges only if they form at most this many runs of consecutive rows
+MAX_RUNS_PER_BLOCK = 32
+
+def _attr(elem, name: str, default = None):
+    value = elem.attrs.get(name, default)
+    return value.decode() if isinstance(value, bytes) else value
+
+def _encoding(elem) -> str:
+    encoding = _attr(elem, "encoding-type")
+    if encoding is None and "h5sparse_format" in elem.attrs:
+        # written by anndata < 0.7
+        encoding = _attr(elem, "h5sparse_format") + "_matrix"
+    return encoding
+
+def _is_array(elem) -> bool:
+    # an h5py dataset or a zarr array (as opposed to a group)
+    return not hasattr(elem, "keys")
+
+def _column_order(group) -> List[str]:
+    return [c.decode() if isinstance(c, bytes) else c for c in group.attrs.get("column-order", [])]
+
+def _runs(rows: np.ndarray) -> List[tuple]:
+    # [start, end) ranges of consecutive rows in the given sorted rows
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(rows)]])
+    return [(rows[s], rows[e-1] + 1) for s, e in zip(starts, ends)]
+
+def _blocks(rows: np.ndarray) -> List[tuple]:
+    # groups the given sorted rows by block of ROWS_PER_BLOCK rows; returns (rows of the block, ranges to read)
+    blocks = []
+    if len(rows) == 0:
+        return blocks
+    block_ids = rows // ROWS_PER_BLOCK
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(block_ids) != 0) + 1, [len(rows)]])
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        block_rows = rows[s:e]
+        runs = _runs(block_rows)
+        if len(runs) > MAX_RUNS_PER_BLOCK:
+            runs = [(block_rows[0], block_rows[-1] + 1)]
+        blocks.append((block_rows, runs))
+    return blocks
+
+def _decode_strings(x: np.ndarray) -> np.ndarray:
+    # string fields of structured arrays (e.g. uns["rank_genes_groups"]["names"]) are read as bytes
+    fields = [(name, object if x.dtype[name].kind == "S" or h5py.check_string_dtype(x.dtype[name]) is not None else x.dtype[name])
+        for name in x.dtype.names]
+    decoded = np.empty(x.shape, dtype = fields)
+    for name in x.dtype.names:
+        if decoded.dtype[name] == object:
+            decoded[name] = [v.decode() if isinstance(v, bytes) else v for v in x[name].ravel()]
+        else:
+            decoded[name] = x[name]
+    return decoded
+
+def _read_rows(dataset, rows: Optional[np.ndarray]) -> np.ndarray:
+    # reads the given sorted rows (or all rows if rows is None) of a dense dataset
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        dataset = dataset.asstr()
+    if rows is None:
+        x = dataset[()]
+        return _decode_strings(x) if isinstance(x, np.ndarray) and x.dtype.names is not None else x
+    parts = []
+    for block_rows, runs in _blocks(rows):
+        for start, end in runs:
+            part = dataset[start:end]
+            in_run = block_rows[(block_rows >= start) & (block_rows < end)]
+            parts.append(part if len(in_run) == end - start else part[in_run - start])
+    if len(parts) == 0:
+        return dataset[0:0]
+    return np.concatenate(parts)
+
+def _read_sparse(group, rows: Optional[np.ndarray]) -> scipy.sparse.spmatrix:
+    encoding = _encoding(group)
+    shape = tuple(group.attrs["shape"] if "shape" in group.attrs else group.attrs["h5sparse_shape"])
+    matrix_type = scipy.sparse.csr_matrix if encoding == "csr_matrix" else scipy.sparse.csc_matrix
+    if rows is None or encoding != "csr_matrix":
+        matrix = matrix_type((group["data"][()], group["indices"][()], group["indptr"][()]), shape = shape)
+        return matrix if rows is None else matrix[rows, :]
+    # read only the entries of the requested rows
+    indptr = group["indptr"][()]
+    data, indices, lengths = [], [], []
+    for block_rows, runs in _blocks(rows):
+        for start, end in runs:
+            run_data = group["data"][indptr[start]:indptr[end]]
+            run_indices = group["indices"][indptr[start]:indptr[end]]
+            run_lengths = np.diff(indptr[start:end+1])
+            in_run = block_rows[(block_rows >= start) & (block_rows < end)]
+            if len(in_run) < end - start:
+                keep = np.zeros(end - start, dtype = bool)
+                keep[in_run - start] = True
+                entries = np.repeat(keep, run_lengths)
+                run_data, run_indices, run_lengths = run_data[entries], run_indices[entries], run_lengths[keep]
+            data.append(run_data)
+            indices.append(run_indices)
+            lengths.append(run_lengths)
+    if len(data) == 0:
+        data, indices, lengths = [group["data"][0:0]], [group["indices"][0:0]], [np.zeros(0, dtype = indptr.dtype)]
+    new_indptr = np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(indptr.dtype)
+    return scipy.sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), new_indptr), shape = (len(rows), shape[1]))
+
+def _read_column(group, name: str, rows: Optional[np.ndarray]):
+    elem = group[name]
+    encoding = _encoding(elem)
+    if encoding == "categorical":
+        codes = _read_rows(elem["codes"], rows)
+        categories = _read_rows(elem["categories"], None)
+        return pd.Categorical.from_codes(codes, categories, ordered = bool(_attr(elem, "ordered", False)))
+    if encoding in ["nullable-integer", "nullable-boolean"]:
+        values, mask = _read_rows(elem["values"], rows), _read_rows(elem["mask"], rows)
+        if encoding == "nullable-integer":
+            return pd.arrays.IntegerArray(values, mask)
+        return pd.arrays.BooleanArray(values, mask)
+    if encoding == "nullable-string-array":
+        values = _read_rows(elem["values"], rows).astype(object)
+        values[_read_rows(elem["mask"], rows)] = pd.NA
+        return pd.array(values, dtype = "string")
+    if "categories" in elem.attrs:
+        # anndata 0.7: the categories are in obs/__categories/<name>, referenced by an object reference in h5ad files and by a path
+        # relative to the data frame in zarr stores
+        categories = elem.attrs["categories"]
+        categories = group[categories] if isinstance(categories, str) else elem.file[categories]
+        return pd.Categorical.from_codes(_read_rows(elem, rows), _read_rows(categories, None), ordered = bool(_attr(categories, "ordered", False)))
+    return _read_rows(elem, rows)
+
+def _read_dataframe(group, columns: Optional[Sequence[str]], rows: Optional[np.ndarray]) -> pd.DataFrame:
+    index_key = _attr(group, "_index")
+    column_order = _column_order(group)
+    if columns is None:
+        columns = column_order
+    else:
+        missing = [c for c in columns if c not in column_order]
+        if len(missing) > 0:
+            raise ValueError("Columns {} not found in {}.".format(missing, group.name))
+    index = pd.Index(_read_rows(group[index_key], rows), name = None if index_key == "_index" else index_key)
+    return pd.DataFrame({c: _read_column(group, c, rows) for c in columns}, index = index, columns = list(columns))
+
+def _read_matrix(elem, rows: Optional[np.ndarray]):
+    if _is_array(elem):
+        return _read_rows(elem, rows)
+    encoding = _encoding(elem)
+    if encoding == "dataframe":
+        return _read_dataframe(elem, None, rows)
+    if encoding in ["csr_matrix", "csc_matrix"]:
+        return _read_sparse(elem, rows)
+    raise ValueError("Unsupported encoding {} of {}.".format(encoding, elem.name))
+
+def _read_dict(group) -> dict:
+    # uns (or part of it): nested dicts of arrays, scalars, data frames and sparse matrices
+    uns = {}
+    for k in group.keys():
+        elem = group[k]
+        if _is_array(elem):
+            uns[k] = _read_rows(elem, None)
+            if _encoding(elem) == "numeric-scalar":
+                uns[k] = uns[k].item()
+        elif _encoding(elem) in ["dataframe", "csr_matrix", "csc_matrix"]:
+            uns[k] = _read_matrix(elem, None)
+        elif _encoding(elem) is not None and _encoding(elem) != "dict":
+            uns[k] = _read_column(group, k, None)
+        else:
+            uns[k] = _read_dict(elem)
+    return uns
+
+class H5adReader:
+    """
+    Opens an h5ad file (a local path or an S3 path) without reading its content; see above. Use as a context manager or call close().
+    Rows can be given as a boolean mask, as integer indices (in any order) or, through rows_of(), as barcodes.
+    """
+    def __init__(self, path: str, store = None):
+        self.path = path
+        self.fileobj = S3ObjectFile(path, store = store) if is_s3_path(path) else None
+        self.file = h5py.File(self.fileobj if self.fileobj is not None else path, "r")
+        self._obs_names = None
+        self._linked = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        for reader in self._linked.values():
+            reader.close()
+        self.file.close()
+        if self.fileobj is not None:
+            self.fileobj.close()
+
+    @property
+    def bytes_read(self) -> int:
+        # number of bytes transferred so far (files on S3 only), including those of the linked files
+        own = self.fileobj.bytes_read if self.fileobj is not None else 0
+        return own + sum([reader.bytes_read for reader in self._linked.values()])
+
+    def _get(self, *keys):
+        # the element at the given path, following external links (relative to the directory of this file)
+        elem = self.file
+        for key in keys:
+            link = elem.get(key, getlink = True) if isinstance(elem, h5py.Group) else None
+            if isinstance(link, h5py.ExternalLink):
+                if link.filename not in self._linked:
+                    path_module = posixpath if is_s3_path(self.path) else os.path
+                    self._linked[link.filename] = H5adReader(path_module.join(path_module.dirname(self.path), link.filename))
+                elem = self._linked[link.filename].file[link.path]
+            else:
+                elem = elem[key]
+        return elem
+
+    @property
+    def n_obs(self) -> int:
+        # read from the metadata of the index, without reading the index
+        return self.file["obs"][_attr(self.file["obs"], "_index")].shape[0]
+
+    @property
+    def n_vars(self) -> int:
+        return self.file["var"][_attr(self.file["var"], "_index")].shape[0]
+
+    @property
+    def obs_names(self) -> pd.Index:
+        if self._obs_names is None:
+            self._obs_names = _read_dataframe(self.file["obs"], [], None).index
+        return self._obs_names
+
+    @property
+    def var_names(self) -> pd.Index:
+        return _read_dataframe(self.file["var"], [], None).index
+
+    def obs_keys(self) -> List[str]:
+        return _column_order(self.file["obs"])
+
+    def obsm_keys(self) -> List[str]:
+        return list(self.file["obsm"].keys()) if "obsm" in self.file else []
+
+    def layers_keys(self) -> List[str]:
+        return list(self.file["layers"].keys()) if "layers" in self.file else []
+
+    def rows_of(self, barcodes: Sequence[str]) -> np.ndarray:
+        # the rows of the cells with the given barcodes, in the order of the file (as with adata[adata.obs_names.isin(barcodes)])
+        return np.flatnonzero(self.obs_names.isin(barcodes))
+
+    def _sorted_rows(self, rows):
+        # returns (sorted unique rows, order of the requested rows within them)
+        if rows is None:
+            return None, None
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            return np.flatnonzero(rows), None
+        rows = np.where(rows < 0, rows + self.n_obs, rows)
+        unique_rows, order = np.unique(rows, return_inverse = True)
+        if len(unique_rows) == len(rows) and np.all(order == np.arange(len(rows))):
+            order = None
+        return unique_rows, order
+
+    @staticmethod
+    def _reorder(x, order):
+        if order is None:
+            return x
+        return x.iloc[order] if isinstance(x, pd.DataFrame) else x[order]
+
+    def nnz(self, layer: Optional[str] = None, rows = None) -> int:
+        # number of stored entries of X (or of the given layer) in the given rows, from the indptr of a csr matrix
+        group = self._get("X") if layer is None else self._get("layers", layer)
+        if _encoding(group) != "csr_matrix":
+            raise ValueError("{} is not a csr matrix.".format(group.name))
+        lengths = np.diff(group["indptr"][()])
+        return int(lengths.sum() if rows is None else lengths[np.asarray(rows)].sum())
+
+    def read_obs(self, columns: Optional[Sequence[str]] = None, rows = None) -> pd.DataFrame:
+        subset = rows is not None
+        rows, order = self._sorted_rows(rows)
+        obs = self._reorder(_read_dataframe(self.file["obs"], columns, rows), order)
+        if subset:
+            # as in a copy of a subset of an AnnData object
+            for c in obs.columns:
+                if isinstance(obs[c].dtype, pd.CategoricalDtype):
+                    obs[c] = obs[c].cat.remove_unused_categories()
+        return obs
+
+    def read_var(self, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        return _read_dataframe(self.file["var"], columns, None)
+
+    def read_X(self, rows = None):
+        rows, order = self._sorted_rows(rows)
+        return self._reorder(_read_matrix(self._get("X"), rows), order)
+
+    def read_layer(self, key: str, rows = None):
+        rows, order = self._sorted_rows(rows)
+        return self._reorder(_read_matrix(self._get("layers", key), rows), order)
+
+    def read_obsm(self, key: str, rows = None):
+        rows, order = self._sorted_rows(rows)
+        return self._reorder(_read_matrix(self._get("obsm", key), rows), order)
+
+    def read_uns(self) -> dict:
+        return _read_dict(self.file["uns"]) if "uns" in self.file else {}
+
+    def read(self, obs: Optional[Sequence[str]] = None, var: Optional[Sequence[str]] = None, X: bool = True,
+        obsm: Optional[Sequence[str]] = None, layers: Optional[Sequence[str]] = None, uns: bool = False, rows = None,
+        barcodes: Optional[Sequence[str]] = None):
+        """
+        Returns an AnnData object with the given obs and var columns, obsm keys and layers (all of them if None; none of them if
+        an empty list), with or without X and uns, and with the given rows or barcodes only (all cells if both are None).
+        """
+        import anndata
+        if barcodes is not None:
+            rows = self.rows_of(barcodes)
+        obsm = self.obsm_keys() if obsm is None else obsm
+        layers = self.layers_keys() if layers is None else layers
+        return anndata.AnnData(
+            X = self.read_X(rows) if X and "X" in self.file else None,
+            obs = self.read_obs(obs, rows),
+            var = self.read_var(var),
+            obsm = {k: self.read_obsm(k, rows) for k in obsm},
+            layers = {k: self.read_layer(k, rows) for k in layers},
+            uns = self.read_uns() if uns else None,
+        )
+
+def read_h5ad_parts(path: str, **kwargs):
+    # one-off version of H5adReader(path).read(**kwargs)
+    with H5adReader(path) as reader:
+        return reader.read(**kwargs)
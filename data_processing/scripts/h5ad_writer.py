@@ -0,0 +1,145 @@
+import os
+import h5py
+import numpy as np
+import scipy.sparse
+from anndata import AnnData
+from typing import NamedTuple, Optional, Sequence, Union
+
+# Storage profiles for the h5ad outputs. write_anndata_with_object_cols used to write every object with lzf and the chunks chosen
+# by h5py, from processed libraries of tens of MB (downloaded and read whole by process_sample) to integrated tissues of several
+# GB (read whole, or a compartment at a time through H5adReader). A profile sets the codec, its level, the shuffle filter and the
+# chunk layout of X, the layers and the obsm arrays, so that each stage can pick one suited to how its output is consumed:
+# - the codec and level trade write time against file size (i.e. transfer time);
+# - the shuffle filter groups the bytes of the values by significance, which helps gzip on float32 counts and embeddings;
+# - smaller chunks mean less data read (and decompressed) beyond the requested rows when rows are read through H5adReader,
+#   at the cost of more chunks (i.e. more requests and a larger chunk index).
+# benchmarks/benchmark_h5ad_profiles.py measures write time, full and row-sliced read time and file size for each profile.
+#
+# The profile of a stage is taken from the optional "h5ad_storage_profile" config of process_library, process_sample,
+# integrate_samples and integrate_using_scanvi; if not set, from the environment variable:
+# IA_H5AD_PROFILE - name of the storage profile (one of PROFILES) of the h5ad outputs (default "lzf")
+#
+# write_h5ad_with_copies() writes a second product of an object (e.g. the cleaned-up version of an integrated object) whose X,
+# layers and embeddings are copied from the h5ad file of the first one at the HDF5 level: the compressed chunks are copied as they
+# are (H5Ocopy), rather than serialized and compressed again. Both files are complete h5ad files that open on their own.
+
+class StorageProfile(NamedTuple):
+    # "lzf", "gzip" or None (no compression)
+    compression: Optional[str] = "lzf"
+    # the level of gzip (0-9); ignored by lzf
+    compression_level: Optional[int] = None
+    shuffle: bool = False
+    # number of rows per chunk of the dense arrays (X, layers and obsm); None for the chunks chosen by h5py
+    chunk_rows: Optional[int] = None
+    # number of values per chunk of the data and indices of the sparse matrices (X and layers); None for the chunks chosen by h5py
+    sparse_chunk_size: Optional[int] = None
+
+PROFILES = {
+    # as all objects used to be written
+    "lzf": StorageProfile(),
+    # for objects that are read a few cells at a time through H5adReader (e.g. the processed samples read by compartment)
+    "lzf_rows": StorageProfile(shuffle = True, chunk_rows = 1024, sparse_chunk_size = 64 * 1024),
+    # smaller files for large objects that are written once and transferred often (e.g. the integrated tissues)
+    "gzip": StorageProfile(compression = "gzip", compression_level = 4, shuffle = True, chunk_rows = 4096,
+        sparse_chunk_size = 256 * 1024),
+    # fastest writes, largest files (e.g. intermediate files that are read once on the same machine)
+    "none": StorageProfile(compression = None),
+}
+DEFAULT_PROFILE = "lzf"
+
+def get_storage_profile(profile: Union[str, StorageProfile, None] = None) -> StorageProfile:
+    # a profile, the name of one of PROFILES, or None for the profile set by IA_H5AD_PROFILE
+    if isinstance(profile, StorageProfile):
+        return profile
+    if profile is None or profile == "":
+        profile = os.environ.get("IA_H5AD_PROFILE", DEFAULT_PROFILE)
+    if profile not in PROFILES:
+        raise ValueError("Unknown h5ad storage profile {}; expected one of {}.".format(profile, list(PROFILES.keys())))
+    return PROFILES[profile]
+
+def _has_layout(profile: StorageProfile) -> bool:
+    # whether the profile sets more than anndata's write() does (i.e. more than the codec and its level)
+    return profile.shuffle or profile.chunk_rows is not None or profile.sparse_chunk_size is not None
+
+def _dataset_kwargs(profile: StorageProfile, values: np.ndarray, chunks: Optional[tuple]) -> dict:
+    if values.size == 0 or profile.compression is None and not profile.shuffle and chunks is None:
+        # empty datasets can't be chunked (which filters require)
+        return {}
+    kwargs = dict(compression = profile.compression, shuffle = profile.shuffle, chunks = True if chunks is None else chunks)
+    if profile.compression == "gzip" and profile.compression_level is not None:
+        kwargs["compression_opts"] = profile.compression_level
+    return kwargs
+
+def _write_array(group, key: str, values: np.ndarray, profile: StorageProfile, attrs: dict = {}) -> None:
+    chunks = None
+    if profile.chunk_rows is not None and values.ndim > 0 and values.shape[0] > 0:
+        chunks = (min(profile.chunk_rows, values.shape[0]),) + values.shape[1:]
+    dataset = group.create_dataset(key, data = values, **_dataset_kwargs(profile, values, chunks))
+    dataset.attrs.update(attrs)
+
+def _write_matrix(group, key: str, matrix, profile: StorageProfile) -> None:
+    # X, a layer or an obsm array, in the encoding of anndata
+    if scipy.sparse.issparse(matrix):
+        if matrix.format not in ["csr", "csc"]:
+            matrix = scipy.sparse.csr_matrix(matrix)
+        matrix_group = group.create_group(key)
+        matrix_group.attrs.update({"encoding-type": matrix.format + "_matrix", "encoding-version": "0.1.0", "shape": list(matrix.shape)})
+        for name in ["data", "indices", "indptr"]:
+            values = getattr(matrix, name)
+            chunks = None
+            if profile.sparse_chunk_size is not None and name != "indptr" and len(values) > 0:
+                chunks = (min(profile.sparse_chunk_size, len(values)),)
+            # resizable, as written by anndata
+            matrix_group.create_dataset(name, data = values, maxshape = (None,), **_dataset_kwargs(profile, values, chunks))
+    else:
+        _write_array(group, key, np.asarray(matrix), profile, {"encoding-type": "array", "encoding-version": "0.2.0"})
+
+def write_h5ad(adata: AnnData, path: str, profile: Union[str, StorageProfile, None] = None) -> None:
+    """
+    Writes adata as an h5ad file at path with the given storage profile (see above). Profiles that only set the codec and its
+    level are written by anndata; otherwise everything but X, the layers and the obsm arrays (obs, var, obsm data frames, varm,
+    obsp, varp, uns) is written by anndata with the codec of the profile, and X, the layers and the obsm arrays are added with the
+    chunk layout and filters of the profile.
+    """
+    profile = get_storage_profile(profile)
+    compression_opts = profile.compression_level if profile.compression == "gzip" else None
+    if not _has_layout(profile) or adata.raw is not None:
+        # raw is written by anndata as a whole
+        adata.write(path, compression = profile.compression, compression_opts = compression_opts)
+        return
+    # as in write_h5ad
+    adata.strings_to_categoricals()
+    arrays = [k for k in adata.obsm.keys() if not hasattr(adata.obsm[k], "columns")]
+    shell = AnnData(obs = adata.obs, var = adata.var, uns = adata.uns, obsm = {k: adata.obsm[k] for k in adata.obsm.keys() if k not in arrays},
+        varm = adata.varm, obsp = adata.obsp, varp = adata.varp)
+    shell.write(path, compression = profile.compression, compression_opts = compression_opts)
+    with h5py.File(path, "a") as f:
+        if adata.X is not None:
+            _write_matrix(f, "X", adata.X, profile)
+        for key, elems in [("layers", adata.layers), ("obsm", {k: adata.obsm[k] for k in arrays})]:
+            if len(elems) > 0:
+                group = f.require_group(key)
+                for k in elems.keys():
+                    _write_matrix(group, k, elems[k], profile)
+
+def write_h5ad_with_copies(adata: AnnData, path: str, source_path: str, copied_obsm: Sequence[str] = [],
+    profile: Union[str, StorageProfile, None] = None) -> None:
+    """
+    Writes adata, without its X and layers, as an h5ad file at path, and copies X, the layers and the given obsm keys into it from
+    the h5ad file at source_path (e.g. the same object before some of its obs and obsm were changed). The copies are made by HDF5
+    (H5Ocopy), which copies the compressed chunks as they are, so the large arrays are compressed once; the chunk layout and filters
+    of the copies are those of source_path.
+    """
+    profile = get_storage_profile(profile)
+    compression_opts = profile.compression_level if profile.compression == "gzip" else None
+    shell = AnnData(obs = adata.obs, var = adata.var, uns = adata.uns, obsm = {k: adata.obsm[k] for k in adata.obsm.keys() if k not in copied_obsm},
+        varm = adata.varm, obsp = adata.obsp, varp = adata.varp)
+    shell.write(path, compression = profile.compression, compression_opts = compression_opts)
+    with h5py.File(source_path, "r") as source, h5py.File(path, "a") as f:
+        if "X" in source:
+            source.copy(source["X"], f, "X")
+        for key, keys in [("layers", list(source["layers"].keys()) if "layers" in source else []), ("obsm", copied_obsm)]:
+            if len(keys) > 0:
+                group = f.require_group(key)
+                for k in keys:
+                    source.copy(source[key][k], group, k)
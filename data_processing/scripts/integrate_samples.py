@@ -40,6 +40,8 @@ sys.path.append(configs["code_path"])
 from utils import *
 from vdj_utils import *
 from logger import SimpleLogger
+# fail now rather than after the processing if the zarr outputs are enabled (IA_ZARR_OUTPUT) but zarr is not installed
+check_zarr_output()
 
 output_destination = configs["output_destination"]
 s3_access_file = configs["s3_access_file"]
@@ -87,6 +89,10 @@ if configs['include_stim']:
     output_h5ad_model_file_stim = "{}.stim.{}.model_data.h5ad".format(configs["output_prefix"], version)
 
 logger = SimpleLogger(filename = logger_file_path)
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
+# model training is skipped for batch keys whose data and model configs did not change since a previous run; see checkpoints.py
+checkpoints = StageCheckpoints(logger)
 logger.add_to_log("Running integrate_samples.py...")
 logger.add_to_log("Starting time: {}".format(get_current_time()))
 with open(integrate_samples_script, "r") as f:
@@ -101,18 +107,14 @@ if is_new_version:
         logger.add_to_log("Uploading new configs version to S3...")
         with open(os.path.join(data_dir,output_configs_file), 'w') as f:
             json.dump(configs, f)
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(
-            data_dir, s3_url, configs["output_prefix"], version, output_configs_file)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        uploads.submit(data_dir, "{}/{}/{}".format(s3_url, configs["output_prefix"], version), output_configs_file)
 else:
     logger.add_to_log("Checking if h5ad file already exists on S3...")
     h5ad_file_exists = False
     logger_file_exists = False
-    ls_cmd = "aws s3 ls {}/{}/{} --recursive".format(s3_url, configs["output_prefix"],version)
-    files = os.popen(ls_cmd).read()
-    logger.add_to_log("aws response: {}\n".format(files))
-    for f in files.rstrip().split('\n'):
+    files = s3_list("{}/{}/{}".format(s3_url, configs["output_prefix"],version))
+    logger.add_to_log("aws response: {}\n".format("\n".join(files)))
+    for f in files:
         if f.split('/')[-1] == output_h5ad_file:
             h5ad_file_exists = True
         if f.split('/')[-1] == logger_file:
@@ -141,6 +143,8 @@ if configs['folder_local_files'].split('.')[-1]=='h5ad':
 else:
     preexisting_h5ad = False
     local_files = os.listdir(configs['folder_local_files']) if configs['folder_local_files'] else []
+    # files that are not available locally are downloaded in the background while the samples are read (in the same order), see prefetch.py
+    transfers = []
     for j in range(len(all_sample_ids)):
         sample_id = all_sample_ids[j]
         sample_version = processed_sample_configs_version[j]
@@ -156,18 +160,20 @@ else:
             stim_h5ad_files.append(sample_h5ad_path)
         if sample_h5ad_file in local_files:
             if os.path.samefile(configs['folder_local_files'], data_dir):
-                sync_cmd = f'echo "{sample_h5ad_file} exists in {data_dir}"'
+                logger.add_to_log(f"{sample_h5ad_file} exists in {data_dir}")
             else:
-                sync_cmd = f'cp {configs["folder_local_files"]}/{sample_h5ad_file} {data_dir}; echo Copied {sample_h5ad_file} from {configs["folder_local_files"]}'
+                cp_cmd = f'cp {configs["folder_local_files"]}/{sample_h5ad_file} {data_dir}; echo Copied {sample_h5ad_file} from {configs["folder_local_files"]}'
+                logger.add_to_log(os.popen(cp_cmd).read())
+            if not os.path.exists(sample_h5ad_path):
+                logger.add_to_log("h5ad file does not exist on aws for sample {}. Terminating execution.".format(sample_id))
+                sys.exit()
         else:
-            sync_cmd = 'aws s3 cp --no-progress s3://immuneaging/processed_samples/{}_GEX/{}/ {} --exclude "*" --include {}'.format(
-            sample_id,sample_version,data_dir,sample_h5ad_file)
-            logger.add_to_log("syncing {}...".format(sample_h5ad_file))
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        aws_response = os.popen(sync_cmd).read()
-        logger.add_to_log(f"aws response: {aws_response}")
-        if not os.path.exists(sample_h5ad_path):
-            logger.add_to_log("h5ad file does not exist on aws for sample {}. Terminating execution.".format(sample_id))
+            transfers.append(("s3://immuneaging/processed_samples/{}_GEX/{}/{}".format(sample_id,sample_version,sample_h5ad_file), sample_h5ad_path))
+    prefetcher = Prefetcher(transfers, logger, only_if_changed=False)
+    for j in range(len(all_sample_ids)):
+        if prefetcher.is_missing(all_h5ad_files[j]):
+            logger.add_to_log("h5ad file does not exist on aws for sample {}. Terminating execution.".format(all_sample_ids[j]))
+            prefetcher.cancel()
             sys.exit()
 
 if configs["integration_level"] == "compartment":
@@ -236,35 +242,28 @@ for integration_mode in integration_modes:
     
     if preexisting_h5ad == False:
         adata_dict = {}
+        # (h5ad file, rows) of the counts of each sample; the counts are concatenated on disk once the genes of all samples are known (see concatenation.py)
+        counts_sources = {}
         for j in range(len(h5ad_files)):
             h5ad_file = h5ad_files[j]
             sample_id = sample_ids[j]
-            if configs["integration_level"] == "compartment":
-                adata_temp = sc.read_h5ad(h5ad_file)
-                idx = adata_temp.obs_names.isin(compartment_barcodes)
-                print(idx)
-                print(adata_temp[idx, :])
-
-                if np.sum(idx) > 2: # i.e. if there are at least three cells that passes the condition above
-                    adata_dict[sample_id] = adata_temp[idx, :].copy()
-                    del adata_temp
-                    gc.collect()
-                else:
-                    del adata_temp
-                    gc.collect()
-                    continue
-            else:
-                adata_dict[sample_id] = sc.read_h5ad(h5ad_file)
+            if not prefetcher.wait(h5ad_file):
+                logger.add_to_log("h5ad file does not exist on aws for sample {}. Terminating execution.".format(sample_id))
+                prefetcher.cancel()
+                sys.exit()
+            with H5adReader(h5ad_file) as reader:
+                idx = None
+                if configs["integration_level"] == "compartment":
+                    # read only the cells of the compartment
+                    idx = reader.rows_of(compartment_barcodes)
+                    logger.add_to_log("{} of {} cells of sample {} are in the {} compartment.".format(len(idx), reader.n_obs, sample_id, compartment))
+                    if len(idx) <= 2: # i.e. keep the sample only if at least three cells pass the condition above
+                        continue
+                adata_dict[sample_id] = read_sample_metadata(reader, idx, drop_obsm = ('X_pca', 'X_scVI', 'X_totalVI', 'X_umap_pca', 'X_umap_scvi', 'X_umap_totalvi'))
+                counts_sources[sample_id] = (h5ad_file, idx)
             # add the tissue to the adata since we may need it as part of a composite batch_key later
             adata_dict[sample_id].obs["tissue"] = samples["Organ"][samples["Sample_ID"] == sample_id].values[0]
             adata_dict[sample_id].obs["sample_id"] = sample_id
-            for field in ('X_pca', 'X_scVI', 'X_totalVI', 'X_umap_pca', 'X_umap_scvi', 'X_umap_totalvi'):
-                if field in adata_dict[sample_id].obsm:
-                    del adata_dict[sample_id].obsm[field]
-            adata_dict[sample_id].X = adata_dict[sample_id].layers['raw_counts']
-            if configs["integration_level"] != "tissue":
-                del adata_dict[sample_id].layers
-            del adata_dict[sample_id].obsp
         if configs["integration_level"] == "tissue" and len(adata_dict) == 0:
             msg = f"No cells found for tissue {compartment} from all samples in {integration_mode} integration mode..."
             if integration_mode != "stim_unstim":
@@ -306,6 +305,13 @@ for integration_mode in integration_modes:
             adata = adata.concatenate([adata_dict[sample_ids[j]] for j in range(1,len(sample_ids))], join="outer", index_unique=None)
         del adata_dict
         gc.collect()
+        # the raw counts are used as X; at the tissue level the layers (those that all the samples have) are kept as well
+        sources = [counts_sources[sample_id] for sample_id in sample_ids]
+        counts_dir = os.path.join(data_dir, "concatenated_counts" + mode_suffix)
+        adata.X = concatenate_layer(os.path.join(counts_dir, "raw_counts"), adata.var_names, sources, "raw_counts", logger).to_csr()
+        if configs["integration_level"] == "tissue":
+            for layer in common_layers([f for f, _ in sources]):
+                adata.layers[layer] = concatenate_layer(os.path.join(counts_dir, layer), adata.var_names, sources, layer, logger).to_csr()
         # Move the summary statistics of the genes (under .var) to a separate csv file
         cols_to_varm = [j for j in adata.var.columns if "n_cells" in j] + \
         [j for j in adata.var.columns if "mean_counts" in j] + \
@@ -315,10 +321,7 @@ for integration_mode in integration_modes:
         adata.var.iloc[:,adata.var.columns.isin(cols_to_varm)].to_csv(os.path.join(data_dir,output_gene_stats_csv_file))
         adata.var = adata.var.drop(labels = cols_to_varm, axis = "columns")
         if not sandbox_mode:
-            sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(
-                data_dir, s3_url, configs["output_prefix"], version, output_gene_stats_csv_file)
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-            logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+            uploads.submit(data_dir, "{}/{}/{}".format(s3_url, configs["output_prefix"], version), output_gene_stats_csv_file)
         
         write_anndata_with_object_cols(adata, data_dir, "concatenated_data_before_processing.h5ad")
     else:
@@ -392,6 +395,20 @@ for integration_mode in integration_modes:
         scvi_model_files = {}
         totalvi_model_files = {}
         run_pca = True
+        if "donor_id+tissue" in batch_keys and "donor_id+tissue" not in adata.obs:
+            # we need to remove cells, if any, that belong to a batch that has a size one
+            # or else the scanpy hvg call below fails. It is ok if there is only ever one or
+            # two such cells, but not if there is a lot of them, which is why we emit a warning
+            # log. The cells are removed before any of the models is trained since the models of
+            # all the batch keys reference their training cells in output_h5ad_file (see model_artifacts.py).
+            batches = adata.obs["donor_id"].astype("str") + "+" + adata.obs["tissue"].astype("str")
+            batch_vc = batches.value_counts()
+            singleton_batches = batch_vc[batch_vc == 1].index.values
+            for b in singleton_batches:
+                barcode = batches.index[batches == b][0]
+                logger.add_to_log(f"Removing cell {barcode} where donor_id+tissue = {b} b/c it's the only one of its batch.", level="warning")
+            if len(singleton_batches) > 0:
+                adata = adata[~batches.isin(singleton_batches).values, :].copy()
         for batch_key in batch_keys:
             if batch_key == 'seq_batch':
                 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -405,19 +422,8 @@ for integration_mode in integration_modes:
             rna = adata.copy()
             if batch_key not in rna.obs:
                 if batch_key == "donor_id+tissue":
+                    # cells of batches of size one were removed above
                     rna.obs[batch_key] = rna.obs["donor_id"].astype("str") + "+" + rna.obs["tissue"].astype("str")
-                    # we need to remove cells, if any, that belong to a batch that has a size one
-                    # or else the scanpy hvg call below fails. It is ok if there is only ever one or
-                    # two such cells, but not if there is a lot of them, which is why we emit a warning
-                    # log.
-                    batch_vc = rna.obs["donor_id+tissue"].value_counts()
-                    for b in batch_vc[batch_vc == 1].index.values:
-                        barcode = rna[rna.obs[batch_key] == b].obs.index[0]
-                        logger.add_to_log(f"Removing cell {barcode} where {batch_key} = {b} b/c it's the only one of its batch.", level="warning")
-                        keep_idx = (rna.obs[batch_key] != b)
-                        rna = rna[keep_idx,:].copy()
-                        # need to also remove it from adata
-                        adata = adata[keep_idx,:].copy()
                 else:
                     logger.add_to_log(f"Batch key {batch_key} not found in adata columns. Terminating execution.", level="error")
                     logging.shutdown()
@@ -453,9 +459,12 @@ for integration_mode in integration_modes:
                 span=1.0,
                 layer=layer)
             rna = rna[:, np.logical_and(rna.var['highly_variable']==True, rna.var['highly_variable_nbatches']>max(min(0.9*len(rna.obs[batch_key].unique()), 1.5), 0.2*len(rna.obs[batch_key].unique())))].copy()
+            # the training data of the models, before they add their outputs to rna
+            rna_hash = content_hash(rna)
             # scvi
             key = f"X_scvi_integrated_batch_key_{batch_key}"
-            _, scvi_model_file = run_model(rna, configs, batch_key, None, "scvi", prefix, version, data_dir, logger, key)
+            scvi_model_file = run_model_with_checkpoint(checkpoints, {"rna": rna_hash}, rna, configs, batch_key, None, "scvi", prefix,
+                version, data_dir, logger, key, reference_h5ad_file=output_h5ad_file)
             scvi_model_files[batch_key] = scvi_model_file
             logger.add_to_log("Calculate neighbors graph and UMAP based on scvi components...")
             neighbors_key = f"scvi_integrated_neighbors_batch_key_{batch_key}"
@@ -478,7 +487,8 @@ for integration_mode in integration_modes:
                 # rest of the data regardless of CITE info
                 retry_count = 4
                 try:
-                    _, totalvi_model_file = run_model(rna, configs, batch_key, "protein_expression", "totalvi", prefix, version, data_dir, logger, latent_key=key, max_retry_count=retry_count)
+                    totalvi_model_file = run_model_with_checkpoint(checkpoints, {"rna": rna_hash}, rna, configs, batch_key, "protein_expression",
+                        "totalvi", prefix, version, data_dir, logger, latent_key=key, max_retry_count=retry_count, reference_h5ad_file=output_h5ad_file)
                     totalvi_model_files[batch_key] = totalvi_model_file
                     logger.add_to_log("Calculate neighbors graph and UMAP based on totalVI components...")
                     neighbors_key = f"totalvi_integrated_neighbors_batch_key_{batch_key}"
@@ -517,9 +527,7 @@ for integration_mode in integration_modes:
         logger.add_to_log("Terminating execution prematurely.")
         if not sandbox_mode:
             # upload log to S3
-            sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{}/ --exclude "*" --include {}'.format( \
-                data_dir, s3_url, configs["output_prefix"], version, logger_file)
-            os.system(sync_cmd)
+            s3_sync(data_dir, "{}/{}/{}/".format(s3_url, configs["output_prefix"], version), logger_file)
         print(err)
         sys.exit()
     logger.add_to_log("Using CellTypist for annotations...")
@@ -529,13 +537,8 @@ for integration_mode in integration_modes:
     leiden_resolutions = [float(j) for j in configs["leiden_resolutions"].split(",")]
     celltypist_model_urls = configs["celltypist_model_urls"].split(",")
     celltypist_dotplot_min_frac = configs["celltypist_dotplot_min_frac"]
-    logger.add_to_log("Downloading CellTypist models...")
-    # download celltypist models
-    celltypist_model_paths = []
-    for celltypist_model_url in celltypist_model_urls:
-        celltypist_model_path = os.path.join(data_dir, celltypist_model_url.split("/")[-1])
-        urllib.request.urlretrieve(celltypist_model_url, celltypist_model_path)
-        celltypist_model_paths.append(celltypist_model_path)
+    # the models are downloaded into these paths when first used (see get_celltypist_model)
+    celltypist_model_paths = [os.path.join(data_dir, celltypist_model_url.split("/")[-1]) for celltypist_model_url in celltypist_model_urls]
     dotplot_paths = []
     for batch_key in batch_keys:
         dotplot_paths += annotate(
@@ -571,11 +574,7 @@ for integration_mode in integration_modes:
         sc.tl.leiden(adata, key_added='overclustering_tissue_percolate', resolution=5.0, neighbors_key="overclustering")
         adata.obs['sum_percolation_score'] = adata.obs['sum_percolation_score'].astype(float)
         
-        df = adata.obs.groupby('overclustering_tissue_percolate')['sum_percolation_score'].agg(['median', 'mean', lambda x: x.quantile(0.75)])
-        for cluster in df.index:
-            adata.obs.loc[adata.obs['overclustering_tissue_percolate'] == cluster, 'sum_percolation_score_q75_cluster'] = df.loc[cluster, '<lambda_0>']
-            adata.obs.loc[adata.obs['overclustering_tissue_percolate'] == cluster, 'sum_percolation_score_median_cluster'] = df.loc[cluster, 'median']
-            adata.obs.loc[adata.obs['overclustering_tissue_percolate'] == cluster, 'sum_percolation_score_mean_cluster'] = df.loc[cluster, 'mean']
+        add_cluster_statistics(adata.obs, 'overclustering_tissue_percolate', 'sum_percolation_score')
         if "filtering" in configs and not apply_filtering:
             tissue = adata.obs['tissue'].iloc[0]
             adata.obs["to_filter"] = "pass filtering"  
@@ -607,38 +606,28 @@ for integration_mode in integration_modes:
     adata.obs["age"] = adata.obs["age"].astype(str)
     adata.obs["BMI"] = adata.obs["BMI"].astype(str)
     adata.obs["height"] = adata.obs["height"].astype(str)
-    write_anndata_with_object_cols(adata, data_dir, output_h5ad_file)
-    write_anndata_with_object_cols(adata, data_dir, output_h5ad_file_cleanup, cleanup=True)
+    h5ad_profile = configs["h5ad_storage_profile"] if "h5ad_storage_profile" in configs else None
+    output_files = write_anndata_with_cleanup(adata, data_dir, output_h5ad_file, output_h5ad_file_cleanup, profile=h5ad_profile)
     # OUTPUT UPLOAD TO S3 - ONLY IF NOT IN SANDBOX MODE
     if not sandbox_mode:
         logger.add_to_log("Uploading h5ad file to S3...")
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {} --include {}'.format(
-            data_dir, s3_url, configs["output_prefix"], version, output_h5ad_file, output_h5ad_file_cleanup)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        s3_output_dir = "{}/{}/{}/".format(s3_url, configs["output_prefix"], version)
+        uploads.submit(data_dir, s3_output_dir, output_files)
         logger.add_to_log("Uploading model files (a single .zip file for each model) and CellTypist dot plots to S3...")
-        inclusions = [f"--include {file}" for file in list(scvi_model_files.values()) + list(totalvi_model_files.values())]
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{}/ --exclude "*" {}'.format(
-            data_dir, s3_url, configs["output_prefix"], version, " ".join(inclusions))
-        sync_cmd += ' --include {}'.format(dotplots_zipfile)         
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        inclusions = list(scvi_model_files.values()) + list(totalvi_model_files.values()) + [dotplots_zipfile]
+        uploads.submit(data_dir, s3_output_dir, inclusions)
         logger.add_to_log("Uploading gene stats csv file to S3...")
         if "filtering" in configs and not configs["filtering"]["apply_filtering"]:
-            sync_cmd = 'aws s3 sync --no-progress {} {}/{}/ --exclude "*" --include {}'.format(
-                data_dir, "s3://immuneaging/per-compartment-barcodes", 
-                f"filter_{configs['filtering']['filter_name']}", 
+            uploads.submit(data_dir, "s3://immuneaging/per-compartment-barcodes/filter_{}/".format(configs['filtering']['filter_name']),
                 f'{tissue}_low_quality_filter.csv')
-            logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-            logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
             
     logger.add_to_log("Number of cells: {}, number of genes: {}.".format(adata.n_obs, adata.n_vars))
 
+uploads.wait()
+logger.add_to_log(checkpoints.report())
 logger.add_to_log("Execution of integrate_samples.py is complete.")
 
 logging.shutdown()
 if not sandbox_mode:
     # Uploading log file to S3.
-    sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(
-        data_dir, s3_url, configs["output_prefix"], version, logger_file)
-    os.system(sync_cmd)
+    s3_sync(data_dir, "{}/{}/{}".format(s3_url, configs["output_prefix"], version), logger_file)
@@ -73,6 +73,8 @@ output_h5ad_file_unstim = "{}.unstim.{}.h5ad".format(output_prefix, version)
 output_h5ad_file_stim = "{}.stim.{}.h5ad".format(output_prefix, version)
 
 logger = SimpleLogger(filename = logger_file_path)
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
 logger.add_to_log("Running integrate_using_scanvi.py...")
 logger.add_to_log("Starting time: {}".format(get_current_time()))
 with open(integrate_using_scanvi_script, "r") as f:
@@ -87,17 +89,14 @@ if is_new_version:
         logger.add_to_log("Uploading new configs version to S3...")
         with open(os.path.join(data_dir,output_configs_file), 'w') as f:
             json.dump(configs, f)
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(data_dir, s3_url, output_prefix, version, output_configs_file)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        uploads.submit(data_dir, "{}/{}/{}".format(s3_url, output_prefix, version), output_configs_file)
 else:
     logger.add_to_log("Checking if h5ad file already exists on S3...")
     h5ad_file_exists = False
     logger_file_exists = False
-    ls_cmd = "aws s3 ls {}/{}/{} --recursive".format(s3_url, output_prefix, version)
-    files = os.popen(ls_cmd).read()
-    logger.add_to_log("aws response: {}\n".format(files))
-    for f in files.rstrip().split('\n'):
+    files = s3_list("{}/{}/{}".format(s3_url, output_prefix, version))
+    logger.add_to_log("aws response: {}\n".format("\n".join(files)))
+    for f in files:
         if f.split('/')[-1] == output_h5ad_file:
             h5ad_file_exists = True
         if f.split('/')[-1] == logger_file:
@@ -156,11 +155,7 @@ for mode in integration_modes:
 all_files = stim_integrated_files + unstim_integrated_files + stim_unstim_integrated_files
 for file in all_files:
     s3_url_integrated = "s3://immuneaging/integrated_samples/{}_level".format(integration_level)
-    sync_cmd = f'aws s3 sync --no-progress {s3_url_integrated}/{output_prefix}/{integrated_object_version} {data_dir} --exclude "*" --include {file}'
-    logger.add_to_log("syncing {}...".format(file))
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    aws_response = os.popen(sync_cmd).read()
-    logger.add_to_log("aws response: {}\n".format(aws_response))
+    aws_sync(f"{s3_url_integrated}/{output_prefix}/{integrated_object_version}", data_dir, file, logger, only_if_changed=True)
     if not os.path.exists(os.path.join(data_dir, file)):
         if ".stim." in file:
             logger.add_to_log(f"file {file} not found on aws. Will skip stim-only integration", level="warning")
@@ -237,20 +232,17 @@ for integration_mode in integration_modes:
             logger.add_to_log("Running for batch_key {}...".format(batch_key))
             if tissue_integration:
                 model_file = f"{prefix}.{integrated_object_version}.scvi_model.zip"
-                data_file = f"{prefix}.{integrated_object_version}.scvi_model.data.h5ad"
             else:
                 model_file = f"{prefix}.{integrated_object_version}.scvi_model_batch_key_{batch_key}.zip"
-                data_file = f"{prefix}.{integrated_object_version}.scvi_model_batch_key_{batch_key}.data.h5ad"
             # unzip the model file
             logger.add_to_log(f"Unzipping model file {model_file}...".format(batch_key))
-            model_path = os.path.join(data_dir, model_file)
-            shutil.unpack_archive(model_path, data_dir)
-            model_path = model_path.replace(f"{integrated_object_version}.", "")[:-4] # remove the .zip
+            model_path = extract_model_artifact(os.path.join(data_dir, model_file), data_dir)
 
             logger.add_to_log("Loading the pre-trained scvi model and creating a scanvi model from it...")
-            vae_data = anndata.read_h5ad(os.path.join(model_path, data_file))
+            # the training data of the model is taken from the integrated h5ad file (or, for older models, from the model file)
+            vae_data = read_model_training_data(model_path, adata)
             add_annotations_to_adata(vae_data, labels_key, unlabeled_category, annotations, valid_libs)
-            vae = scvi.model.SCVI.load(model_path, adata=vae_data)
+            vae = load_model_artifact(scvi.model.SCVI, model_path, vae_data)
             scvi.model.SCANVI.setup_anndata(
                 vae.adata,
                 batch_key=batch_key,
@@ -277,15 +269,10 @@ for integration_mode in integration_modes:
             model_dir_path = os.path.join(data_dir,"{}.scanvi_model_batch_key_{}/".format(prefix, batch_key))
             if os.path.isdir(model_dir_path):
                 os.system("rm -r " + model_dir_path)
-            lvae.save(model_dir_path)
-            # save the data used for fitting the scanvi model separately because we need to call `write_anndata_with_object_cols`
-            logger.add_to_log("Saving the data used for fitting the model...")
-            data_file = "{}.{}.scanvi_model_batch_key_{}.data.h5ad".format(prefix, version, batch_key)
-            write_anndata_with_object_cols(lvae.adata, model_dir_path, data_file)
-            # zip the dir with all the model outputs
-            zipf = zipfile.ZipFile(model_file_path, 'w', zipfile.ZIP_DEFLATED)
-            zipdir(model_dir_path, zipf)
-            zipf.close()
+            # the data used for fitting the scanvi model is referenced by the model file: it is in the output h5ad file of this run
+            reduced_precision = "reduced_precision_model_weights" in configs and configs["reduced_precision_model_weights"] == "True"
+            save_model_artifact(lvae, model_file_path, model_dir_path, "scanvi", batch_key, "{}.{}.h5ad".format(prefix, version),
+                reduced_precision=reduced_precision)
             scanvi_model_files[batch_key] = model_file
             # done with training scanvi
             logger.add_to_log("Calculate neighbors graph and UMAP based on scanvi components...")
@@ -304,22 +291,15 @@ for integration_mode in integration_modes:
         logger.add_to_log("Terminating execution prematurely.")
         if not sandbox_mode:
             # upload log to S3
-            sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{}/ --exclude "*" --include {}'.format( \
-                data_dir, s3_url, output_prefix, version, logger_file)
-            os.system(sync_cmd)
+            s3_sync(data_dir, "{}/{}/{}/".format(s3_url, output_prefix, version), logger_file)
         print(err)
         sys.exit()
     logger.add_to_log("Using CellTypist for annotations...")
     leiden_resolutions = [float(j) for j in configs["leiden_resolutions"].split(",")]
     celltypist_model_urls = configs["celltypist_model_urls"].split(",")
     celltypist_dotplot_min_frac = configs["celltypist_dotplot_min_frac"]
-    logger.add_to_log("Downloading CellTypist models...")
-    # download celltypist models
-    celltypist_model_paths = []
-    for celltypist_model_url in celltypist_model_urls:
-        celltypist_model_path = os.path.join(data_dir, celltypist_model_url.split("/")[-1])
-        urllib.request.urlretrieve(celltypist_model_url, celltypist_model_path)
-        celltypist_model_paths.append(celltypist_model_path)
+    # the models are downloaded into these paths when first used (see get_celltypist_model)
+    celltypist_model_paths = [os.path.join(data_dir, celltypist_model_url.split("/")[-1]) for celltypist_model_url in celltypist_model_urls]
     dotplot_paths = []
     for batch_key in batch_keys:
         dotplot_paths += annotate(
@@ -347,28 +327,22 @@ for integration_mode in integration_modes:
     zipf.close()
     logger.add_to_log("Saving h5ad files...")
     output_h5ad_file = "{}.{}.h5ad".format(prefix, version)
-    write_anndata_with_object_cols(adata, data_dir, output_h5ad_file)
+    h5ad_profile = configs["h5ad_storage_profile"] if "h5ad_storage_profile" in configs else None
+    output_files = write_anndata_with_object_cols(adata, data_dir, output_h5ad_file, profile=h5ad_profile)
     # OUTPUT UPLOAD TO S3 - ONLY IF NOT IN SANDBOX MODE
     if not sandbox_mode:
         logger.add_to_log("Uploading h5ad file to S3...")
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(
-            data_dir, s3_url, output_prefix, version, output_h5ad_file)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        s3_output_dir = "{}/{}/{}/".format(s3_url, output_prefix, version)
+        uploads.submit(data_dir, s3_output_dir, output_files)
         logger.add_to_log("Uploading model files (a single .zip file for each model) and CellTypist dot plots to S3...")
-        inclusions = [f"--include {file}" for file in list(scanvi_model_files.values())]
-        sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{}/ --exclude "*" {}'.format(
-            data_dir, s3_url, output_prefix, version, " ".join(inclusions))
-        sync_cmd += ' --include {}'.format(dotplots_zipfile)         
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        inclusions = list(scanvi_model_files.values()) + [dotplots_zipfile]
+        uploads.submit(data_dir, s3_output_dir, inclusions)
     logger.add_to_log("Number of cells: {}, number of genes: {}.".format(adata.n_obs, adata.n_vars))
 
+uploads.wait()
 logger.add_to_log("Execution of integrate_samples.py is complete.")
 
 logging.shutdown()
 if not sandbox_mode:
     # Uploading log file to S3.
-    sync_cmd = 'aws s3 sync --no-progress {} {}/{}/{} --exclude "*" --include {}'.format(
-        data_dir, s3_url, output_prefix, version, logger_file)
-    os.system(sync_cmd)
+    s3_sync(data_dir, "{}/{}/{}".format(s3_url, output_prefix, version), logger_file)
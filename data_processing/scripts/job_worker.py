@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import socket
+import threading
+import subprocess
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from s3_utils import S3Object, check_conditional_writes, s3_list_objects, s3_mv, s3_put_if, s3_read, s3_rm
+
+# A worker daemon that runs the jobs of the job queue on S3 (s3://immuneaging/job_queue/<job_type>/, see
+# generate_processing_config_files.py); any number of workers, on any number of nodes, can pull jobs from the same queue.
+# This replaces moving the queue to <job_type>.running/ and running the .sh files written by generate_processing_scripts.py by hand.
+#
+# A worker claims a job by writing a lease, <job_type>.leases/<configs file>, with a conditional write (see s3_utils.s3_put_if) so
+# that of the workers that claim the same job at the same time exactly one succeeds. The lease holds the worker, the attempt and the
+# time it expires; the worker renews it (again with a conditional write, on the etag of the lease it wrote last) every third of
+# lease_sec while the job runs, and kills the job if the lease was taken over. The jobs of a worker that died are thus returned to the
+# queue once their leases expire: their configs file never left the queue, and an expired lease can be taken over by any worker.
+# A job that ends is recorded in <job_type>.results/<configs file>.json (worker, attempt, exit code and timestamps), then its configs
+# file is moved to <job_type>.done/ (or <job_type>.failed/, once max_attempts attempts failed) and its lease is deleted. A job that
+# failed before is released (its lease expires right away), so that it is retried, possibly by another worker.
+# A process_sample job is not claimed while process_library jobs of its libraries are still in the queue.
+#
+# Run as follows: python job_worker.py <s3_access_file> <output_destination> <code_path> [<job_types>]
+# where job_types is a comma-separated list of job types, in the order they are claimed (default process_library,process_sample).
+# The configs files of the jobs (with code_path, output_destination, s3_access_file and code_version added, as in
+# generate_processing_scripts.py) and their outputs (<configs file>.<worker>.log) are written to <output_destination>/job_run.
+# Report the throughput and the latencies of the jobs of the queue with: python job_worker.py stats <job_type>
+#
+# The following environment variables can be used to control the worker (all are optional):
+# IA_WORKER_ID - the name of the worker (default <hostname>-<pid>)
+# IA_WORKER_LEASE_SEC - time after which the jobs of a worker that stopped renewing its leases are returned to the queue (default 600)
+# IA_WORKER_POLL_SEC - time between two polls of an empty queue (default 60)
+# IA_WORKER_MAX_ATTEMPTS - max number of attempts of a job (default 3)
+# IA_WORKER_MAX_IDLE_SEC - the worker stops once the queue was empty for that long (default 0, never)
+# IA_WORKER_WARM - if set to 1, the jobs are forked from a warm worker that imported the heavy libraries once (see warm_worker.py)
+
+BUCKET_PATH = "s3://immuneaging"
+QUEUE_PATH = BUCKET_PATH + "/job_queue"
+DEFAULT_JOB_TYPES = ["process_library", "process_sample"]
+# job type -> the job type whose jobs must be done first (see blocked_by)
+JOB_DEPENDENCIES = {"process_sample": "process_library"}
+
+class JobLease(NamedTuple):
+    worker: str
+    attempt: int
+    claimed_at: float
+    expires: float
+
+class ClaimedJob(NamedTuple):
+    job_type: str
+    name: str           # the name of the configs file
+    queued_at: float    # last modified time of the configs file in the queue
+    lease: JobLease
+    lease_etag: str
+
+def queue_path(job_type: str, name: str = "", state: str = "") -> str:
+    # state is "" (the queue itself), "leases", "results", "done" or "failed"
+    return "{}/{}{}/{}".format(QUEUE_PATH, job_type, "." + state if len(state) > 0 else "", name)
+
+def blocked_by(job_type: str, configs: Dict, queued: Dict[str, List[str]]) -> bool:
+    # True if a job that must be done first (JOB_DEPENDENCIES) is still queued; queued is job type -> names of its queued jobs
+    if job_type != "process_sample":
+        return False
+    libs = ["process_library.{}.{}.{}.".format(configs["donor"], configs["seq_run"], lib_id) for lib_id in configs["library_ids"].split(",")]
+    return any([name.startswith(lib) for name in queued.get("process_library", []) for lib in libs])
+
+def get_stage_command(job_type: str, configs_file: str, code_path: str) -> List[str]:
+    return [sys.executable, os.path.join(code_path, "{}.py".format(job_type)), configs_file]
+
+def percentile(values: List[float], q: float) -> float:
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)] if len(values) > 0 else 0
+
+def queue_stats(job_type: str) -> Dict:
+    """
+    Throughput (jobs done per hour, from the first claim to the last job that ended) and latencies (the median, 95th and 99th
+    percentiles and the max of the time in the queue, the run time and their total) of the jobs recorded in <job_type>.results/.
+    """
+    results = []
+    for o in s3_list_objects(queue_path(job_type, state="results")):
+        content = s3_read("{}/{}".format(BUCKET_PATH, o.key))
+        if content is not None:
+            results.append(json.loads(content[0]))
+    done = [r for r in results if r["exit_code"] == 0]
+    stats = {"n_done": len(done), "n_failed": len(results) - len(done)}
+    if len(done) == 0:
+        return stats
+    span = max([r["finished_at"] for r in done]) - min([r["claimed_at"] for r in done])
+    stats["jobs_per_hour"] = len(done) / span * 3600 if span > 0 else 0
+    for key, latencies in [("wait", [r["claimed_at"] - r["queued_at"] for r in done]), ("run", [r["finished_at"] - r["started_at"] for r in done]),
+        ("total", [r["finished_at"] - r["queued_at"] for r in done])]:
+        stats[key] = {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99), "max": max(latencies)}
+    return stats
+
+class JobWorker:
+    """
+    Claims and runs the jobs of the queue (see above) until stop() is called (or, with max_idle_sec, the queue is empty). command
+    (job type, configs file) -> the command of a job can be set for running stub jobs.
+    """
+    def __init__(self, job_types: List[str], output_destination: str, code_path: str, s3_access_file: str = "",
+        worker_id: Optional[str] = None, lease_sec: Optional[float] = None, poll_sec: Optional[float] = None,
+        max_attempts: Optional[int] = None, max_idle_sec: Optional[float] = None, command: Optional[Callable[[str, str], List[str]]] = None,
+        warm_worker = None):
+        if worker_id is None:
+            worker_id = os.environ.get("IA_WORKER_ID", "{}-{}".format(socket.gethostname(), os.getpid()))
+        if lease_sec is None:
+            lease_sec = float(os.environ.get("IA_WORKER_LEASE_SEC", 600))
+        if poll_sec is None:
+            poll_sec = float(os.environ.get("IA_WORKER_POLL_SEC", 60))
+        if max_attempts is None:
+            max_attempts = int(os.environ.get("IA_WORKER_MAX_ATTEMPTS", 3))
+        if max_idle_sec is None:
+            max_idle_sec = float(os.environ.get("IA_WORKER_MAX_IDLE_SEC", 0))
+        self.job_types = job_types
+        self.output_destination = output_destination
+        self.code_path = code_path
+        self.s3_access_file = s3_access_file
+        self.worker_id = worker_id
+        self.lease_sec = lease_sec
+        self.poll_sec = poll_sec
+        self.max_attempts = max_attempts
+        self.max_idle_sec = max_idle_sec
+        self.command = command or (lambda job_type, configs_file: get_stage_command(job_type, configs_file, code_path))
+        self.jobs_run_destination = os.path.join(output_destination, "job_run")
+        self.configs_cache = {}    # (job type, name) -> configs
+        if warm_worker is None and os.environ.get("IA_WORKER_WARM", "0") == "1":
+            from warm_worker import WarmWorker
+            warm_worker = WarmWorker()
+        # jobs are forked from the main thread only, when no heartbeat is running
+        self.warm_worker = warm_worker
+        self.stopping = threading.Event()
+        self.n_done = 0
+        self.n_failed = 0
+
+    def _log(self, msg: str) -> None:
+        print("[{}] {}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), self.worker_id, msg))
+        sys.stdout.flush()
+
+    def stop(self) -> None:
+        # the job in progress is killed and released
+        self.stopping.set()
+
+    def _read_configs(self, job_type: str, name: str) -> Optional[Dict]:
+        if (job_type, name) not in self.configs_cache:
+            content = s3_read(queue_path(job_type, name))
+            if content is None:
+                return None
+            self.configs_cache[(job_type, name)] = json.loads(content[0])
+        return self.configs_cache[(job_type, name)]
+
+    def _write_lease(self, job_type: str, name: str, lease: JobLease, if_match: Optional[str]) -> Optional[str]:
+        return s3_put_if(queue_path(job_type, name, "leases"), json.dumps(lease._asdict()).encode(), if_match)
+
+    def _queued(self) -> Dict[str, List[S3Object]]:
+        queued = {}
+        for job_type in set(self.job_types + list(JOB_DEPENDENCIES.values())):
+            prefix = queue_path(job_type)[len(BUCKET_PATH) + 1:]
+            queued[job_type] = [o for o in s3_list_objects(queue_path(job_type)) if "configs" in o.key and "/" not in o.key[len(prefix):]]
+        return queued
+
+    def claim(self) -> Optional[ClaimedJob]:
+        # claims a job of the first job type that has a job that is not leased (or whose lease expired), or returns None
+        queued = self._queued()
+        queued_names = {job_type: [o.key.split("/")[-1] for o in objects] for job_type, objects in queued.items()}
+        for job_type in self.job_types:
+            # in random order, so that workers that poll at the same time try different jobs
+            for o in random.sample(queued[job_type], len(queued[job_type])):
+                name = o.key.split("/")[-1]
+                lease_content = s3_read(queue_path(job_type, name, "leases"))
+                lease, lease_etag = (JobLease(**json.loads(lease_content[0])), lease_content[1]) if lease_content is not None else (None, None)
+                if lease is not None and lease.expires > time.time():
+                    continue
+                configs = self._read_configs(job_type, name)
+                if configs is None or blocked_by(job_type, configs, queued_names):
+                    continue
+                now = time.time()
+                new_lease = JobLease(self.worker_id, (lease.attempt if lease is not None else 0) + 1, now, now + self.lease_sec)
+                etag = self._write_lease(job_type, name, new_lease, lease_etag)
+                if etag is None:
+                    # another worker claimed it first
+                    continue
+                if lease is not None and lease.worker != self.worker_id and lease.expires > 0:
+                    self._log("took over the expired lease of {} from {}".format(name, lease.worker))
+                return ClaimedJob(job_type, name, o.last_modified, new_lease, etag)
+        return None
+
+    def _heartbeat(self, job: ClaimedJob, done: threading.Event, lost: threading.Event, proc: subprocess.Popen) -> None:
+        # renews the lease every third of lease_sec; kills the job if the lease was taken over
+        etag = job.lease_etag
+        while not done.wait(self.lease_sec / 3):
+            lease = job.lease._replace(expires = time.time() + self.lease_sec)
+            try:
+                new_etag = self._write_lease(job.job_type, job.name, lease, etag)
+            except Exception as err:
+                self._log("failed to renew the lease of {}: {}".format(job.name, err))
+                continue
+            if new_etag is None:
+                self._log("lost the lease of {}; killing the job".format(job.name))
+                lost.set()
+                proc.kill()
+                return
+            etag = new_etag
+        self.lease_etag = etag
+
+    def _finish(self, job: ClaimedJob, state: str, result: Optional[Dict]) -> None:
+        # record the result first, so that a worker that dies half way leaves a job that is cleaned up by the next claim
+        if result is not None:
+            results_path = queue_path(job.job_type, job.name + ".json", "results")
+            previous = s3_read(results_path)
+            s3_put_if(results_path, json.dumps(result).encode(), None if previous is None else previous[1])
+        s3_mv(queue_path(job.job_type, job.name), queue_path(job.job_type, job.name, state))
+        s3_rm(queue_path(job.job_type, job.name, "leases"))
+        self.configs_cache.pop((job.job_type, job.name), None)
+
+    def run_job(self, job: ClaimedJob) -> None:
+        result_content = s3_read(queue_path(job.job_type, job.name + ".json", "results"))
+        if result_content is not None and json.loads(result_content[0])["exit_code"] == 0:
+            # the job was done by a worker that died before moving it out of the queue
+            self._log("{} was done before; moving it out of the queue".format(job.name))
+            self._finish(job, "done", None)
+            return
+        if job.lease.attempt > self.max_attempts:
+            # the last attempt ended with the worker (e.g. it ran out of memory)
+            self._log("{} failed after {} attempts (the last one with its worker)".format(job.name, self.max_attempts))
+            self.n_failed += 1
+            self._finish(job, "failed", {"worker": job.lease.worker, "attempt": self.max_attempts, "exit_code": None,
+                "queued_at": job.queued_at, "claimed_at": job.lease.claimed_at, "started_at": job.lease.claimed_at, "finished_at": time.time()})
+            return
+        configs = dict(self._read_configs(job.job_type, job.name))
+        configs["code_path"] = self.code_path
+        configs["output_destination"] = self.output_destination
+        configs["s3_access_file"] = self.s3_access_file
+        configs["code_version"] = self.code_version
+        os.makedirs(self.jobs_run_destination, exist_ok = True)
+        run_filename = os.path.join(self.jobs_run_destination, job.name)
+        with open(run_filename, "w") as f:
+            json.dump(configs, f)
+        self._log("running {} (attempt {})".format(job.name, job.lease.attempt))
+        started_at = time.time()
+        log_file = os.path.join(self.jobs_run_destination, "{}.{}.log".format(job.name, self.worker_id))
+        if self.warm_worker is not None:
+            proc = self.warm_worker.start(self.command(job.job_type, run_filename), log_file)
+        else:
+            log = open(log_file, "w")
+            proc = subprocess.Popen(self.command(job.job_type, run_filename), stdout = log, stderr = subprocess.STDOUT)
+            log.close()
+        done, lost = threading.Event(), threading.Event()
+        self.lease_etag = job.lease_etag
+        heartbeat = threading.Thread(target = self._heartbeat, args = (job, done, lost, proc), daemon = True)
+        heartbeat.start()
+        while proc.poll() is None:
+            if self.stopping.wait(0.1):
+                proc.terminate()
+                proc.wait()
+        done.set()
+        heartbeat.join()
+        if lost.is_set():
+            # the job is another worker's now
+            return
+        if self.stopping.is_set():
+            # preempted: release the lease without counting the attempt
+            self._write_lease(job.job_type, job.name, job.lease._replace(attempt = job.lease.attempt - 1, expires = 0), self.lease_etag)
+            self._log("stopped {}; released it".format(job.name))
+            return
+        result = {"worker": self.worker_id, "attempt": job.lease.attempt, "exit_code": proc.returncode, "queued_at": job.queued_at,
+            "claimed_at": job.lease.claimed_at, "started_at": started_at, "finished_at": time.time()}
+        if proc.returncode == 0:
+            self.n_done += 1
+            self._finish(job, "done", result)
+            self._log("done with {} ({:.1f} sec)".format(job.name, result["finished_at"] - started_at))
+        elif job.lease.attempt >= self.max_attempts:
+            self.n_failed += 1
+            self._finish(job, "failed", result)
+            self._log("{} failed (exit code {}) after {} attempts".format(job.name, proc.returncode, job.lease.attempt))
+        else:
+            # release the lease right away, so that the job is retried (possibly by another worker)
+            self._write_lease(job.job_type, job.name, job.lease._replace(expires = 0), self.lease_etag)
+            self._log("{} failed (exit code {}); returned it to the queue".format(job.name, proc.returncode))
+
+    def run(self) -> None:
+        # claiming and renewing leases relies on conditional writes; fail here rather than on the first claim
+        check_conditional_writes()
+        try:
+            self.code_version = subprocess.check_output(["git", "describe", "--always"], cwd = Path(self.code_path).resolve().parent,
+                stderr = subprocess.DEVNULL).strip().decode()
+        except (subprocess.CalledProcessError, OSError):
+            self.code_version = "unknown"
+        self._log("pulling jobs of type {} from {}".format(", ".join(self.job_types), QUEUE_PATH))
+        idle_since = time.time()
+        while not self.stopping.is_set():
+            job = self.claim()
+            if job is None:
+                if self.max_idle_sec > 0 and time.time() - idle_since >= self.max_idle_sec:
+                    break
+                self.stopping.wait(self.poll_sec)
+                continue
+            self.run_job(job)
+            idle_since = time.time()
+        self._log("stopping; {} jobs done and {} failed".format(self.n_done, self.n_failed))
+
+if __name__ == "__main__":
+    if sys.argv[1] == "stats":
+        stats = queue_stats(sys.argv[2])
+        print("{} jobs done, {} failed".format(stats["n_done"], stats["n_failed"]))
+        if stats["n_done"] > 0:
+            print("throughput: {:.1f} jobs per hour".format(stats["jobs_per_hour"]))
+            for key in ["wait", "run", "total"]:
+                print("{} (sec): p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}".format(key, *[stats[key][q] for q in ["p50", "p95", "p99", "max"]]))
+        sys.exit()
+    s3_access_file, output_destination, code_path = sys.argv[1], sys.argv[2], sys.argv[3]
+    sys.path.append(code_path)
+    from base_utils import set_access_keys
+    set_access_keys(s3_access_file)
+    worker = JobWorker(sys.argv[4].split(",") if len(sys.argv) > 4 else DEFAULT_JOB_TYPES, output_destination, code_path, s3_access_file)
+    # stop (and release the job in progress) on SIGTERM, e.g. when the node is preempted
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    worker.run()
@@ -0,0 +1,206 @@
+import io
+import os
+import json
+import zlib
+import zipfile
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import torch
+from anndata import AnnData
+from typing import Optional, Union
+
+# Model artifacts of scvi, totalvi and scanvi. A model used to be saved into a directory together with a copy of the data it was
+# fitted on (an lzf h5ad of up to 200000 cells, written from a full copy of the AnnData object), and the directory was then read
+# again to build a deflate zip, which spent most of its time recompressing the already-compressed h5ad. An artifact is a zip of:
+# - the files written by model.save() (the weights and the registry of the model), optionally with the weights cast to float16;
+# - cells.csv: the barcodes of the training cells, their batches and their total counts;
+# - artifact.json: the manifest, which references the h5ad file of the stage that holds the training data (its file name, and the
+#   layer with the counts; X if None) instead of a copy of it.
+# The zip is written in one pass over the files of the model, storing the payloads that don't compress (see _compress_type) as is.
+# The name of the zip and its top directory are as before, so the artifacts are uploaded and unpacked as before.
+#
+# Loading goes through a thin adapter around SCVI.load / TOTALVI.load / SCANVI.load:
+#   model_dir = extract_model_artifact(artifact_path, target_dir)
+#   adata = read_model_training_data(model_dir, reference)  # reference: the referenced h5ad (an AnnData object or a path)
+#   model = load_model_artifact(scvi.model.SCVI, model_dir, adata)
+# read_model_training_data() rebuilds the training data from the reference (the training cells and genes, the counts) and checks
+# that the total counts of each cell match those recorded in cells.csv. Artifacts written before (without a manifest) are read
+# from the h5ad they contain.
+
+MANIFEST_FILE = "artifact.json"
+CELLS_FILE = "cells.csv"
+FORMAT_VERSION = 1
+# payloads whose sample compresses to more than this fraction of its size are stored without compression
+MIN_COMPRESSION_RATIO = 0.9
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+
+def _cast_tensors(obj, from_dtype, to_dtype):
+    # casts the tensors of the given dtype in a (nested) state dict
+    if isinstance(obj, torch.Tensor):
+        return obj.to(to_dtype) if obj.dtype == from_dtype else obj
+    if isinstance(obj, dict):
+        return type(obj)((k, _cast_tensors(v, from_dtype, to_dtype)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cast_tensors(v, from_dtype, to_dtype) for v in obj)
+    return obj
+
+def _compress_type(data: bytes) -> int:
+    # compressed (h5ad, zip, gz) and random-looking (float weights) payloads are not worth deflating
+    sample = data[:COMPRESSION_SAMPLE_SIZE]
+    if len(sample) == 0 or len(zlib.compress(sample, 1)) > MIN_COMPRESSION_RATIO * len(sample):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _write_member(zipf: zipfile.ZipFile, arcname: str, data: bytes) -> None:
+    zipf.writestr(arcname, data, compress_type = _compress_type(data))
+
+def _counts(adata: AnnData, layer: Optional[str]):
+    return adata.X if layer is None else adata.layers[layer]
+
+def _cell_totals(counts) -> np.ndarray:
+    return np.asarray(counts.sum(axis = 1), dtype = np.float64).ravel()
+
+def save_model_artifact(
+        model,
+        artifact_path: str,
+        model_dir_path: str,
+        model_name: str,
+        batch_key: Optional[str],
+        reference_h5ad_file: Optional[str] = None,
+        reference_layer: Optional[str] = None,
+        protein_expression_obsm_key: Optional[str] = None,
+        reduced_precision: bool = False,
+    ) -> None:
+    """
+    Saves the model into model_dir_path (with model.save()) and packages it as an artifact at artifact_path (see above).
+    reference_h5ad_file is the name of the h5ad file, written by the stage next to the artifact, that holds the training cells
+    with their counts in reference_layer (X if None); if None, the artifact holds the model only.
+    """
+    model.save(model_dir_path, overwrite = True)
+    adata = model.adata
+    dir_name = os.path.basename(os.path.normpath(model_dir_path))
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "model_name": model_name,
+        "batch_key": batch_key,
+        "protein_expression_obsm_key": protein_expression_obsm_key,
+        "reference": None if reference_h5ad_file is None else {"h5ad_file": reference_h5ad_file, "layer": reference_layer},
+        "n_obs": adata.n_obs,
+        "var_names": list(adata.var_names),
+        "weights_dtype": "float16" if reduced_precision else "float32",
+    }
+    # models trained without a batch key (e.g. samples with a single library) have an empty batch column
+    batches = adata.obs[batch_key].astype(str).values if batch_key is not None else np.full(adata.n_obs, "")
+    cells = pd.DataFrame({"batch": batches, "total_counts": _cell_totals(adata.X)},
+        index = pd.Index(adata.obs_names, name = "barcode"))
+    with zipfile.ZipFile(artifact_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for root, _, files in os.walk(model_dir_path):
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                arcname = os.path.join(dir_name, os.path.relpath(path, model_dir_path))
+                if reduced_precision and file.endswith(".pt"):
+                    buffer = io.BytesIO()
+                    torch.save(_cast_tensors(torch.load(path, map_location = "cpu"), torch.float32, torch.float16), buffer)
+                    _write_member(zipf, arcname, buffer.getvalue())
+                else:
+                    with open(path, "rb") as f:
+                        _write_member(zipf, arcname, f.read())
+        _write_member(zipf, os.path.join(dir_name, CELLS_FILE), cells.to_csv().encode())
+        _write_member(zipf, os.path.join(dir_name, MANIFEST_FILE), json.dumps(manifest).encode())
+
+def extract_model_artifact(artifact_path: str, target_dir: str) -> str:
+    # unpacks the artifact into target_dir; returns the directory of the model
+    with zipfile.ZipFile(artifact_path) as zipf:
+        dir_names = set([name.split("/")[0] for name in zipf.namelist()])
+        assert len(dir_names) == 1, "Expected a single directory in {}.".format(artifact_path)
+        zipf.extractall(target_dir)
+    return os.path.join(target_dir, dir_names.pop())
+
+def read_model_manifest(model_dir: str) -> Optional[dict]:
+    # None for artifacts written before the manifest was introduced
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def set_artifact_reference(artifact_path: str, reference_h5ad_file: Optional[str], reference_layer: Optional[str] = None) -> None:
+    # points the manifest of the artifact at another h5ad file, e.g. when the artifact of one configs version is restored from a
+    # checkpoint (see checkpoints.py) into another; artifacts without a manifest are left as they are
+    with zipfile.ZipFile(artifact_path) as zipf:
+        members = [(info, zipf.read(info)) for info in zipf.infolist()]
+    manifests = [i for i, (info, _) in enumerate(members) if os.path.basename(info.filename) == MANIFEST_FILE]
+    if len(manifests) == 0:
+        return
+    info, data = members[manifests[0]]
+    manifest = json.loads(data)
+    reference = None if reference_h5ad_file is None else {"h5ad_file": reference_h5ad_file, "layer": reference_layer}
+    if manifest["reference"] == reference:
+        return
+    manifest["reference"] = reference
+    members[manifests[0]] = (info, json.dumps(manifest).encode())
+    tmp_path = artifact_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w") as zipf:
+        for info, data in members:
+            zipf.writestr(info, data, compress_type = info.compress_type)
+    os.replace(tmp_path, artifact_path)
+
+def read_model_training_data(model_dir: str, reference: Union[AnnData, str, None] = None) -> AnnData:
+    """
+    Returns the data the model in model_dir was fitted on: rebuilt from reference (the h5ad file referenced by the manifest, as
+    an AnnData object or a path; read from next to the model directory if None), or, for artifacts written before the manifest
+    was introduced, read from the h5ad file in the model directory.
+    """
+    import anndata
+    manifest = read_model_manifest(model_dir)
+    if manifest is None:
+        data_files = [f for f in os.listdir(model_dir) if f.endswith(".h5ad")]
+        if len(data_files) != 1:
+            raise FileNotFoundError("No training data found in {}.".format(model_dir))
+        return anndata.read_h5ad(os.path.join(model_dir, data_files[0]))
+    if manifest["reference"] is None:
+        raise ValueError("The model in {} does not reference its training data.".format(model_dir))
+    if reference is None:
+        reference = os.path.join(os.path.dirname(os.path.normpath(model_dir)), manifest["reference"]["h5ad_file"])
+    if isinstance(reference, str):
+        reference = anndata.read_h5ad(reference)
+    cells = pd.read_csv(os.path.join(model_dir, CELLS_FILE), index_col = "barcode", dtype = {"barcode": str, "batch": str})
+    missing_cells = ~cells.index.isin(reference.obs_names)
+    missing_genes = ~pd.Index(manifest["var_names"]).isin(reference.var_names)
+    if missing_cells.any() or missing_genes.any():
+        raise ValueError("{} cells and {} genes of the training data are missing from the reference {}.".format(
+            missing_cells.sum(), missing_genes.sum(), manifest["reference"]["h5ad_file"]))
+    rows = reference.obs_names.get_indexer(cells.index)
+    columns = reference.var_names.get_indexer(manifest["var_names"])
+    counts = _counts(reference, manifest["reference"]["layer"])[rows][:, columns]
+    if not np.allclose(_cell_totals(counts), cells["total_counts"].values):
+        raise ValueError("The counts in the reference {} differ from the training data of the model in {}.".format(
+            manifest["reference"]["h5ad_file"], model_dir))
+    adata = AnnData(X = counts.copy() if scipy.sparse.issparse(counts) else np.array(counts),
+        obs = reference.obs.iloc[rows].copy(), var = reference.var.iloc[columns].copy())
+    if manifest["batch_key"] is not None and manifest["batch_key"] not in adata.obs:
+        # batch keys that are derived when training (e.g. donor_id+tissue)
+        adata.obs[manifest["batch_key"]] = pd.Categorical(cells["batch"].values)
+    protein_key = manifest["protein_expression_obsm_key"]
+    if protein_key is not None:
+        # as when training, cells without protein information have zeros
+        proteins = reference.obsm[protein_key]
+        adata.obsm[protein_key] = proteins.iloc[rows].fillna(0) if isinstance(proteins, pd.DataFrame) else np.nan_to_num(proteins[rows])
+    return adata
+
+def load_model_artifact(model_class, model_dir: str, adata: AnnData, **kwargs):
+    """
+    Loads the model in model_dir (see extract_model_artifact) with model_class.load() (e.g. scvi.model.SCVI.load), with adata as
+    its data (see read_model_training_data); weights saved in float16 are cast back to float32 first.
+    """
+    manifest = read_model_manifest(model_dir)
+    if manifest is not None and manifest["weights_dtype"] == "float16":
+        for file in os.listdir(model_dir):
+            if file.endswith(".pt"):
+                path = os.path.join(model_dir, file)
+                torch.save(_cast_tensors(torch.load(path, map_location = "cpu"), torch.float16, torch.float32), path)
+        manifest["weights_dtype"] = "float32"
+        with open(os.path.join(model_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+    return model_class.load(model_dir, adata = adata, **kwargs)
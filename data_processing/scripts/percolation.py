@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from statsmodels.stats import multitest
+from typing import Dict, Optional, Tuple, Union
+
+# Percolation scores: a per-cell score (e.g. doublet probability, total counts) is summarized per (over)cluster, and
+# clusters whose summary is an outlier compared to the rest of the cells are flagged. The cluster summaries used to be
+# written back to the cells with one boolean .loc assignment per cluster, i.e. O(clusters x cells) per score. Here the
+# clusters are encoded once as categorical codes, the per-cluster statistics are computed with bincount / one sort, and
+# they are broadcast back to the cells by indexing with the codes.
+
+def cluster_codes(clusters) -> Tuple[np.ndarray, int]:
+    # integer code of the cluster of every cell (-1 for missing values) and the number of clusters
+    clusters = pd.Categorical(clusters)
+    return np.asarray(clusters.codes), len(clusters.categories)
+
+def to_cells(cluster_values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    # broadcast per-cluster values to the cells; cells without a cluster get NaN (float32 values stay float32, as with .loc assignments)
+    cluster_values = np.asarray(cluster_values)
+    cell_values = cluster_values.astype(cluster_values.dtype if cluster_values.dtype.kind == "f" else np.float64)[codes]
+    cell_values[codes < 0] = np.nan
+    return cell_values
+
+def grouped_mean(values: np.ndarray, codes: np.ndarray, n_clusters: int, skipna: bool = False) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64)
+    keep = codes >= 0
+    if skipna:
+        keep &= ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.bincount(codes[keep], weights=values[keep], minlength=n_clusters) / np.bincount(codes[keep], minlength=n_clusters)
+
+def _sorted_groups(values: np.ndarray, codes: np.ndarray, n_clusters: int, skipna: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # values sorted by cluster and then by value, the start position and size of every cluster, and which clusters have missing values
+    if values.dtype.kind not in "f":
+        values = values.astype(np.float64)
+    isnan = np.isnan(values)
+    keep = codes >= 0
+    has_nan = np.bincount(codes[keep & isnan], minlength=n_clusters) > 0
+    if skipna:
+        keep &= ~isnan
+    values, codes = values[keep], codes[keep]
+    order = np.lexsort((values, codes))
+    counts = np.bincount(codes, minlength=n_clusters)
+    starts = np.cumsum(counts) - counts
+    return values[order], starts, counts, has_nan
+
+def grouped_median(values: np.ndarray, codes: np.ndarray, n_clusters: int, skipna: bool = False) -> np.ndarray:
+    # same as np.median per cluster (skipna=False) or pandas' median per cluster (skipna=True)
+    sorted_values, starts, counts, has_nan = _sorted_groups(np.asarray(values), codes, n_clusters, skipna)
+    medians = np.full(n_clusters, np.nan, dtype=sorted_values.dtype)
+    nonempty = counts > 0
+    lower = starts[nonempty] + (counts[nonempty] - 1) // 2
+    upper = starts[nonempty] + counts[nonempty] // 2
+    medians[nonempty] = (sorted_values[lower] + sorted_values[upper]) / 2
+    if not skipna:
+        medians[has_nan] = np.nan
+    return medians
+
+def grouped_quantile(values: np.ndarray, codes: np.ndarray, n_clusters: int, q: float) -> np.ndarray:
+    # same as pandas' quantile (linear interpolation, missing values are skipped) per cluster
+    sorted_values, starts, counts, _ = _sorted_groups(np.asarray(values), codes, n_clusters, True)
+    quantiles = np.full(n_clusters, np.nan)
+    nonempty = counts > 0
+    position = (counts[nonempty] - 1) * q
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts[nonempty] - 1)
+    a, b = sorted_values[starts[nonempty] + lower], sorted_values[starts[nonempty] + upper]
+    t = position - lower
+    # numpy's interpolation formula, so that the results are identical
+    quantiles[nonempty] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    return quantiles
+
+def _fdrcorrection(cluster_pvals: np.ndarray, cluster_sizes: np.ndarray) -> np.ndarray:
+    # Benjamini-Hochberg correction of the p-values of all the cells, where all the cells of a cluster share its p-value; same as
+    # multitest.fdrcorrection on the per-cell p-values, computed over the clusters (each one is a run of ties in the sorted p-values)
+    n = cluster_sizes.sum()
+    order = np.argsort(cluster_pvals, kind="mergesort")
+    sorted_pvals = cluster_pvals[order]
+    last_rank = np.cumsum(cluster_sizes[order])
+    corrected = np.minimum.accumulate((sorted_pvals / (last_rank / n))[::-1])[::-1]
+    corrected[corrected > 1] = 1
+    cluster_qvals = np.empty(len(cluster_pvals))
+    cluster_qvals[order] = corrected
+    return cluster_qvals
+
+def _cluster_scores(score: pd.Series, codes: np.ndarray, n_clusters: int, threshold) -> np.ndarray:
+    # fraction of cells equal to (for a string threshold) or above the threshold, or the median score if there is no threshold
+    if isinstance(threshold, str):
+        return grouped_mean((score == threshold).values, codes, n_clusters)
+    elif threshold is not None:
+        return grouped_mean((score > threshold).values, codes, n_clusters)
+    return grouped_median(score.values, codes, n_clusters)
+
+def percolate_codes(adata, codes: np.ndarray, n_clusters: int, score_key: str, exclude_high: bool = True, qval: float = 0.1,
+    threshold: Optional[Union[str, float]] = None) -> None:
+    # percolation of one score, given the cluster codes of the cells (see percolate_observation)
+    cluster_scores = _cluster_scores(adata.obs[score_key], codes, n_clusters, threshold)
+    cell_scores = to_cells(cluster_scores, codes)
+    adata.obs[f'{score_key}_median_cluster_scores'] = cell_scores
+    # the center and spread are over the cells (not the clusters), as in the per-cell implementation
+    positive = cell_scores[cell_scores > 0]
+    med = np.median(positive) if len(positive) > 0 else np.nan
+    mad = 0.03 + np.median(abs(cell_scores[cell_scores < med] - med))
+    if exclude_high:
+        cluster_pvals = 1 - norm.cdf(cluster_scores, loc = med, scale = 1.4826*mad)
+    else:
+        cluster_pvals = norm.cdf(cluster_scores, loc = med, scale = 1.4826*mad)
+    cluster_sizes = np.bincount(codes[codes >= 0], minlength=n_clusters)
+    # unused categories are clusters without cells; their scores are NaN and they are left out of the correction
+    nonempty = cluster_sizes > 0
+    if np.isnan(cluster_pvals[nonempty]).any() or (codes < 0).any():
+        # missing values; leave their handling to statsmodels
+        bh_pvals = multitest.fdrcorrection(to_cells(cluster_pvals, codes), alpha=qval)[1]
+    else:
+        cluster_qvals = np.full(n_clusters, np.nan)
+        cluster_qvals[nonempty] = _fdrcorrection(cluster_pvals[nonempty], cluster_sizes[nonempty])
+        bh_pvals = cluster_qvals[codes]
+    adata.obs[f'{score_key}_bh_pval'] = bh_pvals
+    adata.obs[f'{score_key}_percolation'] = adata.obs[f'{score_key}_bh_pval'] < qval
+
+def percolate_observation(adata, overclustering_key, score_key, exclude_high=True, qval=0.1, threshold=None):
+    codes, n_clusters = cluster_codes(adata.obs[overclustering_key])
+    percolate_codes(adata, codes, n_clusters, score_key, exclude_high, qval, threshold)
+
+def percolate_observations(adata, overclustering_key: str, percolation_scores: Dict[str, Dict], logger = None) -> np.ndarray:
+    """
+    Computes all the given percolation scores (obs key -> arguments of percolate_observation, as in the "percolation_score" of the
+    process_sample configs) with the clusters in adata.obs[overclustering_key], and returns the number of percolation scores that
+    flagged each cell. Scores that are not in adata.obs are skipped.
+    """
+    codes, n_clusters = cluster_codes(adata.obs[overclustering_key])
+    sum_percolation_score = np.zeros(adata.n_obs, dtype=np.int64)
+    for obs_key in percolation_scores:
+        if obs_key in adata.obs.columns:
+            percolate_codes(adata, codes, n_clusters, **percolation_scores[obs_key])
+            sum_percolation_score += adata.obs[f'{obs_key}_percolation'].values.astype(int)
+        elif logger is not None:
+            logger.add_to_log(f"Percolation score {obs_key} was not found in obs. Skipping computation.")
+    return sum_percolation_score
+
+def add_cluster_statistics(obs: pd.DataFrame, cluster_key: str, score_key: str) -> None:
+    # the median, mean and 75th percentile of the score in the cluster of each cell, as {score_key}_{median,mean,q75}_cluster
+    codes, n_clusters = cluster_codes(obs[cluster_key])
+    values = obs[score_key].values
+    obs[f'{score_key}_q75_cluster'] = to_cells(grouped_quantile(values, codes, n_clusters, 0.75), codes)
+    obs[f'{score_key}_median_cluster'] = to_cells(grouped_median(values, codes, n_clusters, skipna=True), codes)
+    obs[f'{score_key}_mean_cluster'] = to_cells(grouped_mean(values, codes, n_clusters, skipna=True), codes)
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from resources import get_available_memory
+
+# Runs the processing jobs of the pipeline (process_library.py, process_sample.py and integrate_samples.py) on one node as a
+# dependency graph, instead of running the jobs in the .sh files written by generate_processing_scripts.py one after the other.
+# The graph is built from the configs files of the jobs: a library is processed before the samples that use it (the library_ids
+# and library_types of a process_sample configs file, with its donor and seq_run) and a sample before the integrations that use it
+# (the sample_ids of an integrate_samples configs file); dependencies on jobs that are not in the graph (e.g. libraries that were
+# processed before) are ignored. The jobs whose dependencies are done run concurrently, each with the cores and memory of its stage
+# (see STAGE_CORES and STAGE_MEM_GB), as long as these are free; the ready jobs with the longest chain of jobs after them (by the
+# duration of their previous runs, or STAGE_EST_SEC) start first. A job that fails is retried, up to max_attempts times; the jobs
+# that depend on a job that failed all of its attempts are skipped.
+# The status of every job is saved in the state file after every change, so a run that was interrupted (or that had jobs that failed)
+# resumes by running the same command again: jobs that are done are not run again.
+#
+# Run as follows: python pipeline_dag.py <state_file> <jobs_file> [<jobs_file> ...]
+# where every jobs_file is either a configs file or a file listing configs files, one per line (as the .sh files written by
+# generate_processing_scripts.py and generate_integration_config_files_and_script.py); the output of every attempt of a job is
+# written to <name>.<attempt>.log in the folder of the state file.
+#
+# The following environment variables can be used to control the executor (all are optional):
+# IA_DAG_CORES - number of cores to use (default all the cores of the node)
+# IA_DAG_MEM_GB - memory to use, in GB (default the available memory of the node)
+# IA_DAG_MAX_ATTEMPTS - max number of attempts of a job (default 2)
+# IA_DAG_WARM - if set to 1, the jobs are forked from a warm worker that imported the heavy libraries once (see warm_worker.py)
+
+STAGE_CORES = {"process_library": 2, "process_sample": 4, "integrate_samples": 16}
+STAGE_MEM_GB = {"process_library": 16, "process_sample": 32, "integrate_samples": 128}
+# the expected duration of a job that never ran before
+STAGE_EST_SEC = {"process_library": 900, "process_sample": 1800, "integrate_samples": 14400}
+RETRY_DELAY_SEC = 30
+POLL_INTERVAL_SEC = 1
+# thread pools of numpy, scanpy and torch are sized to the cores of the job
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMBA_NUM_THREADS"]
+
+class PipelineTask(NamedTuple):
+    name: str
+    stage: str
+    configs_file: str
+    command: List[str]
+    deps: List[str]
+    cores: int
+    mem_gb: int
+
+def get_stage(configs: Dict) -> str:
+    if "sample_ids" in configs:
+        return "integrate_samples"
+    if "library_ids" in configs:
+        return "process_sample"
+    return "process_library"
+
+def get_task_name(stage: str, configs: Dict) -> str:
+    if stage == "process_library":
+        return "process_library.{}_{}_{}_{}".format(configs["donor"], configs["seq_run"], configs["library_type"], configs["library_id"])
+    if stage == "process_sample":
+        return "process_sample.{}".format(configs["sample_id"])
+    return "integrate_samples.{}".format(configs["output_prefix"])
+
+def get_stage_command(stage: str, configs_file: str, configs: Dict) -> List[str]:
+    code_path = configs["code_path"] if "code_path" in configs else os.path.dirname(os.path.abspath(__file__))
+    return [sys.executable, os.path.join(code_path, "{}.py".format(stage)), configs_file]
+
+def read_configs_files(jobs_files: List[str]) -> List[str]:
+    configs_files = []
+    for jobs_file in jobs_files:
+        with open(jobs_file) as f:
+            content = f.read()
+        if content.lstrip().startswith("{"):
+            configs_files.append(os.path.abspath(jobs_file))
+        else:
+            configs_files += [line.strip() for line in content.splitlines() if len(line.strip()) > 0 and not line.startswith("#")]
+    return configs_files
+
+def build_pipeline_tasks(configs_files: List[str], command: Optional[Callable[[str, str, Dict], List[str]]] = None,
+    cores: Optional[Dict[str, int]] = None, mem_gb: Optional[Dict[str, int]] = None) -> List[PipelineTask]:
+    """
+    Builds the dependency graph of the jobs with the given configs files (see above). command (stage, configs file, configs) -> the
+    command of a job, and cores and mem_gb (stage -> resources of its jobs) can be set for running stub jobs.
+    """
+    command = command or get_stage_command
+    cores = dict(STAGE_CORES, **(cores or {}))
+    mem_gb = dict(STAGE_MEM_GB, **(mem_gb or {}))
+    jobs = []
+    for configs_file in configs_files:
+        with open(configs_file) as f:
+            configs = json.load(f)
+        stage = get_stage(configs)
+        jobs.append((get_task_name(stage, configs), stage, configs_file, configs))
+    names = set([name for name, _, _, _ in jobs])
+    if len(names) < len(jobs):
+        raise ValueError("More than one configs file for the same job")
+    tasks = []
+    for name, stage, configs_file, configs in jobs:
+        deps = []
+        if stage == "process_sample":
+            library_ids = configs["library_ids"].split(",")
+            if "library_types" in configs:
+                library_types = configs["library_types"].split(",")
+            else:
+                library_types = [configs["library_type"]] * len(library_ids)
+            deps = ["process_library.{}_{}_{}_{}".format(configs["donor"], configs["seq_run"], library_type, library_id)
+                for library_id, library_type in zip(library_ids, library_types)]
+        elif stage == "integrate_samples":
+            deps = ["process_sample.{}".format(sample_id) for sample_id in configs["sample_ids"].split(",")]
+        deps = [dep for dep in deps if dep in names]
+        tasks.append(PipelineTask(name, stage, configs_file, command(stage, configs_file, configs), deps, cores[stage], mem_gb[stage]))
+    return tasks
+
+def critical_path(tasks: List[PipelineTask], durations: Dict[str, float]) -> Tuple[float, List[str]]:
+    # the longest chain of dependent tasks, by the given durations
+    by_name = {task.name: task for task in tasks}
+    longest = {}    # name -> (length of the longest chain ending with the task, the task before it in the chain)
+    def visit(name):
+        if name not in longest:
+            before = max([(visit(dep)[0], dep) for dep in by_name[name].deps], default = (0, None))
+            longest[name] = (before[0] + durations.get(name, 0), before[1])
+        return longest[name]
+    for name in by_name:
+        visit(name)
+    if len(longest) == 0:
+        return 0, []
+    name = max(longest, key = lambda n: longest[n][0])
+    length = longest[name][0]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = longest[name][1]
+    return length, path[::-1]
+
+class PipelineExecutor:
+    """
+    Runs the given tasks (see build_pipeline_tasks) under the cores and memory of the node, saving their status in state_file. run()
+    returns the names of the tasks that are not done (failed, or skipped since a task they depend on failed); the timeline of the run
+    is in events and its statistics are returned by report().
+    """
+    def __init__(self, tasks: List[PipelineTask], state_file: str, cores: Optional[int] = None, mem_gb: Optional[int] = None,
+        max_attempts: Optional[int] = None, warm_worker = None):
+        if cores is None:
+            cores = int(os.environ.get("IA_DAG_CORES", os.cpu_count()))
+        if mem_gb is None:
+            mem_gb = int(os.environ.get("IA_DAG_MEM_GB", 0)) or int(get_available_memory() / 1024 ** 3)
+        if max_attempts is None:
+            max_attempts = int(os.environ.get("IA_DAG_MAX_ATTEMPTS", 2))
+        self.tasks = {task.name: task for task in tasks}
+        for task in tasks:
+            unknown = [dep for dep in task.deps if dep not in self.tasks]
+            if len(unknown) > 0:
+                raise ValueError("Task {} depends on unknown tasks: {}".format(task.name, ", ".join(unknown)))
+        self.state_file = os.path.abspath(state_file)
+        self.log_dir = os.path.dirname(self.state_file)
+        self.cores = cores
+        self.mem_gb = mem_gb
+        self.max_attempts = max_attempts
+        self.state = self._load_state()
+        self.events = []
+        if warm_worker is None and os.environ.get("IA_DAG_WARM", "0") == "1":
+            from warm_worker import WarmWorker
+            warm_worker = WarmWorker()
+        self.warm_worker = warm_worker
+
+    def _load_state(self) -> Dict[str, Dict]:
+        # name -> {"status": "done"/"failed", "attempts", "duration"} of the tasks that ran before
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _save_state(self) -> None:
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.state, f, indent = 1)
+        os.replace(tmp_file, self.state_file)
+
+    def _log(self, msg: str) -> None:
+        print("[{:8.1f}s] {}".format(time.time() - self.start_time, msg))
+        sys.stdout.flush()
+
+    def _priorities(self) -> Dict[str, float]:
+        # the expected duration of the longest chain of tasks starting with every task
+        dependents = {name: [] for name in self.tasks}
+        for task in self.tasks.values():
+            for dep in task.deps:
+                dependents[dep].append(task.name)
+        priorities = {}
+        def visit(name):
+            if name not in priorities:
+                task = self.tasks[name]
+                duration = self.state[name]["duration"] if name in self.state and "duration" in self.state[name] else STAGE_EST_SEC[task.stage]
+                priorities[name] = duration + max([visit(d) for d in dependents[name]], default = 0)
+            return priorities[name]
+        for name in self.tasks:
+            visit(name)
+        return priorities
+
+    def _resources(self, task: PipelineTask) -> Tuple[int, int]:
+        # a task that needs more than the node runs alone
+        return min(task.cores, self.cores), min(task.mem_gb, self.mem_gb)
+
+    def _start(self, task: PipelineTask, attempt: int) -> subprocess.Popen:
+        log_file = os.path.join(self.log_dir, "{}.{}.log".format(task.name, attempt))
+        thread_env = {var: str(self._resources(task)[0]) for var in THREAD_ENV_VARS}
+        if self.warm_worker is not None:
+            proc = self.warm_worker.start(task.command, log_file, thread_env)
+        else:
+            log = open(log_file, "w")
+            proc = subprocess.Popen(task.command, env = dict(os.environ, **thread_env), stdout = log, stderr = subprocess.STDOUT)
+            log.close()
+        self.events.append((task.name, attempt, "start", time.time() - self.start_time))
+        return proc
+
+    def run(self) -> List[str]:
+        self.start_time = time.time()
+        priorities = self._priorities()
+        done = set([name for name in self.tasks if name in self.state and self.state[name]["status"] == "done"])
+        if len(done) > 0:
+            self._log("resuming: {} of {} tasks are done".format(len(done), len(self.tasks)))
+        waiting = [name for name in self.tasks if name not in done]
+        attempts = {name: 0 for name in waiting}
+        not_before = {}     # name -> time before which a failed task is not retried
+        running = {}        # name -> (process, start time)
+        failed = set()
+        try:
+            while len(waiting) + len(running) > 0:
+                # tasks that can no longer run
+                for name in list(waiting):
+                    if any([dep in failed for dep in self.tasks[name].deps]):
+                        waiting.remove(name)
+                        failed.add(name)
+                        self._log("skipping {} (a task it depends on failed)".format(name))
+                # ready tasks, the ones with the longest chains of tasks after them first
+                free_cores = self.cores - sum([self._resources(self.tasks[name])[0] for name in running])
+                free_mem_gb = self.mem_gb - sum([self._resources(self.tasks[name])[1] for name in running])
+                now = time.time()
+                ready = [name for name in waiting if all([dep in done for dep in self.tasks[name].deps]) and not_before.get(name, 0) <= now]
+                for name in sorted(ready, key = lambda n: -priorities[n]):
+                    task = self.tasks[name]
+                    task_cores, task_mem_gb = self._resources(task)
+                    if task_cores <= free_cores and task_mem_gb <= free_mem_gb:
+                        waiting.remove(name)
+                        free_cores -= task_cores
+                        free_mem_gb -= task_mem_gb
+                        attempts[name] += 1
+                        self._log("starting {} (attempt {}) with {} cores and {} GB".format(name, attempts[name], task_cores, task_mem_gb))
+                        running[name] = (self._start(task, attempts[name]), time.time())
+                time.sleep(POLL_INTERVAL_SEC)
+                for name, (proc, start) in list(running.items()):
+                    if proc.poll() is None:
+                        continue
+                    del running[name]
+                    self.events.append((name, attempts[name], "end", time.time() - self.start_time))
+                    duration = time.time() - start
+                    self.state[name] = {"status": "done" if proc.returncode == 0 else "failed", "attempts": attempts[name], "duration": duration}
+                    if proc.returncode == 0:
+                        done.add(name)
+                        self._log("done with {} ({:.1f} sec)".format(name, duration))
+                    elif attempts[name] < self.max_attempts:
+                        waiting.append(name)
+                        not_before[name] = time.time() + RETRY_DELAY_SEC
+                        self._log("{} failed (exit code {}); retrying in {} sec".format(name, proc.returncode, RETRY_DELAY_SEC))
+                    else:
+                        failed.add(name)
+                        self._log("{} failed (exit code {}) after {} attempts".format(name, proc.returncode, attempts[name]))
+                    self._save_state()
+        finally:
+            # interrupted: the tasks in progress are run again on resume
+            for name, (proc, _) in running.items():
+                proc.terminate()
+                proc.wait()
+            self._save_state()
+        self.makespan = time.time() - self.start_time
+        self._log("done; {} of {} tasks are done".format(len(done), len(self.tasks)))
+        return sorted(failed)
+
+    def report(self) -> Dict:
+        """
+        Statistics of the last run: its makespan, the critical path (the longest chain of dependent tasks, by the duration of their
+        last attempts) and the use of the cores and memory of the node (the time of all the attempts of the tasks).
+        """
+        starts = {}
+        core_sec, mem_gb_sec = 0, 0
+        for name, attempt, event, t in self.events:
+            if event == "start":
+                starts[(name, attempt)] = t
+            elif (name, attempt) in starts:
+                duration = t - starts.pop((name, attempt))
+                task_cores, task_mem_gb = self._resources(self.tasks[name])
+                core_sec += duration * task_cores
+                mem_gb_sec += duration * task_mem_gb
+        durations = {name: self.state[name]["duration"] for name in self.tasks if name in self.state}
+        length, path = critical_path(list(self.tasks.values()), durations)
+        return {
+            "makespan": self.makespan,
+            "critical_path_sec": length,
+            "critical_path": path,
+            # no schedule is shorter than the critical path or the total work divided by the cores
+            "lower_bound_sec": max(length, core_sec / self.cores),
+            "core_utilization": core_sec / (self.cores * self.makespan) if self.makespan > 0 else 0,
+            "mem_utilization": mem_gb_sec / (self.mem_gb * self.makespan) if self.makespan > 0 else 0,
+        }
+
+if __name__ == "__main__":
+    tasks = build_pipeline_tasks(read_configs_files(sys.argv[2:]))
+    executor = PipelineExecutor(tasks, sys.argv[1])
+    failed = executor.run()
+    stats = executor.report()
+    print("makespan {:.1f} sec; critical path {:.1f} sec ({}); core utilization {:.0%}; memory utilization {:.0%}".format(stats["makespan"],
+        stats["critical_path_sec"], " -> ".join(stats["critical_path"]), stats["core_utilization"], stats["mem_utilization"]))
+    if len(failed) > 0:
+        print("Tasks not done: {}".format(", ".join(failed)))
+        sys.exit(1)
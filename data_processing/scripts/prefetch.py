@@ -0,0 +1,143 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Type
+
+from logger import BaseLogger
+from s3_utils import S3Object, content_matches, get_max_concurrency, get_object_store, split_s3_path
+
+# Prefetching of the input files of a script (e.g. the h5ad files of the processed libraries in process_sample.py). All the
+# transfers are started up front and run concurrently in the background, and the reader waits for each file only when it
+# needs it, so that reading (and filtering) one file overlaps with downloading the next ones instead of waiting for all of
+# them to be downloaded first. Every downloaded file is verified against the size (and, when available, the md5 checksum)
+# of the object before it is handed to the reader.
+#
+# The following environment variables can be used to control the prefetching (all are optional):
+# IA_PREFETCH_MAX_CONCURRENCY - max number of files downloaded concurrently (default IA_S3_MAX_CONCURRENCY)
+# IA_PREFETCH_DISK_BUDGET_GB - max size of the files that were (or are being) downloaded but were not yet handed to the
+#   reader; transfers wait until the reader catches up (default: no limit). A file that is larger than the budget is
+#   still downloaded once the reader has taken all the previous files.
+
+VERIFY_MAX_ATTEMPTS = 2
+
+def verify_file(local_path: str, o: S3Object) -> bool:
+    # checks the size of the file and, when possible, its checksum (see s3_utils.content_matches)
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != o.size:
+        return False
+    return content_matches(local_path, o) is not False
+
+class Prefetcher:
+    """
+    Downloads the given (s3 path, local path) transfers in the background, in the given order, with up to max_concurrency concurrent
+    transfers and at most disk_budget bytes downloaded ahead of the reader (see above). Call wait(local_path) before reading a file.
+    If only_if_changed is True then files that already exist locally with the size of the object and a modification time that is
+    not older than the object's are not downloaded again (as in s3_utils.s3_sync).
+    """
+    def __init__(self, transfers: List[Tuple[str, str]], logger: Type[BaseLogger], max_concurrency: Optional[int] = None,
+        disk_budget: Optional[int] = None, only_if_changed: bool = True, store = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("IA_PREFETCH_MAX_CONCURRENCY", get_max_concurrency()))
+        if disk_budget is None and "IA_PREFETCH_DISK_BUDGET_GB" in os.environ:
+            disk_budget = int(float(os.environ["IA_PREFETCH_DISK_BUDGET_GB"]) * 1024 ** 3)
+        self.logger = logger
+        self.disk_budget = disk_budget
+        self.only_if_changed = only_if_changed
+        self.store = get_object_store() if store is None else store
+        self.local_paths = [os.path.abspath(t[1]) for t in transfers]
+        self._index = {self.local_paths[i]: i for i in range(len(transfers))}
+        self._sources = [t[0] for t in transfers]
+        self._cond = threading.Condition()
+        # bytes reserved by transfers whose files were not yet handed to the reader
+        self._reserved = [0] * len(transfers)
+        self._has_reservation = [False] * len(transfers)
+        self._handed = [False] * len(transfers)
+        # the reader may skip files (e.g. reads the GEX libraries before the BCR/TCR ones); transfers up to the last file it
+        # asked for are not held back by the budget, so that the reader never waits for a transfer that waits for the reader
+        self._max_requested = -1
+        self._errors = [None] * len(transfers)
+        self._executor = ThreadPoolExecutor(max_workers = max(1, min(max_concurrency, len(transfers))))
+        # the sizes of the objects are needed for the disk budget, and missing objects should be known right away
+        self.objects = list(self._executor.map(self._head, range(len(transfers))))
+        self._futures = [self._executor.submit(self._fetch, i) for i in range(len(transfers))]
+        self._executor.shutdown(wait = False)
+
+    def _head(self, i: int) -> Optional[S3Object]:
+        try:
+            return self.store.head(*split_s3_path(self._sources[i]))
+        except Exception as err:
+            # raised when the reader waits for the file
+            self._errors[i] = err
+            return None
+
+    def is_missing(self, local_path: str) -> bool:
+        # whether the object of the given file does not exist
+        i = self._index.get(os.path.abspath(local_path))
+        return i is not None and self.objects[i] is None and self._errors[i] is None
+
+    def _reserve(self, i: int, size: int) -> None:
+        # transfers reserve their share of the budget in order, unless the reader already asked for the file or a later one
+        with self._cond:
+            while not (i <= self._max_requested or (all(self._has_reservation[:i]) and
+                (self.disk_budget is None or sum(self._reserved) + size <= self.disk_budget or sum(self._reserved) == 0))):
+                self._cond.wait()
+            self._reserved[i] = 0 if self._handed[i] else size
+            self._has_reservation[i] = True
+            self._cond.notify_all()
+
+    def _fetch(self, i: int) -> bool:
+        source, local_path, o = self._sources[i], self.local_paths[i], self.objects[i]
+        if o is None:
+            self._reserve(i, 0)
+            if self._errors[i] is not None:
+                raise self._errors[i]
+            return False
+        if self.only_if_changed and os.path.isfile(local_path) and os.path.getsize(local_path) == o.size and \
+            o.last_modified <= os.path.getmtime(local_path) + 1:
+            self._reserve(i, 0)
+            return True
+        self._reserve(i, o.size)
+        os.makedirs(os.path.dirname(local_path), exist_ok = True)
+        for attempt in range(VERIFY_MAX_ATTEMPTS):
+            self.store.download(*split_s3_path(source), local_path)
+            if verify_file(local_path, o):
+                # like the aws cli, keep the modification time of the object so that the next sync will skip it
+                os.utime(local_path, (o.last_modified, o.last_modified))
+                return True
+            self.logger.add_to_log("Downloaded file {} does not match {} (attempt {} of {}).".format(
+                local_path, source, attempt + 1, VERIFY_MAX_ATTEMPTS), level = "warning")
+        os.remove(local_path)
+        raise ValueError("Failed to download {}: the downloaded file does not match the size or checksum of the object.".format(source))
+
+    def wait(self, local_path: str) -> bool:
+        """
+        Waits for the given file to be downloaded and returns True if it is available locally. Failures are logged rather than
+        raised and missing objects are not logged (as in utils.aws_sync); files that are not part of the transfers are not waited for.
+        """
+        i = self._index.get(os.path.abspath(local_path))
+        if i is None:
+            return os.path.isfile(local_path)
+        with self._cond:
+            self._max_requested = max(self._max_requested, i)
+            self._cond.notify_all()
+        try:
+            available = self._futures[i].result()
+        except Exception as err:
+            available = False
+            if not self._handed[i]:
+                self.logger.add_to_log("Failed to download {} to {}: {}".format(self._sources[i], local_path, err), level = "error")
+        with self._cond:
+            self._handed[i] = True
+            self._reserved[i] = 0
+            self._cond.notify_all()
+        return available
+
+    def cancel(self) -> None:
+        # cancels the transfers that did not start yet, e.g. before exiting following a missing input
+        with self._cond:
+            for f in self._futures:
+                f.cancel()
+            self._max_requested = len(self._futures)
+            self._cond.notify_all()
+
+    def wait_all(self) -> List[bool]:
+        return [self.wait(local_path) for local_path in self.local_paths]
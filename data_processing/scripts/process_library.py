@@ -23,6 +23,8 @@ sys.path.append(configs["code_path"])
 
 from logger import SimpleLogger
 from utils import *
+# fail now rather than after the processing if the zarr outputs are enabled (IA_ZARR_OUTPUT) but zarr is not installed
+check_zarr_output()
 
 VARIABLE_CONFIG_KEYS = ["data_owner","s3_access_file","code_path","output_destination"] # config changes only to these fields will not initialize a new configs version
 sc.settings.verbosity = 1   # verbosity: errors (0), warnings (1), info (2), hints (3)
@@ -56,6 +58,8 @@ if os.path.isfile(logger_file_path):
 
 logger = SimpleLogger(filename = logger_file_path)
 logger.add_to_log("Running process_library.py...")
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
 logger.add_to_log("Starting time: {}".format(timestamp))
 with open(process_lib_script, "r") as f:
     logger.add_to_log("process_library.py md5 checksum: {}\n".format(hashlib.md5(bytes(f.read(), 'utf-8')).hexdigest()))
@@ -69,18 +73,14 @@ if is_new_version:
     logger.add_to_log("Uploading new configs version to S3...")
     cp_cmd = "cp {} {}".format(configs_file, os.path.join(data_dir,output_configs_file))
     os.system(cp_cmd)
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_libraries/{}/{}/ --exclude "*" --include {}'.format(
-        data_dir, prefix, version, output_configs_file)
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(data_dir, "s3://immuneaging/processed_libraries/{}/{}/".format(prefix, version), output_configs_file)
 else:
     logger.add_to_log("Checking if h5ad file already exists on S3...")
     h5ad_file_exists = False
     logger_file_exists = False
-    ls_cmd = "aws s3 ls s3://immuneaging/processed_libraries/{}/{} --recursive".format(prefix,version)
-    files = os.popen(ls_cmd).read()
-    logger.add_to_log("aws response: {}\n".format(files))
-    for f in files.rstrip().split('\n'):
+    files = s3_list("s3://immuneaging/processed_libraries/{}/{}".format(prefix,version))
+    logger.add_to_log("aws response: {}\n".format("\n".join(files)))
+    for f in files:
         if f.split('/')[-1] == h5ad_file:
             h5ad_file_exists = True
         if f.split('/')[-1] == logger_file:
@@ -100,12 +100,11 @@ summary = ["\n{0}\nExecution summary\n{0}".format("="*25)]
 ############################################
 
 def download_aligned_lib_artifact(file_name: str, data_dir: str) -> str:
-    sync_cmd = 'aws s3 sync --no-progress s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/ {} --exclude "*" --include {}'.format(
+    s3_dir = "s3://immuneaging/aligned_libraries/{}/{}_{}_{}_{}/".format(
         configs["aligned_library_configs_version"], configs["donor"], configs["seq_run"], configs["library_type"],
-        configs["library_id"], data_dir, file_name
+        configs["library_id"]
     )
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    aws_sync(s3_dir, data_dir, file_name, logger, only_if_changed=True)
     file_path = os.path.join(data_dir, file_name)
     if not os.path.isfile(file_path):
         msg = "Failed to download file {} from S3.".format(file_name)
@@ -125,15 +124,14 @@ def store_lib_alignment_metrics(adata, data_dir):
         adata.uns["lib_metrics"][metric] = lib_metrics[metric][0] # lib_metrics[metric] is a pandas series with a single row 
 
 def flush_logs_and_upload():
+    # the log file is uploaded last, once all the other uploads are done (and reported in the log)
+    uploads.wait()
     for i in summary:
         logger.add_to_log(i)
     logging.shutdown()
     if not sandbox_mode:
-        sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_libraries/{}/{}/ --exclude "*" --include {}'.format(
-            data_dir, prefix, version, logger_file)
-        os.system(sync_cmd)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        # the logger was shut down so the upload itself is not logged
+        s3_sync(data_dir, "s3://immuneaging/processed_libraries/{}/{}/".format(prefix, version), logger_file)
 
 if configs["library_type"] == "GEX":
     logger.add_to_log("Downloading h5ad file of aligned library from S3...")
@@ -410,14 +408,12 @@ else:
 logger.add_to_log("Saving h5ad file...")
 adata.obs[f'library_pipeline_version_{configs["library_type"]}'] = f"{configs['library_type']}__{configs['library_id']}__{configs['pipeline_version']}"
 adata.obs[f'library_code_version__{configs["library_type"]}'] =  f"{configs['library_type']}__{configs['library_id']}__{configs['code_version']}"
-write_anndata_with_object_cols(adata, data_dir, h5ad_file)
+h5ad_profile = configs["h5ad_storage_profile"] if "h5ad_storage_profile" in configs else None
+output_files = write_anndata_with_object_cols(adata, data_dir, h5ad_file, profile=h5ad_profile)
 
 if not sandbox_mode:
     logger.add_to_log("Uploading h5ad file to S3...")
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_libraries/{}/{}/ --exclude "*" --include {}'.format(
-        data_dir, prefix, version, h5ad_file)
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(data_dir, "s3://immuneaging/processed_libraries/{}/{}/".format(prefix, version), output_files)
 
 logger.add_to_log("Execution of process_library.py is complete.")
 
@@ -17,7 +17,6 @@ import celltypist
 import urllib.request
 import traceback
 import scirpy as ir
-import scrublet
 from typing import Optional
 
 logging.getLogger('numba').setLevel(logging.WARNING)
@@ -43,6 +42,8 @@ from utils import *
 from vdj_utils import *
 from logger import SimpleLogger
 init_scvi_settings()
+# fail now rather than after the processing if the zarr outputs are enabled (IA_ZARR_OUTPUT) but zarr is not installed
+check_zarr_output()
 
 # config changes only to these fields will not initialize a new configs version
 VARIABLE_CONFIG_KEYS = ["data_owner","s3_access_file","code_path","output_destination"]
@@ -98,6 +99,11 @@ if os.path.isfile(logger_file_path):
 
 logger = SimpleLogger(filename = logger_file_path)
 logger.add_to_log("Running process_sample.py...")
+# outputs are uploaded in the background as soon as they are written; see uploads.py
+uploads = UploadQueue(logger)
+# stages whose inputs and configs did not change since a previous run are restored from their checkpoints; see checkpoints.py
+checkpoints = StageCheckpoints(logger)
+s3_output_dir = "s3://immuneaging/processed_samples/{}/{}/".format(prefix, version)
 logger.add_to_log(QC_STRING_START_TIME.format(get_current_time()))
 with open(process_sample_script, "r") as f:
     logger.add_to_log("process_sample.py md5 checksum: {}\n".format(hashlib.md5(bytes(f.read(), 'utf-8')).hexdigest()))
@@ -112,18 +118,14 @@ if is_new_version:
     os.system(cp_cmd)
     if not sandbox_mode:
         logger.add_to_log("Uploading new configs version to S3...")
-        sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(
-            data_dir, prefix, version, output_configs_file)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        uploads.submit(data_dir, s3_output_dir, output_configs_file)
 else:
     logger.add_to_log("Checking if h5ad file already exists on S3...")
     h5ad_file_exists = False
     logger_file_exists = False
-    ls_cmd = "aws s3 ls s3://immuneaging/processed_samples/{}/{} --recursive".format(prefix,version)
-    files = os.popen(ls_cmd).read()
-    logger.add_to_log("aws response: {}\n".format(files))
-    for f in files.rstrip().split('\n'):
+    files = s3_list("s3://immuneaging/processed_samples/{}/{}".format(prefix,version))
+    logger.add_to_log("aws response: {}\n".format("\n".join(files)))
+    for f in files:
         if f.split('/')[-1] == h5ad_file:
             h5ad_file_exists = True
         if f.split('/')[-1] == logger_file:
@@ -148,20 +150,21 @@ if ("processed_libraries_dir" in configs) and (len(configs.get("processed_librar
     logger.add_to_log("Copying h5ad files of processed libraries from {}...".format(processed_libraries_dir))
     cp_cmd = "cp -r {}/ {}".format(processed_libraries_dir.rstrip("/"), data_dir)
     os.system(cp_cmd)
+    prefetcher = Prefetcher([], logger)
 else:
     logger.add_to_log("Downloading h5ad files of processed libraries from S3...")
     logger.add_to_log("*** Note: This can take some time. If you already have the processed libraries, you can halt this process and provide processed_libraries_dir in the config file in order to use your existing h5ad files. ***")   
+    # the files are downloaded in the background while the libraries are read (in the same order), see prefetch.py
+    transfers = []
     for j in range(len(library_ids)):
         library_id = library_ids[j]
         library_type = library_types[j]
         library_version = library_versions[j]
         lib_h5ad_file = "{}_{}_{}_{}.processed.{}.h5ad".format(donor, seq_run,
             library_type, library_id, library_version)
-        sync_cmd = 'aws s3 sync --no-progress s3://immuneaging/processed_libraries/{}_{}_{}_{}/{}/ {} --exclude "*" --include {}'.format(
-            donor, seq_run, library_type, library_id, library_version, data_dir, lib_h5ad_file)
-        logger.add_to_log("syncing {}...".format(lib_h5ad_file))
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        transfers.append(("s3://immuneaging/processed_libraries/{}_{}_{}_{}/{}/{}".format(donor, seq_run, library_type, library_id, library_version, lib_h5ad_file),
+            os.path.join(data_dir, lib_h5ad_file)))
+    prefetcher = Prefetcher(transfers, logger, only_if_changed=True)
 
 summary = ["\n{0}\nExecution summary\n{0}".format("="*25)]
 
@@ -187,7 +190,7 @@ for j in range(len(library_ids)):
     library_version = library_versions[j]
     lib_h5ad_file = os.path.join(data_dir, "{}_{}_{}_{}.processed.{}.h5ad".format(donor, seq_run,
         library_type, library_id, library_version))
-    if not os.path.isfile(lib_h5ad_file):
+    if not prefetcher.wait(lib_h5ad_file):
         # This could either be an error or a legitimate case of missing library (for example if say all cells from that
         # lib were filtered out during lib processing). We want to know about it in either case but this is not the place
         # for it. In both of the aforementioned cases, we'd get to know about it at the outcome of lib processing.
@@ -239,9 +242,7 @@ if len(library_ids_gex)==0:
     logging.shutdown()
     if not sandbox_mode:
         # Uploading log file to S3...
-        sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(
-            data_dir, prefix, version, logger_file)
-        os.system(sync_cmd)
+        s3_sync(data_dir, "s3://immuneaging/processed_samples/{}/{}/".format(prefix, version), logger_file)
     sys.exit()
 
 logger.add_to_log("Concatenating all cells of sample {} from available GEX libraries...".format(sample_id))
@@ -275,7 +276,7 @@ def build_adata_from_ir_libs(lib_type: str, library_ids_ir: List[str]) -> Option
             continue
         lib_h5ad_file = os.path.join(data_dir, "{}_{}_{}_{}.processed.{}.h5ad".format(donor, seq_run,
             library_type, library_id, library_version))
-        if not os.path.isfile(lib_h5ad_file):
+        if not prefetcher.wait(lib_h5ad_file):
             logger.add_to_log("Failed to find library with id {} of type {}. Moving on...".format(library_id, lib_type), level="warning")
             continue
         adata_dict[library_id] = sc.read_h5ad(lib_h5ad_file)
@@ -430,147 +431,164 @@ if not no_cells:
             batch_key = "batch"
         else:
             batch_key = None
-        logger.add_to_log("Running decontX for estimating contamination levels from ambient RNA...")
-        
         decontx_data_dir = os.path.join(data_dir,"decontx")
         os.system("mkdir -p " + decontx_data_dir)
-        raw_counts_file = os.path.join(decontx_data_dir, "{}_raw_counts.npz".format(prefix))
-        decontaminated_counts_file = os.path.join(decontx_data_dir, "{}_decontx_decontaminated.npz".format(prefix))
-        contamination_levels_file = os.path.join(decontx_data_dir, "{}_decontx_contamination.txt".format(prefix))
         decontx_model_file = os.path.join(decontx_data_dir, "{}_{}_decontx_model.RData".format(prefix, version))
-        r_script_file = os.path.join(decontx_data_dir, "{}_decontx_script.R".format(prefix))
-        sparse.save_npz(raw_counts_file, adata.X.T)
-        if len(library_ids_gex)>1:
-            batch_file = os.path.join(decontx_data_dir, "{}_batch.txt".format(prefix))
-            pd.DataFrame(adata.obs[batch_key].values.astype(str)).to_csv(batch_file, header=False, index=False)
+        decontx_stage = checkpoints.stage("decontx", {"counts": adata.X, "cells": adata.obs.index, "genes": adata.var.index,
+            "batch": None if batch_key is None else adata.obs[batch_key].values})
+        if decontx_stage.restored:
+            contamination_levels = decontx_stage.values["contamination_levels"]
+            decontaminated_counts = decontx_stage.values["decontaminated_counts"]
+            decontx_stage.restore_file("model", decontx_model_file)
         else:
-            batch_file = None
-        # R commands for running and outputing decontx
-        l = [
-            "library('celda')",
-            "library('reticulate')",
-            "scipy_sparse <- import('scipy.sparse')",
-            "x <- scipy_sparse$load_npz('{}')".format(raw_counts_file),
-            "dimnames(x) <- list(NULL,NULL)",
-            "batch <- if ('{0}' == 'None') NULL else as.character(read.table('{0}', header=FALSE)$V1)".format(batch_file),
-            "res <- decontX(x=x, batch=batch)",
-            "write.table(res$contamination, file ='{}',quote = FALSE,row.names = FALSE,col.names = FALSE)".format(contamination_levels_file),
-            "scipy_sparse$save_npz('{}', res$decontXcounts)".format(decontaminated_counts_file),
-            "decontx_model <- list('estimates'=res$estimates, 'z'= res$z)",
-            "save(decontx_model, file='{}')".format(decontx_model_file)
-        ]
-        with open(r_script_file,'w') as f: 
-            f.write("\n".join(l))
-        logger.add_to_log("Running the script in {}".format(decontx_data_dir))
-        os.system(f"{configs['rscript']} {r_script_file}")
+            logger.add_to_log("Running decontX for estimating contamination levels from ambient RNA...")
+            raw_counts_file = os.path.join(decontx_data_dir, "{}_raw_counts.npz".format(prefix))
+            decontaminated_counts_file = os.path.join(decontx_data_dir, "{}_decontx_decontaminated.npz".format(prefix))
+            contamination_levels_file = os.path.join(decontx_data_dir, "{}_decontx_contamination.txt".format(prefix))
+            r_script_file = os.path.join(decontx_data_dir, "{}_decontx_script.R".format(prefix))
+            sparse.save_npz(raw_counts_file, adata.X.T)
+            if len(library_ids_gex)>1:
+                batch_file = os.path.join(decontx_data_dir, "{}_batch.txt".format(prefix))
+                pd.DataFrame(adata.obs[batch_key].values.astype(str)).to_csv(batch_file, header=False, index=False)
+            else:
+                batch_file = None
+            # R commands for running and outputing decontx
+            l = [
+                "library('celda')",
+                "library('reticulate')",
+                "scipy_sparse <- import('scipy.sparse')",
+                "x <- scipy_sparse$load_npz('{}')".format(raw_counts_file),
+                "dimnames(x) <- list(NULL,NULL)",
+                "batch <- if ('{0}' == 'None') NULL else as.character(read.table('{0}', header=FALSE)$V1)".format(batch_file),
+                "res <- decontX(x=x, batch=batch)",
+                "write.table(res$contamination, file ='{}',quote = FALSE,row.names = FALSE,col.names = FALSE)".format(contamination_levels_file),
+                "scipy_sparse$save_npz('{}', res$decontXcounts)".format(decontaminated_counts_file),
+                "decontx_model <- list('estimates'=res$estimates, 'z'= res$z)",
+                "save(decontx_model, file='{}')".format(decontx_model_file)
+            ]
+            with open(r_script_file,'w') as f: 
+                f.write("\n".join(l))
+            logger.add_to_log("Running the script in {}".format(decontx_data_dir))
+            os.system(f"{configs['rscript']} {r_script_file}")
+            contamination_levels = pd.read_csv(contamination_levels_file, index_col=0, header=None).index
+            decontaminated_counts = sparse.load_npz(decontaminated_counts_file).T
+            decontx_stage.save({"contamination_levels": contamination_levels, "decontaminated_counts": decontaminated_counts},
+                files={"model": decontx_model_file})
+        if not sandbox_mode:
+            logger.add_to_log("Uploading decontx model file to S3...")
+            uploads.submit(decontx_data_dir, s3_output_dir, decontx_model_file.split("/")[-1])
         logger.add_to_log("Adding decontaminated counts and contamination levels to data object...")
-        contamination_levels = pd.read_csv(contamination_levels_file, index_col=0, header=None).index
-        decontaminated_counts = sparse.load_npz(decontaminated_counts_file).T
         adata.obs["contamination_levels"] = contamination_levels
         adata.layers['decontaminated_counts'] = decontaminated_counts
-        rna = adata.copy()
-        rna = rna[:,rna.var.index.isin(sub_genes)].copy()
-        # remove empty cells after decontaminations
-        n_obs_before = rna.n_obs
-        rna = rna[rna.layers['decontaminated_counts'].sum(axis=1) >= configs["filter_decontaminated_cells_min_genes"],:].copy()
-        n_decon_cells_filtered = n_obs_before-rna.n_obs
-        percent_removed = 100*n_decon_cells_filtered/n_obs_before
-        level = "warning" if percent_removed > 10 else "info"
-        msg = QC_STRING_AMBIENT_RNA.format(n_decon_cells_filtered, percent_removed, configs["filter_decontaminated_cells_min_genes"])
-        logger.add_to_log(msg, level=level)
-        summary.append(msg)
-        # This set of V(D)J genes are expected to express high donor-level variability that is not interesting to us as we want to get a
-        # coherent picture across all donors combined. Thus we filter these out prior to HVG selection, but keep them in the data otherwise.
-        logger.add_to_log("Filtering out vdj genes...")
-        rna = filter_vdj_genes(rna, configs["vdj_genes"], data_dir, logger)
-        logger.add_to_log("Detecting highly variable genes...")
-        rna.layers["rounded_decontaminated_counts_copy"] = rna.X.copy()
-        if configs["highly_variable_genes_flavor"] != "seurat_v3":
-            # highly_variable_genes requires log-transformed data in this case
-            sc.pp.log1p(rna)
-        sc.pp.highly_variable_genes(rna, n_top_genes=configs["n_highly_variable_genes"], subset=True, flavor=configs["highly_variable_genes_flavor"], span = 1.0)
-        rna.X = rna.layers["rounded_decontaminated_counts_copy"]
-        logger.add_to_log("Predict cell type labels using celltypist...")
-        model_urls = configs["celltypist_model_urls"].split(",")
-        if configs["rbc_model_url"] != "":
-            model_urls.append(configs["rbc_model_url"])
-        # run prediction using every specified model (url)
-        rbc_model_name = None
-        rna_copy = rna.copy()
-        # normalize the copied data with a scale of 10000 (which is the scale required by celltypist)
-        logger.add_to_log("normalizing data for celltypist...")
-        sc.pp.normalize_total(rna_copy, target_sum=10000)
-        sc.pp.log1p(rna_copy)
-        for i in range(len(model_urls)):
-            model_file = model_urls[i].split("/")[-1]
-            celltypist_model_name = model_file.split(".")[0]
-            model_path = os.path.join(data_dir,model_file)
-            # download reference data
-            if model_file in os.listdir(data_dir):
-                pass
-            elif model_urls[i].startswith("s3://"):
-                model_folder = model_urls[i][:-len(model_file)] # remove the model_file suffix
-                aws_sync(model_folder, data_dir, model_file, logger)
-            else:
-                urllib.request.urlretrieve(model_urls[i], model_path)
-            model = celltypist.models.Model.load(model = model_path)
-            if "celltypist_over_clustering" in rna.obs.columns:
-                over_clustering = rna.obs["celltypist_over_clustering"]
-            else:
-                over_clustering = None
-            # for some reason celltypist changes the anndata object in a way that then doesn't allow to copy it (which is needed later); a fix is to use a copy of the anndata object.
-            predictions = celltypist.annotate(rna_copy, model = model, majority_voting = True, over_clustering=over_clustering)
-            # save the index for the RBC model if one exists, since we will need it further below
-            if model_file.startswith("RBC_model"):
-                rbc_model_name = celltypist_model_name
-            logger.add_to_log("Saving celltypist annotations for model {}, model description:\n{}".format(model_file, json.dumps(model.description, indent=2)))
-            rna.obs["celltypist_over_clustering"+celltypist_model_name] = predictions.predicted_labels["over_clustering"]
-            if "celltypist_over_clustering" not in rna.obs.columns:
-                rna.obs["celltypist_over_clustering"] = rna.obs["celltypist_over_clustering"+celltypist_model_name]
-            rna.obs["celltypist_majority_voting."+celltypist_model_name] = predictions.predicted_labels["majority_voting"]
-            rna.obs["celltypist_predicted_labels."+celltypist_model_name] = predictions.predicted_labels["predicted_labels"]
-            rna.obs["celltypist_model."+celltypist_model_name] = model_urls[i]
-        # filter out RBC's
-        if rbc_model_name:
+        # the filtering of cells and genes, the highly variable genes and the celltypist annotations
+        annotation_stage = checkpoints.stage("annotation", {"decontx": decontx_stage, "obs": adata.obs, "var": adata.var,
+            "sub_genes": sub_genes}, configs, ["filter_decontaminated_cells_min_genes", "vdj_genes", "highly_variable_genes_flavor",
+            "n_highly_variable_genes", "celltypist_model_urls", "rbc_model_url"])
+        if annotation_stage.restored:
+            rna = annotation_stage.values["rna"]
+            rbc_model_name = annotation_stage.values["rbc_model_name"]
+            summary.append(annotation_stage.values["summary"])
+        else:
+            rna = adata.copy()
+            rna = rna[:,rna.var.index.isin(sub_genes)].copy()
+            # remove empty cells after decontaminations
             n_obs_before = rna.n_obs
-            rna.obs['predicted_erythrocyte'] = rna.obs["celltypist_predicted_labels."+rbc_model_name] == "RBC"
-            percent_removed = 100*(np.sum(rna.obs['predicted_erythrocyte']))/n_obs_before
-            level = "warning" if percent_removed > 20 else "info"
-            logger.add_to_log(QC_STRING_RBC.format(np.sum(rna.obs['predicted_erythrocyte']), percent_removed, rna.n_obs), level=level)
+            rna = rna[rna.layers['decontaminated_counts'].sum(axis=1) >= configs["filter_decontaminated_cells_min_genes"],:].copy()
+            n_decon_cells_filtered = n_obs_before-rna.n_obs
+            percent_removed = 100*n_decon_cells_filtered/n_obs_before
+            level = "warning" if percent_removed > 10 else "info"
+            msg = QC_STRING_AMBIENT_RNA.format(n_decon_cells_filtered, percent_removed, configs["filter_decontaminated_cells_min_genes"])
+            annotation_stage.add_to_log(msg, level=level)
+            summary.append(msg)
+            # This set of V(D)J genes are expected to express high donor-level variability that is not interesting to us as we want to get a
+            # coherent picture across all donors combined. Thus we filter these out prior to HVG selection, but keep them in the data otherwise.
+            logger.add_to_log("Filtering out vdj genes...")
+            rna = filter_vdj_genes(rna, configs["vdj_genes"], data_dir, annotation_stage)
+            logger.add_to_log("Detecting highly variable genes...")
+            rna.layers["rounded_decontaminated_counts_copy"] = rna.X.copy()
+            if configs["highly_variable_genes_flavor"] != "seurat_v3":
+                # highly_variable_genes requires log-transformed data in this case
+                sc.pp.log1p(rna)
+            sc.pp.highly_variable_genes(rna, n_top_genes=configs["n_highly_variable_genes"], subset=True, flavor=configs["highly_variable_genes_flavor"], span = 1.0)
+            rna.X = rna.layers["rounded_decontaminated_counts_copy"]
+            logger.add_to_log("Predict cell type labels using celltypist...")
+            model_urls = configs["celltypist_model_urls"].split(",")
+            if configs["rbc_model_url"] != "":
+                model_urls.append(configs["rbc_model_url"])
+            # run prediction using every specified model (url)
+            rbc_model_name = None
+            rna_copy = rna.copy()
+            # normalize the copied data with a scale of 10000 (which is the scale required by celltypist)
+            logger.add_to_log("normalizing data for celltypist...")
+            sc.pp.normalize_total(rna_copy, target_sum=10000)
+            sc.pp.log1p(rna_copy)
+            for i in range(len(model_urls)):
+                model_file = model_urls[i].split("/")[-1]
+                celltypist_model_name = model_file.split(".")[0]
+                model = get_celltypist_model(model_urls[i], os.path.join(data_dir, model_file), logger)
+                if "celltypist_over_clustering" in rna.obs.columns:
+                    over_clustering = rna.obs["celltypist_over_clustering"]
+                else:
+                    over_clustering = None
+                # for some reason celltypist changes the anndata object in a way that then doesn't allow to copy it (which is needed later); a fix is to use a copy of the anndata object.
+                predictions = celltypist.annotate(rna_copy, model = model, majority_voting = True, over_clustering=over_clustering)
+                # save the index for the RBC model if one exists, since we will need it further below
+                if model_file.startswith("RBC_model"):
+                    rbc_model_name = celltypist_model_name
+                logger.add_to_log("Saving celltypist annotations for model {}, model description:\n{}".format(model_file, json.dumps(model.description, indent=2)))
+                rna.obs["celltypist_over_clustering"+celltypist_model_name] = predictions.predicted_labels["over_clustering"]
+                if "celltypist_over_clustering" not in rna.obs.columns:
+                    rna.obs["celltypist_over_clustering"] = rna.obs["celltypist_over_clustering"+celltypist_model_name]
+                rna.obs["celltypist_majority_voting."+celltypist_model_name] = predictions.predicted_labels["majority_voting"]
+                rna.obs["celltypist_predicted_labels."+celltypist_model_name] = predictions.predicted_labels["predicted_labels"]
+                rna.obs["celltypist_model."+celltypist_model_name] = model_urls[i]
+            # filter out RBC's
+            if rbc_model_name:
+                n_obs_before = rna.n_obs
+                rna.obs['predicted_erythrocyte'] = rna.obs["celltypist_predicted_labels."+rbc_model_name] == "RBC"
+                percent_removed = 100*(np.sum(rna.obs['predicted_erythrocyte']))/n_obs_before
+                level = "warning" if percent_removed > 20 else "info"
+                annotation_stage.add_to_log(QC_STRING_RBC.format(np.sum(rna.obs['predicted_erythrocyte']), percent_removed, rna.n_obs), level=level)
+            annotation_stage.save({"rna": rna, "rbc_model_name": rbc_model_name, "summary": msg})
         if is_cite:
             # there are known spurious failures with totalVI (such as "invalid parameter loc/scale")
             # so we try a few times then carry on with the rest of the script as we can still mine the
             # rest of the data regardless of CITE info
             retry_count = 4
             try:
-                _, totalvi_model_file = run_model(rna, configs, batch_key, prot_exp_obsm_key, "totalvi", prefix, version, data_dir, logger, max_retry_count=retry_count)
+                totalvi_model_file = run_model_with_checkpoint(checkpoints, {"annotation": annotation_stage}, rna, configs, batch_key,
+                    prot_exp_obsm_key, "totalvi", prefix, version, data_dir, logger, max_retry_count=retry_count,
+                    reference_h5ad_file=h5ad_file, reference_layer="raw_counts")
+                if not sandbox_mode:
+                    logger.add_to_log("Uploading totalVI model file to S3...")
+                    uploads.submit(data_dir, s3_output_dir, totalvi_model_file)
             except Exception as err:
                 logger.add_to_log("Execution of totalVI failed with the following error (latest) with retry count {}: {}. Moving on...".format(retry_count, err), "warning")
                 is_cite = False
-        scvi_model, scvi_model_file = run_model(rna, configs, batch_key, None, "scvi", prefix, version, data_dir, logger)
-        logger.add_to_log("Running scrublet for detecting doublets...")
+        scvi_model_file = run_model_with_checkpoint(checkpoints, {"annotation": annotation_stage}, rna, configs, batch_key, None,
+            "scvi", prefix, version, data_dir, logger, reference_h5ad_file=h5ad_file, reference_layer="raw_counts")
+        if not sandbox_mode:
+            logger.add_to_log("Uploading scVI model file to S3...")
+            uploads.submit(data_dir, s3_output_dir, scvi_model_file)
         if len(library_ids_gex)>1:
-            batches = pd.unique(rna.obs[batch_key])
-            logger.add_to_log("Running scrublet on the following batches separately: {}".format(batches))
-            for batch in batches:
-                X = rna.X.A
-                batch_indices = rna.obs["batch"]
-                doublet_scores = np.zeros(shape=(X.shape[0]))
-                doublet_predictions = np.zeros(shape=(X.shape[0]))
-                # run scrublet separately on every batch; should take a couple of seconds
-                for b in np.unique(batch_indices.values):
-                    mask = batch_indices.values == b
-                    scores, predictions = scrublet.Scrublet(X[mask], sim_doublet_ratio=10.).scrub_doublets()
-                    doublet_scores[mask] = scores
-                    doublet_predictions[mask] = predictions
+            batches = rna.obs[batch_key].values
+        else:
+            batches = None
+        # scrublet depends on the counts of the annotated cells only, so it is not affected by changes to the models
+        doublets_stage = checkpoints.stage("doublets", {"annotation": annotation_stage, "batches": batches})
+        if doublets_stage.restored:
+            doublet_scores, doublet_predictions = doublets_stage.values["scores"], doublets_stage.values["predictions"]
         else:
-            logger.add_to_log("Running scrublet...")
-            X = rna.X.A
-            doublet_scores, doublet_predictions = scrublet.Scrublet(X, sim_doublet_ratio=10.).scrub_doublets()
-            
-        rna.obs['doublet_probability'] = doublet_scores
-        rna.obs['doublet_prediction'] = doublet_predictions
-                
+            logger.add_to_log("Running scrublet for detecting doublets...")
+            if batches is not None:
+                logger.add_to_log("Running scrublet on the following batches separately: {}".format(pd.unique(batches)))
+            # scrublet runs on the sparse matrix; batches run concurrently in separate processes
+            max_workers = configs["doublet_detection_max_workers"] if "doublet_detection_max_workers" in configs else None
+            doublet_scores, doublet_predictions = run_scrublet(rna.X, batches, max_workers=max_workers, tmp_dir=data_dir)
+            doublets_stage.save({"scores": doublet_scores, "predictions": doublet_predictions})
+        rna.obs[['doublet_probability', 'doublet_prediction']] = pd.DataFrame(
+            {'doublet_probability': doublet_scores, 'doublet_prediction': doublet_predictions}, index=rna.obs.index)
+
         logger.add_to_log("Removing doublets...")
         n_obs_before = rna.n_obs
         percent_removed = 100*(np.sum(rna.obs['doublet_prediction']!='singlet'))/n_obs_before
@@ -619,12 +637,7 @@ if not no_cells:
         # save raw rna counts
         adata.obs['sum_percolation_score'] = 0
         if 'percolation_score' in configs:
-            for obs_key in configs['percolation_score']:
-                if obs_key in adata.obs.columns:
-                    percolate_observation(adata, overclustering_key='overclustering_percolate', **configs['percolation_score'][obs_key])
-                    adata.obs['sum_percolation_score'] += adata.obs[f'{obs_key}_percolation'].astype(int)
-                else:
-                    logger.add_to_log(f"Percolation score {obs_key} was not found in obs. Skipping computation.")
+            adata.obs['sum_percolation_score'] = percolate_observations(adata, 'overclustering_percolate', configs['percolation_score'], logger)
         adata.obs['sum_percolation_score'] = adata.obs['sum_percolation_score'].astype('category')
         adata.layers["raw_counts"] = adata.X.copy()
         if adata.n_obs > 0:
@@ -636,40 +649,27 @@ if not no_cells:
         logger.add_to_log("Terminating execution prematurely.")
         if not sandbox_mode:
             # upload log to S3
-            sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(
-                data_dir, prefix, version, logger_file)
-            os.system(sync_cmd)
+            s3_sync(data_dir, "s3://immuneaging/processed_samples/{}/{}/".format(prefix, version), logger_file)
         print(err)
         sys.exit()
 
 logger.add_to_log("Saving h5ad file...")
 adata.obs['sample_pipeline_version'] = f"{configs['donor']}__{configs['pipeline_version']}"
 adata.obs['sample_code_version'] =  f"{configs['donor']}__{configs['code_version']}"
-write_anndata_with_object_cols(adata, data_dir, h5ad_file)
+h5ad_profile = configs["h5ad_storage_profile"] if "h5ad_storage_profile" in configs else None
+output_files = write_anndata_with_object_cols(adata, data_dir, h5ad_file, profile=h5ad_profile)
 
 ###############################################################
 ###### OUTPUT UPLOAD TO S3 - ONLY IF NOT IN SANDBOX MODE ######
 ###############################################################
 
+# the model files were queued for upload when they were saved
 if not sandbox_mode:
     logger.add_to_log("Uploading h5ad file to S3...")
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(data_dir, prefix, version, h5ad_file)
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
-    if not no_cells:
-        logger.add_to_log("Uploading model files (a single .zip file for each model) to S3...")
-        sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(data_dir, prefix, version, scvi_model_file)
-        if is_cite:
-            # also upload the totalvi file if we had CITE data
-            sync_cmd += ' --include {}'.format(totalvi_model_file)
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))        
-        logger.add_to_log("Uploading decontx model file to S3...")
-        sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(
-            decontx_data_dir, prefix, version, decontx_model_file.split("/")[-1])
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+    uploads.submit(data_dir, s3_output_dir, output_files)
+    uploads.wait()
 
+logger.add_to_log(checkpoints.report())
 logger.add_to_log("Execution of process_sample.py is complete.")
 
 summary.append(QC_STRING_COUNTS.format(adata.n_obs, adata.n_vars))
@@ -679,6 +679,4 @@ for i in summary:
 logging.shutdown()
 if not sandbox_mode:
     # Uploading log file to S3...
-    sync_cmd = 'aws s3 sync --no-progress {} s3://immuneaging/processed_samples/{}/{}/ --exclude "*" --include {}'.format(
-        data_dir, prefix, version, logger_file)
-    os.system(sync_cmd)
+    s3_sync(data_dir, "s3://immuneaging/processed_samples/{}/{}/".format(prefix, version), logger_file)
@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+# Helpers for sizing parallel work to the resources of the machine and running it.
+
+def get_available_memory() -> Optional[int]:
+    # memory in bytes that can be allocated without swapping, or None if it cannot be determined on this platform. This is
+    # MemAvailable of /proc/meminfo, which includes the page cache and other reclaimable memory; the free memory (MemFree,
+    # which is what SC_AVPHYS_PAGES reports) is only a fraction of it on a node that has been reading large files
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def run_python_scripts(commands: List[List[str]], max_workers: int) -> None:
+    """
+    Runs each of the given commands (a python script followed by its arguments) in a separate python process, up to max_workers
+    processes at a time. Separate processes are used rather than a multiprocessing pool since forking a process that already used
+    OpenMP thread pools (torch, numba, sklearn) can deadlock, and spawned pool workers would re-run the calling (top level) script.
+    """
+    def run(command):
+        res = subprocess.run([sys.executable] + command, capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ValueError("Command {} failed with exit code {}:\n{}".format(" ".join(command), res.returncode, res.stderr))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        list(executor.map(run, commands))
@@ -0,0 +1,195 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Optional, Tuple
+
+from s3_utils import LOCAL_ROOT_ENV, S3Object, add_write_listener, get_object_store, split_s3_path
+
+# Persistent local index (an SQLite database) of the keys in the bucket. Listing a large prefix on S3 (e.g. all of
+# aligned_libraries/) takes one request per 1000 keys, so checking versions and existence of objects by listing
+# the bucket over and over is expensive; instead, prefixes are listed once and subsequent queries are answered
+# from the index as long as the listing of the prefix is not older than max_age seconds.
+#
+# The index is refreshed incrementally: only the prefixes that are queried get (re)listed, and once a top level
+# directory (e.g. processed_libraries/) was missed several times in a process the whole directory is listed at once.
+# Writes and deletes done through s3_utils are applied to the index as they happen, so that the pipeline always
+# sees its own changes; changes done by others are picked up once the listing expires.
+#
+# The following environment variables can be used to control the index (all are optional):
+# IA_CACHE_DIR - directory for local caches (default ~/.cache/immuneaging)
+# IA_S3_INDEX_MAX_AGE - max age in seconds of a listing before it is refreshed (default 300); 0 disables the caching
+# IA_S3_INDEX_PATH - path of the index file (default <IA_CACHE_DIR>/s3_listing_index.<backend>.sqlite)
+
+DEFAULT_MAX_AGE = 300
+# number of misses in a top level directory after which the whole directory is listed
+ROOT_REFRESH_AFTER_MISSES = 3
+# the default pattern of versioned objects - a /vX/ folder in the key; the last group in the pattern is the version number
+VERSION_PATTERN = "/v(\\d+)/"
+_MAX_CHAR = "\U0010ffff"
+
+def get_key_components(key: str) -> List[str]:
+    # the folder and file names in the key, plus their parts separated by "_" or "."
+    # e.g. "aligned_libraries/v1/D1_001_GEX_L1/D1_001.L1.v1.h5ad" -> "aligned_libraries", "aligned", "libraries", "v1", "D1_001_GEX_L1", "D1", "001", "GEX", "L1", ...
+    components = set()
+    for name in key.split("/"):
+        components.add(name)
+        components.update(re.split("[._]", name))
+    components.discard("")
+    return list(components)
+
+def get_cache_dir() -> str:
+    cache_dir = os.environ.get("IA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "immuneaging"))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def _prefix_range(prefix: str) -> Tuple[str, str]:
+    # all keys that start with prefix are in the range [prefix, prefix + max char)
+    return prefix, prefix + _MAX_CHAR
+
+class S3ListingIndex:
+    def __init__(self, db_path: str, max_age: float = DEFAULT_MAX_AGE):
+        self.db_path = db_path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._root_misses = {}
+        self._conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self._conn:
+            # WAL allows concurrent readers while one process refreshes the index
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, size INTEGER, last_modified REAL, PRIMARY KEY (bucket, key)) WITHOUT ROWID")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS listings (bucket TEXT, prefix TEXT, listed_at REAL, PRIMARY KEY (bucket, prefix))")
+            # allows looking up the keys that include a given library id, sample id, etc. without scanning the whole prefix
+            self._conn.execute("CREATE TABLE IF NOT EXISTS components (bucket TEXT, component TEXT, key TEXT, PRIMARY KEY (bucket, component, key)) WITHOUT ROWID")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS components_key ON components (bucket, key)")
+
+    def _insert(self, bucket: str, objects: List[S3Object]) -> None:
+        self._conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+            [(bucket, o.key, o.size, o.last_modified) for o in objects])
+        self._conn.executemany("INSERT OR IGNORE INTO components VALUES (?, ?, ?)",
+            [(bucket, c, o.key) for o in objects for c in get_key_components(o.key)])
+
+    def _is_fresh(self, bucket: str, prefix: str, max_age: float) -> bool:
+        # the listing of prefix is fresh if prefix or any of its parent prefixes was listed in the last max_age seconds
+        if max_age <= 0:
+            return False
+        parents = [prefix[:i] for i in range(len(prefix) + 1)]
+        row = self._conn.execute(
+            "SELECT MAX(listed_at) FROM listings WHERE bucket = ? AND prefix IN ({})".format(",".join(["?"] * len(parents))),
+            [bucket] + parents).fetchone()
+        return row[0] is not None and row[0] >= time.time() - max_age
+
+    def refresh(self, s3_path: str) -> int:
+        """
+        Lists s3_path (recursively) and replaces the entries of the index under it. Returns the number of keys listed.
+        """
+        bucket, prefix = split_s3_path(s3_path)
+        listed_at = time.time()
+        objects = get_object_store().list_objects(bucket, prefix)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ?", (bucket, *_prefix_range(prefix)))
+            self._conn.execute("DELETE FROM components WHERE bucket = ? AND key >= ? AND key < ?", (bucket, *_prefix_range(prefix)))
+            self._insert(bucket, objects)
+            # listings of sub prefixes are superseded by this listing
+            self._conn.execute("DELETE FROM listings WHERE bucket = ? AND prefix >= ? AND prefix < ?", (bucket, *_prefix_range(prefix)))
+            self._conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (bucket, prefix, listed_at))
+        return len(objects)
+
+    def _ensure_fresh(self, bucket: str, prefix: str, max_age: Optional[float]) -> None:
+        max_age = self.max_age if max_age is None else max_age
+        if self._is_fresh(bucket, prefix, max_age):
+            return
+        root = prefix.split("/")[0] + "/" if "/" in prefix else prefix
+        self._root_misses[(bucket, root)] = self._root_misses.get((bucket, root), 0) + 1
+        if self._root_misses[(bucket, root)] > ROOT_REFRESH_AFTER_MISSES and max_age > 0:
+            # many different prefixes of the same top level directory are queried (e.g. one per library) - list the whole directory once
+            self.refresh("s3://{}/{}".format(bucket, root))
+        else:
+            self.refresh("s3://{}/{}".format(bucket, prefix))
+
+    def list_objects(self, s3_path: str, contains: Optional[str] = None, component: Optional[str] = None, max_age: Optional[float] = None) -> List[S3Object]:
+        """
+        Returns the objects whose key starts with the key in s3_path, refreshing the index first if the listing of s3_path
+        is older than max_age seconds. The results can be further restricted to keys that include the string contains and/or
+        keys that have component as one of their components (see get_key_components); the latter is an indexed lookup.
+        """
+        bucket, prefix = split_s3_path(s3_path)
+        self._ensure_fresh(bucket, prefix, max_age)
+        if component is not None:
+            # CROSS JOIN makes sqlite look up the component first rather than scanning the objects under the prefix
+            query = "SELECT o.key, o.size, o.last_modified FROM components c CROSS JOIN objects o ON o.bucket = c.bucket AND o.key = c.key WHERE c.bucket = ? AND c.component = ? AND c.key >= ? AND c.key < ?"
+            args = [bucket, component, *_prefix_range(prefix)]
+        else:
+            query = "SELECT o.key, o.size, o.last_modified FROM objects o WHERE o.bucket = ? AND o.key >= ? AND o.key < ?"
+            args = [bucket, *_prefix_range(prefix)]
+        if contains is not None:
+            query += " AND instr(o.key, ?) > 0"
+            args.append(contains)
+        return [S3Object(*row) for row in self._conn.execute(query + " ORDER BY o.key", args)]
+
+    def list(self, s3_path: str, contains: Optional[str] = None, component: Optional[str] = None, max_age: Optional[float] = None) -> List[str]:
+        return [o.key for o in self.list_objects(s3_path, contains, component, max_age)]
+
+    def exists(self, s3_path: str, max_age: Optional[float] = None) -> bool:
+        bucket, key = split_s3_path(s3_path)
+        self._ensure_fresh(bucket, key, max_age)
+        return self._conn.execute("SELECT 1 FROM objects WHERE bucket = ? AND key = ?", (bucket, key)).fetchone() is not None
+
+    def latest_version(self, s3_path: str, pattern: str = VERSION_PATTERN, contains: Optional[str] = None, component: Optional[str] = None, max_age: Optional[float] = None) -> int:
+        """
+        Returns the largest version number found by matching pattern against the keys under s3_path (restricted by contains
+        and component as in list_objects); the version number is taken from the last group in the pattern. Returns -1 if there are no matches.
+        """
+        latest_version = -1
+        regex = re.compile(pattern)
+        for key in self.list(s3_path, contains, component, max_age):
+            m = regex.search(key)
+            if bool(m):
+                latest_version = max(latest_version, int(m[m.lastindex]))
+        return latest_version
+
+    def apply_changes(self, bucket: str, written: List[S3Object], deleted: List[str]) -> None:
+        # keep the index up to date with writes and deletes done by this process (registered as a listener in s3_utils)
+        with self._lock, self._conn:
+            self._insert(bucket, [o for o in written if o is not None])
+            self._conn.executemany("DELETE FROM objects WHERE bucket = ? AND key = ?", [(bucket, k) for k in deleted])
+            self._conn.executemany("DELETE FROM components WHERE bucket = ? AND key = ?", [(bucket, k) for k in deleted])
+
+_index = None
+_index_path = None
+_index_lock = threading.Lock()
+
+def get_listing_index() -> S3ListingIndex:
+    # one index per backend (S3 or a local fake bucket), shared by all the callers in the process
+    global _index, _index_path
+    local_root = os.environ.get(LOCAL_ROOT_ENV, "")
+    backend = "s3" if len(local_root) == 0 else "local_" + hashlib.md5(bytes(os.path.abspath(local_root), "utf-8")).hexdigest()[:8]
+    db_path = os.environ.get("IA_S3_INDEX_PATH", os.path.join(get_cache_dir(), "s3_listing_index.{}.sqlite".format(backend)))
+    with _index_lock:
+        if _index is None or _index_path != db_path:
+            _index = S3ListingIndex(db_path, max_age = float(os.environ.get("IA_S3_INDEX_MAX_AGE", DEFAULT_MAX_AGE)))
+            _index_path = db_path
+            add_write_listener(_apply_changes_to_index)
+    return _index
+
+def _apply_changes_to_index(bucket: str, written: List[S3Object], deleted: List[str]) -> None:
+    if _index is not None:
+        _index.apply_changes(bucket, written, deleted)
+
+def s3_list_cached(s3_path: str, contains: Optional[str] = None, component: Optional[str] = None, max_age: Optional[float] = None) -> List[str]:
+    """
+    Same as s3_utils.s3_list but answered from the local listing index; see S3ListingIndex.list_objects.
+    """
+    return get_listing_index().list(s3_path, contains, component, max_age)
+
+def s3_exists_cached(s3_path: str, max_age: Optional[float] = None) -> bool:
+    return get_listing_index().exists(s3_path, max_age)
+
+def s3_latest_version(s3_path: str, pattern: str = VERSION_PATTERN, contains: Optional[str] = None, component: Optional[str] = None, max_age: Optional[float] = None) -> int:
+    return get_listing_index().latest_version(s3_path, pattern, contains, component, max_age)
+
+def refresh_listing_index(s3_path: str) -> int:
+    # lists the whole s3_path at once; useful before looking up many objects under the same prefix
+    return get_listing_index().refresh(s3_path)
@@ -0,0 +1,621 @@
+import io
+import os
+import time
+import random
+import hashlib
+import shutil
+import fcntl
+import fnmatch
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple, Type, Union
+
+# In-process client for the object store. This replaces shelling out to the aws cli (one process, one
+# connection and one credentials lookup per command) with a single pooled client per process that is
+# shared by all the transfers of a script.
+#
+# The following environment variables can be used to control the client (all are optional):
+# IA_S3_LOCAL_ROOT - if set, s3://<bucket>/<key> is read from and written to <IA_S3_LOCAL_ROOT>/<bucket>/<key>
+#   on the local filesystem instead of S3; useful for running the pipeline offline or against a fake bucket.
+# IA_S3_MAX_CONCURRENCY - max number of objects transferred concurrently (default 16); also sets the size of the connection pool.
+# IA_S3_MAX_RETRIES - max number of attempts per request before giving up (default 5); the requests are retried by botocore, and
+#   a ranged or small read whose body fails while it is streamed is requested again up to as many times.
+# IA_S3_MULTIPART_CHUNKSIZE_MB - part size for multipart transfers of large files (default 64).
+
+S3_PREFIX = "s3://"
+LOCAL_ROOT_ENV = "IA_S3_LOCAL_ROOT"
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 64
+# block size and cache size of ranged reads (see S3ObjectFile)
+DEFAULT_RANGE_BLOCK_SIZE = 1024 * 1024
+DEFAULT_RANGE_CACHED_BLOCKS = 64
+# a conditional write (see put_if) that lost to a concurrent write of the same key
+CONDITION_FAILED_ERROR_CODES = ["412", "409", "PreconditionFailed", "ConditionalRequestConflict"]
+
+class S3Object(NamedTuple):
+    key: str # the key relative to the bucket, e.g. "processed_samples/<sample>/v1/<file>"
+    size: int
+    last_modified: float # posix timestamp
+    etag: Optional[str] = None # only set by head() of S3Store; the md5 of the content for objects that were not uploaded in parts
+
+def is_s3_path(path: str) -> bool:
+    return path.startswith(S3_PREFIX)
+
+def split_s3_path(s3_path: str) -> Tuple[str, str]:
+    # "s3://immuneaging/processed_samples/x" -> ("immuneaging", "processed_samples/x")
+    assert is_s3_path(s3_path), "Not an S3 path: {}".format(s3_path)
+    parts = s3_path[len(S3_PREFIX):].split("/", 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+def _as_dir_prefix(key: str) -> str:
+    return key if (len(key) == 0 or key.endswith("/")) else key + "/"
+
+def _read_with_retries(request: Callable, max_retries: int, streaming_errors: Tuple[Type[Exception], ...]) -> Tuple[dict, bytes]:
+    # the response of a get_object request and its body; botocore already retries the request itself (see the client config), so only a
+    # body that fails while it is streamed (after botocore returned the response) is requested again, with exponential backoff (plus jitter)
+    attempt = 0
+    while True:
+        response = request()
+        try:
+            return response, response["Body"].read()
+        except streaming_errors:
+            attempt += 1
+            if attempt >= max_retries:
+                raise
+            time.sleep(min(30, 0.5 * 2 ** (attempt-1)) + random.uniform(0, 0.5))
+
+class S3Store:
+    """
+    Object store backed by S3 through a single boto3 client. The client keeps a pool of connections that is
+    shared across threads, and large objects are transferred as concurrent multipart uploads/downloads.
+    Credentials are taken from the environment (see utils.set_access_keys).
+    """
+    def __init__(self, max_concurrency: int, max_retries: int, multipart_chunksize_mb: int):
+        try:
+            import boto3
+            from botocore.config import Config
+            from boto3.s3.transfer import TransferConfig
+            from botocore.exceptions import ResponseStreamingError, IncompleteReadError, ReadTimeoutError, ConnectionClosedError
+        except ImportError as e:
+            raise ImportError(
+                "boto3 is not installed. Please install boto3 via: pip install boto3"
+            )
+        self.max_retries = max_retries
+        self.streaming_errors = (ResponseStreamingError, IncompleteReadError, ReadTimeoutError, ConnectionClosedError)
+        # each concurrent object transfer can itself use several connections for multipart transfers
+        parts_concurrency = max(2, max_concurrency // 2)
+        client_config = Config(
+            max_pool_connections = max_concurrency * parts_concurrency,
+            # the only retries of the requests (transient errors and throttling; errors such as 404 or 403 are not retried), with
+            # max_retries attempts in total; the transfers below also retry a download whose body fails while it is streamed (see
+            # s3transfer), and read_range and get do the same through _read_with_retries
+            retries = {"total_max_attempts": max_retries, "mode": "adaptive"},
+        )
+        self.client = boto3.session.Session().client("s3", config=client_config)
+        chunksize = multipart_chunksize_mb * 1024 * 1024
+        self.transfer_config = TransferConfig(
+            multipart_threshold = chunksize,
+            multipart_chunksize = chunksize,
+            max_concurrency = parts_concurrency,
+            use_threads = True,
+        )
+
+    def list_objects(self, bucket: str, prefix: str) -> List[S3Object]:
+        objects = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for o in page.get("Contents", []):
+                objects.append(S3Object(o["Key"], o["Size"], o["LastModified"].timestamp()))
+        return objects
+
+    def list_dir(self, bucket: str, prefix: str) -> Tuple[List[str], List[S3Object]]:
+        # returns the common prefixes ("sub directories") and objects immediately under prefix
+        dirs, objects = [], []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+            dirs += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            objects += [S3Object(o["Key"], o["Size"], o["LastModified"].timestamp()) for o in page.get("Contents", [])]
+        return dirs, objects
+
+    def head(self, bucket: str, key: str) -> Optional[S3Object]:
+        try:
+            o = self.client.head_object(Bucket=bucket, Key=key)
+        except Exception as err:
+            if str(getattr(err, "response", {}).get("Error", {}).get("Code", "")) in ["404", "NoSuchKey"]:
+                return None
+            raise
+        return S3Object(key, o["ContentLength"], o["LastModified"].timestamp(), o.get("ETag", "").strip('"') or None)
+
+    def read_range(self, bucket: str, key: str, start: int, length: int) -> bytes:
+        # a failure while streaming the body retries the whole request
+        def get() -> dict:
+            return self.client.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(start, start + length - 1))
+        return _read_with_retries(get, self.max_retries, self.streaming_errors)[1]
+
+    def download(self, bucket: str, key: str, local_path: str) -> None:
+        # boto3 downloads into a temporary file and renames it, so partial files are never left behind
+        self.client.download_file(bucket, key, local_path, Config=self.transfer_config)
+
+    def upload(self, local_path: str, bucket: str, key: str) -> None:
+        self.client.upload_file(local_path, bucket, key, Config=self.transfer_config)
+
+    def copy(self, src_bucket: str, src_key: str, dst_bucket: str, dst_key: str) -> None:
+        # server-side (multipart if needed) copy; no data goes through the local machine
+        self.client.copy({"Bucket": src_bucket, "Key": src_key}, dst_bucket, dst_key, Config=self.transfer_config)
+
+    def get(self, bucket: str, key: str) -> Optional[Tuple[bytes, str]]:
+        # the content of a (small) object and its etag, or None if it does not exist
+        try:
+            o, body = _read_with_retries(lambda: self.client.get_object(Bucket=bucket, Key=key), self.max_retries, self.streaming_errors)
+            return body, o["ETag"].strip('"')
+        except Exception as err:
+            if str(getattr(err, "response", {}).get("Error", {}).get("Code", "")) in ["404", "NoSuchKey"]:
+                return None
+            raise
+
+    def put_if(self, bucket: str, key: str, body: bytes, if_match: Optional[str] = None) -> Optional[str]:
+        # writes the object only if it does not exist (if_match is None) or if its etag is if_match; returns the etag of the new
+        # object, or None if the condition does not hold (e.g. another process wrote the object first)
+        condition = {"IfNoneMatch": "*"} if if_match is None else {"IfMatch": '"{}"'.format(if_match)}
+        try:
+            o = self.client.put_object(Bucket=bucket, Key=key, Body=body, **condition)
+        except Exception as err:
+            if str(getattr(err, "response", {}).get("Error", {}).get("Code", "")) in CONDITION_FAILED_ERROR_CODES:
+                return None
+            raise
+        return o["ETag"].strip('"')
+
+    def supports_conditional_writes(self) -> bool:
+        # IfNoneMatch and IfMatch on PutObject are only known to the botocore releases of late 2024 onwards; older ones reject
+        # them as unknown parameters (a ParamValidationError, raised before any request is sent)
+        members = self.client.meta.service_model.operation_model("PutObject").input_shape.members
+        return "IfNoneMatch" in members and "IfMatch" in members
+
+    def delete(self, bucket: str, keys: List[str]) -> None:
+        for i in range(0, len(keys), 1000):
+            batch = {"Objects": [{"Key": k} for k in keys[i:i+1000]], "Quiet": True}
+            self.client.delete_objects(Bucket=bucket, Delete=batch)
+
+class LocalStore:
+    """
+    Object store backed by a directory on the local filesystem: s3://<bucket>/<key> maps to <root>/<bucket>/<key>.
+    Implements the same interface as S3Store.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def _stat(self, bucket: str, path: str) -> S3Object:
+        st = os.stat(path)
+        key = os.path.relpath(path, os.path.join(self.root, bucket)).replace(os.sep, "/")
+        return S3Object(key, st.st_size, st.st_mtime)
+
+    def list_objects(self, bucket: str, prefix: str) -> List[S3Object]:
+        # prefix is a string prefix of the key (as in S3), not necessarily a directory
+        bucket_dir = os.path.join(self.root, bucket)
+        search_dir = os.path.join(bucket_dir, os.path.dirname(prefix))
+        objects = []
+        for root, dirs, files in os.walk(search_dir):
+            for f in files:
+                o = self._stat(bucket, os.path.join(root, f))
+                if o.key.startswith(prefix):
+                    objects.append(o)
+        return sorted(objects, key=lambda o: o.key)
+
+    def list_dir(self, bucket: str, prefix: str) -> Tuple[List[str], List[S3Object]]:
+        search_dir = self._path(bucket, os.path.dirname(prefix))
+        dir_key = prefix[:len(prefix) - len(prefix.split("/")[-1])]
+        dirs, objects = [], []
+        if not os.path.isdir(search_dir):
+            return dirs, objects
+        for name in sorted(os.listdir(search_dir)):
+            key = dir_key + name
+            if not key.startswith(prefix):
+                continue
+            if os.path.isdir(os.path.join(search_dir, name)):
+                dirs.append(key + "/")
+            else:
+                objects.append(self._stat(bucket, os.path.join(search_dir, name)))
+        return dirs, objects
+
+    def head(self, bucket: str, key: str) -> Optional[S3Object]:
+        path = self._path(bucket, key)
+        return self._stat(bucket, path) if os.path.isfile(path) else None
+
+    def read_range(self, bucket: str, key: str, start: int, length: int) -> bytes:
+        with open(self._path(bucket, key), "rb") as fp:
+            fp.seek(start)
+            return fp.read(length)
+
+    def download(self, bucket: str, key: str, local_path: str) -> None:
+        self._copy_file(self._path(bucket, key), local_path)
+
+    def upload(self, local_path: str, bucket: str, key: str) -> None:
+        self._copy_file(local_path, self._path(bucket, key))
+
+    def copy(self, src_bucket: str, src_key: str, dst_bucket: str, dst_key: str) -> None:
+        self._copy_file(self._path(src_bucket, src_key), self._path(dst_bucket, dst_key))
+
+    def get(self, bucket: str, key: str) -> Optional[Tuple[bytes, str]]:
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as fp:
+            body = fp.read()
+        return body, hashlib.md5(body).hexdigest()
+
+    def put_if(self, bucket: str, key: str, body: bytes, if_match: Optional[str] = None) -> Optional[str]:
+        # the check and the write are atomic across the processes that share root (as the conditional writes of S3)
+        path = self._path(bucket, key)
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+        # the lock file is outside of the bucket so that it is never listed
+        with open(os.path.join(self.root, ".{}.put_if.lock".format(bucket)), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = self.get(bucket, key)
+            if (current is not None) if if_match is None else (current is None or current[1] != if_match):
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp_path, "wb") as fp:
+                fp.write(body)
+            os.replace(tmp_path, path)
+        return hashlib.md5(body).hexdigest()
+
+    def supports_conditional_writes(self) -> bool:
+        return True
+
+    def delete(self, bucket: str, keys: List[str]) -> None:
+        for k in keys:
+            path = self._path(bucket, k)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    @staticmethod
+    def _copy_file(source: str, target: str) -> None:
+        # write into a temporary file first so that readers never see a partially written file
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        tmp_target = "{}.{}.tmp".format(target, threading.get_ident())
+        shutil.copy2(source, tmp_target)
+        os.replace(tmp_target, target)
+
+_store = None
+_store_key = None
+_store_lock = threading.Lock()
+# functions that are called following every write and delete done through this module, as func(bucket, written_objects, deleted_keys);
+# used for keeping local caches of the bucket listing (see s3_index.py) up to date with the changes made by the pipeline itself
+_write_listeners = []
+
+def add_write_listener(func: Callable) -> None:
+    if func not in _write_listeners:
+        _write_listeners.append(func)
+
+def _notify_listeners(bucket: str, written: List[S3Object] = [], deleted: List[str] = []) -> None:
+    for func in _write_listeners:
+        try:
+            func(bucket, written, deleted)
+        except Exception as err:
+            # a failure to update a cache should never fail the transfer itself
+            print("Failed to notify {} of changes in bucket {}: {}".format(func, bucket, err))
+
+def get_max_concurrency() -> int:
+    return int(os.environ.get("IA_S3_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+
+def get_multipart_chunksize() -> int:
+    return int(os.environ.get("IA_S3_MULTIPART_CHUNKSIZE_MB", DEFAULT_MULTIPART_CHUNKSIZE_MB)) * 1024 * 1024
+
+def md5_etag(local_path: str, part_size: Optional[int] = None, n_parts: int = 1) -> str:
+    # the etag that S3 gives to the file's content when uploaded in one part, or in n_parts parts of part_size bytes
+    part_md5s = []
+    with open(local_path, "rb") as fp:
+        for i in range(n_parts):
+            md5 = hashlib.md5()
+            remaining = part_size if n_parts > 1 else None
+            while remaining is None or remaining > 0:
+                chunk = fp.read(8 * 1024 * 1024 if remaining is None else min(remaining, 8 * 1024 * 1024))
+                if len(chunk) == 0:
+                    break
+                md5.update(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+            part_md5s.append(md5)
+    if n_parts == 1:
+        return part_md5s[0].hexdigest()
+    return "{}-{}".format(hashlib.md5(b"".join([m.digest() for m in part_md5s])).hexdigest(), n_parts)
+
+def content_matches(local_path: str, o: S3Object) -> Optional[bool]:
+    """
+    Compares the content of a local file with an object through the object's etag. Returns None if the etag cannot be
+    reproduced locally: no etag (e.g. LocalStore), or a multipart upload with a part size other than the pipeline's.
+    """
+    if o.etag is None:
+        return None
+    if os.path.getsize(local_path) != o.size:
+        return False
+    if "-" not in o.etag:
+        return md5_etag(local_path) == o.etag
+    part_size = get_multipart_chunksize()
+    n_parts = int(o.etag.split("-")[1])
+    if n_parts != max(1, -(-o.size // part_size)):
+        return None
+    return md5_etag(local_path, part_size, n_parts) == o.etag
+
+def get_object_store() -> Union[S3Store, LocalStore]:
+    """
+    Returns the process-wide object store client. The client is created on first use and re-created only
+    if the backend or the credentials in the environment change (e.g. following a call to set_access_keys).
+    """
+    global _store, _store_key
+    local_root = os.environ.get(LOCAL_ROOT_ENV, "")
+    key = (local_root, os.environ.get("AWS_ACCESS_KEY_ID", ""), os.environ.get("AWS_SECRET_ACCESS_KEY", ""))
+    with _store_lock:
+        if _store is None or _store_key != key:
+            if len(local_root) > 0:
+                _store = LocalStore(local_root)
+            else:
+                _store = S3Store(
+                    max_concurrency = get_max_concurrency(),
+                    max_retries = int(os.environ.get("IA_S3_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+                    multipart_chunksize_mb = int(os.environ.get("IA_S3_MULTIPART_CHUNKSIZE_MB", DEFAULT_MULTIPART_CHUNKSIZE_MB)),
+                )
+            _store_key = key
+    return _store
+
+def _matches(rel_path: str, include: Optional[List[str]]) -> bool:
+    # same semantics as --exclude "*" --include <pattern> in the aws cli: patterns are matched against the path relative to the source dir
+    return include is None or any(fnmatch.fnmatch(rel_path, pattern) for pattern in include)
+
+def _run_concurrently(func: Callable, tasks: List[tuple]) -> List[str]:
+    if len(tasks) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(get_max_concurrency(), len(tasks))) as executor:
+        return list(executor.map(lambda t: func(*t), tasks))
+
+def _list_local_files(local_dir: str) -> List[str]:
+    rel_paths = []
+    for root, dirs, files in os.walk(local_dir):
+        for f in files:
+            rel_paths.append(os.path.relpath(os.path.join(root, f), local_dir).replace(os.sep, "/"))
+    return sorted(rel_paths)
+
+def s3_list(s3_path: str) -> List[str]:
+    """
+    Returns the keys of all objects whose key starts with the key in s3_path
+    (equivalent to the last column of `aws s3 ls <s3_path> --recursive`).
+    """
+    bucket, prefix = split_s3_path(s3_path)
+    return [o.key for o in get_object_store().list_objects(bucket, prefix)]
+
+def s3_list_objects(s3_path: str) -> List[S3Object]:
+    bucket, prefix = split_s3_path(s3_path)
+    return get_object_store().list_objects(bucket, prefix)
+
+def s3_ls(s3_path: str) -> List[str]:
+    """
+    Non-recursive listing (equivalent to `aws s3 ls <s3_path>`): returns the names of the sub directories
+    (with a trailing "/") and of the objects that are immediately under s3_path.
+    """
+    bucket, prefix = split_s3_path(s3_path)
+    dirs, objects = get_object_store().list_dir(bucket, prefix)
+    dir_key = prefix[:len(prefix) - len(prefix.split("/")[-1])]
+    return [d[len(dir_key):] for d in dirs] + [o.key[len(dir_key):] for o in objects]
+
+def s3_exists(s3_path: str) -> bool:
+    bucket, key = split_s3_path(s3_path)
+    return get_object_store().head(bucket, key) is not None
+
+def s3_read(s3_path: str) -> Optional[Tuple[bytes, str]]:
+    # the content of a small object (e.g. a configs file or a lease) and its etag, or None if it does not exist
+    return get_object_store().get(*split_s3_path(s3_path))
+
+def check_conditional_writes() -> None:
+    # raises if the object store client can't do the conditional writes of s3_put_if (see S3Store.supports_conditional_writes)
+    if not get_object_store().supports_conditional_writes():
+        import botocore
+        raise RuntimeError("botocore {} does not support conditional writes (IfNoneMatch/IfMatch on PutObject); "
+            "install boto3/botocore 1.35.99 or later (see envs/immune_aging.py_env.v5.yml).".format(botocore.__version__))
+
+def s3_put_if(s3_path: str, body: bytes, if_match: Optional[str] = None) -> Optional[str]:
+    """
+    Conditional write of a small object: writes body only if the object does not exist (if_match is None) or if its current
+    etag is if_match. Of concurrent writers with the same condition exactly one succeeds. Returns the etag of the new object,
+    or None if the condition does not hold.
+    """
+    bucket, key = split_s3_path(s3_path)
+    etag = get_object_store().put_if(bucket, key, body, if_match)
+    if etag is not None:
+        _notify_listeners(bucket, written=[S3Object(key, len(body), time.time(), etag)])
+    return etag
+
+class S3ObjectFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object that fetches only the byte ranges that are read (e.g. by h5py, which
+    accepts file objects). Small reads are served from a cache of block_size blocks, since file formats like HDF5 issue many
+    small reads for their metadata; reads that span more than a block are fetched directly. bytes_read is the total number of
+    bytes fetched from the store.
+    """
+    def __init__(self, s3_path: str, block_size: int = DEFAULT_RANGE_BLOCK_SIZE, max_cached_blocks: int = DEFAULT_RANGE_CACHED_BLOCKS, store = None):
+        self.store = get_object_store() if store is None else store
+        self.bucket, self.key = split_s3_path(s3_path)
+        o = self.store.head(self.bucket, self.key)
+        if o is None:
+            raise FileNotFoundError("Object {} does not exist.".format(s3_path))
+        self.size = o.size
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.bytes_read = 0
+        self.n_requests = 0
+        self._pos = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self.size + offset
+        return self._pos
+
+    def _fetch(self, start: int, length: int) -> bytes:
+        data = self.store.read_range(self.bucket, self.key, start, length)
+        self.bytes_read += len(data)
+        self.n_requests += 1
+        return data
+
+    def _block(self, i: int) -> bytes:
+        if i in self._blocks:
+            self._blocks.move_to_end(i)
+            return self._blocks[i]
+        start = i * self.block_size
+        block = self._fetch(start, min(self.block_size, self.size - start))
+        self._blocks[i] = block
+        if len(self._blocks) > self.max_cached_blocks:
+            self._blocks.popitem(last = False)
+        return block
+
+    def readinto(self, b) -> int:
+        with self._lock:
+            n = max(0, min(len(b), self.size - self._pos))
+            if n == 0:
+                return 0
+            start, end = self._pos, self._pos + n
+            if n > self.block_size:
+                b[:n] = self._fetch(start, n)
+            else:
+                chunks = []
+                for i in range(start // self.block_size, (end - 1) // self.block_size + 1):
+                    block = self._block(i)
+                    chunks.append(block[max(0, start - i * self.block_size):end - i * self.block_size])
+                b[:n] = b"".join(chunks)
+            self._pos = end
+            return n
+
+def s3_cp(source: str, target: str) -> str:
+    """
+    Copies a single file from/to S3 (equivalent to `aws s3 cp <source> <target>`). If target is an existing
+    local dir or ends with "/" then the file is placed under target. Returns a response in the format of the aws cli.
+    """
+    store = get_object_store()
+    if target.endswith("/") or os.path.isdir(target):
+        target = target.rstrip("/") + "/" + source.split("/")[-1]
+    if is_s3_path(source) and is_s3_path(target):
+        dst_bucket, dst_key = split_s3_path(target)
+        store.copy(*split_s3_path(source), dst_bucket, dst_key)
+        if len(_write_listeners) > 0:
+            _notify_listeners(dst_bucket, written=[store.head(dst_bucket, dst_key)])
+        return "copy: {} to {}\n".format(source, target)
+    if is_s3_path(source):
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        bucket, key = split_s3_path(source)
+        o = store.head(bucket, key)
+        if o is None:
+            return ""
+        store.download(bucket, key, target)
+        os.utime(target, (o.last_modified, o.last_modified))
+        return "download: {} to {}\n".format(source, target)
+    dst_bucket, dst_key = split_s3_path(target)
+    store.upload(source, dst_bucket, dst_key)
+    _notify_listeners(dst_bucket, written=[S3Object(dst_key, os.path.getsize(source), time.time())])
+    return "upload: {} to {}\n".format(source, target)
+
+def s3_cp_many(transfers: List[Tuple[str, str]]) -> str:
+    # runs s3_cp on each (source, target) pair concurrently through the shared client
+    return "".join(_run_concurrently(s3_cp, transfers))
+
+def s3_sync(source: str, target: str, include: Optional[Union[str, List[str]]] = None, only_if_changed: bool = True) -> str:
+    """
+    Transfers all files under the source dir that match any of the include patterns into the target dir, where either
+    source or target (or both) are S3 paths. Files are transferred concurrently through the shared client.
+
+    If only_if_changed is True (equivalent to `aws s3 sync <source> <target> --exclude "*" --include <include>`) then files
+    that already exist in target with the same size and a modification time that is not older than the source's are skipped;
+    otherwise (equivalent to `aws s3 cp --recursive ...`) all matching files are transferred.
+
+    Returns a response in the format of the aws cli, which is empty if nothing was transferred.
+    """
+    if isinstance(include, str):
+        include = [include]
+    store = get_object_store()
+    # list the source and target
+    if is_s3_path(source):
+        src_bucket, src_prefix = split_s3_path(source)
+        src_prefix = _as_dir_prefix(src_prefix)
+        src_files = {o.key[len(src_prefix):]: o for o in store.list_objects(src_bucket, src_prefix)}
+    else:
+        src_files = {}
+        if os.path.isdir(source):
+            for f in _list_local_files(source):
+                st = os.stat(os.path.join(source, f))
+                src_files[f] = S3Object(f, st.st_size, st.st_mtime)
+    src_files = {f: o for f, o in src_files.items() if _matches(f, include)}
+    if is_s3_path(target):
+        dst_bucket, dst_prefix = split_s3_path(target)
+        dst_prefix = _as_dir_prefix(dst_prefix)
+    def needs_transfer(f: str, o: S3Object) -> bool:
+        if not only_if_changed:
+            return True
+        if is_s3_path(target):
+            t = store.head(dst_bucket, dst_prefix + f)
+        else:
+            local_path = os.path.join(target, f)
+            t = S3Object(f, os.path.getsize(local_path), os.path.getmtime(local_path)) if os.path.isfile(local_path) else None
+        return t is None or t.size != o.size or o.last_modified > t.last_modified + 1
+    def transfer(f: str) -> str:
+        o = src_files[f]
+        if not needs_transfer(f, o):
+            return ""
+        source_path = source.rstrip("/") + "/" + f
+        if is_s3_path(source) and is_s3_path(target):
+            store.copy(src_bucket, src_prefix + f, dst_bucket, dst_prefix + f)
+            _notify_listeners(dst_bucket, written=[S3Object(dst_prefix + f, o.size, time.time())])
+            return "copy: {} to {}\n".format(source_path, target.rstrip("/") + "/" + f)
+        if is_s3_path(source):
+            local_path = os.path.join(target, f)
+            os.makedirs(os.path.dirname(os.path.abspath(local_path)), exist_ok=True)
+            store.download(src_bucket, src_prefix + f, local_path)
+            # like the aws cli, keep the modification time of the object so that the next sync will skip it
+            os.utime(local_path, (o.last_modified, o.last_modified))
+            return "download: {} to {}\n".format(source_path, local_path)
+        store.upload(os.path.join(source, f), dst_bucket, dst_prefix + f)
+        _notify_listeners(dst_bucket, written=[S3Object(dst_prefix + f, o.size, time.time())])
+        return "upload: {} to {}\n".format(os.path.join(source, f), target.rstrip("/") + "/" + f)
+    return "".join(_run_concurrently(transfer, [(f,) for f in sorted(src_files)]))
+
+def s3_rm(s3_path: str, recursive: bool = False, include: Optional[Union[str, List[str]]] = None) -> str:
+    if isinstance(include, str):
+        include = [include]
+    store = get_object_store()
+    bucket, key = split_s3_path(s3_path)
+    if recursive:
+        prefix = _as_dir_prefix(key)
+        keys = [o.key for o in store.list_objects(bucket, prefix) if _matches(o.key[len(prefix):], include)]
+    else:
+        keys = [key] if store.head(bucket, key) is not None else []
+    store.delete(bucket, keys)
+    _notify_listeners(bucket, deleted=keys)
+    return "".join(["delete: {}{}/{}\n".format(S3_PREFIX, bucket, k) for k in keys])
+
+def s3_mv(source: str, target: str, recursive: bool = False, include: Optional[Union[str, List[str]]] = None) -> str:
+    # a move is a (server-side) copy followed by a delete of the source objects
+    if not recursive:
+        resp = s3_cp(source, target)
+        if len(resp) > 0:
+            s3_rm(source)
+        return resp.replace("copy:", "move:")
+    resp = s3_sync(source, target, include, only_if_changed=False)
+    s3_rm(source, recursive=True, include=include)
+    return resp.replace("copy:", "move:")
@@ -0,0 +1,118 @@
+import logging
+import threading
+import pandas as pd
+from typing import Dict, List, Optional
+
+# Lookup tables over the Samples tab of the immune aging sheet. Each row of the tab is a sample, and the "GEX lib",
+# "BCR lib" and "TCR lib" columns hold comma separated lists of the libraries of the sample; looking up the donor or
+# the samples of a library used to scan all the rows (and split all the lists) on every call. The tables are built
+# in one pass over the tab and are shared by all the callers in the process as long as the tab does not change.
+# Rows whose vdj libraries can't be paired with their gex libraries (no gex library, or fewer gex than vdj libraries) are
+# left out of the vdj -> gex mapping with a warning, so that one malformed row does not break the lookups of all the others.
+
+LIB_TYPES = ["GEX", "BCR", "TCR"]
+VDJ_LIB_TYPES = ["BCR", "TCR"]
+
+def _check_lib_type(lib_type: str, lib_types: List[str] = LIB_TYPES) -> None:
+    if lib_type not in lib_types:
+        raise ValueError("Unsupported lib_type: {}. Must be one of: {}".format(lib_type, ", ".join(lib_types)))
+
+def _split_libs(value) -> List[str]:
+    if pd.isnull(value):
+        return []
+    return value.split(",")
+
+class SampleMetadataIndex:
+    def __init__(self, samples: pd.DataFrame):
+        self.samples = samples.reset_index(drop=True)
+        # lib type -> lib id -> positions of the rows (samples) that include the library
+        self._lib_rows = {lib_type: {} for lib_type in LIB_TYPES}
+        # vdj lib type -> vdj lib id -> corresponding gex lib id
+        self._vdj_to_gex = {lib_type: {} for lib_type in VDJ_LIB_TYPES}
+        # lib type -> donor id -> lib ids
+        self._donor_libs = {lib_type: {} for lib_type in LIB_TYPES}
+        self._sample_rows = {}
+        donors = self.samples["Donor ID"].values
+        for lib_type in LIB_TYPES:
+            column_name = "{} lib".format(lib_type)
+            if column_name not in self.samples.columns:
+                continue
+            for i, value in enumerate(self.samples[column_name].values):
+                libs = _split_libs(value)
+                for lib in libs:
+                    self._lib_rows[lib_type].setdefault(lib, []).append(i)
+                self._donor_libs[lib_type].setdefault(donors[i], set()).update(libs)
+                if lib_type in VDJ_LIB_TYPES and len(libs) > 0:
+                    self._add_vdj_libs(lib_type, i, libs)
+        if "Sample_ID" in self.samples.columns:
+            for i, sample_id in enumerate(self.samples["Sample_ID"].values):
+                self._sample_rows.setdefault(sample_id, i)
+
+    def _add_vdj_libs(self, lib_type: str, i: int, libs: List[str]) -> None:
+        # the j-th vdj library of a sample corresponds to its j-th gex library
+        gex_libs = _split_libs(self.samples["GEX lib"].iloc[i]) if "GEX lib" in self.samples.columns else []
+        if len(gex_libs) < len(libs):
+            logging.warning("Sample {} has {} {} libraries but {} GEX libraries; its {} libraries are not mapped to GEX libraries.".format(
+                self.samples["Sample_ID"].iloc[i] if "Sample_ID" in self.samples.columns else "in row {}".format(i), len(libs), lib_type,
+                len(gex_libs), lib_type))
+            return
+        for j in range(len(libs)):
+            self._vdj_to_gex[lib_type][libs[j]] = gex_libs[j]
+
+    def get_donor_id(self, lib_type: str, lib_id: str) -> str:
+        # the donor of the first sample that includes the library, or "" if there is no such sample
+        _check_lib_type(lib_type)
+        rows = self._lib_rows[lib_type].get(lib_id, [])
+        return self.samples["Donor ID"].iloc[rows[0]] if len(rows) > 0 else ""
+
+    def get_lib_samples(self, lib_type: str, lib_id: str) -> pd.DataFrame:
+        # the rows of all the samples that include the library
+        _check_lib_type(lib_type)
+        return self.samples.iloc[self._lib_rows[lib_type].get(lib_id, [])]
+
+    def get_sample_ids(self, lib_type: str, lib_id: str) -> List[str]:
+        return list(self.get_lib_samples(lib_type, lib_id)["Sample_ID"])
+
+    def get_sample(self, sample_id: str) -> Optional[pd.Series]:
+        # the row of the sample (donor, organ, site, etc.), or None if the sample is not in the sheet
+        i = self._sample_rows.get(sample_id)
+        return None if i is None else self.samples.iloc[i]
+
+    def get_libs(self, lib_type: str, donor_id: Optional[str] = None) -> set:
+        # all the libraries of the given type, optionally only those of a given donor
+        _check_lib_type(lib_type)
+        if donor_id is not None:
+            return set(self._donor_libs[lib_type].get(donor_id, set()))
+        return set(self._lib_rows[lib_type].keys())
+
+    def get_vdj_lib_to_gex_lib(self, lib_type: str) -> Dict[str, str]:
+        _check_lib_type(lib_type, VDJ_LIB_TYPES)
+        return dict(self._vdj_to_gex[lib_type])
+
+_index = None
+_index_key = None
+_index_samples = None
+_index_lock = threading.Lock()
+
+def index_samples(samples: pd.DataFrame, key: Optional[tuple] = None) -> SampleMetadataIndex:
+    """
+    Returns the index of the given Samples tab. key identifies the content of the tab (e.g. the time its snapshot was fetched,
+    see base_utils.get_sheet_version) and the index is only rebuilt when key changes; if key is None, the index is kept for as
+    long as the same data frame is passed.
+    """
+    global _index, _index_key, _index_samples
+    with _index_lock:
+        if _index is None or _index_key != key or (key is None and _index_samples is not samples):
+            _index = SampleMetadataIndex(samples)
+            _index_key = key
+            # holding on to the data frame also keeps its id from being reused by another one
+            _index_samples = samples
+    return _index
+
+def get_cached_index(key: Optional[tuple]) -> Optional[SampleMetadataIndex]:
+    """
+    Returns the index that index_samples built for key, or None if there is none (key is None, or the tab changed since); this
+    lets callers skip reading the tab when the index is up to date.
+    """
+    with _index_lock:
+        return _index if key is not None and _index_key == key else None
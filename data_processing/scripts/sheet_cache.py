@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import warnings
+import threading
+import pandas as pd
+from typing import Dict, List, Optional
+
+from s3_index import get_cache_dir
+
+# Snapshot cache of the tabs of the immune aging Google sheet. The sheet used to be downloaded on every call to
+# read_immune_aging_sheet, which happens many times in one run (e.g. once per library in vdj_utils, once per protein
+# panel in get_internal_protein_names); instead, the tabs are downloaded once, kept in memory and stored as a local
+# snapshot that is reused by subsequent calls and processes until it is older than max_age seconds.
+#
+# On the first miss all the tabs in SNAPSHOT_SHEETS are downloaded together; other tabs (e.g. protein
+# panels) are downloaded when first requested and added to the snapshot. Each tab is stored as a pickled data frame
+# so that the column types are kept as they were parsed from the downloaded csv.
+#
+# The following environment variables can be used to control the cache (all are optional):
+# IA_CACHE_DIR - directory for local caches (default ~/.cache/immuneaging)
+# IA_SHEET_MAX_AGE - max age in seconds of a tab before it is downloaded again (default 600); 0 disables the caching
+# IA_SHEET_OFFLINE - if set to 1, tabs are never downloaded and are read from the snapshot regardless of their age
+# IA_SHEET_URL - url template of the sheet tabs (with {} for the tab name); useful for testing against a local server
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1XC6DnTpdLjnsTMReGIeqY4sYWXViKke_cMwHwhbdxIY/gviz/tq?tqx=out:csv&sheet={}"
+# testing url of bad sample sheet
+# SHEET_URL = "https://docs.google.com/spreadsheets/d/1YO1HLGLnO3PPUiK1vKZd52yoCInwpLl60zoi4zxkOrE/gviz/tq?tqx=out:csv&sheet={}"
+SNAPSHOT_SHEETS = ["Samples", "Donors", "CITE key", "Dictionary"]
+SNAPSHOT_FORMAT_VERSION = 1
+DEFAULT_MAX_AGE = 600
+
+class SheetSnapshot:
+    def __init__(self, snapshot_dir: str, url: str = SHEET_URL, max_age: float = DEFAULT_MAX_AGE, offline: bool = False):
+        self.snapshot_dir = snapshot_dir
+        self.url = url
+        self.max_age = max_age
+        self.offline = offline
+        self.n_downloads = 0
+        self._lock = threading.Lock()
+        # sheet name -> (fetched_at, data frame)
+        self._sheets = {}
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.snapshot_dir, "manifest.json")
+
+    def _sheet_path(self, sheet: str) -> str:
+        return os.path.join(self.snapshot_dir, "{}.{}.pkl".format(re.sub("[^A-Za-z0-9]+", "_", sheet),
+            hashlib.md5(bytes(sheet, "utf-8")).hexdigest()[:8]))
+
+    def _load_manifest(self) -> Dict:
+        try:
+            with open(self._manifest_path()) as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        # snapshots written by other versions of this module or for a different sheet are ignored
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION or manifest.get("url") != self.url:
+            return {}
+        return manifest.get("sheets", {})
+
+    def _save(self, fetched: Dict[str, pd.DataFrame], fetched_at: float) -> None:
+        # write the tabs and then the manifest; each file is replaced atomically so that concurrent readers never see partial files
+        manifest = self._load_manifest()
+        for sheet, data in fetched.items():
+            tmp_path = self._sheet_path(sheet) + ".tmp.{}".format(os.getpid())
+            data.to_pickle(tmp_path)
+            os.replace(tmp_path, self._sheet_path(sheet))
+            manifest[sheet] = {"file": os.path.basename(self._sheet_path(sheet)), "fetched_at": fetched_at, "n_rows": len(data)}
+        tmp_path = self._manifest_path() + ".tmp.{}".format(os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump({"format_version": SNAPSHOT_FORMAT_VERSION, "url": self.url, "sheets": manifest}, fp, indent=2)
+        os.replace(tmp_path, self._manifest_path())
+
+    def _download(self, sheet: str, quiet: bool = True) -> str:
+        # downloads the tab into a csv file and returns its path; as when the sheet was downloaded by read_immune_aging_sheet,
+        # warnings raised while downloading are errors, while those raised while parsing the file (see refresh) are not
+        try:
+            import gdown
+        except ImportError as e:
+            raise ImportError(
+                "gdown is not installed. Please install gdown via: pip install gdown"
+            )
+        output_fn = self._sheet_path(sheet) + ".download.{}.{}.csv".format(os.getpid(), threading.get_ident())
+        with warnings.catch_warnings(record=True) as w:
+            warnings.filterwarnings("error")
+            output_fn = gdown.download(self.url.format(sheet), output_fn, quiet=quiet)
+
+            if len(w) == 1:
+                msg = w[0]
+                warnings.showwarning(
+                    msg.message, msg.category, msg.filename, msg.lineno, msg.line
+                )
+        self.n_downloads += 1
+        return output_fn
+
+    def _is_fresh(self, fetched_at: float) -> bool:
+        return self.offline or time.time() - fetched_at < self.max_age
+
+    def refresh(self, sheets: Optional[List[str]] = None, quiet: bool = True) -> None:
+        """
+        Downloads the given tabs (default: SNAPSHOT_SHEETS) and replaces them in memory and in the local snapshot.
+        """
+        sheets = SNAPSHOT_SHEETS if sheets is None else sheets
+        fetched_at = time.time()
+        # the tabs are downloaded one after the other in the calling thread since the warnings filters (see _download) are process
+        # wide and not thread safe; all of them are downloaded before any is parsed so that they are from about the same time
+        output_fns = []
+        try:
+            for sheet in sheets:
+                output_fns.append(self._download(sheet, quiet))
+            fetched = {sheet: pd.read_csv(output_fn) for sheet, output_fn in zip(sheets, output_fns)}
+        finally:
+            for output_fn in output_fns:
+                if os.path.exists(output_fn):
+                    os.remove(output_fn)
+        self._save(fetched, fetched_at)
+        for sheet, data in fetched.items():
+            self._sheets[sheet] = (fetched_at, data)
+
+    def get(self, sheet: str, quiet: bool = True) -> pd.DataFrame:
+        """
+        Returns a copy of the given tab from memory, from the local snapshot, or by downloading it, in that order,
+        depending on which one is not older than max_age seconds. In offline mode the tab is never downloaded.
+        """
+        with self._lock:
+            if sheet in self._sheets and self._is_fresh(self._sheets[sheet][0]):
+                return self._sheets[sheet][1].copy()
+            manifest = self._load_manifest()
+            if sheet in manifest and self._is_fresh(manifest[sheet]["fetched_at"]):
+                self._sheets[sheet] = (manifest[sheet]["fetched_at"], pd.read_pickle(self._sheet_path(sheet)))
+                return self._sheets[sheet][1].copy()
+            if self.offline:
+                raise ValueError("Sheet {} is not available in the local snapshot at {} and IA_SHEET_OFFLINE is set.".format(sheet, self.snapshot_dir))
+            # a miss on one of the main tabs refreshes all of them at once since they are typically all used in the same run
+            sheets = [s for s in SNAPSHOT_SHEETS if s not in self._sheets or not self._is_fresh(self._sheets[s][0])] if sheet in SNAPSHOT_SHEETS else [sheet]
+            try:
+                self.refresh(sheets, quiet)
+            except Exception:
+                if sheet not in manifest:
+                    raise
+                logging.warning("Could not download sheet {}; using the snapshot from {} instead.".format(
+                    sheet, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest[sheet]["fetched_at"]))))
+                self._sheets[sheet] = (manifest[sheet]["fetched_at"], pd.read_pickle(self._sheet_path(sheet)))
+            return self._sheets[sheet][1].copy()
+
+    def fetched_at(self, sheet: str) -> Optional[float]:
+        # the time the tab that get() returns from memory was downloaded (by this or another process), or None if it was not read yet
+        # or is older than max_age (the next get() reads it again)
+        entry = self._sheets.get(sheet)
+        return None if entry is None or not self._is_fresh(entry[0]) else entry[0]
+
+_snapshot = None
+_snapshot_key = None
+_snapshot_lock = threading.Lock()
+
+def get_sheet_snapshot() -> SheetSnapshot:
+    # one snapshot per sheet url and settings, shared by all the callers in the process
+    global _snapshot, _snapshot_key
+    url = os.environ.get("IA_SHEET_URL", SHEET_URL)
+    max_age = float(os.environ.get("IA_SHEET_MAX_AGE", DEFAULT_MAX_AGE))
+    offline = os.environ.get("IA_SHEET_OFFLINE", "0") == "1"
+    key = (url, max_age, offline, os.environ.get("IA_CACHE_DIR", ""))
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot_key != key:
+            snapshot_dir = os.path.join(get_cache_dir(), "sheet_snapshot.{}".format(hashlib.md5(bytes(url, "utf-8")).hexdigest()[:8]))
+            _snapshot = SheetSnapshot(snapshot_dir, url, max_age, offline)
+            _snapshot_key = key
+    return _snapshot
+
+def read_sheet_cached(sheet: str, quiet: bool = True) -> pd.DataFrame:
+    return get_sheet_snapshot().get(sheet, quiet)
+
+def refresh_sheet_snapshot(sheets: Optional[List[str]] = None) -> None:
+    # forces downloading the tabs, e.g. right after editing the sheet
+    get_sheet_snapshot().refresh(sheets)
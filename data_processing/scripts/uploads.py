@@ -0,0 +1,98 @@
+import os
+import time
+import atexit
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Type, Union
+
+from logger import BaseLogger
+from s3_utils import content_matches, get_max_concurrency, get_object_store, s3_cp, split_s3_path
+
+# Background uploads of the outputs of a script. Outputs used to be uploaded one after the other at the end of the script
+# (and in align_library.py with one sync per file), so the machine was idle on network I/O for the duration of all the
+# uploads. Instead, every output is submitted as soon as it is final and is uploaded concurrently in the background while
+# the script keeps running; the script waits for the uploads only at the end (or at exit), where a report is logged.
+#
+# An upload is skipped if the object already exists with the same content: compared through the etag (md5) when the store
+# provides one, or otherwise (e.g. LocalStore) by size and modification time as in s3_utils.s3_sync.
+#
+# The following environment variables can be used to control the uploads (all are optional):
+# IA_UPLOAD_MAX_CONCURRENCY - max number of files uploaded concurrently (default IA_S3_MAX_CONCURRENCY)
+# IA_UPLOAD_MAX_ATTEMPTS - max number of attempts per file (default 3); each attempt itself retries failed requests
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+class UploadQueue:
+    def __init__(self, logger: Type[BaseLogger], max_concurrency: Optional[int] = None, max_attempts: Optional[int] = None):
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("IA_UPLOAD_MAX_CONCURRENCY", get_max_concurrency()))
+        if max_attempts is None:
+            max_attempts = int(os.environ.get("IA_UPLOAD_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self._executor = ThreadPoolExecutor(max_workers = max_concurrency)
+        self._lock = threading.Lock()
+        # (local path, s3 path, future) of the uploads that were not reported yet
+        self._pending = []
+        # wait for the uploads also if the script exits early (e.g. sys.exit() following an error)
+        atexit.register(self.wait)
+
+    def submit(self, local_dir: str, s3_dir: str, files: Union[str, List[str]]) -> None:
+        """
+        Starts uploading the given file(s) in local_dir into s3_dir in the background (same arguments as utils.aws_sync).
+        The files should not be modified after they are submitted.
+        """
+        if isinstance(files, str):
+            files = [files]
+        with self._lock:
+            for f in files:
+                local_path = os.path.join(local_dir, f)
+                s3_path = s3_dir.rstrip("/") + "/" + f
+                self.logger.add_to_log("Queued upload: {} -> {}".format(local_path, s3_path))
+                self._pending.append((local_path, s3_path, self._executor.submit(self._upload, local_path, s3_path)))
+
+    def _upload(self, local_path: str, s3_path: str) -> str:
+        # returns "uploaded" or "unchanged"; raises the last error if all the attempts failed
+        bucket, key = split_s3_path(s3_path)
+        store = get_object_store()
+        attempt = 0
+        while True:
+            try:
+                o = store.head(bucket, key)
+                if o is not None and o.size == os.path.getsize(local_path):
+                    same_content = content_matches(local_path, o)
+                    if same_content or (same_content is None and os.path.getmtime(local_path) <= o.last_modified + 1):
+                        return "unchanged"
+                s3_cp(local_path, s3_path)
+                return "uploaded"
+            except Exception as err:
+                attempt += 1
+                if attempt >= self.max_attempts or isinstance(err, FileNotFoundError):
+                    raise
+                time.sleep(min(30, 2 ** attempt) + random.uniform(0, 1))
+
+    def wait(self) -> bool:
+        """
+        Waits for all the submitted uploads and logs a report; returns True if all of them succeeded. Failed uploads are
+        logged rather than raised (as in utils.aws_sync).
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if len(pending) == 0:
+            return True
+        start = time.time()
+        n_uploaded, n_unchanged, n_bytes, failed = 0, 0, 0, []
+        for local_path, s3_path, future in pending:
+            try:
+                if future.result() == "uploaded":
+                    n_uploaded += 1
+                    n_bytes += os.path.getsize(local_path)
+                else:
+                    n_unchanged += 1
+            except Exception as err:
+                failed.append(local_path)
+                self.logger.add_to_log("Failed to upload {} to {}: {}".format(local_path, s3_path, err), level = "error")
+        self.logger.add_to_log("Uploads complete: {} uploaded ({:.1f} MB), {} unchanged, {} failed; waited {:.2f} seconds for the uploads to finish.".format(
+            n_uploaded, n_bytes / 1024 / 1024, n_unchanged, len(failed), time.time() - start), level = "error" if len(failed) > 0 else "info")
+        return len(failed) == 0
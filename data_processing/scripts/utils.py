@@ -8,6 +8,7 @@ import pandas as pd
 import numpy as np
 import scvi
 import zipfile
+import urllib.request
 import anndata
 import subprocess
 import time
@@ -18,32 +19,34 @@ from typing import Type, List, NamedTuple, Optional
 import traceback
 from datetime import datetime
 from logger import BaseLogger
+from base_utils import *
+from s3_utils import s3_list, s3_ls, s3_exists, s3_cp, s3_cp_many, s3_sync, s3_mv, s3_rm
+from s3_index import s3_list_cached, s3_exists_cached, s3_latest_version, refresh_listing_index
+from sheet_cache import read_sheet_cached, refresh_sheet_snapshot
+from sample_metadata import SampleMetadataIndex, index_samples, get_cached_index
 import scanpy as sc
 import celltypist
 import logging
 from scipy.stats import norm
+import scipy.sparse
+import copy
+from doublets import run_scrublet
+from clustering import leiden_sweep
+from percolation import percolate_observation, percolate_observations, add_cluster_statistics
+from prefetch import Prefetcher
+from uploads import UploadQueue
+from fastq_fetch import FastqFetcher, read_md5_manifest
+from warm_cache import get_resident
+from h5ad_reader import H5adReader, read_h5ad_parts
+from concatenation import SparseRowStore, read_sample_metadata, common_layers, concatenate_layer
+from h5ad_writer import StorageProfile, PROFILES, get_storage_profile, write_h5ad, write_h5ad_with_copies
+from model_artifacts import save_model_artifact, extract_model_artifact, read_model_manifest, read_model_training_data, load_model_artifact, set_artifact_reference
+from checkpoints import StageCheckpoints, FileContent, content_hash
+from zarr_store import ZarrReader, write_zarr, h5ad_to_zarr, zarr_to_h5ad, zarr_output_enabled, check_zarr_output, zarr_file_name, list_zarr_files
 from statsmodels.stats import multitest
 
 logging.getLogger('numba').setLevel(logging.WARNING)
 
-AUTHORIZED_EXECUTERS = ["b750bd0287811e901c88dc328187e25f", "1c75133ab6a1fc3ed9233d3fe40b3d73", "5781bb0290325ec9e3f9c4c930dc3412"] # md5 checksums of the AWS_SECRET_ACCESS_KEY value of those that are authorized to upload outputs of processing scripts to the server; note that individuals with upload permission to aws can bypass that by changing the code - this is just designed to alert users that they should only use sandbox mode.
-
-class CELLRANGER_METRICS_NT(NamedTuple):
-    MEDIAN_GENES_PER_CELL: str = "Median Genes per Cell"
-    MEDIAN_UMI_COUNTS_PER_CELL: str = "Median UMI Counts per Cell"
-    SEQUENCING_SATURATION: str = "Sequencing Saturation"
-
-CELLRANGER_METRICS = CELLRANGER_METRICS_NT()
-
-# these are formatted strings that we use to log QC stats and use them to parse those lines back
-# if you edit these make sure to update all call sites that use them
-QC_STRING_DOUBLETS = "Removed {} estimated doublets (percent removed: {:.2f}%); {} droplets remained."
-QC_STRING_AMBIENT_RNA = "Removed {} cells (percent removed: {:.2f}%) with total decontaminated counts below filter_decontaminated_cells_min_genes={}"
-QC_STRING_VDJ = "Removed {} vdj genes (percent removed: {:.2f}%); {} genes remained."
-QC_STRING_RBC = "Removed {} red blood cells (percent removed: {:.2f}%); {} droplets remained."
-QC_STRING_COUNTS = "Final number of cells: {}, final number of genes: {}."
-QC_STRING_START_TIME = "Starting time: {}"
-
 def init_scvi_settings():
     # This does two things:
     # 1. Makes the logger look good in a log file
@@ -55,186 +58,7 @@ def init_scvi_settings():
 sc.settings.n_jobs = 20
 sc.settings.max_memory = 300
 
-TIME_FORMAT = "%H:%M, %m-%d-%Y"
-DATE_FORMAT = "%m/%d/%Y"
-
-def get_current_time():
-    return time.strftime(TIME_FORMAT)
-
-def get_date_from_time(t: str):
-    dt = datetime.strptime(t, TIME_FORMAT)
-    return dt.strftime(DATE_FORMAT)
-
-def set_access_keys(filepath, return_dict = False):
-	"""
-	Sets the user's access keys to the AWS S3 bucket.
-
-	Assumes this file includes only two uncommented lines with keys:
-	export AWS_ACCESS_KEY_ID=<key>
-	export AWS_SECRET_ACCESS_KEY=<key>
-
-	If return_dict == True then only returns the dictionary.
-	"""
-	keys = {}
-	with open(filepath) as fp:
-		for i in fp:
-			if len(i.rstrip()) and i[0]!="#":
-				cmd = i.rstrip().split(" ")
-				assert(cmd[0] == "export")
-				cmd.pop(0)
-				for i in range(len(cmd)-1,-1,-1):
-					if len(cmd[i]) == 0:
-						cmd.pop(i)
-				pair = "".join(cmd).split("=")
-				keys[pair[0]] = pair[1]
-	if return_dict:
-		return(keys)
-	for k in keys:
-		os.environ[k] = keys[k]
-
-def load_configs(filename):
-    with open(filename) as f: 
-        data = f.read()	
-    configs = json.loads(data)
-    return configs
-
-def get_configs_status(configs, s3_path, configs_file_prefix, variable_config_keys, data_dir):
-	ls_cmd = 'aws s3 ls {} --recursive'.format(s3_path)
-	files = os.popen(ls_cmd).read()
-	files = [file.split(' ')[-1] for file in files.rstrip().split('\n')]
-	latest_configs_file = None
-	latest_version_num = 0
-	is_new_version = False
-	for f in files:
-		j = f.split('/')[-1].split('.')[0:-1]
-		if ".".join(j[0:-1]) == configs_file_prefix and '/'.join(f.split('/')[:-1] + ['.'.join([f.split('/')[-3], 'unstim', f.split('/')[-2], 'h5ad'])]) in files:
-			v = int(j[-1][1:])
-			if v > latest_version_num:
-				latest_version_num = v
-				latest_configs_file = "/".join(f.split('/')[-2:])
-	if latest_configs_file is None:
-		version = 1
-	else:
-		cp_cmd = 'aws s3 cp {}/{} {}'.format(s3_path, latest_configs_file, data_dir)
-		os.system(cp_cmd)
-		configs_invariant = {i:configs[i] for i in configs if i not in variable_config_keys}
-		with open(os.path.join(data_dir, latest_configs_file.split('/')[-1])) as f:
-			latest_configs = json.loads(f.read().rstrip())
-			latest_configs_invariant = {i:latest_configs[i] for i in latest_configs if i not in variable_config_keys}
-			if configs_invariant == latest_configs_invariant:
-				version = latest_version_num
-			else:
-				version = latest_version_num + 1
-	if version > latest_version_num:
-		is_new_version = True
-	print(is_new_version,"v"+str(version))
-	return [is_new_version,"v"+str(version)]
-
-def get_latest_object_version(s3_access_file: str, s3_path: str, folder_name: Optional[str] = None):
-    set_access_keys(s3_access_file)
-    latest_version = -1
-    ls_cmd = 'aws s3 ls {} --recursive'.format(s3_path)
-    ls  = os.popen(ls_cmd).read()
-    if len(ls) != 0:
-        # search for patterns of /vX/. If there is a match, the regex group
-        # one is "X" (X can be any integer >0)
-        pattern = "/v(\d+)/"
-        filenames = ls.split("\n")
-        for filename in filenames:
-            if folder_name is not None and folder_name not in filename:
-                continue
-            m = re.search(pattern, filename)
-            if bool(m):
-                version = int(m[1])
-                if latest_version < version:
-                    latest_version = version
-    if latest_version == -1:
-        print(f"Could not find the latest version. s3_path: {s3_path}")
-    return "v" + str(latest_version)
-
-def get_configs_version_alignment(configs, data_dir, configs_dir_remote, configs_file_remote_prefix, variable_config_keys):
-	# This function checks if the configs file is using configs that were already used (while disregarding fields variable_config_keys) and are therefore documented on S3.
-	# If this is the first time these configs are used then it creates a new configs version and uploads the new configs to S3.
-	# Finally, the version of the configs is returned; to be used for stamping results files with the configs version.
-	configs_dir_local = os.path.join(data_dir,"configs")
-	os.system("mkdir -p " + configs_dir_local)
-	cmd = 'aws s3 sync {0} {1} --exact-timestamps'.format(configs_dir_remote, configs_dir_local)
-	os.system(cmd)
-	version = None
-	max_version = 0
-	configs_invariant = {i:configs[i] for i in configs if i not in variable_config_keys}
-	for configs_file in glob.glob(os.path.join(configs_dir_local,"*.txt")):
-		with open(configs_file) as f:
-			f_configs = json.loads(f.read().rstrip())
-		if configs_invariant == f_configs:
-			version = configs_file.split('/')[-1][0:-4].split('.')[1]
-			break
-		version_num = int(configs_file.split('/')[-1][0:-4].split('.')[1][1:])
-		if (version_num > max_version):
-			max_version = version_num
-	if version is None:
-		version = "v{0}".format(max_version+1)
-		configs_file = os.path.join(configs_dir_local,"{0}{1}.txt".format(configs_file_remote_prefix, version))
-		with open(configs_file, 'w') as f:
-			json.dump(configs_invariant, f)
-		cmd = 'aws s3 sync {0} {1} --exclude "*" --include {2}'.format(configs_dir_local,configs_dir_remote,configs_file)
-		#print("Uploading configs_file to S3 : {0}".format(os.popen(cmd).read()))
-		os.system(cmd)
-	return version
-
-def zipdir(path, ziph):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), 
-                os.path.join(path, '..')))
-
-def read_immune_aging_sheet(sheet, output_fn=None, quiet=True):
-    if 'IA_sample_spreadsheet.xlsx' in os.listdir(os.getcwd()):
-        logging.warning(f'Using previously downloaded sample spreadsheet at {os.getcwd()}/IA_sample_spreadsheet.xlsx')
-        data = pd.read_excel('IA_sample_spreadsheet.xlsx', sheet_name=sheet)
-    else:
-        url = "https://docs.google.com/spreadsheets/d/1XC6DnTpdLjnsTMReGIeqY4sYWXViKke_cMwHwhbdxIY/gviz/tq?tqx=out:csv&sheet={}".format(
-            sheet
-        )
-
-        # testing url of bad sample sheet
-        # url = "https://docs.google.com/spreadsheets/d/1YO1HLGLnO3PPUiK1vKZd52yoCInwpLl60zoi4zxkOrE/gviz/tq?tqx=out:csv&sheet={}".format(
-        #     sheet
-        # )
-
-        try:
-            import gdown
-        except ImportError as e:
-            raise ImportError(
-                "gdown is not installed. Please install gdown via: pip install gdown"
-            )
-
-        with warnings.catch_warnings(record=True) as w:
-            warnings.filterwarnings("error")
-            # output_fn = gdown.download(url, output_fn, quiet=quiet, fuzzy=True)
-            output_fn = gdown.download(url, output_fn, quiet=quiet)
-
-            if len(w) == 1:
-                msg = w[0]
-                warnings.showwarning(
-                    msg.message, msg.category, msg.filename, msg.lineno, msg.line
-                )
-
-        data = pd.read_csv(output_fn)
-        os.remove(output_fn)
-    return data
-
-def draw_separator_line():
-    try:
-        width = os.get_terminal_size().columns / 5
-        print(" " * floor(width)  + "\u2014" * 3 * floor(width) + " " * floor(width) + "\n")
-    except:
-        # we might end up here if we can't get the terminal size. In this case, just draw a line
-        # with a hard-coded length
-        width = 50
-        print("\u2014" * width + "\n")
-
-def write_anndata_with_object_cols(adata: AnnData, data_dir: str, h5ad_file: str, cleanup:bool = False) -> None:
+def write_anndata_with_object_cols(adata: AnnData, data_dir: str, h5ad_file: str, cleanup:bool = False, profile: Optional[str] = None) -> List[str]:
     # There can be some BCR-/TCR- columns that have dtype "object" due to being all NaN, thus causing
     # the write to fail. We replace them with 'nan'. Note this isn't ideal, however, since some of those
     # columns can be non-string types (e.g. they can be integer counts), but is something we can handle
@@ -250,8 +74,37 @@ def write_anndata_with_object_cols(adata: AnnData, data_dir: str, h5ad_file: str
         except Exception as e:
             print(Exception)
             pass
-    adata.write(os.path.join(data_dir,h5ad_file), compression="lzf")
-        
+    # profile is the name of the storage profile of the h5ad file (see h5ad_writer.py); None for the one set by IA_H5AD_PROFILE
+    write_h5ad(adata, os.path.join(data_dir,h5ad_file), profile)
+    # returns the files that were written (relative to data_dir), i.e. the files to upload
+    if not zarr_output_enabled():
+        return [h5ad_file]
+    write_zarr(adata, os.path.join(data_dir, zarr_file_name(h5ad_file)))
+    return [h5ad_file] + list_zarr_files(data_dir, zarr_file_name(h5ad_file))
+
+def write_anndata_with_cleanup(adata: AnnData, data_dir: str, h5ad_file: str, cleanup_h5ad_file: str, profile: Optional[str] = None) -> List[str]:
+    # Writes adata to h5ad_file and its cleaned-up version (see cleanup_adata) to cleanup_h5ad_file, serializing and compressing the
+    # large arrays once: X, the layers and the embeddings of cleanup_h5ad_file are copied from h5ad_file chunk by chunk (see
+    # h5ad_writer.write_h5ad_with_copies), so only the obs, obsm data frames and uns of the cleaned-up version are serialized again.
+    # Both files are complete h5ad files. adata itself is not cleaned up.
+    output_files = write_anndata_with_object_cols(adata, data_dir, h5ad_file, profile=profile)
+    cleaned = AnnData(obs = adata.obs.copy(), var = adata.var, uns = dict(adata.uns), varm = adata.varm, obsp = adata.obsp,
+        obsm = {k: v.copy() if isinstance(v, pd.DataFrame) else v for k, v in adata.obsm.items()})
+    try:
+        cleanup_adata(cleaned)
+    except Exception as e:
+        print(Exception)
+        pass
+    # the arrays of obsm are not changed by the cleanup, unlike its data frames
+    copied_obsm = [k for k in cleaned.obsm.keys() if k in adata.obsm.keys() and not isinstance(cleaned.obsm[k], pd.DataFrame)]
+    write_h5ad_with_copies(cleaned, os.path.join(data_dir, cleanup_h5ad_file), os.path.join(data_dir, h5ad_file), copied_obsm, profile)
+    if not zarr_output_enabled():
+        return output_files + [cleanup_h5ad_file]
+    cleaned = AnnData(X = adata.X, layers = adata.layers, obs = cleaned.obs, var = cleaned.var, uns = cleaned.uns, obsm = cleaned.obsm,
+        varm = cleaned.varm)
+    write_zarr(cleaned, os.path.join(data_dir, zarr_file_name(cleanup_h5ad_file)))
+    return output_files + [cleanup_h5ad_file] + list_zarr_files(data_dir, zarr_file_name(cleanup_h5ad_file))
+
 def cleanup_adata(adata: AnnData) -> None:
     dir_path = os.path.dirname(os.path.realpath(__file__))
     with open(os.path.join(dir_path, "rename_dictionaries.json"), 'r') as j:
@@ -307,7 +160,9 @@ def run_model(
         data_dir: str,
         logger: Type[BaseLogger],
         latent_key: str = None,
-        max_retry_count: int = 0
+        max_retry_count: int = 0,
+        reference_h5ad_file: str = None,
+        reference_layer: str = None
     ):
     """
     Wrapper for `_run_model_impl` that retries the call up to `max_retry_count` times
@@ -325,7 +180,9 @@ def run_model(
                 version,
                 data_dir,
                 logger,
-                latent_key
+                latent_key,
+                reference_h5ad_file,
+                reference_layer
             )
         except Exception as err:
             n_tries += 1
@@ -370,7 +227,9 @@ def _run_model_impl(
         version: str,
         data_dir: str,
         logger: Type[BaseLogger],
-        latent_key: str = None
+        latent_key: str = None,
+        reference_h5ad_file: str = None,
+        reference_layer: str = None
     ):
     """
     Runs scvi or totalvi model depending on the given model_name.
@@ -397,6 +256,11 @@ def _run_model_impl(
         Logger object to use when adding logs.
 	latent_key
 		key to be used for saving the latent representation in adata.obsm.
+    reference_h5ad_file
+        Name of the h5ad file (written to data_dir by the caller) that holds the cells the model is trained on; the model
+        artifact references it instead of holding a copy of the data (see model_artifacts.py).
+    reference_layer
+        The layer of reference_h5ad_file with the counts the model is trained on (X if None).
 
     Returns
     -------
@@ -434,31 +298,67 @@ def _run_model_impl(
     if latent_key is None:
         latent_key = "X_scVI" if model_name=="scvi" else "X_totalVI"
     adata.obsm[latent_key] = latent
-    model_file = "{}.{}.{}_model_batch_key_{}.zip".format(prefix, version, model_name, batch_key)
+    model_file = get_model_file_name(prefix, version, model_name, batch_key)
     logger.add_to_log("Saving the model into {}...".format(model_file))
     model_file_path = os.path.join(data_dir, model_file)
     model_dir_path = os.path.join(data_dir,"{}.{}_model_batch_key_{}/".format(prefix, model_name, batch_key))
-    model.save(model_dir_path, overwrite=True)
-    # save the data used for fitting the model; this is useful for applying reference-based integration on query data later on (based on the current model and data).
-    if adata.n_obs < 200000: # Reduce disk foot print of models.
-        logger.add_to_log("Saving the data used for fitting the model...")
-        data_file = "{}.{}.{}_model_batch_key_{}.data.h5ad".format(prefix, version, model_name, batch_key)
-        adata_copy = adata.copy()
-        write_anndata_with_object_cols(adata_copy, model_dir_path, data_file)
-    # zip the dir with all the model outputs
-    zipf = zipfile.ZipFile(model_file_path, 'w', zipfile.ZIP_DEFLATED)
-    zipdir(model_dir_path, zipf)
-    zipf.close()
+    # the data used for fitting the model (useful for applying reference-based integration on query data later on) is referenced
+    # by the model artifact rather than copied into it
+    reduced_precision = "reduced_precision_model_weights" in configs and configs["reduced_precision_model_weights"] == "True"
+    save_model_artifact(model, model_file_path, model_dir_path, model_name, batch_key, reference_h5ad_file, reference_layer,
+        protein_expression_obsm_key, reduced_precision)
     return model, model_file
 
-def aws_sync(source: str, target: str, include: str, logger: Type[BaseLogger], do_log: bool = True) -> None:
-    sync_cmd = 'aws s3 cp --recursive --no-progress {} {} --exclude "*" --include "{}"'.format(source, target, include)
-    if do_log:
-        logger.add_to_log("syncing {}...".format(include))
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    aws_response = os.popen(sync_cmd).read()
-    if do_log:
-        logger.add_to_log("aws response: {}\n".format(aws_response))
+def get_model_file_name(prefix: str, version: str, model_name: str, batch_key: str) -> str:
+    return "{}.{}.{}_model_batch_key_{}.zip".format(prefix, version, model_name, batch_key)
+
+# the configs that _run_model_impl reads
+MODEL_CONFIG_KEYS = ["use_layer_norm", "use_batch_norm", "gene_likelihood", "n_layers", "n_latent", "empirical_protein_background_prior",
+    "scvi_max_epochs", "totalvi_max_epochs", "lr", "early_stopping", "train_size", "early_stopping_patience", "batch_size",
+    "limit_train_batches", "n_epochs_kl_warmup", "reduce_lr_on_plateau", "reduced_precision_model_weights"]
+
+def run_model_with_checkpoint(
+        checkpoints: StageCheckpoints,
+        inputs: dict,
+        adata: AnnData,
+        configs: dict,
+        batch_key: str,
+        protein_expression_obsm_key: str,
+        model_name: str,
+        prefix: str,
+        version: str,
+        data_dir: str,
+        logger: Type[BaseLogger],
+        latent_key: str = None,
+        max_retry_count: int = 0,
+        reference_h5ad_file: str = None,
+        reference_layer: str = None
+    ) -> str:
+    """
+    Runs `run_model` as a stage (see checkpoints.py) whose inputs are the given inputs (the stages or the data that adata
+    was derived from) and the configs in MODEL_CONFIG_KEYS. If the stage is restored from its checkpoint then the latent
+    representation and the obs columns added when setting up adata are restored into adata and the model file into data_dir,
+    without training the model. Returns the name of the model file.
+    """
+    if latent_key is None:
+        latent_key = "X_scVI" if model_name=="scvi" else "X_totalVI"
+    model_file = get_model_file_name(prefix, version, model_name, batch_key)
+    stage = checkpoints.stage("{}_batch_key_{}".format(model_name, batch_key), dict(inputs, batch_key=batch_key,
+        protein_expression_obsm_key=protein_expression_obsm_key, latent_key=latent_key), configs, MODEL_CONFIG_KEYS)
+    if stage.restored:
+        adata.obsm[latent_key] = stage.values["latent"]
+        for col in stage.values["obs"]:
+            adata.obs[col] = stage.values["obs"][col]
+        stage.restore_file("model", os.path.join(data_dir, model_file))
+        # the artifact of another configs version references the h5ad file of that version
+        set_artifact_reference(os.path.join(data_dir, model_file), reference_h5ad_file, reference_layer)
+        return model_file
+    obs_columns = set(adata.obs.columns)
+    _, model_file = run_model(adata, configs, batch_key, protein_expression_obsm_key, model_name, prefix, version, data_dir, stage,
+        latent_key, max_retry_count, reference_h5ad_file, reference_layer)
+    stage.save({"latent": adata.obsm[latent_key], "obs": {col: adata.obs[col] for col in adata.obs.columns
+        if col not in obs_columns or col.startswith("_scvi")}}, files={"model": os.path.join(data_dir, model_file)})
+    return model_file
 
 def filter_vdj_genes(rna: AnnData, aws_file_path: str, data_dir: str, logger: Type[BaseLogger]) -> AnnData:
     file_path_components = aws_file_path.split("/")
@@ -501,50 +401,13 @@ def get_internal_protein_names(df):
         if df.shape[1] == protein_panel.shape[0]:
             return protein_panel["internal_name"]
 
-def dir_and_files_exist(dir_name: str, file_names: List[str]) -> bool:
-    exists = os.path.isdir(dir_name)
-    if exists:
-        for fn in file_names:
-            if not os.path.isfile(fn):
-                exists = False
-                break
-    return exists
-
 def is_immune_type(df: pd.DataFrame) -> pd.DataFrame:
     known_immune_types = ["ILC", "T cells", "B cells", "monocytes", "Monocytes", "Macrophages", "macrophages", "NK cells", "T\(", "Mast cells", "Treg\(diff\)", "DC"]
     return df.isin(known_immune_types)
 
-def strip_integration_markers(barcode: str, valid_libs: List[str] = None) -> str:
-    # for example from "AACTGTCAAGTCGT-1_CZI-IA11512684-1-2-10" returns "AACTGTCAAGTCGT-1_CZI-IA11512684"
-    # Note this function assumes that the library id encoded in the barcode is of the form xxx-yyy (for example "CZI-IA11512684"),
-    # otherwise, the behavior is undefined
-    parts = barcode.split("_")
-    cell_barcode = parts[0]
-    lib_id_plus_integration_markers = parts[1].split("-")
-    lib_id = "-".join([lib_id_plus_integration_markers[0], lib_id_plus_integration_markers[1]])
-    if valid_libs is not None and lib_id not in valid_libs:
-        raise ValueError(f"lib_id {lib_id} is not a valid library. Are you sure your barcode {barcode} contains a lib_id of the form xxx-yyy?")
-    return "_".join([cell_barcode, lib_id])
    
 def get_all_libs(lib_type: str, donor_id: Optional[str] = None) -> set:
-    if lib_type not in ["GEX", "BCR", "TCR"]:
-        raise ValueError("Unsupported lib_type: {}. Must be one of: GEX, BCR, TCR".format(lib_type))
-    all_libs = set()
-    samples = read_immune_aging_sheet("Samples")
-    column_name = "{} lib".format(lib_type)
-    libs_all = samples[column_name] if donor_id is None else samples[samples["Donor ID"] == donor_id][column_name]
-    for i in range(len(libs_all)):
-        if libs_all.iloc[i] is np.nan:
-            continue
-        libs = libs_all.iloc[i].split(",")
-        all_libs.update(libs)
-    return all_libs
-
-def get_all_donors() -> dict:
-    samples = read_immune_aging_sheet("Samples")
-    df = samples[["Donor ID", "Seq run"]].astype("str")
-    donor_to_seq = df.drop_duplicates().to_dict(orient="records")
-    return donor_to_seq
+    return get_sample_metadata_index().get_libs(lib_type, donor_id)
 
 def extend_removed_features_df(adata, obsm_key, exclude_df):
     if obsm_key not in adata.obsm:
@@ -561,66 +424,6 @@ def extend_removed_features_df(adata, obsm_key, exclude_df):
             suffixes=("_left_merged", "_right_merged")
         )
 
-# Utility function to rename TLN folders and files to LLN on S3
-# as a consequence of renaming these samples in our IA Sample spreadsheet
-def handle_sample_tln_to_lln_renaming(donor_id: str, delete_lln: bool = False):
-    path_prefix = "s3://immuneaging/processed_samples/"
-    def get_tln_lln_folders():
-        ls_cmd = 'aws s3 ls {}'.format(path_prefix)
-        files = os.popen(ls_cmd).read()
-        lln_folders, tln_folders = [], []
-        for f in files.rstrip().split('\n'):
-            folder_name = f.split('PRE ')[-1]
-            if folder_name.startswith(donor_id + "-LLN"):
-                lln_folders.append(folder_name)
-            elif folder_name.startswith(donor_id + "-TLN"):
-                tln_folders.append(folder_name)
-        return lln_folders, tln_folders
-    lln_folders, tln_folders = get_tln_lln_folders()
-    if len(lln_folders) > 0:
-        if delete_lln:
-            for lf in lln_folders:
-                ls_cmd = 'aws s3 rm --recursive {}'.format(path_prefix+lf)
-                os.popen(ls_cmd).read()
-        else:
-            print("LLN folder(s) present: {}".format(", ".join(lln_folders)))
-            return
-    if len(tln_folders) > 0:
-        for tf in tln_folders:
-            dest = tf.replace("TLN", "LLN")
-            ls_cmd = 'aws s3 mv --recursive {} {}'.format(path_prefix+tf, path_prefix+dest)
-            os.popen(ls_cmd).read()
-    # rename TLN to LLN in file names
-    lln_folders, _ = get_tln_lln_folders()
-    for lf in lln_folders:
-        ls_cmd = 'aws s3 ls --recursive {}'.format(path_prefix+lf)
-        files = os.popen(ls_cmd).read()
-        for f in files.rstrip().split('\n'):
-            dir_name = f.split(' ')[-1]
-            file_name = dir_name.split('/')[-1]
-            dir_name_no_file_name = dir_name.removesuffix(file_name)
-            new_file_name = file_name.replace("TLN", "LLN")
-            ia_path = "s3://immuneaging/"
-            ls_cmd = 'aws s3 mv {} {}'.format(ia_path+dir_name, ia_path+dir_name_no_file_name+new_file_name)
-            print(ls_cmd)
-            os.popen(ls_cmd).read()
-
-def read_csv_from_aws(
-        data_dir: str,
-        aws_dir: str,
-        aws_filename: str,
-        logger: Type[BaseLogger],
-    ):
-    sync_cmd = 'aws s3 sync --no-progress {} {} --exclude "*" --include {}'.format(aws_dir, data_dir, aws_filename)
-    logger.add_to_log("sync_cmd: {}".format(sync_cmd))
-    logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
-    file_path = os.path.join(data_dir, aws_filename)
-    if not os.path.isfile(file_path):
-        msg = "Failed to download file {} from S3.".format(aws_filename)
-        logger.add_to_log(msg, level="error")
-        raise ValueError(msg)
-    return pd.read_csv(file_path)
-
 # detects which datapoints in x have extreme values (does not count missing data as outliers)
 def detect_outliers(x, num_sds):
     # a value is considered as an outlier if it is more extreme that the mean plus (or minus) num_sds times the standard deviation
@@ -643,6 +446,44 @@ def find_abundant_labels(labels, frac):
             labels_include.append(l)
     return labels_include
 
+def majority_vote(predicted_labels: pd.Series, over_clustering, min_prop: float = 0) -> pd.Series:
+    # same as the majority voting of celltypist (every cluster gets its most frequent predicted label, ties broken by label order),
+    # with the votes counted in a sparse clusters x labels matrix rather than a crosstab
+    labels = pd.Categorical(predicted_labels.values)
+    clusters = pd.Categorical(np.asarray(over_clustering))
+    votes = scipy.sparse.coo_matrix((np.ones(len(labels)), (clusters.codes, labels.codes)),
+        shape=(len(clusters.categories), len(labels.categories))).tocsr().toarray()
+    majority = np.asarray(labels.categories.astype(str))[votes.argmax(axis=1)].astype(object)
+    majority[votes.max(axis=1) / np.maximum(votes.sum(axis=1), 1) < min_prop] = "Heterogeneous"
+    return pd.Series(majority[clusters.codes], index=predicted_labels.index).astype("category")
+
+def subset_celltypist_predictions(predictions, cells: np.ndarray):
+    # celltypist predictions (an AnnotationResult) of a subset of the cells, given as a boolean mask
+    subset = copy.copy(predictions)
+    subset.predicted_labels = predictions.predicted_labels[cells]
+    subset.decision_matrix = predictions.decision_matrix[cells]
+    subset.probability_matrix = predictions.probability_matrix[cells]
+    subset.adata = predictions.adata[cells]
+    if hasattr(predictions, "cell_count"):
+        subset.cell_count = int(np.sum(cells))
+    return subset
+
+def get_celltypist_model(model_url: str, model_path: str, logger: Optional[Type[BaseLogger]] = None):
+    """
+    Returns the celltypist model at model_url (an https or s3 url), which is downloaded into model_path (unless it is there already)
+    and loaded once per process; the jobs of a warm worker (see warm_worker.py) get it from the worker, loaded already.
+    """
+    def load():
+        if not os.path.isfile(model_path):
+            if logger is not None:
+                logger.add_to_log("Downloading the celltypist model {}...".format(model_url))
+            if model_url.startswith("s3://"):
+                s3_cp(model_url, model_path)
+            else:
+                urllib.request.urlretrieve(model_url, model_path)
+        return celltypist.models.Model.load(model = model_path)
+    return get_resident(("celltypist_model", model_url), load)
+
 def annotate(
     adata,
     model_paths,
@@ -660,21 +501,36 @@ def annotate(
     sc.pp.normalize_total(adata_new, target_sum=1e4)
     sc.pp.log1p(adata_new)
     dotplot_paths = []
+    # the neighborhood graph does not depend on the resolution, so compute it once and cluster with all the resolutions on top of it
+    logger.add_to_log("Computing the neighborhood graph...")
+    start = time.time()
+    sc.pp.neighbors(adata_new, n_neighbors = n_neighbors, use_rep = components_key, key_added = neighbors_key)
+    logger.add_to_log("Computing the neighborhood graph took {:.2f} seconds.".format(time.time() - start))
+    logger.add_to_log("Running Leiden clustering using resolutions {0}...".format(resolutions))
+    leiden_labels = leiden_sweep(adata_new, resolutions, neighbors_key, logger)
+    # the celltypist predictions (per cell) do not depend on the clustering, so predict once per model; only the majority voting
+    # and the dotplots are redone for every resolution, using the cached predictions
+    model_predictions = []
+    abundant_cells = []
+    for m in range(len(model_paths)):
+        logger.add_to_log("Running CellTypist annotation using model {0}...".format(model_paths[m]))
+        predictions = celltypist.annotate(adata_new, model = get_celltypist_model(model_urls[m], model_paths[m], logger), majority_voting = False)
+        model_predictions.append(predictions)
+        abundant_cell_types = find_abundant_labels(labels = predictions.predicted_labels["predicted_labels"], frac = dotplot_min_frac)
+        abundant_cells.append(predictions.predicted_labels["predicted_labels"].isin(abundant_cell_types).values)
     for r in range(len(resolutions)):
         resolution = resolutions[r]
-        logger.add_to_log("Running Leiden clustering using resolution={0}...".format(resolution))
-        sc.pp.neighbors(adata_new, n_neighbors = n_neighbors, use_rep = components_key, key_added = neighbors_key)
-        sc.tl.leiden(adata_new, resolution = resolution, key_added='leiden', neighbors_key = neighbors_key, n_iterations=2)
+        adata_new.obs["leiden"] = leiden_labels[resolution]
         # save the leiden clusters and majority voting results in the original anndata
         leiden_key_added = f"{model_name}.leiden_resolution_{str(resolution)}"
         adata.obs[leiden_key_added] = adata_new.obs["leiden"]
         for m in range(len(model_paths)):
             celltypist_model_name = model_urls[m].split("/")[-1].split(".")[0]
             model_path = model_paths[m]
-            logger.add_to_log("Running CellTypist annotation using model {0}...".format(model_path))
-            predictions = celltypist.annotate(adata_new, model = model_path, majority_voting = True, over_clustering = 'leiden')
-            logger.add_to_log("Saving CellTypist outputs for model {0}...".format(model_path))
-            adata.obs["celltypist_majority_voting.{0}.{1}.leiden_resolution_{2}".format(celltypist_model_name, model_name, str(resolution))] = predictions.predicted_labels["majority_voting"]
+            predictions = model_predictions[m]
+            logger.add_to_log("Saving CellTypist outputs for model {0} and resolution={1}...".format(model_path, resolution))
+            adata.obs["celltypist_majority_voting.{0}.{1}.leiden_resolution_{2}".format(celltypist_model_name, model_name, str(resolution))] = majority_vote(
+                predictions.predicted_labels["predicted_labels"], adata_new.obs["leiden"])
             if r == 0 and save_all_outputs:
                 # save the rest of the outputs; these outputs do not change with different leiden resolution so should save only once
                 adata.obs["celltypist_model_url.{0}".format(celltypist_model_name)] = model_urls[m]
@@ -682,15 +538,8 @@ def annotate(
                 adata.obsm["celltypist_probability_matrix.{0}".format(celltypist_model_name)] = predictions.probability_matrix
             # generate and save a dotplot only for the abundant cell types
             logger.add_to_log("Generating a dotplot based on the CellTypist outputs...")
-            abundant_cell_types = find_abundant_labels(labels = predictions.predicted_labels["predicted_labels"], frac = dotplot_min_frac)
-            dotplot_predictions = celltypist.annotate(
-                adata_new[predictions.predicted_labels["predicted_labels"].isin(abundant_cell_types),:].copy(),
-                model = model_path,
-                majority_voting = True,
-                over_clustering = 'leiden'
-            )
             celltypist.dotplot(
-                dotplot_predictions,
+                subset_celltypist_predictions(predictions, abundant_cells[m]),
                 use_as_reference = 'leiden',
                 use_as_prediction = 'predicted_labels',
                 show = False,
@@ -708,21 +557,38 @@ def annotate(
     return dotplot_paths
 
 def get_donor_id_for_lib(library_type, library_id, samples=None):
-    if library_type not in ["GEX", "BCR", "TCR"]:
-        raise ValueError("Unsupported lib_type: {}. Must be one of: GEX, BCR, TCR".format(library_type))
-    if samples is None:
-        samples = read_immune_aging_sheet("Samples")
-    column_name = "{} lib".format(library_type)
-    donor_id_col_name = "Donor ID"
-    libs_all = samples[[column_name, donor_id_col_name]]
-    for i in range(len(libs_all)):
-        if libs_all.loc[i, column_name] is np.nan:
-            continue
-        libs = libs_all.loc[i, column_name].split(",")
-        if library_id in libs:
-            # found it
-            return libs_all.loc[i, donor_id_col_name]
-    return ""
+    return get_sample_metadata_index(samples).get_donor_id(library_type, library_id)
+
+def get_sample_metadata_index(samples=None) -> SampleMetadataIndex:
+    # lookup tables (library -> donor, library -> samples, vdj library -> gex library, etc.) over the Samples tab; see sample_metadata.py
+    if samples is not None:
+        return index_samples(samples)
+    # the tab is read (and the tables rebuilt) only if it was not read yet, expired or was downloaded again since the tables were built
+    index = get_cached_index(get_sheet_version("Samples"))
+    if index is not None:
+        return index
+    samples = read_immune_aging_sheet("Samples")
+    return index_samples(samples, key=get_sheet_version("Samples"))
+
+def get_library_h5ad_path(library_type, library_id, s3_access_file, stage, seq_run, donor_id):
+    # returns the (s3 dir, file name) of the h5ad file of the given library at the given stage ("processed" or "aligned"); the
+    # latest version is looked up on S3 rather than in the listing index, which may not have the versions written by other nodes yet
+    if stage == "processed":
+        file_name_partial = "{}_{}_{}_{}".format(donor_id, seq_run, library_type, library_id)
+        s3_processed_lib_path = "s3://immuneaging/processed_libraries/{}".format(file_name_partial)
+        version = get_latest_object_version(s3_access_file, s3_processed_lib_path, max_age=0)
+        file_name = "{}.processed.{}.h5ad".format(file_name_partial, version)
+        s3_dir = "{}/{}/".format(s3_processed_lib_path, version)
+    elif stage == "aligned":
+        if library_type != "GEX":
+            raise NotImplementedError()
+        file_name_partial = "{}_{}.{}".format(donor_id, seq_run, library_id)
+        s3_aligned_lib_path = "s3://immuneaging/aligned_libraries"
+        folder_name = "{}_{}_{}_{}".format(donor_id, seq_run, library_type, library_id)
+        version = get_latest_object_version(s3_access_file, s3_aligned_lib_path, folder_name=folder_name, max_age=0)
+        file_name = "{}.{}.h5ad".format(file_name_partial, version)
+        s3_dir = "{}/{}/{}".format(s3_aligned_lib_path, version, folder_name)
+    return s3_dir, file_name
 
 def read_library(library_type, library_id, s3_access_file, working_dir, stage, logger, remove_adata=True, samples=None, donor_id=None):
     if donor_id is None:
@@ -731,33 +597,13 @@ def read_library(library_type, library_id, s3_access_file, working_dir, stage, l
     # at this layer. Almost all donors have 001 as the seq run, but a few
     # have 002 or 003 so try for those too
     for seq_run in ["001", "002", "003"]:
-        if stage == "processed":
-            file_name_partial = "{}_{}_{}_{}".format(donor_id, seq_run, library_type, library_id)
-            s3_processed_lib_path = "s3://immuneaging/processed_libraries/{}".format(file_name_partial)
-            version = get_latest_object_version(s3_access_file, s3_processed_lib_path)
-            file_name = "{}.processed.{}.h5ad".format(file_name_partial, version)
-            sync_cmd = 'aws s3 sync --no-progress {}/{}/ {} --exclude "*" --include {}'.format(
-                s3_processed_lib_path, version, working_dir, file_name
-            )
-        elif stage == "aligned":
-            if library_type != "GEX":
-                raise NotImplementedError()
-            file_name_partial = "{}_{}.{}".format(donor_id, seq_run, library_id)
-            s3_aligned_lib_path = "s3://immuneaging/aligned_libraries"
-            folder_name = "{}_{}_{}_{}".format(donor_id, seq_run, library_type, library_id)
-            version = get_latest_object_version(s3_access_file, s3_aligned_lib_path, folder_name=folder_name)
-            file_name = "{}.{}.h5ad".format(file_name_partial, version)
-            sync_cmd = 'aws s3 sync --no-progress {}/{}/{} {} --exclude "*" --include {}'.format(
-                s3_aligned_lib_path, version, folder_name, working_dir, file_name
-            )
-
-        logger.add_to_log("sync_cmd: {}".format(sync_cmd))
+        s3_dir, file_name = get_library_h5ad_path(library_type, library_id, s3_access_file, stage, seq_run, donor_id)
         adata_file = os.path.join(working_dir, file_name)
         if os.path.isfile(adata_file):
             logger.add_to_log(f"file {adata_file} already downloaded, skipping download")
             break
 
-        logger.add_to_log("aws response: {}\n".format(os.popen(sync_cmd).read()))
+        aws_sync(s3_dir, working_dir, file_name, logger, only_if_changed=True)
         if not os.path.isfile(adata_file):
             logger.add_to_log("Failed to download file {} from S3 using seq_run: {}".format(file_name, seq_run))
         else:
@@ -772,18 +618,18 @@ def read_library(library_type, library_id, s3_access_file, working_dir, stage, l
         os.remove(adata_file)
     return adata
 
-def get_tissues_or_compartments(s3_access_file: str, tissue_or_compartment: str, skip_tissues: Optional[List[str]] = None):
-    assert tissue_or_compartment in ["tissue", "compartment"]
-    set_access_keys(s3_access_file)
-    samples = read_immune_aging_sheet("Samples")
-    tissues_or_compartments = []
-    if tissue_or_compartment == "tissue":
-        tissues_or_compartments = np.unique(samples["Organ"][np.logical_not(pd.isnull(samples["Organ"]))])
-        if skip_tissues is not None:
-            tissues_or_compartments = [t for t in tissues_or_compartments if t not in skip_tissues]
-    else:
-        tissues_or_compartments = ["T", "B", "Myeloid", "Other"]
-    return tissues_or_compartments
+def open_library(library_type, library_id, s3_access_file, stage, logger, samples=None, donor_id=None) -> Optional[H5adReader]:
+    # same as read_library but returns a lazy reader of the h5ad file on S3 (see h5ad_reader.py) instead of downloading and reading all of it
+    if donor_id is None:
+        donor_id = get_donor_id_for_lib(library_type, library_id, samples)
+    for seq_run in ["001", "002", "003"]:
+        s3_dir, file_name = get_library_h5ad_path(library_type, library_id, s3_access_file, stage, seq_run, donor_id)
+        s3_path = s3_dir.rstrip("/") + "/" + file_name
+        if s3_exists(s3_path):
+            return H5adReader(s3_path)
+        logger.add_to_log("File {} not found on S3 using seq_run: {}".format(file_name, seq_run))
+    logger.add_to_log("Failed to find file {} on S3.".format(file_name))
+    return None
 
 def add_annotations_to_adata(
     adata: AnnData,
@@ -825,25 +671,5 @@ def get_cluster_wise_cell_type_overview(adata: AnnData, ct_key: str, leiden_key:
 
     return df
 
-def percolate_observation(adata, overclustering_key, score_key, exclude_high=True, qval=0.1, threshold=None):
-    def grouped_threshold(x, threshold):
-        if isinstance(threshold, str):
-            return np.mean(x==threshold)
-        elif threshold is not None:
-            return np.mean(x>threshold)
-        else:
-            return np.median(x)
-    df = adata.obs.groupby(overclustering_key).agg({score_key: lambda x: grouped_threshold(x, threshold)})
-    for cluster in df.index:
-        adata.obs.loc[adata.obs[overclustering_key] == cluster, f'{score_key}_median_cluster_scores'] = df.loc[cluster, score_key]
-    med = adata.obs[f'{score_key}_median_cluster_scores'][adata.obs[f'{score_key}_median_cluster_scores']>0].median()
-    mad = 0.03 + np.median(abs(adata.obs[f'{score_key}_median_cluster_scores'][adata.obs[f'{score_key}_median_cluster_scores'] < med] - med))
-    if exclude_high:
-        pvals = 1 - norm.cdf(adata.obs[f'{score_key}_median_cluster_scores'], loc = med, scale = 1.4826*mad)
-    else:
-        pvals = norm.cdf(adata.obs[f'{score_key}_median_cluster_scores'], loc = med, scale = 1.4826*mad)
-    adata.obs[f'{score_key}_bh_pval'] = multitest.fdrcorrection(pvals, alpha=qval)[1]
-    adata.obs[f'{score_key}_percolation'] = adata.obs[f'{score_key}_bh_pval'] < qval
-    
 def softmax(x):
     return(np.exp(x)/np.sum(np.exp(x.values), axis=1, keepdims=True))
\ No newline at end of file
@@ -14,32 +14,8 @@ from logger import SimpleLogger
 def get_vdj_lib_to_gex_lib_mapping(samples=None):
     # Returns a mapping of all vdj libraries to their corresponding gex libraries
     # in the form of two dictionaries, one for bcr libs and one for tcr libs
-    if samples is None:
-        samples = read_immune_aging_sheet("Samples")
-
-    def add_lib(lib_type: str, all_libs: dict) -> None:
-        if lib_type not in ["BCR", "TCR"]:
-            raise ValueError("Unsupported lib_type: {}. Must be one of: BCR, TCR".format(lib_type))
-        column_name = "{} lib".format(lib_type)
-        libs_all = samples[column_name]
-        gex_libs_all = samples["GEX lib"]
-        for i in range(len(libs_all)):
-            if libs_all.iloc[i] is np.nan:
-                continue
-            libs = libs_all.iloc[i].split(",")
-            gex_libs = gex_libs_all.iloc[i].split(",")
-            for j in range(len(libs)):
-                lib = libs[j]
-                corresponding_gex_lib = gex_libs[j]
-                all_libs[lib] = corresponding_gex_lib
-
-    all_bcr_libs = {}
-    add_lib("BCR", all_bcr_libs)
-
-    all_tcr_libs = {}
-    add_lib("TCR", all_tcr_libs)
-
-    return all_bcr_libs, all_tcr_libs
+    index = get_sample_metadata_index(samples)
+    return index.get_vdj_lib_to_gex_lib("BCR"), index.get_vdj_lib_to_gex_lib("TCR")
 
 def get_gex_lib_to_vdj_lib_mapping():
     bcr_to_gex, tcr_to_gex = get_vdj_lib_to_gex_lib_mapping()
@@ -78,17 +54,15 @@ def report_vdj_vs_cell_label_metrics_all_libs(ir_lib_type: str, tissue_adatas: L
     if ir_lib_type not in ["BCR", "TCR"]:
         raise ValueError("Unsupported lib_type: {}. Must be one of: BCR, TCR".format(ir_lib_type))
     is_b = ir_lib_type == "BCR"
-    ir_libs = list(get_vdj_lib_to_gex_lib_mapping()[0 if is_b else 1].keys())
-    samples = read_immune_aging_sheet("Samples")
+    index = get_sample_metadata_index()
+    ir_libs = list(index.get_vdj_lib_to_gex_lib(ir_lib_type).keys())
     first = True
     for lib in ir_libs:
         # get some other metadata associated with this lib
-        col_name = "{} lib".format(ir_lib_type)
-        samples["Pick?"] = samples[col_name].fillna('').apply(lambda x: "Yes" if lib in x.split(",") else "No")
-        idx = samples["Pick?"] == "Yes"
-        sites = samples[idx]["Site"]
-        donors = samples[idx]["Donor ID"]
-        organs = set(samples[idx]["Organ"])
+        lib_samples = index.get_lib_samples(ir_lib_type, lib)
+        sites = lib_samples["Site"]
+        donors = lib_samples["Donor ID"]
+        organs = set(lib_samples["Organ"])
         if len(set(sites)) > 1:
             raise ValueError("More than one site was found for lib id {} of type {}".format(lib, ir_lib_type))
         if len(set(donors)) > 1:
@@ -386,30 +360,22 @@ def gather_extra_info_for_ir_libs(
             # at this layer. Almost all donors have 001 as the seq run, but a few
             # have 002 or 003 so try for those too
             for seq_run in ["001", "002", "003"]:
-                file_name_partial = "{}_{}_{}_{}".format(donor_id, seq_run, library_type, library_id)
-                s3_processed_lib_path = "s3://immuneaging/processed_libraries/{}".format(file_name_partial)
-                version = get_latest_object_version(s3_access_file, s3_processed_lib_path)
-                file_name = "{}.processed.{}.h5ad".format(file_name_partial, version)
-                sync_cmd = 'aws s3 sync --no-progress {}/{}/ {} --exclude "*" --include {}'.format(
-                    s3_processed_lib_path, version, working_dir, file_name
-                )
-
-                print("sync_cmd: {}".format(sync_cmd))
-                print("aws response: {}\n".format(os.popen(sync_cmd).read()))
-                adata_file = os.path.join(working_dir, file_name)
-                if not os.path.isfile(adata_file):
-                    print("Failed to download file {} from S3 using seq_run: {}".format(file_name, seq_run))
+                s3_dir, file_name = get_library_h5ad_path(library_type, library_id, s3_access_file, "processed", seq_run, donor_id)
+                s3_path = s3_dir + file_name
+                found = s3_exists(s3_path)
+                if not found:
+                    print("File {} not found on S3 using seq_run: {}".format(file_name, seq_run))
                 else:
                     break # don't need to try the other seq runs
             
             col_name = CSV_HEADER_NUM_CELLS_POST_QC if library_type != "GEX" else CSV_HEADER_NUM_GEX_CELLS_POST_QC
-            if not os.path.isfile(adata_file):
-                print("Failed to download file {} from S3.".format(file_name, seq_run))
+            if not found:
+                print("Failed to find file {} on S3.".format(file_name))
                 row[col_name] = -1
             else:
-                adata = anndata.read_h5ad(adata_file)
-                row[col_name] = adata.n_obs
-                os.remove(adata_file)
+                # only the number of cells is needed; read it from the metadata of the file rather than downloading the file
+                with H5adReader(s3_path) as reader:
+                    row[col_name] = reader.n_obs
 
         add_info_from_processed_lib_object(lib_type, lib)
         add_info_from_processed_lib_object("GEX", gex_lib)
@@ -436,28 +402,27 @@ def get_ir_gex_intersection(
     log_file_path = f"{log_file_dir}/vdj_seq_sat_logs_{unique_artifact_prefix}.log"
     logger = SimpleLogger(filename = log_file_path)
 
-    irs = get_vdj_lib_to_gex_lib_mapping()[0 if ir_type == "BCR" else 1]
+    index = get_sample_metadata_index()
+    irs = index.get_vdj_lib_to_gex_lib(ir_type)
     df = pd.DataFrame(columns=["donor_id", "ir_type", "ir_lib", "gex_lib", "ir_gex_diff_pct", "ir_gex_pre_qc_diff_pct"])
-    samples = read_immune_aging_sheet("Samples")
 
     for ir_id,gex_id in irs.items():
-        donor_id = get_donor_id_for_lib(ir_type, ir_id, samples)
+        donor_id = index.get_donor_id(ir_type, ir_id)
         if only_donors is not None and donor_id not in only_donors:
             continue
-        adata_ir = read_library(ir_type, ir_id, s3_access_file, working_dir, "processed", logger, remove_adata=False, donor_id=donor_id)
-        adata_gex = read_library("GEX", gex_id, s3_access_file, working_dir, "processed", logger, remove_adata=False, donor_id=donor_id)
-        adata_gex_pre_qc = read_library(
-            "GEX",
-            gex_id,
-            s3_access_file,
-            working_dir,
-            "aligned",
-            logger,
-            remove_adata=False,
-            donor_id=donor_id
-        )
-
-        if adata_ir is None or adata_gex is None or adata_gex_pre_qc is None:
+        # only the barcodes are needed; read them directly from the h5ad files on S3 rather than downloading the files
+        readers = [
+            open_library(ir_type, ir_id, s3_access_file, "processed", logger, donor_id=donor_id),
+            open_library("GEX", gex_id, s3_access_file, "processed", logger, donor_id=donor_id),
+            open_library("GEX", gex_id, s3_access_file, "aligned", logger, donor_id=donor_id),
+        ]
+        barcodes = [None if r is None else r.obs_names for r in readers]
+        for r in readers:
+            if r is not None:
+                r.close()
+        ir_barcodes, gex_barcodes, gex_pre_qc_barcodes = barcodes
+
+        if ir_barcodes is None or gex_barcodes is None or gex_pre_qc_barcodes is None:
             logger.add_to_log(f"❌❌ error. ir lib: {ir_id}, gex lib: {gex_id}")
             new_row = {
                 "donor_id": donor_id,
@@ -470,12 +435,12 @@ def get_ir_gex_intersection(
             df = df.append(new_row, ignore_index=True)
             continue
         # add the gex library ID to the cell barcode name for the aligned lib
-        adata_gex_pre_qc.obs_names = adata_gex_pre_qc.obs_names + "_" + gex_id
-        ir_gex_diff = len(np.setdiff1d(adata_ir.obs.index, adata_gex.obs.index))
-        ir_gex_diff_pct = (ir_gex_diff/len(adata_ir.obs.index)) * 100
+        gex_pre_qc_barcodes = gex_pre_qc_barcodes + "_" + gex_id
+        ir_gex_diff = len(np.setdiff1d(ir_barcodes, gex_barcodes))
+        ir_gex_diff_pct = (ir_gex_diff/len(ir_barcodes)) * 100
         # same but pre gex qc
-        ir_gex_pre_qc_diff = len(np.setdiff1d(adata_ir.obs.index, adata_gex_pre_qc.obs.index))
-        ir_gex_pre_qc_diff_pct = (ir_gex_pre_qc_diff/len(adata_ir.obs.index)) * 100
+        ir_gex_pre_qc_diff = len(np.setdiff1d(ir_barcodes, gex_pre_qc_barcodes))
+        ir_gex_pre_qc_diff_pct = (ir_gex_pre_qc_diff/len(ir_barcodes)) * 100
         logger.add_to_log(f"👉👉 ir lib: {ir_id}, ir type: {ir_type}, gex lib: {gex_id}, ir_gex_diff_pct: {ir_gex_diff_pct:.2f}, ir_gex_pre_qc_diff_pct: {ir_gex_pre_qc_diff_pct:.2f}")
         new_row = {
             "donor_id": donor_id,
@@ -589,17 +554,15 @@ def report_vdj_lib_ss_and_fp_metrics_for_all_libs(
             print(csv_file.getvalue())
             csv_file.close()
 
-    ir_libs = list(get_vdj_lib_to_gex_lib_mapping()[0 if ir_lib_type == "BCR" else 1].keys())
-    samples = read_immune_aging_sheet("Samples")
+    index = get_sample_metadata_index()
+    ir_libs = list(index.get_vdj_lib_to_gex_lib(ir_lib_type).keys())
     first = True
     for lib in ir_libs:
         # get some other metadata associated with this lib
-        col_name = "{} lib".format(ir_lib_type)
-        samples["Pick?"] = samples[col_name].fillna('').apply(lambda x: "Yes" if lib in x.split(",") else "No")
-        idx = samples["Pick?"] == "Yes"
-        sites = samples[idx]["Site"]
-        donors = samples[idx]["Donor ID"]
-        organs = set(samples[idx]["Organ"])
+        lib_samples = index.get_lib_samples(ir_lib_type, lib)
+        sites = lib_samples["Site"]
+        donors = lib_samples["Donor ID"]
+        organs = set(lib_samples["Organ"])
         if len(set(sites)) > 1:
             raise ValueError("More than one site was found for lib id {} of type {}".format(lib, ir_lib_type))
         if len(set(donors)) > 1:
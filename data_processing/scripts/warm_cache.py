@@ -0,0 +1,26 @@
+import threading
+from typing import Any, Callable, Hashable, List
+
+# Objects that are expensive to load (e.g. celltypist models, see utils.get_celltypist_model) and that are kept for the life of
+# the process once loaded. A script run on its own loads them on first use as before; the jobs run by a warm worker (see
+# warm_worker.py) are forked from a process that loaded them already, so they find them here without loading them again.
+
+_objects = {}
+_lock = threading.Lock()
+
+def get_resident(key: Hashable, load: Callable[[], Any]) -> Any:
+    # the object with the given key, loaded with load() if it is not resident yet
+    with _lock:
+        if key not in _objects:
+            _objects[key] = load()
+        return _objects[key]
+
+def is_resident(key: Hashable) -> bool:
+    return key in _objects
+
+def resident_keys() -> List[Hashable]:
+    return list(_objects.keys())
+
+def clear_resident() -> None:
+    with _lock:
+        _objects.clear()
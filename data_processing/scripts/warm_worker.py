@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import runpy
+import signal
+import importlib
+import traceback
+from typing import Callable, Dict, List, Optional
+
+# A warm worker runs the processing jobs (process_library.py, process_sample.py and integrate_samples.py) in processes forked from
+# one process that imported the heavy libraries (scanpy, scvi-tools, torch, celltypist, scirpy) and loaded the celltypist models and
+# the tabs of the sheet of the jobs (see warm_cache.py and sheet_cache.py) once, instead of a new python process per job that imports
+# and loads all of them again. Every job runs its script as python would (as __main__, with its arguments in sys.argv) in its own
+# forked process, so nothing that a job changes (module globals, settings, the environment, the working dir) leaks into the next one,
+# and a job that crashes does not take the worker down.
+# The worker itself never computes anything (it only imports and loads): forking a process that already used OpenMP thread pools
+# (torch, numba, sklearn) can deadlock (see resources.py). The jobs make their own S3 clients, rather than sharing the connection
+# pool of the worker.
+#
+# Run as follows: python warm_worker.py <jobs_file> [<jobs_file> ...]
+# where every jobs_file is either a configs file or a file listing configs files, one per line (as the .sh files written by
+# generate_processing_scripts.py); the jobs run one after the other, and the output of each is written to <configs file>.log.
+# pipeline_dag.py and job_worker.py can run their jobs in a warm worker as well (see IA_DAG_WARM and IA_WORKER_WARM).
+#
+# The following environment variables can be used to control the worker (all are optional):
+# IA_WARM_MODULES - comma-separated list of the modules imported by the worker (default WARM_MODULES)
+
+WARM_MODULES = ["numpy", "pandas", "scipy.sparse", "anndata", "scanpy", "torch", "scvi", "celltypist", "scirpy",
+    "statsmodels.stats.multitest", "utils"]
+
+def get_configs_file(command: List[str]) -> Optional[str]:
+    # the configs file in the arguments of a job, if any
+    for arg in command[2:]:
+        if arg.endswith(".txt") or arg.endswith(".json"):
+            return arg
+    return None
+
+def preload_job_resources(configs: Dict) -> None:
+    # the celltypist models of a job and the tabs of the sheet, loaded into the worker (and thus into the jobs forked from it)
+    from s3_index import get_cache_dir
+    from sheet_cache import SNAPSHOT_SHEETS, read_sheet_cached
+    from utils import get_celltypist_model, set_access_keys
+    if "s3_access_file" in configs:
+        set_access_keys(configs["s3_access_file"])
+    model_urls = configs["celltypist_model_urls"].split(",") if "celltypist_model_urls" in configs else []
+    if "rbc_model_url" in configs and configs["rbc_model_url"] != "":
+        model_urls.append(configs["rbc_model_url"])
+    model_dir = os.path.join(get_cache_dir(), "celltypist_models")
+    os.makedirs(model_dir, exist_ok = True)
+    for model_url in model_urls:
+        get_celltypist_model(model_url, os.path.join(model_dir, model_url.split("/")[-1]))
+    for sheet in SNAPSHOT_SHEETS:
+        read_sheet_cached(sheet)
+
+class ForkedJob:
+    """
+    A job forked from a warm worker, with the interface of subprocess.Popen that pipeline_dag.py and job_worker.py use.
+    """
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self) -> int:
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def terminate(self) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+def _run_job(command: List[str], log_file: Optional[str], env: Dict[str, str]) -> None:
+    # runs in the forked process and never returns
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if log_file is not None:
+            fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+        os.environ.update(env)
+        if "OMP_NUM_THREADS" in env and "torch" in sys.modules:
+            # torch read the variable when it was imported by the worker
+            sys.modules["torch"].set_num_threads(int(env["OMP_NUM_THREADS"]))
+        if "s3_utils" in sys.modules:
+            sys.modules["s3_utils"]._store = None
+        script = os.path.abspath(command[1])
+        sys.argv = command[1:]
+        sys.path.insert(0, os.path.dirname(script))
+        runpy.run_path(script, run_name = "__main__")
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file = sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+class WarmWorker:
+    """
+    Imports the modules (see above) on creation; start() forks a job from it and run() runs the given jobs one after the other.
+    A job is a python command, [python, script, args...]. preload (configs of a job -> None) loads the resources of a job before it
+    is forked (default preload_job_resources). startup_sec is the time it took to import the modules and preload_sec the time spent
+    loading the resources of the jobs so far.
+    """
+    def __init__(self, modules: Optional[List[str]] = None, preload: Optional[Callable[[Dict], None]] = None):
+        if modules is None:
+            modules = os.environ.get("IA_WARM_MODULES", ",".join(WARM_MODULES)).split(",")
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        start = time.time()
+        self.modules = []
+        for module in modules:
+            try:
+                importlib.import_module(module)
+                self.modules.append(module)
+            except ImportError as err:
+                print("Not preloading module {}: {}".format(module, err))
+        self.startup_sec = time.time() - start
+        self.preload_job = preload or preload_job_resources
+        self.preload_sec = 0
+
+    def preload(self, configs_file: str) -> None:
+        # a job that cannot preload its resources loads them itself
+        start = time.time()
+        try:
+            with open(configs_file) as f:
+                configs = json.load(f)
+            self.preload_job(configs)
+        except Exception as err:
+            print("Failed to preload the resources of {}: {}".format(configs_file, err))
+        self.preload_sec += time.time() - start
+
+    def start(self, command: List[str], log_file: Optional[str] = None, env: Optional[Dict[str, str]] = None) -> ForkedJob:
+        configs_file = get_configs_file(command)
+        if configs_file is not None:
+            self.preload(configs_file)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            _run_job(command, log_file, env or {})
+        return ForkedJob(pid)
+
+    def run(self, commands: List[List[str]], log_files: Optional[List[str]] = None) -> List[int]:
+        # the exit codes of the jobs
+        return [self.start(command, log_files[i] if log_files is not None else None).wait() for i, command in enumerate(commands)]
+
+if __name__ == "__main__":
+    from pipeline_dag import build_pipeline_tasks, read_configs_files
+    tasks = build_pipeline_tasks(read_configs_files(sys.argv[1:]))
+    worker = WarmWorker()
+    print("Imported {} in {:.1f} sec".format(", ".join(worker.modules), worker.startup_sec))
+    failed = []
+    for task in tasks:
+        start = time.time()
+        exit_code = worker.start(task.command, task.configs_file + ".log").wait()
+        print("{} {} ({:.1f} sec)".format(task.name, "done" if exit_code == 0 else "failed (exit code {})".format(exit_code), time.time() - start))
+        if exit_code != 0:
+            failed.append(task.name)
+    if len(failed) > 0:
+        print("Failed jobs: {}".format(", ".join(failed)))
+        sys.exit(1)
@@ -0,0 +1,223 @@
+import os
+import shutil
+import threading
+import numpy as np
+import scipy.sparse
+from anndata import AnnData
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+from h5ad_reader import H5adReader
+from s3_utils import get_max_concurrency, get_object_store, is_s3_path, split_s3_path
+
+try:
+    import zarr
+    import numcodecs
+    # since zarr 2.11 other mappings are wrapped in a store that hides getitems() and listdir()
+    _StoreBase = getattr(zarr.storage, "BaseStore", MutableMapping)
+except ImportError:
+    zarr = None
+    _StoreBase = MutableMapping
+
+# Chunked, columnar output format (zarr directory stores) alongside the lzf-compressed h5ad files. An h5ad file is written
+# serially, compressed as a whole and transferred as a single object, so every consumer downloads all of it even if it needs
+# one obs column. In a zarr store every array (each obs column, embedding, the data/indices/indptr of X and of each layer) is
+# split into chunks that are separate files, so:
+# - X and the layers are written by compressing their chunks concurrently (blosc releases the GIL) - see write_zarr();
+# - the chunk files are uploaded and downloaded concurrently (UploadQueue / s3_sync);
+# - any obs column, embedding or row range is read on its own, fetching only its chunks (concurrently) - see ZarrReader,
+#   which reads local stores and stores on S3.
+#
+# The layout is that of anndata.write_zarr(), so stores can also be read with anndata.read_zarr(). Converters between the two
+# formats are h5ad_to_zarr() and zarr_to_h5ad(), also as a script:
+#   python zarr_store.py <input .h5ad or .zarr> <output .zarr or .h5ad>
+#
+# The following environment variables can be used to control the zarr outputs (all are optional):
+# IA_ZARR_OUTPUT - if "1", the processed libraries, processed samples and integrated objects are also written (and uploaded) as
+#   zarr stores next to the h5ad files, i.e. <name>.zarr next to <name>.h5ad (default "0")
+# IA_ZARR_CHUNK_SIZE - number of values per chunk of X and the layers (default 1048576, i.e. 4MB of float32 before compression)
+# IA_ZARR_MAX_CONCURRENCY - max number of chunks compressed concurrently (default: the number of CPUs)
+
+ZARR_SUFFIX = ".zarr"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# the default compressor of zarr (used by anndata for the other arrays); on par with lzf in speed
+COMPRESSOR_KWARGS = dict(cname = "lz4", clevel = 5)
+
+def _check_zarr() -> None:
+    if zarr is None:
+        raise ImportError("zarr is not installed. Please install zarr via: pip install zarr")
+
+def zarr_output_enabled() -> bool:
+    return os.environ.get("IA_ZARR_OUTPUT", "0") == "1"
+
+def check_zarr_output() -> None:
+    # called by the scripts that write zarr outputs when they start, so that a missing zarr fails the run before the processing
+    # rather than after the h5ad file was written
+    if zarr_output_enabled():
+        _check_zarr()
+
+def zarr_file_name(h5ad_file: str) -> str:
+    # "<name>.h5ad" -> "<name>.zarr"
+    return (h5ad_file[:-len(".h5ad")] if h5ad_file.endswith(".h5ad") else h5ad_file) + ZARR_SUFFIX
+
+def list_zarr_files(data_dir: str, zarr_file: str) -> List[str]:
+    # the files of the given store in data_dir, relative to data_dir (e.g. for UploadQueue.submit or aws_sync)
+    files = []
+    for root, _, names in os.walk(os.path.join(data_dir, zarr_file)):
+        files += [os.path.relpath(os.path.join(root, name), data_dir) for name in names]
+    return sorted(files)
+
+def _compressor():
+    return numcodecs.Blosc(shuffle = numcodecs.Blosc.SHUFFLE, **COMPRESSOR_KWARGS)
+
+def _write_array(group, key: str, values: np.ndarray, chunk_rows: int, executor: ThreadPoolExecutor, attrs: dict = {}) -> None:
+    # creates the array and writes each chunk in a separate task; tasks write disjoint chunks, which zarr allows without locking
+    z = group.create_dataset(key, shape = values.shape, dtype = values.dtype, chunks = (chunk_rows,) + values.shape[1:],
+        compressor = _compressor())
+    z.attrs.update(attrs)
+    futures = [executor.submit(z.__setitem__, slice(start, start + chunk_rows), values[start:start + chunk_rows])
+        for start in range(0, values.shape[0], chunk_rows)]
+    for f in futures:
+        f.result()
+
+def _write_matrix(group, key: str, matrix, chunk_size: int, executor: ThreadPoolExecutor) -> None:
+    # X or a layer, in the encoding of anndata
+    if scipy.sparse.issparse(matrix):
+        if matrix.format not in ["csr", "csc"]:
+            matrix = scipy.sparse.csr_matrix(matrix)
+        encoding = matrix.format + "_matrix"
+        matrix_group = group.create_group(key)
+        matrix_group.attrs.update({"encoding-type": encoding, "encoding-version": "0.1.0", "shape": list(matrix.shape)})
+        for name in ["data", "indices", "indptr"]:
+            _write_array(matrix_group, name, getattr(matrix, name), chunk_size, executor)
+    else:
+        matrix = np.asarray(matrix)
+        chunk_rows = max(1, chunk_size // max(1, int(np.prod(matrix.shape[1:]))))
+        _write_array(group, key, matrix, chunk_rows, executor, {"encoding-type": "array", "encoding-version": "0.2.0"})
+
+def write_zarr(adata: AnnData, path: str, chunk_size: Optional[int] = None, max_concurrency: Optional[int] = None) -> None:
+    """
+    Writes adata as a zarr directory store at path (replacing it if it exists). Everything but X and the layers (obs, var, obsm,
+    varm, obsp, varp, uns) is written by anndata; X and the layers, which are most of the data, are written with their chunks
+    compressed concurrently.
+    """
+    _check_zarr()
+    if chunk_size is None:
+        chunk_size = int(os.environ.get("IA_ZARR_CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+    if max_concurrency is None:
+        max_concurrency = int(os.environ.get("IA_ZARR_MAX_CONCURRENCY", os.cpu_count()))
+    shutil.rmtree(path, ignore_errors = True)
+    if adata.raw is not None:
+        # raw is written by anndata as a whole
+        adata.write_zarr(path)
+        return
+    # as in write_h5ad
+    adata.strings_to_categoricals()
+    shell = AnnData(obs = adata.obs, var = adata.var, uns = adata.uns, obsm = adata.obsm, varm = adata.varm, obsp = adata.obsp,
+        varp = adata.varp)
+    shell.write_zarr(path)
+    group = zarr.open_group(path, mode = "a")
+    with ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+        if adata.X is not None:
+            _write_matrix(group, "X", adata.X, chunk_size, executor)
+        if len(adata.layers) > 0:
+            layers = group.require_group("layers")
+            for key in adata.layers.keys():
+                _write_matrix(layers, key, adata.layers[key], chunk_size, executor)
+    # the metadata of all the arrays in a single object, which readers fetch once instead of per array (this also replaces the
+    # metadata consolidated by later versions of anndata before X and the layers were written)
+    zarr.consolidate_metadata(path)
+
+def h5ad_to_zarr(h5ad_path: str, zarr_path: str, **kwargs) -> None:
+    import anndata
+    write_zarr(anndata.read_h5ad(h5ad_path), zarr_path, **kwargs)
+
+def zarr_to_h5ad(zarr_path: str, h5ad_path: str) -> None:
+    # zarr_path can also be a store on S3
+    import anndata
+    _check_zarr()
+    store = S3ZarrStore(zarr_path) if is_s3_path(zarr_path) else zarr_path
+    anndata.read_zarr(store).write(h5ad_path, compression = "lzf")
+    if is_s3_path(zarr_path):
+        store.close()
+
+class S3ZarrStore(_StoreBase):
+    """
+    Read-only zarr store over a store on S3 (or on the local store that replaces S3; see s3_utils.get_object_store). The keys
+    are listed once when the store is opened; the chunks of a read are fetched concurrently (getitems()). bytes_read is the
+    total number of bytes fetched from the store.
+    """
+    def __init__(self, s3_path: str, store = None, max_concurrency: Optional[int] = None):
+        self.store = get_object_store() if store is None else store
+        self.bucket, prefix = split_s3_path(s3_path)
+        self.prefix = prefix.rstrip("/") + "/"
+        self._sizes = {o.key[len(self.prefix):]: o.size for o in self.store.list_objects(self.bucket, self.prefix)}
+        if len(self._sizes) == 0:
+            raise FileNotFoundError("Store {} does not exist.".format(s3_path))
+        self._executor = ThreadPoolExecutor(max_workers = get_max_concurrency() if max_concurrency is None else max_concurrency)
+        self._lock = threading.Lock()
+        self.bytes_read = 0
+
+    def __getitem__(self, key: str) -> bytes:
+        if key not in self._sizes:
+            raise KeyError(key)
+        data = self.store.read_range(self.bucket, self.prefix + key, 0, self._sizes[key])
+        with self._lock:
+            self.bytes_read += len(data)
+        return data
+
+    def getitems(self, keys: Sequence[str], **kwargs) -> Dict[str, bytes]:
+        # missing keys are chunks that were never written (i.e. filled with the fill value) and are omitted
+        keys = [k for k in keys if k in self._sizes]
+        return dict(zip(keys, self._executor.map(self.__getitem__, keys)))
+
+    def __contains__(self, key) -> bool:
+        return key in self._sizes
+
+    def __iter__(self):
+        return iter(self._sizes)
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def listdir(self, path: str = "") -> List[str]:
+        path = path.strip("/") + "/" if path.strip("/") else ""
+        return sorted(set([k[len(path):].split("/")[0] for k in self._sizes if k.startswith(path)]))
+
+    def __setitem__(self, key, value):
+        raise PermissionError("S3ZarrStore is read-only.")
+
+    def __delitem__(self, key):
+        raise PermissionError("S3ZarrStore is read-only.")
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+class ZarrReader(H5adReader):
+    """
+    H5adReader over a zarr store (a local directory or an S3 path): reads only the requested obs/var columns, obsm keys, layers
+    and rows, i.e. only their chunks.
+    """
+    def __init__(self, path: str, store = None):
+        _check_zarr()
+        self.path = path
+        self.fileobj = S3ZarrStore(path, store = store) if is_s3_path(path) else None
+        store = self.fileobj if self.fileobj is not None else zarr.storage.DirectoryStore(path)
+        self.file = zarr.open_consolidated(store, mode = "r") if ".zmetadata" in store else zarr.open_group(store, mode = "r")
+        self._obs_names = None
+        self._linked = {}
+
+    def close(self) -> None:
+        if self.fileobj is not None:
+            self.fileobj.close()
+
+if __name__ == "__main__":
+    import sys
+    input_path, output_path = sys.argv[1].rstrip("/"), sys.argv[2].rstrip("/")
+    if input_path.endswith(".h5ad") and output_path.endswith(ZARR_SUFFIX):
+        h5ad_to_zarr(input_path, output_path)
+    elif input_path.endswith(ZARR_SUFFIX) and output_path.endswith(".h5ad"):
+        zarr_to_h5ad(input_path, output_path)
+    else:
+        raise ValueError("Expected an .h5ad input and a .zarr output or vice versa.")